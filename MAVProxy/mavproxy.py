@@ -11,12 +11,10 @@ import sys, os, time, socket, signal
 import fnmatch, errno, threading
 import serial
 import traceback
-import select
 import shlex
 import math
 import platform
 import json
-import struct
 import glob
 
 try:
@@ -41,6 +39,9 @@ from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import dumpstacks
 from MAVProxy.modules.lib import mp_substitute
 from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib import mp_eventloop
+from MAVProxy.modules.lib import mp_logwriter
+from MAVProxy.modules.lib import mp_linkworker
 from MAVProxy.modules.mavproxy_link import preferred_ports
 
 # adding all this allows pyinstaller to build a working windows executable
@@ -246,6 +247,7 @@ class MPState(object):
               MPSetting('shownoise', bool, True, 'Show non-MAVLink data'),
               MPSetting('baudrate', int, opts.baudrate, 'baudrate for new links', range=(0,10000000), increment=1),
               MPSetting('rtscts', bool, opts.rtscts, 'enable flow control'),
+              MPSetting('linkworker', bool, opts.link_worker, 'read and parse new links in a worker process'),
               MPSetting('select_timeout', float, 0.01, 'select timeout'),
 
               MPSetting('altreadout', int, 10, 'Altitude Readout',
@@ -308,12 +310,16 @@ class MPState(object):
 
         self.status = MPStatus()
 
+        # main loop fd dispatch, rebuilt when the link and output
+        # lists below change
+        self.event_loop = mp_eventloop.EventLoop(self.event_sources)
+
         # master mavlink device
         self.mav_master = None
 
         # mavlink outputs
-        self.mav_outputs = []
-        self.sysid_outputs = {}
+        self.mav_outputs = mp_eventloop.TrackedList(self.event_loop)
+        self.sysid_outputs = mp_eventloop.TrackedDict(self.event_loop)
 
         # Mapping of all detected sysid's to links
         # Key is link id, value is all detected sysid's/compid's in that link
@@ -326,9 +332,13 @@ class MPState(object):
         self.mav_param_by_sysid = {}
         self.mav_param_by_sysid[(self.settings.target_system,self.settings.target_component)] = mavparm.MAVParmDict()
         self.modules = []
+        # bumped whenever the set of modules or their message
+        # subscriptions change, see MPModule.subscribe()
+        self.module_generation = 0
         self.public_modules = {}
         self.functions = MAVFunctions()
-        self.select_extra = {}
+        self.select_extra = mp_eventloop.TrackedDict(self.event_loop)
+        self.event_loop.extra = self.select_extra
         self.continue_mode = False
         self.aliases = {}
         import platform
@@ -340,6 +350,15 @@ class MPState(object):
         self.attitude_time_s = 0
         self.position = None
 
+    def event_sources(self):
+        '''return (connection, handler) pairs for the main loop to read'''
+        ret = []
+        if self.mav_master is not None:
+            ret.extend([(m, process_master) for m in self.mav_master])
+        ret.extend([(m, process_mavlink) for m in self.mav_outputs])
+        ret.extend([(m, process_mavlink) for m in self.sysid_outputs.values()])
+        return ret
+
     @property
     def mav_param(self):
         '''map mav_param onto the current target system parameters'''
@@ -374,6 +393,7 @@ class MPState(object):
                 module = m.init(mpstate, **kwargs)
                 if isinstance(module, mp_module.MPModule):
                     mpstate.modules.append((module, m))
+                    mpstate.module_generation += 1
                     if not quiet:
                         if kwargs:
                             print("Loaded module %s with kwargs = %s" % (modname, kwargs))
@@ -404,8 +424,10 @@ class MPState(object):
                     if t.is_alive():
                         print("unload on module %s did not complete" % m.name)
                         mpstate.modules.remove((m,pm))
+                        mpstate.module_generation += 1
                         return False
                 mpstate.modules.remove((m,pm))
+                mpstate.module_generation += 1
                 if modname in mpstate.public_modules:
                     del mpstate.public_modules[modname]
                 print("Unloaded module %s" % modname)
@@ -793,6 +815,11 @@ def process_stdin(line):
 
 def process_master(m):
     '''process packets from the MAVLink master'''
+    if isinstance(m, mp_linkworker.mavworker):
+        # data already read and parsed by the link worker process
+        for (s, frames) in m.recv_batches():
+            process_master_data(m, s, frames)
+        return
     try:
         s = m.recv(16*1024)
     except Exception:
@@ -803,14 +830,18 @@ def process_master(m):
     if len(s) == 0:
         time.sleep(0.1)
         return
+    process_master_data(m, s)
 
+def process_master_data(m, s, frames=None):
+    '''process a buffer of data from a MAVLink master. If the link has a
+    worker process then frames are the MAVLink frames it found in s'''
     mpstate.status.bytecounters['MasterIn'][m.linknum].update(len(s))
 
     if (mpstate.settings.compdebug & 1) != 0:
         return
 
     if mpstate.logqueue_raw:
-        mpstate.logqueue_raw.put(bytearray(s))
+        mpstate.logqueue_raw.put(s)
 
     if mpstate.status.setup_mode:
         if mpstate.system == 'Windows':
@@ -826,7 +857,10 @@ def process_master(m):
     global mavversion
     if m.first_byte and mavversion is None:
         m.auto_mavlink_version(s)
-    msgs = m.mav.parse_buffer(s)
+    if frames is None:
+        msgs = m.mav.parse_buffer(s)
+    else:
+        msgs = m.decode_frames(frames)
     if msgs:
         for msg in msgs:
             sysid = msg.get_srcSystem()
@@ -874,7 +908,7 @@ def process_mavlink(slave):
                 mpstate.master(target_sysid).write(mbuf)
             if mpstate.logqueue:
                 usec = int(time.time() * 1.0e6)
-                mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+                mpstate.logqueue.log_message(usec, m.get_msgbuf())
             if mpstate.status.watch:
                 for msg_type in mpstate.status.watch:
                     if fnmatch.fnmatch(m.get_type().upper(), msg_type.upper()):
@@ -895,19 +929,6 @@ def mkdir_p(dir):
     mkdir_p(os.path.dirname(dir))
     os.mkdir(dir)
 
-def log_writer():
-    '''log writing thread'''
-    while True:
-        mpstate.logfile_raw.write(bytearray(mpstate.logqueue_raw.get()))
-        timeout = time.time() + 10
-        while not mpstate.logqueue_raw.empty() and time.time() < timeout:
-            mpstate.logfile_raw.write(mpstate.logqueue_raw.get())
-        while not mpstate.logqueue.empty() and time.time() < timeout:
-            mpstate.logfile.write(mpstate.logqueue.get())
-        if mpstate.settings.flushlogs or time.time() >= timeout:
-            mpstate.logfile.flush()
-            mpstate.logfile_raw.flush()
-
 # If state_basedir is NOT set then paths for logs and aircraft
 # directories are relative to mavproxy's cwd
 def log_paths():
@@ -958,8 +979,11 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
         mode = 'wb'
 
     try:
-        mpstate.logfile = open(logpath_telem, mode=mode)
-        mpstate.logfile_raw = open(logpath_telem_raw, mode=mode)
+        # the log writers use a separate thread for writing to the
+        # logfile to prevent delays during disk writes (important as
+        # delays can be long if camera app is running)
+        logpath_telem = mpstate.logqueue.open(logpath_telem, mode=mode)
+        mpstate.logqueue_raw.open(logpath_telem_raw, mode=mode)
         print("Log Directory: %s" % mpstate.status.logdir)
         print("Telemetry log: %s" % logpath_telem)
 
@@ -971,13 +995,6 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
                 print("ERROR: Not enough free disk space for logfile")
                 mpstate.status.exit = True
                 return
-
-        # use a separate thread for writing to the logfile to prevent
-        # delays during disk writes (important as delays can be long if camera
-        # app is running)
-        t = threading.Thread(target=log_writer, name='log_writer')
-        t.daemon = True
-        t.start()
     except Exception as e:
         print("ERROR: opening log file for writing: %s" % e)
         mpstate.status.exit = True
@@ -1108,65 +1125,30 @@ def main_loop():
 
         periodic_tasks()
 
-        rin = []
-        for master in mpstate.mav_master:
-            if master.fd is not None and not master.portdead:
-                rin.append(master.fd)
-        for m in mpstate.mav_outputs:
-            rin.append(m.fd)
-        for sysid in mpstate.sysid_outputs:
-            m = mpstate.sysid_outputs[sysid]
-            rin.append(m.fd)
-        if rin == []:
+        events = mpstate.event_loop.poll(mpstate.settings.select_timeout)
+        if events is None:
             time.sleep(0.0001)
             continue
 
-        for fd in mpstate.select_extra:
-            rin.append(fd)
-        try:
-            (rin, win, xin) = select.select(rin, [], [], mpstate.settings.select_timeout)
-        except select.error:
-            continue
-
-        if mpstate is None:
-            return
-
-        for fd in rin:
+        for (fd, fn, arg, is_extra) in events:
             if mpstate is None:
-                  return
-            for master in mpstate.mav_master:
-                  if fd == master.fd:
-                        process_master(master)
-                        if mpstate is None:
-                              return
-                        continue
-            for m in mpstate.mav_outputs:
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                          return
-                    continue
-
-            for sysid in mpstate.sysid_outputs:
-                m = mpstate.sysid_outputs[sysid]
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                          return
-                    continue
-
+                return
+            if not is_extra:
+                fn(arg)
+                continue
             # this allow modules to register their own file descriptors
             # for the main select loop
-            if fd in mpstate.select_extra:
-                try:
-                    # call the registered read function
-                    (fn, args) = mpstate.select_extra[fd]
-                    fn(args)
-                except Exception as msg:
-                    if mpstate.settings.moddebug == 1:
-                        print(msg)
-                    # on an exception, remove it from the select list
-                    mpstate.select_extra.pop(fd)
+            try:
+                # call the registered read function
+                fn(arg)
+            except Exception as msg:
+                if mpstate.settings.moddebug == 1:
+                    print(msg)
+                # on an exception, remove it from the select list
+                mpstate.select_extra.pop(fd, None)
+
+        if mpstate is None:
+            return
 
 
 
@@ -1258,6 +1240,8 @@ if __name__ == '__main__':
                       default=0, help='MAVLink target master component')
     parser.add_option("--logfile", dest="logfile", help="MAVLink master logfile",
                       default='mav.tlog')
+    parser.add_option("--log-compression", default='none', type='choice', choices=['none', 'gzip', 'zstd', 'lz4'],
+                      help="compress telemetry logs as they are written (none, gzip, zstd, lz4)")
     parser.add_option("-a", "--append-log", dest="append_log", help="Append to log files",
                       action='store_true', default=False)
     parser.add_option("--quadcopter", dest="quadcopter", help="use quadcopter controls",
@@ -1291,6 +1275,8 @@ if __name__ == '__main__':
     parser.add_option("-c", "--continue", dest='continue_mode', action='store_true', default=False, help="continue logs")
     parser.add_option("--dialect",  default="ardupilotmega", help="MAVLink dialect")
     parser.add_option("--rtscts",  action='store_true', help="enable hardware RTS/CTS flow control")
+    parser.add_option("--link-worker", action='store_true', default=False,
+                      help="read and parse master links in worker processes")
     parser.add_option("--moddebug",  type=int, help="module debug level", default=0)
     parser.add_option("--mission", dest="mission", help="mission name", default=None)
     parser.add_option("--daemon", action='store_true', help="run in daemon mode, do not start interactive shell")
@@ -1340,8 +1326,13 @@ if __name__ == '__main__':
     # queues for logging
 
     if not opts.no_state:
-        mpstate.logqueue = multiproc.Queue()
-        mpstate.logqueue_raw = multiproc.Queue()
+        try:
+            flush_now = lambda : mpstate.settings.flushlogs
+            mpstate.logqueue = mp_logwriter.LogWriter(compression=opts.log_compression, flush_now=flush_now)
+            mpstate.logqueue_raw = mp_logwriter.LogWriter(compression=opts.log_compression, flush_now=flush_now)
+        except (ImportError, ValueError) as e:
+            print("ERROR: log compression %s: %s" % (opts.log_compression, e))
+            sys.exit(1)
     else:
         mpstate.logqueue = None
         mpstate.logqueue_raw = None
@@ -1368,7 +1359,7 @@ if __name__ == '__main__':
     mpstate.settings.target_system = opts.TARGET_SYSTEM
     mpstate.settings.target_component = opts.TARGET_COMPONENT
 
-    mpstate.mav_master = []
+    mpstate.mav_master = mp_eventloop.TrackedList(mpstate.event_loop)
 
     mpstate.rl = rline.rline("MAV> ", mpstate)
 
@@ -1562,4 +1553,14 @@ if __name__ == '__main__':
             print("Unloading module %s" % m.name)
             m.unload()
 
+    # stop any link worker processes
+    for master in mpstate.mav_master:
+        if isinstance(master, mp_linkworker.mavworker):
+            master.close()
+
+    # write out any queued log data
+    if mpstate.logqueue:
+        mpstate.logqueue.close()
+        mpstate.logqueue_raw.close()
+
     sys.exit(1)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+'''
+shared memory transport for video frames
+
+FrameRing is a few frame sized slots in shared memory. The producer
+copies (or colour converts) each frame straight into a slot and sends
+only the slot number, sequence number and shape to the consumer, so
+frames are not pickled and copied through a pipe.
+
+Each slot has a sequence number that is odd while the producer writes
+it. The consumer checks it before and after copying a frame out, and
+throws the copy away if the slot was overwritten meanwhile. It also
+marks the slot it is reading, and the producer writes round the other
+slots, so with three slots that rarely happens. The consumer only ever
+shows the newest frame it has been told about, so when it falls behind
+the older ones are dropped rather than queued.
+
+FrameStats holds counters in shared memory written by both sides, so
+the producer can report the frames dropped and the latency from being
+given a frame to showing it.
+
+Run this file directly to compare sending 1080p frames this way with
+pickling them through a queue
+
+AP_FLAKE8_CLEAN
+'''
+
+import struct
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# slot data is aligned to this
+SLOT_ALIGN = 64
+
+
+def available():
+    '''True if shared memory is supported'''
+    return shared_memory is not None
+
+
+class FrameStats(object):
+    '''frame counters in shared memory. frames is written by the
+    producer and the rest by the consumer'''
+    layout = struct.Struct('<QQQQdd')
+    fields = ['frames', 'displayed', 'dropped', 'torn', 'latency_sum', 'latency_max']
+
+    def __init__(self, name=None):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.layout.size)
+            self.layout.pack_into(self.shm.buf, 0, 0, 0, 0, 0, 0.0, 0.0)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+
+    def __getstate__(self):
+        # pickled when the child is started by spawning rather than fork
+        return {'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'])
+
+    def get(self):
+        '''the counters as a dict'''
+        return dict(zip(self.fields, self.layout.unpack_from(self.shm.buf, 0)))
+
+    def _set(self, index, fmt, value):
+        struct.pack_into(fmt, self.shm.buf, 8 * index, value)
+
+    def add_frame(self):
+        '''producer: count a frame sent'''
+        self._set(0, '<Q', self.get()['frames'] + 1)
+
+    def add_displayed(self, latency):
+        '''consumer: count a frame shown latency seconds after it was sent'''
+        s = self.get()
+        self._set(1, '<Q', s['displayed'] + 1)
+        self._set(4, '<d', s['latency_sum'] + latency)
+        self._set(5, '<d', max(s['latency_max'], latency))
+
+    def add_dropped(self, n=1):
+        '''consumer: count frames replaced by a newer one before being shown'''
+        self._set(2, '<Q', self.get()['dropped'] + n)
+
+    def add_torn(self):
+        '''consumer: count frames overwritten while being read'''
+        self._set(3, '<Q', self.get()['torn'] + 1)
+
+    def describe(self):
+        s = self.get()
+        avg = s['latency_sum'] / s['displayed'] if s['displayed'] else 0
+        return "%u frames %u displayed %u dropped %u torn, latency avg %.1fms max %.1fms" % (
+            s['frames'], s['displayed'], s['dropped'], s['torn'], 1000 * avg, 1000 * s['latency_max'])
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class FrameRing(object):
+    '''nslots slots of slot_size bytes each for frames, in shared memory'''
+    # the slot the consumer is reading, or -1
+    header = struct.Struct('<q')
+    # per slot sequence number
+    slot_header = struct.Struct('<Q')
+
+    def __init__(self, slot_size, nslots=3, name=None):
+        self.slot_size = slot_size
+        self.nslots = nslots
+        self.stride = SLOT_ALIGN + (slot_size + SLOT_ALIGN - 1) // SLOT_ALIGN * SLOT_ALIGN
+        size = SLOT_ALIGN + nslots * self.stride
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.header.pack_into(self.shm.buf, 0, -1)
+            for i in range(nslots):
+                self.slot_header.pack_into(self.shm.buf, self.slot_offset(i), 0)
+            self.owner = True
+        else:
+            # the resource tracker is shared with the parent, so
+            # attaching here does not cause an unlink when we exit
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+        self.seqs = [0] * nslots
+        self.next_slot = 0
+        self.last_slot = -1
+
+    def slot_offset(self, slot):
+        return SLOT_ALIGN + slot * self.stride
+
+    def slot_seq(self, slot):
+        return self.slot_header.unpack_from(self.shm.buf, self.slot_offset(slot))[0]
+
+    def slot_array(self, slot, shape, dtype=np.uint8):
+        '''a numpy array of the given shape over a slot'''
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if nbytes > self.slot_size:
+            raise ValueError("frame of %u bytes too large for slot of %u" % (nbytes, self.slot_size))
+        return np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=self.slot_offset(slot) + SLOT_ALIGN)
+
+    def reading(self):
+        return self.header.unpack_from(self.shm.buf, 0)[0]
+
+    def write(self, img, convert=None):
+        '''producer: put a frame in a slot, returning (slot, seq). If
+        given, convert(src, dst) fills the slot from img rather than a
+        plain copy, eg with a colour conversion'''
+        busy = (self.reading(), self.last_slot)
+        slot = self.next_slot
+        for i in range(self.nslots):
+            if slot not in busy:
+                break
+            slot = (slot + 1) % self.nslots
+        self.next_slot = (slot + 1) % self.nslots
+        ofs = self.slot_offset(slot)
+        seq = self.seqs[slot] + 1
+        self.slot_header.pack_into(self.shm.buf, ofs, seq)
+        dst = self.slot_array(slot, img.shape, img.dtype)
+        if convert is not None:
+            convert(img, dst)
+        else:
+            np.copyto(dst, img)
+        seq += 1
+        self.slot_header.pack_into(self.shm.buf, ofs, seq)
+        self.seqs[slot] = seq
+        self.last_slot = slot
+        return (slot, seq)
+
+    def read(self, slot, seq, shape, dtype=np.uint8):
+        '''consumer: copy a frame out of its slot, or return None if it
+        has been overwritten since it was sent'''
+        self.header.pack_into(self.shm.buf, 0, slot)
+        try:
+            if self.slot_seq(slot) != seq:
+                return None
+            data = self.slot_array(slot, shape, dtype).copy()
+            if self.slot_seq(slot) != seq:
+                return None
+        finally:
+            self.header.pack_into(self.shm.buf, 0, -1)
+        return data
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+if __name__ == '__main__':
+    import pickle
+    import time
+    from argparse import ArgumentParser
+    from MAVProxy.modules.lib import multiproc
+
+    parser = ArgumentParser(description='compare a FrameRing with pickling frames through a queue')
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--fps", type=float, default=60, help="frame rate sent")
+    parser.add_argument("--display-fps", type=float, default=30, help="rate the consumer shows frames at")
+    args = parser.parse_args()
+
+    shape = (args.height, args.width, 3)
+
+    class Frame(object):
+        '''a frame sent whole, like MPImageData'''
+        def __init__(self, img, t):
+            self.data = img.tobytes()
+            self.t = t
+
+    def consumer(queue, stats_name, result):
+        '''show the newest frame at the display rate'''
+        stats = FrameStats(stats_name) if stats_name else None
+        rings = {}
+        latency = []
+        dropped = 0
+        read_time = 0
+        while True:
+            time.sleep(1.0 / args.display_fps)
+            latest = None
+            while not queue.empty():
+                obj = queue.get()
+                if obj is None:
+                    result.put((latency, dropped, read_time))
+                    return
+                if latest is not None:
+                    dropped += 1
+                latest = obj
+            if latest is None:
+                continue
+            t0 = time.time()
+            if isinstance(latest, Frame):
+                np.frombuffer(latest.data, dtype=np.uint8).reshape(shape)
+            else:
+                (name, slot_size, slot, seq, t) = latest
+                if name not in rings:
+                    rings[name] = FrameRing(slot_size, name=name)
+                if rings[name].read(slot, seq, shape) is None:
+                    stats.add_torn()
+                    continue
+                latest = Frame(np.zeros(1, dtype=np.uint8), t)
+            now = time.time()
+            read_time += now - t0
+            latency.append(now - latest.t)
+
+    rng = np.random.default_rng(1)
+    img = rng.integers(0, 255, size=shape, dtype=np.uint8)
+
+    def run(name, use_ring):
+        queue = multiproc.Queue()
+        result = multiproc.Queue()
+        stats = FrameStats() if use_ring else None
+        ring = FrameRing(img.nbytes) if use_ring else None
+        child = multiproc.Process(target=consumer, args=(queue, stats.name if stats else None, result))
+        child.start()
+        send_time = 0
+        t_start = time.time()
+        for i in range(args.frames):
+            t0 = time.time()
+            if use_ring:
+                (slot, seq) = ring.write(img)
+                queue.put((ring.name, ring.slot_size, slot, seq, t0))
+            else:
+                queue.put(Frame(img, t0))
+            send_time += time.time() - t0
+            delay = t_start + (i + 1) / args.fps - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        queue.put(None)
+        (latency, dropped, read_time) = result.get()
+        child.join()
+        shown = len(latency)
+        print("%s: send %.2fms/frame, read %.2fms/frame, %u shown %u dropped, latency avg %.1fms max %.1fms" % (
+            name, 1000 * send_time / args.frames, 1000 * read_time / max(shown, 1), shown, dropped,
+            1000 * sum(latency) / max(shown, 1), 1000 * max(latency + [0])))
+        if use_ring:
+            if stats.get()['torn']:
+                print("  %u torn" % stats.get()['torn'])
+            ring.close()
+            stats.close()
+
+    print("%ux%u frames, %u bytes, %.0ffps sent %.0ffps shown, pickled size %u" % (
+        args.width, args.height, img.nbytes, args.fps, args.display_fps, len(pickle.dumps(Frame(img, 0)))))
+    run('queue', False)
+    run('ring', True)
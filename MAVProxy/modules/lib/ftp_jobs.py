@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+'''
+queue of MAVLink FTP downloads
+
+Downloads are queued as jobs and run on their own FTP sessions, as many
+at once as the settings and the vehicle allow (ArduPilot keeps one file
+open at a time, so by default one runs while the rest wait and each
+starts as soon as the one before finishes). Callers get the job back
+and can follow its progress.
+
+Downloads to a file keep their state in a file alongside it while they
+run: the remote file's size and CRC32 and the ranges still missing. A
+download of the same file that finds this state asks the vehicle for
+the file's CRC32 again, and if the file is unchanged carries on where
+the last one stopped. The finished file is checked against the CRC32.
+
+AP_FLAKE8_CLEAN
+'''
+
+import json
+import os
+import time
+import zlib
+
+# the extension of the file holding a partial download's state
+RESUME_SUFFIX = '.ftpresume'
+
+# finished jobs kept for listing
+KEEP_FINISHED = 20
+
+QUEUED = 'queued'
+OPENING = 'opening'
+CHECKING = 'checking'
+READING = 'reading'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+def crc32(data, crc=0):
+    '''the CRC32 as calculated by CalcFileCRC32 on the vehicle, which is
+    the usual CRC32 without the inversion before and after'''
+    return (~zlib.crc32(data, ~crc & 0xFFFFFFFF)) & 0xFFFFFFFF
+
+
+def file_crc32(fh, length=None, blocksize=1 << 20):
+    '''the vehicle style CRC32 of the first length bytes of a file'''
+    fh.seek(0)
+    crc = 0
+    remaining = length
+    while remaining is None or remaining > 0:
+        n = blocksize if remaining is None else min(blocksize, remaining)
+        data = fh.read(n)
+        if not data:
+            break
+        crc = crc32(data, crc)
+        if remaining is not None:
+            remaining -= len(data)
+    return crc
+
+
+class FTPJob(object):
+    '''one file download.
+
+    With local None the file is kept in memory and given to callback
+    when done. callback(None) is called if the download fails.
+    callback_progress(fh, nbytes) is called as data arrives.
+    '''
+    def __init__(self, job_id, remote, local=None, callback=None, callback_progress=None, label=None):
+        self.job_id = job_id
+        self.remote = remote
+        self.local = local
+        self.callback = callback
+        self.callback_progress = callback_progress
+        self.label = label if label is not None else remote
+        self.state = QUEUED
+        self.session = None
+        self.fh = None
+        self.read = None
+        self.remote_size = None
+        self.remote_crc = None
+        self.resume_state = None
+        self.resumed = False
+        self.resumed_bytes = 0
+        self.open_retries = 0
+        self.crc_retries = 0
+        # if the CRC has been asked for to check a resumed download
+        self.crc_at_end = False
+        self.last_request = 0
+        self.last_burst_read = None
+        self.last_save = 0
+        self.queue_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        self.error = None
+
+    def in_memory(self):
+        return self.local is None
+
+    def active(self):
+        return self.state in [OPENING, CHECKING, READING]
+
+    def finished(self):
+        return self.state in [DONE, FAILED, CANCELLED]
+
+    def received_bytes(self):
+        if self.read is None:
+            return 0
+        return self.read.received_bytes()
+
+    def progress(self):
+        '''fraction done, or None if the file size isn't known'''
+        if self.state == DONE:
+            return 1.0
+        if not self.remote_size:
+            return None
+        return min(self.received_bytes() / float(self.remote_size), 1.0)
+
+    def rate(self):
+        '''bytes per second fetched by this job'''
+        if self.read is None:
+            return 0
+        return self.read.stats.rate()
+
+    def describe(self):
+        progress = self.progress()
+        size = "%u" % self.remote_size if self.remote_size is not None else "?"
+        ret = "%3u %-9s %s %u/%s bytes" % (self.job_id, self.state, self.label, self.received_bytes(), size)
+        if progress is not None:
+            ret += " %.0f%%" % (100 * progress)
+        if self.read is not None:
+            ret += " %.1fkByte/s" % (self.rate() / 1024.0)
+        if self.resumed:
+            ret += " resumed at %u" % self.resumed_bytes
+        if self.error is not None:
+            ret += " (%s)" % self.error
+        return ret
+
+    def resume_filename(self):
+        return self.local + RESUME_SUFFIX
+
+    def save_state(self):
+        '''record how far a download to a file has got, so it can be resumed'''
+        if self.in_memory() or self.read is None:
+            return
+        if self.fh is not None and not self.fh.closed:
+            # the state must not claim data that is still buffered
+            self.fh.flush()
+        state = {'remote': self.remote,
+                 'size': self.remote_size,
+                 'crc': self.remote_crc,
+                 'head': self.read.head,
+                 'eof': self.read.eof,
+                 'missing': list(self.read.missing)}
+        tmpname = self.resume_filename() + '.tmp'
+        try:
+            with open(tmpname, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmpname, self.resume_filename())
+        except Exception as ex:
+            print("FTP: failed to save %s: %s" % (self.resume_filename(), ex))
+        self.last_save = time.time()
+
+    def load_state(self):
+        '''load the state of an earlier download of this file, if any'''
+        if self.in_memory() or not os.path.exists(self.local):
+            return None
+        try:
+            with open(self.resume_filename()) as f:
+                state = json.load(f)
+        except Exception:
+            return None
+        if state.get('remote', None) != self.remote:
+            return None
+        return state
+
+    def clear_state(self):
+        if self.in_memory():
+            return
+        try:
+            os.unlink(self.resume_filename())
+        except OSError:
+            pass
+
+
+class FTPJobQueue(object):
+    '''the download jobs, in the order they were queued'''
+    def __init__(self):
+        self.jobs = []
+        self.next_id = 1
+
+    def add(self, remote, local=None, callback=None, callback_progress=None, label=None):
+        job = FTPJob(self.next_id, remote, local, callback, callback_progress, label)
+        self.next_id += 1
+        self.jobs.append(job)
+        return job
+
+    def get(self, job_id):
+        for job in self.jobs:
+            if job.job_id == job_id:
+                return job
+        return None
+
+    def active(self):
+        return [j for j in self.jobs if j.active()]
+
+    def queued(self):
+        return [j for j in self.jobs if j.state == QUEUED]
+
+    def by_session(self, session):
+        '''the running job using a session'''
+        for job in self.jobs:
+            if job.active() and job.session == session:
+                return job
+        return None
+
+    def prune(self):
+        '''forget the oldest finished jobs'''
+        finished = [j for j in self.jobs if j.finished()]
+        for job in finished[:max(0, len(finished) - KEEP_FINISHED)]:
+            self.jobs.remove(job)
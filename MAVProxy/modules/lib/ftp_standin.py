@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+'''
+in-process stand-in for a vehicle's MAVLink FTP server
+
+Serves files from memory the way ArduPilot's FTP server does, over a
+simulated telemetry link with latency, limited bandwidth and loss:
+
+ - requests are queued (up to queue_size, later ones are dropped) and
+   handled one at a time
+ - a burst read streams up to BURST_PACKETS packets, and requests that
+   arrive meanwhile wait for it to finish
+ - replies go out no faster than the link bandwidth allows, and packets
+   are lost at random, either whole or through byte errors so that
+   longer packets are more likely to be lost
+ - up to max_open files may be open at once, each on its own session
+   (ArduPilot allows one)
+
+Run this file directly to benchmark downloads with the ftp module
+against it
+
+AP_FLAKE8_CLEAN
+'''
+
+import collections
+import heapq
+import itertools
+import random
+import struct
+import time
+
+from pymavlink import mavutil
+
+from MAVProxy.modules import mavproxy_ftp as ftp
+from MAVProxy.modules.lib import ftp_jobs
+from MAVProxy.modules.lib import ftp_window
+
+# packets in one burst read
+BURST_PACKETS = 500
+
+
+class StandinLink(object):
+    '''one direction of a telemetry link'''
+    def __init__(self, latency=0.05, bandwidth=0, loss=0.0, byte_error=0.0, rng=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.byte_error = byte_error
+        self.rng = rng if rng is not None else random.Random(1)
+        self.busy_until = 0
+        self.queue = []
+        self.counter = itertools.count()
+        self.sent = 0
+        self.lost = 0
+
+    def idle(self, now):
+        '''see if another packet can start being sent'''
+        return self.busy_until <= now
+
+    def send(self, item, nbytes, now):
+        '''send a packet of nbytes, which may be lost on the way'''
+        start = max(now, self.busy_until)
+        if self.bandwidth > 0:
+            self.busy_until = start + nbytes / float(self.bandwidth)
+        else:
+            self.busy_until = start
+        self.sent += 1
+        survive = (1.0 - self.loss) * (1.0 - self.byte_error) ** nbytes
+        if self.rng.random() >= survive:
+            self.lost += 1
+            return
+        heapq.heappush(self.queue, (self.busy_until + self.latency, next(self.counter), item))
+
+    def receive(self, now):
+        '''return the packets that have arrived by now'''
+        ret = []
+        while self.queue and self.queue[0][0] <= now:
+            ret.append(heapq.heappop(self.queue)[2])
+        return ret
+
+
+class FTPServerStandin(object):
+    '''a MAVLink FTP server for files held in a dict of name to bytes.
+    Replies are addressed to target_system and target_component'''
+    def __init__(self, files, uplink, downlink, target_system=255, target_component=0, queue_size=5, max_open=1):
+        self.files = files
+        self.uplink = uplink
+        self.downlink = downlink
+        self.target_system = target_system
+        self.target_component = target_component
+        self.queue_size = queue_size
+        self.max_open = max_open
+        self.requests = collections.deque()
+        self.open_files = {}
+        self.burst = None
+        self.dropped_requests = 0
+
+    def handle_message(self, payload, now):
+        '''take a FILE_TRANSFER_PROTOCOL payload sent by the client'''
+        self.uplink.send(bytes(bytearray(payload)), ftp.HDR_Len + ftp_window.PACKET_OVERHEAD, now)
+
+    def update(self, now):
+        '''accept requests and send replies as the link allows'''
+        for payload in self.uplink.receive(now):
+            if len(self.requests) >= self.queue_size:
+                self.dropped_requests += 1
+                continue
+            self.requests.append(payload)
+        while self.downlink.idle(now):
+            if self.burst is not None:
+                self.burst_packet(now)
+            elif self.requests:
+                self.handle_request(self.requests.popleft(), now)
+            else:
+                break
+
+    def receive(self, now):
+        '''return the replies that have reached the client'''
+        return self.downlink.receive(now)
+
+    def reply(self, req, opcode, offset, data, now, seq=None, burst_complete=0):
+        if seq is None:
+            seq = (req.seq + 1) % 65536
+        op = ftp.FTP_OP(seq, req.session, opcode, len(data), req.opcode, burst_complete, offset, bytearray(data))
+        payload = op.pack()
+        payload.extend(bytearray(ftp.HDR_Len + ftp.MAX_Payload - len(payload)))
+        msg = mavutil.mavlink.MAVLink_file_transfer_protocol_message(0, self.target_system, self.target_component,
+                                                                     list(payload))
+        self.downlink.send(msg, len(data) + ftp_window.PACKET_OVERHEAD, now)
+
+    def nack(self, req, error, now, offset=0, seq=None):
+        self.reply(req, ftp.OP_Nack, offset, bytearray([error]), now, seq=seq)
+
+    def handle_request(self, payload, now):
+        (seq, session, opcode, size, req_opcode, burst_complete, pad, offset) = struct.unpack(
+            "<HBBBBBBI", payload[:ftp.HDR_Len])
+        req = ftp.FTP_OP(seq, session, opcode, size, req_opcode, burst_complete, offset,
+                         payload[ftp.HDR_Len:ftp.HDR_Len + size])
+        if opcode == ftp.OP_TerminateSession:
+            self.open_files.pop(session, None)
+            self.reply(req, ftp.OP_Ack, 0, b'', now)
+        elif opcode == ftp.OP_ResetSessions:
+            self.open_files = {}
+            self.reply(req, ftp.OP_Ack, 0, b'', now)
+        elif opcode == ftp.OP_OpenFileRO:
+            name = req.payload.decode('ascii')
+            if session in self.open_files or len(self.open_files) >= self.max_open:
+                self.nack(req, ftp.ERR_Fail, now)
+            elif name not in self.files:
+                self.nack(req, ftp.ERR_FileNotFound, now)
+            else:
+                self.open_files[session] = self.files[name]
+                self.reply(req, ftp.OP_Ack, 0, struct.pack("<I", len(self.files[name])), now)
+        elif opcode == ftp.OP_CalcFileCRC32:
+            name = req.payload.decode('ascii')
+            if name not in self.files:
+                self.nack(req, ftp.ERR_FileNotFound, now)
+            else:
+                self.reply(req, ftp.OP_Ack, 0, struct.pack("<I", ftp_jobs.crc32(self.files[name])), now)
+        elif opcode in [ftp.OP_ReadFile, ftp.OP_BurstReadFile]:
+            if session not in self.open_files:
+                self.nack(req, ftp.ERR_InvalidSession, now)
+            elif opcode == ftp.OP_ReadFile:
+                data = self.open_files[session][offset:offset + min(size, ftp.MAX_Payload)]
+                if len(data) == 0:
+                    self.nack(req, ftp.ERR_EndOfFile, now, offset=offset)
+                else:
+                    self.reply(req, ftp.OP_Ack, offset, data, now)
+            else:
+                self.burst = (req, 0)
+        else:
+            self.nack(req, ftp.ERR_UnknownCommand, now)
+
+    def burst_packet(self, now):
+        '''send the next packet of a burst read'''
+        (req, i) = self.burst
+        size = req.size if req.size > 0 else ftp.MAX_Payload
+        offset = req.offset + i * size
+        seq = (req.seq + 1 + i) % 65536
+        file_data = self.open_files.get(req.session, b'')
+        data = file_data[offset:offset + size]
+        if len(data) == 0:
+            # the offset of the end of the file
+            self.nack(req, ftp.ERR_EndOfFile, now, offset=min(offset, len(file_data)), seq=seq)
+            self.burst = None
+            return
+        complete = i == BURST_PACKETS - 1
+        self.reply(req, ftp.OP_Ack, offset, data, now, seq=seq, burst_complete=int(complete))
+        self.burst = None if complete else (req, i + 1)
+
+
+class Settings(object):
+    source_system = 255
+    source_component = 0
+    target_system = 1
+    target_component = 1
+
+
+class MAV(object):
+    '''passes requests to the stand-in, recording their opcodes'''
+    def __init__(self, server):
+        self.server = server
+        self.opcodes = []
+
+    def file_transfer_protocol_send(self, network, target_system, target_component, payload):
+        self.opcodes.append(payload[3])
+        self.server.handle_message(payload, time.time())
+
+
+class Master(object):
+    def __init__(self, server):
+        self.mav = MAV(server)
+
+
+class MPState(object):
+    '''the parts of the MAVProxy state the ftp module uses'''
+    def __init__(self, master):
+        self.public_modules = {}
+        self.command_map = {}
+        self.completions = {}
+        self.completion_functions = {}
+        self.settings = Settings()
+        self._master = master
+
+    def master(self):
+        return self._master
+
+
+def new_module(server, settings=[]):
+    '''an ftp module talking to the stand-in server'''
+    module = ftp.FTPModule(MPState(Master(server)))
+    for (k, v) in settings:
+        module.ftp_settings.set(k, v)
+    return module
+
+
+def step(server, module):
+    '''pass requests and replies over the link, and run the module's idle task'''
+    now = time.time()
+    server.update(now)
+    for m in server.receive(now):
+        module.mavlink_packet(m)
+    module.idle_task()
+    time.sleep(0.001)
+
+
+if __name__ == "__main__":
+    import os
+    import shutil
+    import tempfile
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='benchmark ftp downloads against a simulated vehicle')
+    parser.add_argument("--size", type=int, default=131072, help="file size in bytes")
+    parser.add_argument("--files", type=int, default=1, help="number of files to queue at once")
+    parser.add_argument("--latency", type=float, default=0.05, help="one way link latency in seconds")
+    parser.add_argument("--bandwidth", type=int, default=20000, help="downlink bytes per second")
+    parser.add_argument("--loss", type=float, default=0.05, help="chance of losing a packet")
+    parser.add_argument("--byte-error", type=float, default=0.0, help="chance of an error in each byte")
+    parser.add_argument("--timeout", type=float, default=120, help="give up on a download after this long")
+    parser.add_argument("--resume", action='store_true', help="interrupt a download to a file half way and resume it")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    files = {}
+    for i in range(args.files):
+        files['log%u.bin' % i] = os.urandom(args.size)
+
+    def run(name, settings, max_open=1):
+        rng = random.Random(args.seed)
+        uplink = StandinLink(args.latency, 0, args.loss, args.byte_error, rng)
+        downlink = StandinLink(args.latency, args.bandwidth, args.loss, args.byte_error, rng)
+        server = FTPServerStandin(files, uplink, downlink, max_open=max_open)
+        module = new_module(server, settings)
+        results = {}
+        t0 = time.time()
+        jobs = []
+        for name_i in sorted(files.keys()):
+            jobs.append(module.queue_get(name_i, callback=lambda fh, n=name_i: results.__setitem__(n, fh)))
+        while len(results) < len(files) and time.time() - t0 < args.timeout:
+            step(server, module)
+        dt = time.time() - t0
+        ok = all([results.get(n) is not None and results[n].read() == files[n] for n in files])
+        total = args.size * len(files)
+        print("%-9s %s in %.1fs %.2fkByte/s, %u/%u packets lost, %u requests dropped" % (
+            name, "OK" if ok else "FAILED", dt, total / dt / 1024.0,
+            uplink.lost + downlink.lost, uplink.sent + downlink.sent, server.dropped_requests))
+        module.cmd_cancel()
+        for job in jobs:
+            print("          %s" % job.describe())
+
+    def run_resume():
+        '''download to a file, stop half way, then start again with a new module'''
+        tmpdir = tempfile.mkdtemp()
+        local = os.path.join(tmpdir, 'log0.bin')
+        data = files['log0.bin']
+        rng = random.Random(args.seed)
+        uplink = StandinLink(args.latency, 0, args.loss, args.byte_error, rng)
+        downlink = StandinLink(args.latency, args.bandwidth, args.loss, args.byte_error, rng)
+        server = FTPServerStandin(files, uplink, downlink)
+        module = new_module(server, [])
+        job = module.queue_get('log0.bin', local)
+        t0 = time.time()
+        while job.received_bytes() < args.size // 2 and time.time() - t0 < args.timeout:
+            step(server, module)
+        # the link goes away; the state saved periodically is all that's left
+        first = job.received_bytes()
+        job.save_state()
+        time.sleep(0.5)
+        server = FTPServerStandin(files, uplink, downlink)
+        uplink.receive(time.time() + 10)
+        downlink.receive(time.time() + 10)
+        module = new_module(server, [])
+        job = module.queue_get('log0.bin', local)
+        t1 = time.time()
+        while not job.finished() and time.time() - t1 < args.timeout:
+            step(server, module)
+        with open(local, 'rb') as f:
+            ok = f.read() == data
+        print("resume    %s, %u bytes before stopping, resumed at %u, %u bytes fetched after, %.1fs+%.1fs" % (
+            "OK" if ok and job.resumed else "FAILED", first, job.resumed_bytes,
+            job.read.stats.bytes if job.read is not None else 0, t1 - t0, time.time() - t1))
+        print("          %s" % job.describe())
+        shutil.rmtree(tmpdir)
+
+    print("%u x %u bytes, latency %.3fs, %u bytes/s, loss %.1f%%, byte error %.4f%%" % (
+        args.files, args.size, args.latency, args.bandwidth, 100 * args.loss, 100 * args.byte_error))
+    if args.resume:
+        run_resume()
+    elif args.files > 1:
+        run('1 session', [])
+        run('2 sessions', [('sessions', 2)], max_open=2)
+        run('2 on AP', [('sessions', 2)])
+    else:
+        run('fixed', [('burst_read_size', 80), ('max_backlog', 5), ('retry_time', 0.5)])
+        run('adaptive', [])
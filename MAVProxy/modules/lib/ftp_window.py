@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+'''
+sliding window read engine for MAVLink FTP downloads
+
+Keeps track of which parts of a file being downloaded are missing and
+which reads for them are outstanding, for a client that streams the
+file with burst reads and fills the holes lost packets leave with
+individual reads:
+
+ - missing bytes are kept in a sorted set of ranges, so looking up,
+   splitting and merging gaps is a bisect rather than a list scan
+ - up to a window of gap reads are outstanding at once. The window is
+   the number of replies the link carries in a round trip, so the link
+   is kept busy without queueing more requests than the server holds
+ - reads time out after a retransmit timeout computed from the smoothed
+   round trip time and its variation (as in RFC 6298). While a burst is
+   streaming the server can't answer reads, so the timeout counts from
+   the last burst packet. The timeout only backs off if nothing at all
+   has been heard since the read was sent, as on a lossy radio link
+   most timeouts are a lost packet rather than a slow server
+ - the burst packet size is chosen from the measured loss, assuming
+   packets are lost through byte errors so smaller packets survive more
+   often but carry more overhead
+
+See ftp_standin.py for a simulated server to benchmark against
+
+AP_FLAKE8_CLEAN
+'''
+
+import bisect
+import math
+import time
+
+# largest FTP read payload
+MAX_PAYLOAD = 239
+
+# smallest burst packet size the adaptive sizing will pick
+MIN_BURST_SIZE = 32
+
+# bytes of MAVLink and FTP headers around each packet's payload
+PACKET_OVERHEAD = 27
+
+# limits on the retransmit timeout in seconds
+MIN_RTO = 0.1
+MAX_RTO = 5.0
+
+
+class GapSet(object):
+    '''a set of byte offsets, held as sorted disjoint [start, end) ranges'''
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.size = 0
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def first(self):
+        '''the lowest range as (start, end), or None if empty'''
+        if not self.starts:
+            return None
+        return (self.starts[0], self.ends[0])
+
+    def add(self, start, end):
+        '''add a range, merging it with any it overlaps or touches'''
+        if end <= start:
+            return
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            self.size -= sum([self.ends[k] - self.starts[k] for k in range(i, j)])
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+        self.size += end - start
+
+    def remove(self, start, end):
+        '''remove a range, returning the number of bytes that were in the set'''
+        i = bisect.bisect_right(self.ends, start)
+        j = bisect.bisect_left(self.starts, end)
+        if i >= j:
+            return 0
+        removed = sum([self.ends[k] - self.starts[k] for k in range(i, j)])
+        starts = []
+        ends = []
+        if self.starts[i] < start:
+            starts.append(self.starts[i])
+            ends.append(start)
+        if self.ends[j - 1] > end:
+            starts.append(end)
+            ends.append(self.ends[j - 1])
+        removed -= sum([e - s for (s, e) in zip(starts, ends)])
+        self.starts[i:j] = starts
+        self.ends[i:j] = ends
+        self.size -= removed
+        return removed
+
+    def intersection(self, start, end):
+        '''return the ranges in the set within [start, end)'''
+        i = bisect.bisect_right(self.ends, start)
+        j = bisect.bisect_left(self.starts, end)
+        return [(max(self.starts[k], start), min(self.ends[k], end)) for k in range(i, j)]
+
+
+class RTTEstimator(object):
+    '''smoothed round trip time and retransmit timeout'''
+    def __init__(self, initial_rto=1.0):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.samples = 0
+
+    def sample(self, rtt):
+        '''add a round trip time measured on a request that wasn't retried'''
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+        self.samples += 1
+
+    def backoff(self):
+        '''double the timeout after a loss'''
+        self.rto = min(self.rto * 2, MAX_RTO)
+
+
+class TransferStats(object):
+    '''counters for a download'''
+    def __init__(self):
+        self.start_time = time.time()
+        self.end_time = None
+        self.bytes = 0
+        self.packets = 0
+        self.bursts = 0
+        self.burst_retries = 0
+        self.reads = 0
+        self.timeouts = 0
+        self.duplicates = 0
+        self.lost_bytes = 0
+
+    def elapsed(self):
+        end = self.end_time if self.end_time is not None else time.time()
+        return max(end - self.start_time, 1.0e-6)
+
+    def rate(self):
+        '''bytes per second'''
+        return self.bytes / self.elapsed()
+
+
+class ReadRequest(object):
+    '''an outstanding gap read'''
+    def __init__(self, offset, length, now):
+        self.offset = offset
+        self.length = length
+        self.sent = now
+        self.retry = False
+
+
+class ReadWindow(object):
+    '''state of one download.
+
+    head is the end of the data the burst has streamed so far. Bytes
+    below the head that haven't arrived are in missing, and those of
+    them not covered by an outstanding read are also in unrequested.
+    burst_size and retry_time of 0 are adaptive, and max_window is the
+    most reads the server can queue.
+    '''
+    def __init__(self, burst_size=0, max_window=5, retry_time=0, rtt=None):
+        self.head = 0
+        self.eof = False
+        self.missing = GapSet()
+        self.unrequested = GapSet()
+        self.retried = GapSet()
+        self.outstanding = {}
+        self.fixed_burst_size = min(burst_size, MAX_PAYLOAD)
+        self.burst_size = self.fixed_burst_size or MAX_PAYLOAD
+        self.max_window = max(1, max_window)
+        self.window = self.max_window
+        self.packet_interval = None
+        self.retry_time = retry_time
+        self.rtt = rtt if rtt is not None else RTTEstimator()
+        self.last_burst_rx = 0
+        self.last_rx = 0
+        self.last_backoff = 0
+        self.loss = None
+        self.burst_packets = 0
+        self.burst_lost = 0
+        self.stats = TransferStats()
+
+    def finished(self):
+        return self.eof and self.missing.size == 0
+
+    def received_bytes(self):
+        '''bytes of the file received so far'''
+        return self.head - self.missing.size
+
+    def restore(self, head, eof, missing):
+        '''carry on from an earlier download that got to head, with a
+        list of (start, end) ranges missing'''
+        self.head = head
+        self.eof = eof
+        for (start, end) in missing:
+            self.missing.add(start, end)
+            self.unrequested.add(start, end)
+
+    def timeout(self):
+        '''seconds before a request is retried'''
+        if self.retry_time > 0:
+            return self.retry_time
+        return self.rtt.rto
+
+    def fill(self, offset, length):
+        '''record data below the head, returning the number of new bytes'''
+        new = self.missing.remove(offset, offset + length)
+        self.unrequested.remove(offset, offset + length)
+        self.retried.remove(offset, offset + length)
+        self.stats.bytes += new
+        return new
+
+    def burst_data(self, offset, length, now):
+        '''record a burst packet, returning the number of new bytes'''
+        if offset >= self.head and self.head > 0 and now - self.last_burst_rx < 1.0:
+            # time per packet on the link, for sizing the window
+            packets = (offset - self.head) // max(length, 1) + 1
+            interval = (now - self.last_burst_rx) / packets
+            if self.packet_interval is None:
+                self.packet_interval = interval
+            self.packet_interval = 0.9 * self.packet_interval + 0.1 * interval
+        self.last_burst_rx = now
+        self.last_rx = now
+        self.stats.packets += 1
+        end = offset + length
+        new = 0
+        if offset < self.head:
+            # an earlier burst, or one sent again after a stall
+            new = self.fill(offset, min(end, self.head) - offset)
+            offset = min(end, self.head)
+        if end > self.head:
+            if offset > self.head:
+                # packets were lost on the way
+                self.missing.add(self.head, offset)
+                self.unrequested.add(self.head, offset)
+                self.stats.lost_bytes += offset - self.head
+                self.burst_lost += (offset - self.head + self.burst_size - 1) // self.burst_size
+            self.burst_packets += 1
+            self.head = end
+            self.stats.bytes += end - offset
+            new += end - offset
+        if new == 0:
+            self.stats.duplicates += 1
+        return new
+
+    def read_reply(self, offset, length, now):
+        '''record the reply to a gap read. Returns the number of new
+        bytes, or None if the reply is short of what was asked for'''
+        self.stats.packets += 1
+        self.last_rx = now
+        req = self.outstanding.pop(offset, None)
+        if req is None:
+            # a reply to a read that was given up on
+            return self.count_duplicate(self.fill(offset, length))
+        if not req.retry and req.sent > self.last_burst_rx:
+            # the server wasn't busy with a burst, so this is a true
+            # round trip (Karn's algorithm skips retries)
+            self.rtt.sample(now - req.sent)
+        if length < req.length and offset + length < self.head:
+            return None
+        return self.count_duplicate(self.fill(offset, length))
+
+    def count_duplicate(self, new):
+        if new == 0:
+            self.stats.duplicates += 1
+        return new
+
+    def expire(self, now):
+        '''give up on reads that have timed out, so their bytes are read again'''
+        timeout = self.timeout()
+        for req in list(self.outstanding.values()):
+            if now - max(req.sent, self.last_burst_rx) < timeout:
+                continue
+            self.outstanding.pop(req.offset)
+            self.stats.timeouts += 1
+            for (s, e) in self.missing.intersection(req.offset, req.offset + req.length):
+                self.unrequested.add(s, e)
+                self.retried.add(s, e)
+            if self.last_rx < req.sent and now - self.last_backoff > timeout:
+                # nothing has come back at all, so slow down
+                self.last_backoff = now
+                self.rtt.backoff()
+
+    def window_size(self):
+        '''how many gap reads may be outstanding'''
+        if self.packet_interval is None or self.rtt.srtt is None:
+            return self.max_window
+        return max(1, min(self.max_window, int(math.ceil(self.rtt.srtt / max(self.packet_interval, 1.0e-4))) + 1))
+
+    def next_reads(self, now):
+        '''return a list of (offset, length) gap reads to send now'''
+        self.expire(now)
+        self.window = self.window_size()
+        ret = []
+        while len(self.outstanding) < self.window and self.unrequested.size > 0:
+            (start, end) = self.unrequested.first()
+            length = min(end - start, MAX_PAYLOAD)
+            self.unrequested.remove(start, start + length)
+            req = ReadRequest(start, length, now)
+            req.retry = len(self.retried.intersection(start, start + length)) > 0
+            self.outstanding[start] = req
+            self.stats.reads += 1
+            ret.append((start, length))
+        return ret
+
+    def next_burst_size(self):
+        '''the packet size for the next burst, chosen from the loss on
+        the bursts so far'''
+        self.stats.bursts += 1
+        total = self.burst_packets + self.burst_lost
+        if total > 0:
+            loss = self.burst_lost / float(total)
+            self.loss = loss if self.loss is None else 0.7 * self.loss + 0.3 * loss
+        self.burst_packets = 0
+        self.burst_lost = 0
+        if self.fixed_burst_size or self.loss is None:
+            return self.burst_size
+        # if each byte survives with probability q, a packet of L bytes
+        # gets through with probability q**(L+overhead). Pick the L that
+        # delivers the most payload per byte sent
+        q = (1.0 - min(self.loss, 0.99)) ** (1.0 / (self.burst_size + PACKET_OVERHEAD))
+
+        def goodput(size):
+            return size * q ** (size + PACKET_OVERHEAD) / (size + PACKET_OVERHEAD)
+        best = max(range(MIN_BURST_SIZE, MAX_PAYLOAD + 1), key=goodput)
+        if goodput(best) > 1.05 * goodput(self.burst_size):
+            self.burst_size = best
+        return self.burst_size
+
+    def describe(self):
+        '''a summary of the transfer for status output'''
+        s = self.stats
+        return ("%u bytes in %.1fs %.1fkByte/s, %u packets %u bursts %u burst retries, "
+                "%u reads %u timeouts %u duplicates, %u bytes lost %u missing, "
+                "rtt=%s rto=%.2f window=%u burst_size=%u loss=%s" % (
+                    s.bytes, s.elapsed(), s.rate() / 1024.0, s.packets, s.bursts, s.burst_retries,
+                    s.reads, s.timeouts, s.duplicates, s.lost_bytes, self.missing.size,
+                    "%.3f" % self.rtt.srtt if self.rtt.srtt is not None else "-",
+                    self.timeout(), self.window, self.burst_size,
+                    "%.1f%%" % (100 * self.loss) if self.loss is not None else "-"))
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+'''
+batch rendering of graphs to image files
+
+Renders a list of graph definitions from one log to a directory of
+images, spreading the graphs over a pool of worker processes. The log
+is shared with the workers with the same mmap wrappers used for other
+child tasks (see multiproc_util.MPDataLogChildTask), so workers don't
+parse the log again. A timing report is written alongside the images.
+
+Run this file directly with a log filename and an output directory to
+render the stock graphs from the command line
+
+AP_FLAKE8_CLEAN
+'''
+
+import fnmatch
+import os
+import re
+import time
+
+from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib.multiproc_util import MPDataLogChildTask, mutex
+
+REPORT_FILENAME = 'timing.txt'
+
+
+class GraphJob(object):
+    '''one graph to render'''
+    def __init__(self, name, expression, filename):
+        self.name = name
+        self.expression = expression
+        self.filename = filename
+
+
+class GraphResult(object):
+    '''the outcome of rendering one graph'''
+    def __init__(self, job, points=0, process_time=0, render_time=0, cpu_time=0, error=None):
+        self.job = job
+        self.points = points
+        self.process_time = process_time
+        self.render_time = render_time
+        self.cpu_time = cpu_time
+        self.error = error
+        self.pid = os.getpid()
+
+
+def graph_filename(name, fmt='png'):
+    '''make a file name from a graph name, which may contain / for menus'''
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name.strip()).strip('_') + '.' + fmt
+
+
+def select_graphs(graphs, patterns=None):
+    '''return the graphs with names matching any of a list of fnmatch
+    patterns, or all graphs if there are no patterns'''
+    if not patterns:
+        return list(graphs)
+    return [g for g in graphs if any([fnmatch.fnmatch(g.name, p) for p in patterns])]
+
+
+def make_jobs(graphs, directory, fmt='png'):
+    '''make a list of GraphJob from GraphDefinitions, making sure every
+    graph gets its own output file'''
+    jobs = []
+    used = set()
+    for g in graphs:
+        filename = graph_filename(g.name, fmt)
+        n = 1
+        while filename in used:
+            n += 1
+            filename = graph_filename('%s_%u' % (g.name, n), fmt)
+        used.add(filename)
+        jobs.append(GraphJob(g.name, g.expression, os.path.join(directory, filename)))
+    return jobs
+
+
+class GraphRenderer(object):
+    '''renders graphs from an open log.
+
+    options is a dict of graph settings: condition, xaxis, marker,
+    linestyle, show_flightmode, legend, legend2, max_rate, title,
+    flightmode_selections, flightmodes, colourmap and colcache
+    '''
+    def __init__(self, mlog, filename, options):
+        self.mlog = mlog
+        self.filename = filename
+        self.options = options
+        self.columns = None
+        if options.get('colcache', False):
+            from MAVProxy.modules.lib import logcolumns
+            try:
+                self.columns = logcolumns.LogColumns(filename, mlog)
+            except Exception as ex:
+                print("Column cache unavailable: %s" % ex)
+
+    def render(self, job):
+        '''render one graph to its file, returning a GraphResult'''
+        import pylab
+        from MAVProxy.modules.lib import grapher
+        opts = self.options
+        t0 = time.time()
+        c0 = time.process_time()
+        try:
+            self.mlog.rewind()
+            mg = grapher.MavGraph(opts.get('colourmap', None))
+            mg.set_title(opts.get('title', None) or job.name)
+            if opts.get('max_rate', 0) > 0:
+                mg.set_max_message_rate(opts['max_rate'])
+            mg.set_marker(opts.get('marker', None))
+            mg.set_condition(opts.get('condition', None))
+            mg.set_xaxis(opts.get('xaxis', None))
+            mg.set_linestyle(opts.get('linestyle', None))
+            mg.set_show_flightmode(opts.get('show_flightmode', True))
+            mg.set_legend(opts.get('legend', 'upper left'))
+            mg.set_legend2(opts.get('legend2', 'upper right'))
+            mg.add_mav(self.mlog, self.columns)
+            for f in job.expression.split():
+                mg.add_field(f)
+            mg.process(opts.get('flightmode_selections', []), opts.get('flightmodes', None))
+            points = sum([len(y) for y in mg.y])
+            t1 = time.time()
+            mg.show(1, block=False, output=job.filename)
+            pylab.close('all')
+            t2 = time.time()
+        except Exception as ex:
+            return GraphResult(job, process_time=time.time()-t0, cpu_time=time.process_time()-c0, error=str(ex))
+        return GraphResult(job, points, t1-t0, t2-t1, time.process_time()-c0)
+
+    def close(self):
+        if self.columns is not None:
+            self.columns.close()
+            self.columns = None
+
+
+# the renderer in a pool worker
+worker_renderer = None
+
+
+def use_file_backend():
+    '''switch matplotlib to a backend that only writes files. This
+    affects the whole process so is only done in workers'''
+    # stop grapher selecting a GUI backend if it is imported after this
+    os.environ['MPLBACKEND'] = 'agg'
+    import matplotlib.pyplot
+    matplotlib.pyplot.switch_backend('agg')
+
+
+def worker_init(task):
+    '''set up a pool worker with the shared log'''
+    global worker_renderer
+    task.unwrap()
+    use_file_backend()
+    worker_renderer = GraphRenderer(task.mlog, task.filename, task.options)
+
+
+def worker_render(job):
+    return worker_renderer.render(job)
+
+
+class GraphBatchTask(MPDataLogChildTask):
+    '''render a list of graphs from a log with a pool of worker processes'''
+    def __init__(self, *args, **kwargs):
+        '''
+        Parameters
+        ----------
+        mlog : DFReader / mavmmaplog
+            A dataflash or telemetry log
+        filename : str
+            The name the log was loaded from, for the column cache
+        options : dict
+            Graph settings, see GraphRenderer
+        processes : int
+            Number of worker processes, 0 for one per CPU
+        '''
+        super(GraphBatchTask, self).__init__(*args, **kwargs)
+        self.filename = kwargs['filename']
+        self.options = kwargs.get('options', {})
+        self.processes = kwargs.get('processes', 0)
+        if self.processes <= 0:
+            self.processes = os.cpu_count() or 1
+
+    def can_fork(self):
+        '''see if the log can be shared with worker processes'''
+        if os.name == 'nt':
+            # the log can't be pickled on Windows
+            return False
+        return hasattr(self.mlog, 'data_map') and (hasattr(self.mlog, 'filehandle') or hasattr(self.mlog, 'f'))
+
+    def prefetch_columns(self, jobs):
+        '''extract the columns all the graphs need once, so the workers
+        can load them from the column cache'''
+        if not self.options.get('colcache', False):
+            return
+        from MAVProxy.modules.lib import logcolumns
+        text = ' '.join([j.expression for j in jobs] +
+                        [self.options.get('condition', None) or '', self.options.get('xaxis', None) or ''])
+        types = sorted(set(re.findall(r'[A-Z_][A-Z0-9_]+', text)))
+        try:
+            columns = logcolumns.LogColumns(self.filename, self.mlog)
+            columns.prefetch(types)
+            columns.close()
+        except Exception as ex:
+            print("Column cache unavailable: %s" % ex)
+        self.mlog.rewind()
+
+    def run(self, jobs, progress=None):
+        '''render all the jobs, returning a list of GraphResult in the
+        same order. progress(result) is called as each graph finishes'''
+        self.prefetch_columns(jobs)
+        results = {}
+        if not self.can_fork():
+            use_file_backend()
+            renderer = GraphRenderer(self.mlog, self.filename, self.options)
+            for i in range(len(jobs)):
+                results[i] = renderer.render(jobs[i])
+                if progress is not None:
+                    progress(results[i])
+            renderer.close()
+            self.mlog.rewind()
+            return [results[i] for i in range(len(jobs))]
+
+        # the log is wrapped while the workers start, as for a child task
+        with mutex:
+            self.wrap()
+            try:
+                pool = multiproc.Pool(max(1, min(self.processes, len(jobs))),
+                                      initializer=worker_init, initargs=(self,))
+            finally:
+                self.unwrap()
+        try:
+            # results come back as copies, so match them up by filename
+            index = dict([(j.filename, i) for (i, j) in enumerate(jobs)])
+            for r in pool.imap_unordered(worker_render, jobs):
+                results[index[r.job.filename]] = r
+                if progress is not None:
+                    progress(r)
+        finally:
+            pool.close()
+            pool.join()
+        return [results[i] for i in range(len(jobs))]
+
+
+def format_report(results, wall_time, processes):
+    '''return a timing report for a batch as a string'''
+    lines = []
+    lines.append("%-40s %10s %9s %9s %8s  %s" % ("graph", "points", "data(s)", "draw(s)", "pid", "file"))
+    cpu = 0
+    failed = 0
+    for r in results:
+        cpu += r.cpu_time
+        if r.error is not None:
+            failed += 1
+            lines.append("%-40s %10s %9.2f %9s %8u  ERROR: %s" % (
+                r.job.name[:40], '-', r.process_time, '-', r.pid, r.error))
+            continue
+        lines.append("%-40s %10u %9.2f %9.2f %8u  %s" % (r.job.name[:40], r.points, r.process_time, r.render_time,
+                                                         r.pid, os.path.basename(r.job.filename)))
+    lines.append("")
+    lines.append("%u graphs, %u failed, %u processes" % (len(results), failed, processes))
+    lines.append("total %.2fs cpu %.2fs, %.2f processes busy on average" % (wall_time, cpu, cpu / max(wall_time, 1.0e-6)))
+    return '\n'.join(lines) + '\n'
+
+
+def render_graphs(mlog, filename, graphs, directory, options, processes=0, fmt='png', progress=None):
+    '''render a list of GraphDefinitions to a directory. Returns
+    (results, report) and writes the report to the directory'''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    jobs = make_jobs(graphs, directory, fmt)
+    task = GraphBatchTask(mlog=mlog, filename=filename, options=options, processes=processes)
+    t0 = time.time()
+    results = task.run(jobs, progress)
+    report = format_report(results, time.time() - t0, task.processes)
+    with open(os.path.join(directory, REPORT_FILENAME), 'w') as f:
+        f.write(report)
+    return (results, report)
+
+
+if __name__ == '__main__':
+    import xml.etree.ElementTree as ET
+    from argparse import ArgumentParser
+    from MAVProxy.modules.lib import mp_logwriter
+    from MAVProxy.modules.lib.graphdefinition import GraphDefinition
+
+    parser = ArgumentParser(description='render graphs from a log to image files')
+    parser.add_argument("--graphs", default=None, help="graph XML file, default the stock graphs")
+    parser.add_argument("--jobs", type=int, default=0, help="number of processes, 0 for one per CPU")
+    parser.add_argument("--format", default='png', help="image format")
+    parser.add_argument("--select", default=None, help="comma separated graph name patterns")
+    parser.add_argument("--no-colcache", action='store_true', help="don't use the log column cache")
+    parser.add_argument("log")
+    parser.add_argument("directory")
+    args = parser.parse_args()
+
+    mlog = mp_logwriter.mavlink_connection(args.log)
+    flightmodes = mlog.flightmode_list()
+    if hasattr(mlog, 'name_to_id'):
+        logtypes = set(mlog.name_to_id.keys())
+    else:
+        logtypes = set(mlog.messages.keys())
+
+    if args.graphs is not None:
+        gfiles = [args.graphs]
+    else:
+        gdir = os.path.join(os.path.dirname(__file__), '..', '..', 'tools', 'graphs')
+        gfiles = [os.path.join(gdir, f) for f in sorted(os.listdir(gdir)) if f.endswith('.xml')]
+    # use the first expression of each graph that only needs messages in the log
+    graphs = []
+    names = set()
+    for f in gfiles:
+        for g in ET.parse(f).getroot().findall('graph'):
+            name = g.get('name')
+            if name in names:
+                continue
+            for e in g.findall('expression'):
+                if set(re.findall(r'[A-Z_][A-Z0-9_]+', e.text)).issubset(logtypes):
+                    graphs.append(GraphDefinition(name, e.text.strip(), '', [e.text], f))
+                    names.add(name)
+                    break
+    patterns = args.select.split(',') if args.select else None
+    graphs = select_graphs(graphs, patterns)
+
+    def progress(r):
+        print("%s %s" % (r.job.name, "ERROR: " + r.error if r.error else "OK"))
+
+    options = {'flightmodes': flightmodes, 'colcache': not args.no_colcache}
+    (results, report) = render_graphs(mlog, args.log, graphs, args.directory, options,
+                                      processes=args.jobs, fmt=args.format, progress=progress)
+    print(report)
@@ -39,7 +39,10 @@ class Graph_UI(object):
         self.mg.set_linestyle(self.mestate.settings.linestyle)
         self.mg.set_show_flightmode(self.mestate.settings.show_flightmode)
         self.mg.set_legend(self.mestate.settings.legend)
-        self.mg.add_mav(copy.copy(self.mestate.mlog))
+        columns = None
+        if self.mestate.settings.colcache:
+            columns = self.mestate.columns
+        self.mg.add_mav(copy.copy(self.mestate.mlog), columns)
         for f in graphdef.expression.split():
             self.mg.add_field(f)
         self.mg.process(self.mestate.flightmode_selections, self.mestate.mlog._flightmodes)
@@ -48,6 +51,7 @@ class Graph_UI(object):
         #To avoid slowdowns in Windows (which copies the vars to the new process)
         #We need to empty this var when we're finished with it
         self.mg.mav_list = []
+        self.mg.columns_list = []
         child = multiproc.Process(target=self.mg.show, args=[self.lenmavlist,], kwargs={"xlim_pipe" : self.xlim_pipe})
         child.start()
         self.xlim_pipe[1].close()
@@ -15,6 +15,8 @@ from math import *
 from pymavlink.mavextra import *
 import pylab
 from pymavlink import mavutil
+from MAVProxy.modules.lib import mp_logwriter
+from MAVProxy.modules.lib import vecexpr
 import threading
 import numpy as np
 
@@ -64,6 +66,16 @@ def timestamp_to_days(timestamp, timeshift=0):
     sec_to_days = 1.0 / (60*60*24)
     return tday_base + (timestamp - tday_basetime) * sec_to_days
 
+def timestamps_to_days(timestamps, timeshift=0):
+    '''convert a numpy array of log timestamps to days'''
+    if len(timestamps) == 0:
+        return timestamps
+    timestamp_to_days(float(timestamps[0]), timeshift)
+    if tday_base is None:
+        return np.zeros(len(timestamps))
+    sec_to_days = 1.0 / (60*60*24)
+    return tday_base + (timestamps - tday_basetime) * sec_to_days
+
 class MilliFormatter(matplotlib.dates.AutoDateFormatter):
     '''tick formatter that shows millisecond resolution'''
     def __init__(self, locator):
@@ -83,6 +95,7 @@ class MavGraph(object):
         self.lowest_x = None
         self.highest_x = None
         self.mav_list = []
+        self.columns_list = []
         self.fields = []
         self.condition = None
         self.xaxis = None
@@ -132,9 +145,11 @@ class MavGraph(object):
         '''add another field to plot'''
         self.fields.append(field)
 
-    def add_mav(self, mav):
-        '''add another data source to plot'''
+    def add_mav(self, mav, columns=None):
+        '''add another data source to plot, optionally with a
+        logcolumns.LogColumns for the same log'''
         self.mav_list.append(mav)
+        self.columns_list.append(columns)
 
     def set_condition(self, condition):
         '''set graph condition'''
@@ -489,15 +504,8 @@ class MavGraph(object):
             self.y[i].append(v)
             self.x[i].append(xv)
 
-    def process_mav(self, mlog, flightmode_selections):
-        '''process one file'''
-        self.vars = {}
-        idx = 0
-        all_false = True
-        for s in flightmode_selections:
-            if s:
-                all_false = False
-
+    def prepare_fields(self):
+        '''strip labels and axis markers from fields and see which are simple'''
         self.num_fields = len(self.fields)
 
         self.custom_labels = [None] * self.num_fields
@@ -529,6 +537,67 @@ class MavGraph(object):
             else:
                 self.simple_field.append((m.group(1),m.group(2)))
 
+    def add_columns(self, i, x, y):
+        '''add arrays of data for a field'''
+        if len(self.x[i]) == 0:
+            self.x[i] = x
+            self.y[i] = y
+        else:
+            self.x[i] = np.concatenate((np.asarray(self.x[i]), x))
+            self.y[i] = np.concatenate((np.asarray(self.y[i]), y))
+
+    def flightmode_mask(self, timestamps, flightmode_selections):
+        '''return a mask of timestamps in the selected flight modes, or None for all'''
+        if not any(flightmode_selections):
+            return None
+        modes = self.flightmode_list or []
+        ends = np.array([t1 if t1 is not None else np.inf for (mode, t0, t1) in modes], dtype=float)
+        idx = np.searchsorted(ends, timestamps, side='right')
+        selected = np.zeros(len(flightmode_selections)+1, dtype=bool)
+        selected[:len(flightmode_selections)] = flightmode_selections
+        return selected[np.minimum(idx, len(flightmode_selections))]
+
+    def process_columns(self, columns, flightmode_selections):
+        '''process one file from its column cache. Returns False if the
+        graph needs the per message path'''
+        if self.flightmode_list:
+            # prime the timestamp conversion
+            timestamp_to_days(self.flightmode_list[0][1], self.timeshift)
+
+        def row_mask(timestamps):
+            return self.flightmode_mask(timestamps, flightmode_selections)
+
+        # evaluate every field before adding any data, so we can still
+        # fall back to the per message path
+        results = []
+        for i in range(self.num_fields):
+            try:
+                results.append(vecexpr.evaluate_field(columns, self.fields[i],
+                                                      condition=self.condition,
+                                                      xaxis=self.xaxis,
+                                                      row_mask_fn=row_mask,
+                                                      max_rate=self.max_message_rate,
+                                                      msg_types=self.msg_types))
+            except (vecexpr.Unsupported, SyntaxError) as ex:
+                if MAVGRAPH_DEBUG:
+                    print("%s: %s" % (self.fields[i], ex))
+                return False
+        for i in range(self.num_fields):
+            (t, x, y) = results[i]
+            if x is None:
+                x = timestamps_to_days(t, self.timeshift)
+            self.add_columns(i, x, y)
+        return True
+
+    def process_mav(self, mlog, flightmode_selections):
+        '''process one file'''
+        self.vars = {}
+        idx = 0
+        all_false = True
+        for s in flightmode_selections:
+            if s:
+                all_false = False
+
         if len(self.flightmode_list) > 0:
             # prime the timestamp conversion
             timestamp_to_days(self.flightmode_list[0][1], self.timeshift)
@@ -620,8 +689,12 @@ class MavGraph(object):
 
         timeshift = self.timeshift
 
+        self.prepare_fields()
         for fi in range(0, len(self.mav_list)):
             mlog = self.mav_list[fi]
+            columns = self.columns_list[fi] if fi < len(self.columns_list) else None
+            if columns is not None and self.process_columns(columns, flightmode_selections):
+                continue
             self.process_mav(mlog, flightmode_selections)
 
 
@@ -707,6 +780,7 @@ if __name__ == "__main__":
     parser.add_argument("--output", default=None, help="provide an output format")
     parser.add_argument("--timeshift", type=float, default=0, help="shift time on first graph in seconds")
     parser.add_argument("--grid", action='store_true', help="show a grid")
+    parser.add_argument("--colcache", action='store_true', help="use a column cache next to the log")
     parser.add_argument("logs_fields", metavar="<LOG or FIELD>", nargs="+")
     args = parser.parse_args()
 
@@ -715,10 +789,14 @@ if __name__ == "__main__":
     filenames = []
     for f in args.logs_fields:
         if os.path.exists(f):
-            mlog = mavutil.mavlink_connection(f, notimestamps=args.notimestamps,
-                                              zero_time_base=args.zero_time_base,
-                                              dialect=args.dialect)
-            mg.add_mav(mlog)
+            mlog = mp_logwriter.mavlink_connection(f, notimestamps=args.notimestamps,
+                                                   zero_time_base=args.zero_time_base,
+                                                   dialect=args.dialect)
+            columns = None
+            if args.colcache:
+                from MAVProxy.modules.lib import logcolumns
+                columns = logcolumns.LogColumns(f, mlog)
+            mg.add_mav(mlog, columns)
         else:
             mg.add_field(f)
     mg.set_condition(args.condition)
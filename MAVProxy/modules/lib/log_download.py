@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+'''
+sliding window engine for dataflash log downloads over LOG_DATA
+
+The vehicle serves one LOG_REQUEST_DATA range at a time, streaming it
+in 90 byte LOG_DATA packets, and a new request replaces the one it is
+serving. So rather than several requests outstanding at once the
+download keeps one request of up to a window of bytes going and sends
+the next one a round trip before the current one runs out, so the link
+doesn't sit idle between them:
+
+ - received data is kept as a sorted set of missing ranges below the
+   highest byte received, so finding the next gap is a bisect rather
+   than a scan over every block of the log
+ - each request starts at the lowest missing byte, so gaps are filled
+   as the download goes rather than all at the end. Gaps separated by
+   a packet or two of received data are asked for in one request
+ - a request that stops delivering is sent again after a retransmit
+   timeout from the measured round trip time
+ - writes are gathered into aligned chunks, so the file is written in
+   large blocks rather than a seek and write per packet
+
+See log_standin.py for a simulated vehicle to benchmark against
+
+AP_FLAKE8_CLEAN
+'''
+
+import collections
+import itertools
+
+from MAVProxy.modules.lib.ftp_window import GapSet, RTTEstimator, TransferStats
+
+# payload bytes in a LOG_DATA packet
+LOG_DATA_LEN = 90
+
+# count that asks for everything from the offset to the end of the log
+TO_END = 0xFFFFFFFF
+
+# holes in the data up to this size are asked for again along with the
+# gaps either side of them rather than splitting a request
+MERGE_BYTES = 2 * LOG_DATA_LEN
+
+
+class ChunkWriter(object):
+    '''gathers writes at scattered offsets into chunk_size blocks aligned
+    to chunk_size in the file, writing each block once it is full. At
+    most max_chunks partly filled blocks are held, after which the
+    oldest is written out as it stands'''
+    def __init__(self, fh, chunk_size=65536, max_chunks=64):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.chunks = collections.OrderedDict()
+        self.writes = 0
+
+    def write(self, ofs, data):
+        data = memoryview(data)
+        while len(data) > 0:
+            idx = ofs // self.chunk_size
+            base = idx * self.chunk_size
+            start = ofs - base
+            n = min(len(data), self.chunk_size - start)
+            chunk = self.chunks.get(idx, None)
+            if chunk is None:
+                chunk = (bytearray(self.chunk_size), GapSet())
+                self.chunks[idx] = chunk
+            (buf, filled) = chunk
+            buf[start:start + n] = data[:n]
+            filled.add(start, start + n)
+            if filled.size == self.chunk_size:
+                self.write_chunk(idx)
+            ofs += n
+            data = data[n:]
+        while len(self.chunks) > self.max_chunks:
+            self.write_chunk(next(iter(self.chunks)))
+
+    def write_chunk(self, idx):
+        '''write out the filled parts of a chunk'''
+        (buf, filled) = self.chunks.pop(idx)
+        base = idx * self.chunk_size
+        for (start, end) in filled:
+            self.fh.seek(base + start)
+            self.fh.write(buf[start:end])
+            self.writes += 1
+
+    def flush(self):
+        '''write out everything held'''
+        for idx in sorted(self.chunks.keys()):
+            self.write_chunk(idx)
+        self.fh.flush()
+
+
+class LogRequest(object):
+    '''a LOG_REQUEST_DATA sent to the vehicle'''
+    def __init__(self, ofs, count, now, retry=False):
+        self.ofs = ofs
+        self.count = count
+        self.sent = now
+        self.retry = retry
+        # the end of the data received for this request so far
+        self.received = ofs
+        self.last_rx = None
+        # when a later request replaced this one on the vehicle
+        self.superseded = None
+        # if the first packet times the round trip
+        self.timed = not retry
+
+    def end(self):
+        return self.ofs + self.count
+
+    def remaining(self):
+        return max(self.end() - self.received, 0)
+
+    def last_heard(self):
+        return max(self.sent, self.last_rx or 0, self.superseded or 0)
+
+
+class LogDownload(object):
+    '''state of one log download to fh. size is the log size from
+    LOG_ENTRY, or None if it isn't known, in which case the download
+    ends at the first short packet'''
+    def __init__(self, log_num, fh, size=None, window=1 << 20, chunk_size=65536, rtt=None):
+        self.log_num = log_num
+        self.size = size if size else None
+        self.window = max(window, LOG_DATA_LEN)
+        self.head = 0
+        self.missing = GapSet()
+        # requests whose data may still arrive, oldest first
+        self.pending = []
+        self.request = None
+        self.writer = ChunkWriter(fh, chunk_size)
+        self.rtt = rtt if rtt is not None else RTTEstimator()
+        self.link_rate = None
+        self.rate_start = None
+        self.rate_bytes = 0
+        self.last_rx = 0
+        self.last_backoff = 0
+        self.requests = 0
+        self.retries = 0
+        self.stats = TransferStats()
+
+    def finished(self):
+        return self.size is not None and self.head >= self.size and self.missing.size == 0
+
+    def received_bytes(self):
+        return self.head - self.missing.size
+
+    def rate(self):
+        '''bytes per second the link delivers, or None if not known yet'''
+        return self.link_rate
+
+    def in_flight(self):
+        '''bytes the link carries in a round trip'''
+        if self.link_rate is None or self.rtt.srtt is None:
+            return LOG_DATA_LEN
+        return max(int(self.link_rate * self.rtt.srtt), LOG_DATA_LEN)
+
+    def measure_rate(self, now):
+        '''measure the link rate over periods of steady streaming.
+        Packets are handled in batches, so single intervals mean little'''
+        idle = max(self.rtt.srtt / 2, 0.02) if self.rtt.srtt is not None else 0.02
+        if self.rate_start is None or now - self.last_rx > idle:
+            self.rate_start = now
+            self.rate_bytes = 0
+            return
+        self.rate_bytes += LOG_DATA_LEN
+        dt = now - self.rate_start
+        if dt < 0.25:
+            return
+        rate = self.rate_bytes / dt
+        self.link_rate = rate if self.link_rate is None else 0.7 * self.link_rate + 0.3 * rate
+        self.rate_start = now
+        self.rate_bytes = 0
+
+    def data(self, ofs, count, data, now):
+        '''record a LOG_DATA packet, returning the number of new bytes'''
+        self.stats.packets += 1
+        self.measure_rate(now)
+        self.last_rx = now
+        end = ofs + count
+        for req in reversed(self.pending):
+            if req.ofs <= ofs < req.end():
+                if req.last_rx is None and ofs == req.ofs and req.timed:
+                    self.rtt.sample(now - req.sent)
+                req.last_rx = now
+                req.received = max(req.received, end)
+                if count < LOG_DATA_LEN and end < req.end():
+                    # a short packet before the end of what was asked
+                    # for is the end of the log
+                    self.size = end
+                break
+        if self.size is not None:
+            for req in self.pending:
+                req.count = max(min(req.count, self.size - req.ofs), 0)
+        self.pending = [r for r in self.pending if r.remaining() > 0]
+        new = 0
+        if ofs < self.head:
+            new = self.missing.remove(ofs, min(end, self.head))
+        if end > self.head:
+            if ofs > self.head:
+                self.missing.add(self.head, ofs)
+                self.stats.lost_bytes += ofs - self.head
+            new += end - max(ofs, self.head)
+            self.head = end
+        if self.size is not None and self.head > self.size:
+            # the log is shorter than LOG_ENTRY said
+            self.missing.remove(self.size, self.head)
+            self.head = self.size
+        if new > 0:
+            self.writer.write(ofs, data[:count])
+        else:
+            self.stats.duplicates += 1
+        self.stats.bytes += new
+        return new
+
+    def wanted(self, exclude=[]):
+        '''generate the (start, end) ranges not yet received in order,
+        leaving out the sorted list of ranges in exclude'''
+        ranges = iter(self.missing)
+        if self.size is None or self.head < self.size:
+            ranges = itertools.chain(ranges, [(self.head, self.size if self.size is not None else TO_END)])
+        for (s, e) in ranges:
+            for (xs, xe) in exclude:
+                if xe <= s or xs >= e:
+                    continue
+                if s < xs:
+                    yield (s, xs)
+                s = max(s, xe)
+                if s >= e:
+                    break
+            if s < e:
+                yield (s, e)
+
+    def next_range(self, exclude=[]):
+        '''the (ofs, count) to ask for next, starting at the lowest byte
+        not yet received or asked for'''
+        ranges = self.wanted(exclude)
+        first = next(ranges, None)
+        if first is None:
+            return None
+        (start, end) = first
+        for (s, e) in ranges:
+            if s - end > MERGE_BYTES or s - start >= self.window:
+                break
+            end = e
+        count = min(end - start, self.window)
+        return (start, count)
+
+    def expire(self, now):
+        '''give up on requests that have stopped delivering, so what
+        they didn't deliver is asked for again. Returns True if the
+        request the vehicle was serving timed out'''
+        timed_out = False
+        for req in self.pending[:]:
+            if now - req.last_heard() <= self.rtt.rto:
+                continue
+            self.pending.remove(req)
+            if req is not self.request:
+                # replaced by a later request
+                continue
+            timed_out = True
+            self.stats.timeouts += 1
+            self.retries += 1
+            if self.last_rx < req.sent and now - self.last_backoff > self.rtt.rto:
+                # nothing has come back at all, so slow down
+                self.last_backoff = now
+                self.rtt.backoff()
+        return timed_out
+
+    def next_request(self, now):
+        '''return a LogRequest to send now, or None'''
+        if self.finished():
+            return None
+        retry = self.expire(now)
+        cur = self.request if self.request in self.pending else None
+        if cur is not None:
+            if cur.last_rx is None:
+                # wait until the vehicle will have sent all of it by
+                # the time the next request gets there
+                if self.link_rate is None or now - cur.sent < cur.count / self.link_rate:
+                    return None
+            elif cur.remaining() > self.in_flight():
+                # ask for the next range a round trip before this one
+                # runs out
+                return None
+        exclude = sorted([(r.received, r.end()) for r in self.pending])
+        r = self.next_range(exclude)
+        if r is None:
+            return None
+        req = LogRequest(r[0], r[1], now, retry)
+        for p in self.pending:
+            if req.ofs < p.end() and req.end() > p.ofs:
+                # packets on their way for that request could be taken
+                # for the reply to this one
+                req.timed = False
+        if cur is not None:
+            cur.superseded = now
+        self.request = req
+        self.pending.append(req)
+        self.requests += 1
+        self.stats.reads += 1
+        return req
+
+    def close(self):
+        self.writer.flush()
+        if self.stats.end_time is None:
+            self.stats.end_time = self.last_rx or None
+
+    def describe(self):
+        '''a summary of the download for status output'''
+        s = self.stats
+        size = "%u" % self.size if self.size is not None else "?"
+        return ("%u/%s bytes in %.1fs %.1fkByte/s, %u packets %u requests %u retries, "
+                "%u duplicates %u bytes lost %u missing, %u writes, rtt=%s rto=%.2f" % (
+                    self.received_bytes(), size, s.elapsed(), s.rate() / 1024.0, s.packets, self.requests,
+                    self.retries, s.duplicates, s.lost_bytes, self.missing.size, self.writer.writes,
+                    "%.3f" % self.rtt.srtt if self.rtt.srtt is not None else "-", self.rtt.rto))
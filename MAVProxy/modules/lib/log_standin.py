@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+'''
+in-process stand-in for a vehicle serving dataflash logs over LOG_DATA
+
+Serves logs from memory the way ArduPilot does, over a simulated
+telemetry link (see ftp_standin.py) with latency, limited bandwidth and
+loss:
+
+ - a LOG_REQUEST_DATA replaces the request being served
+ - the requested range is streamed as 90 byte LOG_DATA packets as fast
+   as the link allows, with a short packet at the end of the log and a
+   packet with a count of zero for a request starting past the end
+ - LOG_REQUEST_END stops the transfer
+
+Run this file directly to benchmark downloads with the log module
+against it
+
+AP_FLAKE8_CLEAN
+'''
+
+import random
+
+from pymavlink import mavutil
+
+from MAVProxy.modules.lib.ftp_standin import StandinLink
+from MAVProxy.modules.lib.log_download import LOG_DATA_LEN
+
+# bytes of MAVLink framing around a message payload
+MAVLINK_OVERHEAD = 12
+
+
+class LogServerStandin(object):
+    '''serves logs held in a dict of log number to bytes'''
+    def __init__(self, logs, uplink, downlink):
+        self.logs = logs
+        self.uplink = uplink
+        self.downlink = downlink
+        self.log_num = None
+        self.ofs = 0
+        self.remaining = 0
+        self.requests = 0
+
+    def log_request_data_send(self, target_system, target_component, log_num, ofs, count, now):
+        self.uplink.send(('data', log_num, ofs, count), 12 + MAVLINK_OVERHEAD, now)
+
+    def log_request_end_send(self, target_system, target_component, now):
+        self.uplink.send(('end',), MAVLINK_OVERHEAD, now)
+
+    def update(self, now):
+        '''accept requests and send data as the link allows'''
+        for req in self.uplink.receive(now):
+            self.requests += 1
+            if req[0] == 'end':
+                self.log_num = None
+                continue
+            (log_num, ofs, count) = req[1:]
+            if log_num not in self.logs:
+                continue
+            self.log_num = log_num
+            self.ofs = ofs
+            self.remaining = max(min(count, len(self.logs[log_num]) - ofs), 0)
+            if self.remaining == 0:
+                self.send_data(now)
+        while self.log_num is not None and self.remaining > 0 and self.downlink.idle(now):
+            self.send_data(now)
+
+    def send_data(self, now):
+        '''send the next packet of the request'''
+        n = min(self.remaining, LOG_DATA_LEN)
+        data = bytearray(self.logs[self.log_num][self.ofs:self.ofs + n])
+        data.extend(bytearray(LOG_DATA_LEN - n))
+        msg = mavutil.mavlink.MAVLink_log_data_message(self.log_num, self.ofs, n, list(data))
+        self.downlink.send(msg, 4 + 2 + 1 + LOG_DATA_LEN + MAVLINK_OVERHEAD, now)
+        self.ofs += n
+        self.remaining -= n
+        if n == 0:
+            self.log_num = None
+
+    def receive(self, now):
+        '''return the packets that have reached the client'''
+        return self.downlink.receive(now)
+
+
+if __name__ == "__main__":
+    import os
+    import shutil
+    import tempfile
+    import time
+    from argparse import ArgumentParser
+
+    from MAVProxy.modules import mavproxy_log
+
+    parser = ArgumentParser(description='benchmark log downloads against a simulated vehicle')
+    parser.add_argument("--size", type=int, default=1000000, help="log size in bytes")
+    parser.add_argument("--latency", type=float, default=0.05, help="one way link latency in seconds")
+    parser.add_argument("--bandwidth", type=int, default=100000, help="downlink bytes per second")
+    parser.add_argument("--loss", type=float, default=0.02, help="chance of losing a packet")
+    parser.add_argument("--timeout", type=float, default=300, help="give up on a download after this long")
+    parser.add_argument("--known-size", action='store_true', help="give the log size as a LOG_ENTRY would")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    class Settings(object):
+        source_system = 255
+        source_component = 0
+        target_system = 1
+        target_component = 1
+
+    class MAV(object):
+        def __init__(self, server):
+            self.server = server
+
+        def log_request_data_send(self, *args):
+            self.server.log_request_data_send(*args, now=time.time())
+
+        def log_request_end_send(self, *args):
+            self.server.log_request_end_send(*args, now=time.time())
+
+    class Master(object):
+        def __init__(self, server):
+            self.mav = MAV(server)
+
+    class Console(object):
+        def set_status(self, *args, **kwargs):
+            pass
+
+    class MPState(object):
+        '''the parts of the MAVProxy state the log module uses'''
+        def __init__(self, master):
+            self.public_modules = {}
+            self.command_map = {}
+            self.completions = {}
+            self.completion_functions = {}
+            self.module_generation = 0
+            self.settings = Settings()
+            self.console = Console()
+            self._master = master
+
+        def master(self):
+            return self._master
+
+    class Entry(object):
+        def __init__(self, size):
+            self.size = size
+
+    data = os.urandom(args.size)
+    tmpdir = tempfile.mkdtemp()
+
+    def run(name, settings):
+        rng = random.Random(args.seed)
+        uplink = StandinLink(args.latency, 0, args.loss, 0, rng)
+        downlink = StandinLink(args.latency, args.bandwidth, args.loss, 0, rng)
+        server = LogServerStandin({1: data}, uplink, downlink)
+        module = mavproxy_log.LogModule(MPState(Master(server)))
+        for (k, v) in settings:
+            module.log_settings.set(k, v)
+        if args.known_size:
+            module.entries[1] = Entry(len(data))
+        filename = os.path.join(tmpdir, 'log1.bin')
+        t0 = time.time()
+        module.log_download(1, filename)
+        download = module.download
+        while module.download is not None and time.time() - t0 < args.timeout:
+            now = time.time()
+            server.update(now)
+            for m in server.receive(now):
+                module.mavlink_packet(m)
+            module.idle_task()
+            time.sleep(0.0005)
+        dt = time.time() - t0
+        with open(filename, 'rb') as f:
+            ok = f.read() == data
+        print("%-12s %s in %.1fs %.1fkByte/s, %u/%u packets lost, %u requests" % (
+            name, "OK" if ok else "FAILED", dt, args.size / dt / 1024.0,
+            uplink.lost + downlink.lost, uplink.sent + downlink.sent, server.requests))
+        print("             %s" % download.describe())
+
+    print("%u bytes, latency %.3fs, %u bytes/s, loss %.1f%%" % (
+        args.size, args.latency, args.bandwidth, 100 * args.loss))
+    run('window 64k', [('window', 65536)])
+    run('window 1M', [])
+    shutil.rmtree(tmpdir)
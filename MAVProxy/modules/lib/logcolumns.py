@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+'''
+columnar cache of log messages for graphing
+
+A LogColumns object holds one NumPy array per numeric field of each
+message type, plus an array of message timestamps, so graphs can be
+evaluated over whole columns rather than one message at a time.
+
+Columns are extracted the first time a message type is asked for. For
+binary dataflash logs with microsecond timestamps the records are
+gathered straight out of the memory mapped log using the index built by
+DFReader, other logs are scanned once with recv_match(). Extracted
+columns are saved in a sidecar file next to the log (LOGNAME.colcache.npz)
+so later sessions don't need to touch the log at all
+
+Run this file directly with a log filename for a benchmark
+
+AP_FLAKE8_CLEAN
+'''
+
+import json
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+# bump this when the layout of the sidecar file changes
+CACHE_VERSION = 2
+CACHE_EXTENSION = '.colcache.npz'
+
+# struct format characters with a numpy equivalent
+struct_to_numpy = {
+    'b': 'i1', 'B': 'u1',
+    'h': '<i2', 'H': '<u2',
+    'i': '<i4', 'I': '<u4',
+    'q': '<i8', 'Q': '<u8',
+    'e': '<f2', 'f': '<f4', 'd': '<f8',
+}
+
+# number of records gathered at a time from a dataflash log
+gather_chunk = 65536
+
+
+class MessageColumns(object):
+    '''columns for one message type. position gives the order of each
+    message in the log, for lining up messages of different types'''
+    def __init__(self, name, timestamp, columns, instance_field=None, position=None):
+        self.name = name
+        self.timestamp = timestamp
+        self.columns = columns
+        self.instance_field = instance_field
+        self.position = position
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def __contains__(self, field):
+        return field in self.columns
+
+    def field(self, name):
+        '''return the array for a field'''
+        return self.columns[name]
+
+    def fieldnames(self):
+        return list(self.columns.keys())
+
+    def instance_mask(self, instance):
+        '''return a boolean mask selecting one instance of this message'''
+        if self.instance_field is None or self.instance_field not in self.columns:
+            return None
+        return self.columns[self.instance_field] == float(instance)
+
+
+def log_key(filename, mlog=None):
+    '''return a key that changes when the log or the way it was opened changes'''
+    st = os.stat(filename)
+    key = [CACHE_VERSION, st.st_size, st.st_mtime_ns]
+    if mlog is not None:
+        key.append(type(mlog).__name__)
+        key.append(bool(getattr(mlog, '_zero_time_base', False)))
+        key.append(bool(getattr(mlog, 'notimestamps', False)))
+    return key
+
+
+class LogColumns(object):
+    '''columnar view of a log, with a persistent sidecar cache.
+
+    filename is the log as the user named it, which is used for the
+    cache file name and validity check. mlog is the open log to extract
+    columns from, which may be a decompressed copy of filename
+    '''
+    def __init__(self, filename, mlog, cache=True):
+        self.filename = filename
+        self.mlog = mlog
+        self.types = {}
+        self.cache_filename = filename + CACHE_EXTENSION if cache else None
+        self.dirty = False
+        self.key = log_key(filename, mlog)
+        self.npz = None
+        self.cached_types = {}
+        self.load()
+
+    def load(self):
+        '''open the sidecar cache if it is valid for this log'''
+        if self.cache_filename is None or not os.path.exists(self.cache_filename):
+            return
+        try:
+            npz = np.load(self.cache_filename, allow_pickle=False)
+            meta = json.loads(str(npz['_meta']))
+        except Exception as ex:
+            print("Ignoring bad column cache %s: %s" % (self.cache_filename, ex))
+            return
+        if meta.get('key') != self.key:
+            npz.close()
+            return
+        self.npz = npz
+        self.cached_types = meta['types']
+
+    def close(self):
+        if self.npz is not None:
+            self.npz.close()
+            self.npz = None
+
+    def _from_cache(self, mtype):
+        '''load one message type from the sidecar cache'''
+        info = self.cached_types[mtype]
+        if info is None:
+            return None
+        timestamp = self.npz['%s._timestamp' % mtype]
+        position = None
+        if '%s._position' % mtype in self.npz.files:
+            position = self.npz['%s._position' % mtype]
+        columns = {}
+        for f in info['fields']:
+            columns[f] = self.npz['%s.%s' % (mtype, f)]
+        return MessageColumns(mtype, timestamp, columns, info.get('instance_field'), position)
+
+    def get(self, mtype):
+        '''return MessageColumns for a message type, or None if the log
+        has no messages of that type'''
+        if mtype not in self.types:
+            self.prefetch([mtype])
+        return self.types[mtype]
+
+    def prefetch(self, types):
+        '''make sure all of a list of message types are available'''
+        missing = []
+        for mtype in types:
+            if mtype in self.types:
+                continue
+            if mtype in self.cached_types:
+                self.types[mtype] = self._from_cache(mtype)
+            else:
+                missing.append(mtype)
+        if len(missing) == 0:
+            return
+        scan = []
+        for mtype in missing:
+            cols = extract_dfbinary(self.mlog, mtype)
+            if cols is False:
+                scan.append(mtype)
+            else:
+                self.types[mtype] = cols
+        if len(scan) > 0:
+            self.types.update(extract_scan(self.mlog, scan))
+        self.dirty = True
+        self.save()
+
+    def save(self):
+        '''write all extracted columns to the sidecar file'''
+        if self.cache_filename is None or not self.dirty:
+            return
+        arrays = {}
+        meta_types = {}
+        all_types = set(self.types.keys()).union(set(self.cached_types.keys()))
+        for mtype in all_types:
+            if mtype in self.types:
+                cols = self.types[mtype]
+            else:
+                cols = self._from_cache(mtype)
+            if cols is None:
+                meta_types[mtype] = None
+                continue
+            meta_types[mtype] = {'fields': cols.fieldnames(), 'instance_field': cols.instance_field}
+            arrays['%s._timestamp' % mtype] = cols.timestamp
+            if cols.position is not None:
+                arrays['%s._position' % mtype] = cols.position
+            for f in cols.fieldnames():
+                arrays['%s.%s' % (mtype, f)] = cols.field(f)
+        arrays['_meta'] = np.array(json.dumps({'key': self.key, 'types': meta_types}))
+        dirname = os.path.dirname(os.path.abspath(self.cache_filename))
+        tmpname = None
+        try:
+            (fd, tmpname) = tempfile.mkstemp(dir=dirname, suffix=CACHE_EXTENSION)
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.chmod(tmpname, 0o644)
+            self.close()
+            os.replace(tmpname, self.cache_filename)
+        except OSError as ex:
+            print("Unable to save column cache %s: %s" % (self.cache_filename, ex))
+            if tmpname is not None and os.path.exists(tmpname):
+                os.unlink(tmpname)
+            self.cache_filename = None
+            return
+        self.dirty = False
+        self.load()
+
+
+def extract_dfbinary(mlog, mtype):
+    '''gather the columns for a message type directly from a binary
+    dataflash log. Returns False if this log or message can't be handled
+    this way, None if there are no messages of this type'''
+    try:
+        from pymavlink import DFReader
+    except ImportError:
+        return False
+    if not isinstance(mlog, DFReader.DFReader_binary):
+        return False
+    if not isinstance(mlog.clock, DFReader.DFReaderClock_usec):
+        return False
+    if mtype not in mlog.name_to_id:
+        return None
+    type_id = mlog.name_to_id[mtype]
+    fmt = mlog.formats[type_id]
+    if len(fmt.columns) == 0 or fmt.columns[0] != 'TimeUS':
+        return False
+    offsets = np.asarray(mlog.offsets[type_id], dtype=np.int64)
+    body_len = fmt.len - 3
+    offsets = offsets[offsets + fmt.len <= mlog.data_len] + 3
+    if len(offsets) == 0:
+        return None
+
+    # build a structured dtype with just the numeric fields
+    names = []
+    formats = []
+    field_offsets = []
+    mults = []
+    ofs = 0
+    for i in range(len(fmt.columns)):
+        c = fmt.format[i]
+        sfmt = DFReader.FORMAT_TO_STRUCT[c][0]
+        size = struct.calcsize('<' + sfmt)
+        if sfmt in struct_to_numpy and c != 'a':
+            names.append(fmt.columns[i])
+            formats.append(struct_to_numpy[sfmt])
+            field_offsets.append(ofs)
+            mults.append(fmt.msg_mults[i])
+        ofs += size
+    if ofs != body_len:
+        return False
+    dtype = np.dtype({'names': names, 'formats': formats, 'offsets': field_offsets, 'itemsize': body_len})
+
+    raw = np.frombuffer(mlog.data_map, dtype=np.uint8)
+    records = np.empty(len(offsets), dtype=dtype)
+    span = np.arange(body_len, dtype=np.int64)
+    for i in range(0, len(offsets), gather_chunk):
+        ofs = offsets[i:i+gather_chunk]
+        records[i:i+len(ofs)] = raw[ofs[:, None] + span].view(dtype).reshape(-1)
+    del raw
+
+    columns = {}
+    for (name, mult) in zip(names, mults):
+        v = records[name]
+        if mult is not None:
+            # same order of operations as DFMessage for identical results
+            if mult > 0.0 and mult < 1.0:
+                v = v / (1/mult)
+            else:
+                v = v * mult
+        columns[name] = np.ascontiguousarray(v)
+    timestamp = mlog.clock.timebase + columns['TimeUS'] * 0.000001
+    return MessageColumns(mtype, timestamp, columns, fmt.instance_field, offsets - 3)
+
+
+def log_position(mlog):
+    '''return the current read position in a log, or None if unknown'''
+    if hasattr(mlog, 'offset'):
+        return mlog.offset
+    try:
+        return mlog.f.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def extract_scan(mlog, types):
+    '''extract columns for a list of message types by reading the log.
+    Returns a dict of type to MessageColumns (or None if there are no
+    messages of that type). The log is left rewound'''
+    rows = {}
+    fields = {}
+    timestamps = {}
+    instance_fields = {}
+    positions = {}
+    mlog.rewind()
+    while True:
+        m = mlog.recv_match(type=types)
+        if m is None:
+            break
+        mtype = m.get_type()
+        if mtype not in rows:
+            if mtype not in types:
+                continue
+            # only numeric fields are stored
+            fields[mtype] = [f for f in m._fieldnames if isinstance(getattr(m, f, None), (int, float))]
+            rows[mtype] = []
+            timestamps[mtype] = []
+            positions[mtype] = []
+            fmt = getattr(m, 'fmt', None)
+            instance_fields[mtype] = getattr(fmt, 'instance_field', None)
+        rows[mtype].append([getattr(m, f, None) for f in fields[mtype]])
+        timestamps[mtype].append(m._timestamp)
+        positions[mtype].append(log_position(mlog))
+    mlog.rewind()
+
+    ret = {}
+    for mtype in types:
+        if mtype not in rows:
+            ret[mtype] = None
+            continue
+        try:
+            table = np.array(rows[mtype], dtype=np.float64)
+        except (TypeError, ValueError):
+            # a field that is sometimes not a number
+            table = np.array([[v if isinstance(v, (int, float)) else np.nan for v in r] for r in rows[mtype]],
+                             dtype=np.float64)
+        if None in positions[mtype]:
+            position = None
+        else:
+            position = np.array(positions[mtype], dtype=np.int64)
+        columns = {}
+        for i in range(len(fields[mtype])):
+            columns[fields[mtype][i]] = np.ascontiguousarray(table[:, i])
+        ret[mtype] = MessageColumns(mtype, np.array(timestamps[mtype], dtype=np.float64), columns,
+                                    instance_fields[mtype], position)
+    return ret
+
+
+if __name__ == '__main__':
+    import time
+    from argparse import ArgumentParser
+    from pymavlink import mavutil
+
+    parser = ArgumentParser(description='log column cache benchmark')
+    parser.add_argument("--types", default=None, help="comma separated message types, default all")
+    parser.add_argument("--no-cache", action='store_true', help="don't use the sidecar cache")
+    parser.add_argument("log")
+    args = parser.parse_args()
+
+    t0 = time.time()
+    mlog = mavutil.mavlink_connection(args.log)
+    t1 = time.time()
+    print("Opened log in %.2fs" % (t1 - t0))
+    if args.types is not None:
+        types = args.types.split(',')
+    elif hasattr(mlog, 'name_to_id'):
+        types = sorted(mlog.name_to_id.keys())
+    else:
+        types = sorted(mlog.messages.keys())
+
+    cols = LogColumns(args.log, mlog, cache=not args.no_cache)
+    t2 = time.time()
+    cols.prefetch(types)
+    t3 = time.time()
+    print("Columns for %u types in %.2fs" % (len(types), t3 - t2))
+
+    # compare with reading the messages one at a time
+    count = 0
+    mlog.rewind()
+    t4 = time.time()
+    while mlog.recv_match(type=types) is not None:
+        count += 1
+    t5 = time.time()
+    mlog.rewind()
+    print("recv_match over %u messages in %.2fs" % (count, t5 - t4))
+    for mtype in types:
+        c = cols.get(mtype)
+        if c is not None:
+            print("%-16s %8u rows %3u fields" % (mtype, len(c), len(c.columns)))
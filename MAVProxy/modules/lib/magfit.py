@@ -12,9 +12,9 @@ import sys, time, os, math, copy
 from pymavlink import mavutil
 from pymavlink import mavextra
 from pymavlink.rotmat import Vector3
-from pymavlink.rotmat import Matrix3
 from pymavlink.rotmat import rotations
 from MAVProxy.modules.lib import grapher
+from MAVProxy.modules.lib import logcolumns
 from MAVProxy.modules.lib.multiproc_util import MPDataLogChildTask
 
 import matplotlib
@@ -63,66 +63,253 @@ def StringToRotationID(s):
             return i
     return 0
 
-def correct(MAG, BAT, c):
-    '''correct a mag sample, returning a Vector3'''
-    mag = Vector3(MAG.MagX, MAG.MagY, MAG.MagZ)
+def correction_matrix(c):
+    '''return the elliptical correction matrix as a numpy array'''
+    return numpy.array([[c.diag.x,    c.offdiag.x, c.offdiag.y],
+                        [c.offdiag.x, c.diag.y,    c.offdiag.z],
+                        [c.offdiag.y, c.offdiag.z, c.diag.z]])
 
-    # add the given offsets
-    mag += c.offsets
+def vec3(v):
+    '''convert a Vector3 to a numpy array'''
+    return numpy.array([v.x, v.y, v.z])
 
-    # multiply by scale factor
-    mag *= c.scaling
+def correct(mag, curr, c):
+    '''correct mag samples, returning an Nx3 array. mag is an Nx3 array
+    of samples and curr an array of battery currents which is NaN where
+    there is no current'''
+    # add the given offsets and multiply by scale factor
+    mag = (mag + vec3(c.offsets)) * c.scaling
 
     # apply elliptical corrections
-    mat = Matrix3(
-        Vector3(c.diag.x,    c.offdiag.x,  c.offdiag.y),
-        Vector3(c.offdiag.x, c.diag.y,     c.offdiag.z),
-        Vector3(c.offdiag.y, c.offdiag.z,  c.diag.z))
-
-    mag = mat * mag
+    mag = mag.dot(correction_matrix(c).T)
 
     # apply compassmot corrections
-    if BAT is not None and hasattr(BAT, 'Curr') and not math.isnan(BAT.Curr):
-        mag += c.cmot * BAT.Curr
+    if curr is not None:
+        mag = mag + numpy.outer(numpy.nan_to_num(curr, nan=0.0), vec3(c.cmot))
 
     return mag
 
-def get_yaw(ATT,MAG,BAT,c):
+def euler_rows(roll, pitch, yaw):
+    '''rows of the DCM matrix for arrays of Euler angles in degrees, as
+    Matrix3.from_euler()'''
+    r = numpy.radians(roll)
+    p = numpy.radians(pitch)
+    y = numpy.radians(yaw)
+    (cr, sr) = (numpy.cos(r), numpy.sin(r))
+    (cp, sp) = (numpy.cos(p), numpy.sin(p))
+    (cy, sy) = (numpy.cos(y), numpy.sin(y))
+    a = (cp * cy, (sr * sp * cy) - (cr * sy), (cr * sp * cy) + (sr * sy))
+    b = (cp * sy, (sr * sp * sy) + (cr * cy), (cr * sp * sy) - (sr * cy))
+    c = (-sp, sr * cp, cr * cp)
+    return (a, b, c)
+
+def get_yaw(data, mag, c):
     '''calculate heading from raw magnetometer and new offsets'''
-
-    mag = correct(MAG, BAT, c)
+    m = correct(mag, data.curr, c)
 
     # go via a DCM matrix to match the APM calculation
-    dcm_matrix = mavextra.rotation_df(ATT)
-    cos_pitch_sq = 1.0-(dcm_matrix.c.x*dcm_matrix.c.x)
-    headY = mag.y * dcm_matrix.c.z - mag.z * dcm_matrix.c.y
-    headX = mag.x * cos_pitch_sq - dcm_matrix.c.x * (mag.y * dcm_matrix.c.y + mag.z * dcm_matrix.c.z)
-
-    global declination
-    yaw = math.degrees(math.atan2(-headY,headX)) + declination
-    if yaw < 0:
-        yaw += 360
-    return yaw
-
-def expected_field(ATT, yaw):
-    '''return expected magnetic field for attitude'''
-    global earth_field
-
-    roll = ATT.Roll
-    pitch = ATT.Pitch
-
-    rot = Matrix3()
-    rot.from_euler(math.radians(roll), math.radians(pitch), math.radians(yaw))
-
-    field = rot.transposed() * earth_field
+    (cx, cy, cz) = euler_rows(data.roll, data.pitch, 0)[2]
+    cos_pitch_sq = 1.0-(cx*cx)
+    headY = m[:,1] * cz - m[:,2] * cy
+    headX = m[:,0] * cos_pitch_sq - cx * (m[:,1] * cy + m[:,2] * cz)
+
+    yaw = numpy.degrees(numpy.arctan2(-headY,headX)) + declination
+    return numpy.where(yaw < 0, yaw + 360, yaw)
+
+def expected_field(data, yaw):
+    '''return expected magnetic field for attitudes as an Nx3 array'''
+    (a, b, c) = euler_rows(data.roll, data.pitch, yaw)
+    e = earth_field
+    # rot.transposed() * earth_field
+    return numpy.column_stack((a[0] * e.x + b[0] * e.y + c[0] * e.z,
+                               a[1] * e.x + b[1] * e.y + c[1] * e.z,
+                               a[2] * e.x + b[2] * e.y + c[2] * e.z))
+
+def wrap_180(angle):
+    angle = numpy.where(angle > 180, angle - 360, angle)
+    return numpy.where(angle < -180, angle + 360, angle)
+
+class MagData(object):
+    '''mag samples as arrays, with the attitude and battery current at
+    the time of each sample'''
+    def __init__(self, t, mag, ofs, roll, pitch, yaw, curr):
+        self.t = t
+        self.mag = mag
+        self.ofs = ofs
+        self.roll = roll
+        self.pitch = pitch
+        self.yaw = yaw
+        self.curr = curr
+
+    def __len__(self):
+        return len(self.t)
+
+    def select(self, idx):
+        '''return the samples selected by an index or mask array'''
+        return MagData(self.t[idx], self.mag[idx], self.ofs[idx], self.roll[idx],
+                       self.pitch[idx], self.yaw[idx], self.curr[idx])
+
+class MagFitLog(object):
+    '''columns of the messages magfit uses, extracted from the log once
+    and kept so that changing fit options does not rescan the log'''
+    def __init__(self, mlog):
+        self.mlog = mlog
+        self.columns = {}
+        self.parameters = None
+
+    def get(self, mtype):
+        '''return logcolumns.MessageColumns for a message type, or None'''
+        if mtype not in self.columns:
+            cols = logcolumns.extract_dfbinary(self.mlog, mtype)
+            if cols is False:
+                cols = logcolumns.extract_scan(self.mlog, [mtype])[mtype]
+            self.columns[mtype] = cols
+        return self.columns[mtype]
+
+    def get_parameters(self):
+        '''return a dict of parameter values from the log'''
+        if self.parameters is None:
+            self.parameters = {}
+            self.mlog.rewind()
+            while True:
+                msg = self.mlog.recv_match(type=['PARM'])
+                if msg is None:
+                    break
+                self.parameters[msg.Name] = msg.Value
+            self.mlog.rewind()
+        return self.parameters
+
+def first_index(values, test):
+    '''index of the first of the sorted values for which test() is true,
+    given that it is false then true along the values'''
+    (lo, hi) = (0, len(values))
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if test(values[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+def in_range_mask(timestamps, timestamp_in_range):
+    '''mask of timestamps inside the selected time range. The range is
+    one interval, so its ends are found by bisecting the sorted
+    timestamps and the mask is made from them with numpy'''
+    timestamps = numpy.asarray(timestamps)
+    ts = numpy.sort(timestamps)
+    lo = first_index(ts, lambda t: timestamp_in_range(t) >= 0)
+    hi = first_index(ts, lambda t: timestamp_in_range(t) > 0)
+    if lo >= hi:
+        return numpy.zeros(len(timestamps), dtype=bool)
+    return (timestamps >= ts[lo]) & (timestamps <= ts[hi - 1])
+
+def latest(cols, mask, key, keys):
+    '''index of the latest row of cols selected by mask at or before each
+    of keys, or -1 if there is none'''
+    rows = numpy.flatnonzero(mask)
+    idx = numpy.searchsorted(key[rows], keys, side='right') - 1
+    return numpy.where(idx >= 0, rows[numpy.maximum(idx, 0)], -1)
+
+def order_keys(*cols):
+    '''return arrays giving the log order of messages of several types,
+    the position in the log if known, otherwise the timestamp'''
+    if all([c.position is not None for c in cols]):
+        return [c.position for c in cols]
+    return [c.timestamp for c in cols]
+
+def extract_data(log, mag_msg, mag_instance, parameters, timestamp_in_range):
+    '''line up mag samples with attitude and battery messages. Returns a
+    MagData, or None if the log lacks the messages needed'''
+    MAG = log.get(mag_msg)
+    ATT_NAME = margs['Attitude']
+    ATT = log.get(ATT_NAME)
+    if MAG is None or ATT is None:
+        return None
 
-    return field
+    # the attitude at each ATT_NAME message
+    att_mask = in_range_mask(ATT.timestamp, timestamp_in_range)
+    if 'C' in ATT:
+        # use core zero for EKF attitude
+        att_mask &= ATT.field('C') == 0
+    if ATT_NAME == 'XKY0':
+        # get yaw from GSF, and roll/pitch from ATT
+        ATT2 = log.get('ATT')
+        if ATT2 is None:
+            return None
+        (k2, k) = order_keys(ATT2, ATT)
+        idx = latest(ATT2, in_range_mask(ATT2.timestamp, timestamp_in_range), k2, k)
+        att_mask &= idx >= 0
+        idx = numpy.maximum(idx, 0)
+        roll = ATT2.field('Roll')[idx]
+        pitch = ATT2.field('Pitch')[idx]
+        yaw = numpy.degrees(ATT.field('YC'))
+    else:
+        roll = ATT.field('Roll')
+        pitch = ATT.field('Pitch')
+        yaw = ATT.field('Yaw')
+    roll = roll + math.degrees(parameters.get('AHRS_TRIM_X', 0))
+    pitch = pitch + math.degrees(parameters.get('AHRS_TRIM_Y', 0))
+    yaw = yaw + math.degrees(parameters.get('AHRS_TRIM_Z', 0))
+
+    # the attitude at each mag sample
+    mag_mask = in_range_mask(MAG.timestamp, timestamp_in_range)
+    if mag_instance is not None:
+        if 'I' in MAG:
+            mag_mask &= MAG.field('I') == mag_instance
+        elif mag_instance != 0:
+            mag_mask[:] = False
+    (km, ka) = order_keys(MAG, ATT)
+    att_idx = latest(ATT, att_mask, ka, km)
+    mag_mask &= att_idx >= 0
+
+    # the battery current at each mag sample
+    curr = numpy.full(len(MAG), numpy.nan)
+    BAT = log.get('BAT')
+    if BAT is not None and 'Curr' in BAT:
+        bat_mask = in_range_mask(BAT.timestamp, timestamp_in_range)
+        if 'Instance' in BAT:
+            bat_mask &= BAT.field('Instance') == margs['BatteryNum'] - 1
+        (km, kb) = order_keys(MAG, BAT)
+        bat_idx = latest(BAT, bat_mask, kb, km)
+        curr = numpy.where(bat_idx >= 0, BAT.field('Curr')[numpy.maximum(bat_idx, 0)], numpy.nan)
+
+    rows = numpy.flatnonzero(mag_mask)
+    rows = rows[::margs['Reduce']]
+
+    # optional time based decimation, keeping the first sample in each interval
+    interval = margs.get('Interval', 0)
+    if interval > 0 and len(rows) > 0:
+        t = MAG.timestamp[rows]
+        bins = numpy.floor((t - t[0]) / interval)
+        rows = rows[numpy.unique(bins, return_index=True)[1]]
+
+    a = att_idx[rows]
+    mag = numpy.column_stack((MAG.field('MagX')[rows], MAG.field('MagY')[rows], MAG.field('MagZ')[rows]))
+    ofs = numpy.column_stack((MAG.field('OfsX')[rows], MAG.field('OfsY')[rows], MAG.field('OfsZ')[rows]))
+    return MagData(MAG.timestamp[rows], mag.astype(float), ofs.astype(float), roll[a], pitch[a], yaw[a], curr[rows])
+
+def gps_earth_field(log, timestamp_in_range):
+    '''set the earth field from the first GPS fix in range, returning
+    False if there is none'''
+    global earth_field, declination
+    GPS = log.get('GPS')
+    if GPS is None:
+        return False
+    mask = in_range_mask(GPS.timestamp, timestamp_in_range) & (GPS.field('Status') >= 3)
+    fix = numpy.flatnonzero(mask)
+    if len(fix) == 0:
+        return False
+    lat = GPS.field('Lat')[fix[0]]
+    lon = GPS.field('Lng')[fix[0]]
+    earth_field = mavextra.expected_earth_field_lat_lon(lat, lon)
+    (declination,inclination,intensity) = mavextra.get_mag_field_ef(lat, lon)
+    return True
 
 data = None
 old_corrections = Correction()
 
-def wmm_error(p):
-    '''world magnetic model error with correction fit'''
+def params_to_correction(p):
+    '''make a Correction from a list of fit parameters'''
     p = list(p)
     c = copy.copy(old_corrections)
 
@@ -137,20 +324,21 @@ def wmm_error(p):
 
     if margs['CMOT']:
         c.cmot = Vector3(p.pop(0), p.pop(0), p.pop(0))
+    else:
+        c.cmot = Vector3(0.0, 0.0, 0.0)
+    return c
 
-    ret = 0
-
-    for (MAG,ATT,BAT) in data:
-        yaw = get_yaw(ATT,MAG,BAT,c)
-        expected = expected_field(ATT, yaw)
-        observed = correct(MAG,BAT,c)
-
-        error = (expected - observed).length()
-        ret += error
+def wmm_error(p):
+    '''world magnetic model error with correction fit'''
+    c = params_to_correction(p)
+    if not margs['CMOT']:
+        c.cmot = old_corrections.cmot
 
-    ret /= len(data)
+    yaw = get_yaw(data, data.mag, c)
+    expected = expected_field(data, yaw)
+    observed = correct(data.mag, data.curr, c)
 
-    return ret
+    return numpy.mean(numpy.linalg.norm(expected - observed, axis=1))
 
 def fit_WWW():
     from scipy import optimize
@@ -196,57 +384,36 @@ def fit_WWW():
     if imode != 0:
         print("Fit failed: %s" % smode)
         sys.exit(1)
-    p = list(p)
-
-    c.offsets = Vector3(p.pop(0), p.pop(0), p.pop(0))
-    c.scaling = p.pop(0)
+    return params_to_correction(p)
 
-    if margs['Elliptical']:
-        c.diag = Vector3(p.pop(0), p.pop(0), p.pop(0))
-        c.offdiag = Vector3(p.pop(0), p.pop(0), p.pop(0))
-    else:
-        c.diag = Vector3(1.0, 1.0, 1.0)
-        c.offdiag = Vector3(0.0, 0.0, 0.0)
-
-    if margs['CMOT']:
-        c.cmot = Vector3(p.pop(0), p.pop(0), p.pop(0))
-    else:
-        c.cmot = Vector3(0.0, 0.0, 0.0)
-    return c
-
-def remove_offsets(MAG, BAT, c):
-    '''remove all corrections to get raw sensor data'''
-    correction_matrix = Matrix3(Vector3(c.diag.x,    c.offdiag.x, c.offdiag.y),
-                                Vector3(c.offdiag.x, c.diag.y,    c.offdiag.z),
-                                Vector3(c.offdiag.y, c.offdiag.z, c.diag.z))
+def remove_offsets(data, c):
+    '''remove all corrections to get raw sensor data. Returns the new
+    Nx3 mag array and a mask of valid samples, or None'''
     try:
-        correction_matrix = correction_matrix.invert()
-    except Exception:
+        inverse = numpy.linalg.inv(correction_matrix(c))
+    except numpy.linalg.LinAlgError:
         return None
 
-    field = Vector3(MAG.MagX, MAG.MagY, MAG.MagZ)
-    if BAT is not None and hasattr(BAT,'Curr') and not math.isnan(BAT.Curr):
-        field -= c.cmot * BAT.Curr
-    field = correction_matrix * field
+    field = data.mag - numpy.outer(numpy.nan_to_num(data.curr, nan=0.0), vec3(c.cmot))
+    field = field.dot(inverse.T)
     field *= 1.0 / c.scaling
-    field -= Vector3(MAG.OfsX, MAG.OfsY, MAG.OfsZ)
+    field -= data.ofs
 
-    if math.isnan(field.x) or math.isnan(field.y) or math.isnan(field.z):
-        return None
-    MAG.MagX = int(field.x)
-    MAG.MagY = int(field.y)
-    MAG.MagZ = int(field.z)
-    return MAG
+    valid = ~numpy.isnan(field).any(axis=1)
+    return (numpy.trunc(field), valid)
 
-def magfit(mlog, timestamp_in_range):
-    '''find best magnetometer offset fit to a log file'''
+def magfit(mlog, timestamp_in_range, log=None):
+    '''find best magnetometer offset fit to a log file. log is a
+    MagFitLog holding data already extracted from mlog'''
 
     global earth_field, declination
     global data
-    data = []
+    data = None
+    earth_field = None
+    declination = None
 
-    ATT = None
-    BAT = None
+    if log is None:
+        log = MagFitLog(mlog)
 
     mag_msg = margs['Magnetometer']
     global mag_idx
@@ -265,78 +432,28 @@ def magfit(mlog, timestamp_in_range):
         mag_instance = None
         mag_idx = ''
 
-    count = 0
-    parameters = {}
+    t0 = time.time()
 
     # get parameters
-    mlog.rewind()
-    while True:
-        msg = mlog.recv_match(type=['PARM'])
-        if msg is None:
-            break
-        parameters[msg.Name] = msg.Value
-
-    mlog.rewind()
+    parameters = log.get_parameters()
 
     lat = margs['Lattitude']
     lon = margs['Longitude']
     if lat != 0 and lon != 0:
         earth_field = mavextra.expected_earth_field_lat_lon(lat, lon)
         (declination,inclination,intensity) = mavextra.get_mag_field_ef(lat, lon)
-        print("Earth field: %s  strength %.0f declination %.1f degrees" % (earth_field, earth_field.length(), declination))
-
-    ATT_NAME = margs['Attitude']
+    elif not gps_earth_field(log, timestamp_in_range):
+        print("No GPS fix in range, set Lattitude and Longitude")
+        return
+    print("Earth field: %s  strength %.0f declination %.1f degrees" % (earth_field, earth_field.length(), declination))
 
-    mtypes = ['GPS',mag_msg,ATT_NAME,'BAT']
-    if ATT_NAME == "XKY0":
-        mtypes.append('ATT')
-    last_ATT = None
-    print("Attitude source %s mtypes=%s" % (ATT_NAME, mtypes))
+    print("Attitude source %s mag %s" % (margs['Attitude'], mag_msg))
 
     # extract MAG data
-    while True:
-        msg = mlog.recv_match(type=mtypes)
-        if msg is None:
-            break
-        in_range = timestamp_in_range(msg._timestamp)
-        if in_range < 0:
-            continue
-        if in_range > 0:
-            break
-        if msg.get_type() == 'GPS' and msg.Status >= 3 and earth_field is None:
-            earth_field = mavextra.expected_earth_field(msg)
-            (declination,inclination,intensity) = mavextra.get_mag_field_ef(msg.Lat, msg.Lng)
-            print("Earth field: %s  strength %.0f declination %.1f degrees" % (earth_field, earth_field.length(), declination))
-        if msg.get_type() == 'ATT':
-            # needed for XKY0 for yaw
-            last_ATT = msg
-        if msg.get_type() == ATT_NAME:
-            if getattr(msg, 'C', 0) != 0:
-                # use core zero for EKF attitude
-                continue
-            if ATT_NAME == 'XKY0':
-                if last_ATT is None:
-                    continue
-                # get yaw from GSF, and roll/pitch from ATT
-                ATT = last_ATT
-                ATT.Yaw = math.degrees(msg.YC)
-            else:
-                ATT = msg
-            ATT.Roll  += math.degrees(parameters['AHRS_TRIM_X'])
-            ATT.Pitch += math.degrees(parameters['AHRS_TRIM_Y'])
-            ATT.Yaw   += math.degrees(parameters['AHRS_TRIM_Z'])
-        if msg.get_type() == 'BAT':
-            if hasattr(msg,'Instance'):
-                if margs['BatteryNum'] != msg.Instance+1:
-                    continue
-            BAT = msg
-        if msg.get_type() == mag_msg and ATT is not None:
-            if mag_instance is not None:
-                if getattr(msg,'I',0) != mag_instance:
-                    continue
-            if count % margs['Reduce'] == 0:
-                data.append((msg,ATT,BAT))
-            count += 1
+    data = extract_data(log, mag_msg, mag_instance, parameters, timestamp_in_range)
+    if data is None:
+        print("Missing messages for %s and %s" % (mag_msg, margs['Attitude']))
+        return
 
     old_corrections.offsets = Vector3(parameters.get('COMPASS_OFS%s_X' % mag_idx,0.0),
                                       parameters.get('COMPASS_OFS%s_Y' % mag_idx,0.0),
@@ -354,6 +471,8 @@ def magfit(mlog, timestamp_in_range):
         old_corrections.cmot = Vector3(parameters.get('COMPASS_MOT%s_X' % mag_idx,0.0),
                                        parameters.get('COMPASS_MOT%s_Y' % mag_idx,0.0),
                                        parameters.get('COMPASS_MOT%s_Z' % mag_idx,0.0))
+    else:
+        old_corrections.cmot = Vector3(0.0, 0.0, 0.0)
     old_corrections.scaling = parameters.get('COMPASS_SCALE%s' % mag_idx, None)
     if old_corrections.scaling is None or old_corrections.scaling < 0.1:
         force_scale = False
@@ -368,28 +487,25 @@ def magfit(mlog, timestamp_in_range):
         rot = rotations[orig_orient].rt * rotations[new_orient].r
 
     # remove existing corrections
-    data2 = []
-    for (MAG,ATT,BAT) in data:
-        MAG = remove_offsets(MAG, BAT, old_corrections)
-        if MAG is None:
-            continue
+    ret = remove_offsets(data, old_corrections)
+    if ret is None:
+        data = data.select(numpy.zeros(len(data), dtype=bool))
+    else:
+        (data.mag, valid) = ret
         if rot is not None:
-            v = Vector3(MAG.MagX,MAG.MagY,MAG.MagZ)
-            v = rot * v
-            MAG.MagX = v.x
-            MAG.MagY = v.y
-            MAG.MagZ = v.z
-        data2.append((MAG,ATT,BAT))
-    data = data2
-
-    print("Extracted %u points" % len(data))
+            data.mag = data.mag.dot(numpy.array([vec3(rot.a), vec3(rot.b), vec3(rot.c)]).T)
+        data = data.select(valid)
+
+    print("Extracted %u points in %.1fs" % (len(data), time.time() - t0))
     print("Current: %s diag: %s offdiag: %s cmot: %s scale: %.2f" % (
         old_corrections.offsets, old_corrections.diag, old_corrections.offdiag, old_corrections.cmot, old_corrections.scaling))
     if len(data) == 0:
         return
 
     # do fit
+    t0 = time.time()
     c = fit_WWW()
+    print("Fit in %.1fs" % (time.time() - t0))
 
     # normalise diagonals to scale factor
     if force_scale:
@@ -409,62 +525,39 @@ def magfit(mlog, timestamp_in_range):
     print("New: %s diag: %s offdiag: %s cmot: %s scale: %.2f" % (
         c.offsets, c.diag, c.offdiag, c.cmot, c.scaling))
 
-    x = []
-
-    corrected = {}
-    corrected['Yaw'] = []
-    expected1 = {}
-    expected2 = {}
-    uncorrected = {}
-    uncorrected['Yaw'] = []
-    yaw_change1 = []
-    yaw_change2 = []
-    for i in range(len(data)):
-        (MAG,ATT,BAT) = data[i]
-        yaw1 = get_yaw(ATT,MAG,BAT,c)
-        corrected['Yaw'].append(yaw1)
-        ef1 = expected_field(ATT, yaw1)
-        cf = correct(MAG, BAT, c)
-
-        yaw2 = get_yaw(ATT,MAG,BAT,old_corrections)
-        ef2 = expected_field(ATT, yaw2)
-        uncorrected['Yaw'].append(yaw2)
-        uf = correct(MAG, BAT, old_corrections)
-
-        yaw_change1.append(mavextra.wrap_180(yaw1 - yaw2))
-        yaw_change2.append(mavextra.wrap_180(yaw1 - ATT.Yaw))
-        for axis in ['x','y','z']:
-            if not axis in corrected:
-                corrected[axis] = []
-                uncorrected[axis] = []
-                expected1[axis] = []
-                expected2[axis] = []
-            corrected[axis].append(getattr(cf, axis))
-            uncorrected[axis].append(getattr(uf, axis))
-            expected1[axis].append(getattr(ef1, axis))
-            expected2[axis].append(getattr(ef2, axis))
-        x.append(i)
+    x = numpy.arange(len(data))
+
+    yaw1 = get_yaw(data, data.mag, c)
+    expected1 = expected_field(data, yaw1)
+    corrected = correct(data.mag, data.curr, c)
+
+    yaw2 = get_yaw(data, data.mag, old_corrections)
+    expected2 = expected_field(data, yaw2)
+    uncorrected = correct(data.mag, data.curr, old_corrections)
+
+    # show change in yaw estimate from old corrections to new
+    yaw_change1 = wrap_180(yaw1 - yaw2)
+    yaw_change2 = wrap_180(yaw1 - data.yaw)
 
     c.show_parms()
 
     fig, axs = pyplot.subplots(3, 1, sharex=True)
 
-    for axis in ['x','y','z']:
-        axs[0].plot(numpy.array(x), numpy.array(uncorrected[axis]), label='Uncorrected %s' % axis.upper() )
-        axs[0].plot(numpy.array(x), numpy.array(expected2[axis]), label='Expected %s' % axis.upper() )
+    for (i, axis) in enumerate(['x','y','z']):
+        axs[0].plot(x, uncorrected[:,i], label='Uncorrected %s' % axis.upper() )
+        axs[0].plot(x, expected2[:,i], label='Expected %s' % axis.upper() )
         axs[0].legend(loc='upper left')
         axs[0].set_title('Original')
         axs[0].set_ylabel('Field (mGauss)')
 
-        axs[1].plot(numpy.array(x), numpy.array(corrected[axis]), label='Corrected %s' % axis.upper() )
-        axs[1].plot(numpy.array(x), numpy.array(expected1[axis]), label='Expected %s' % axis.upper() )
+        axs[1].plot(x, corrected[:,i], label='Corrected %s' % axis.upper() )
+        axs[1].plot(x, expected1[:,i], label='Expected %s' % axis.upper() )
         axs[1].legend(loc='upper left')
         axs[1].set_title('Corrected')
         axs[1].set_ylabel('Field (mGauss)')
 
-    # show change in yaw estimate from old corrections to new
-    axs[2].plot(numpy.array(x), numpy.array(yaw_change1), label='Mag Yaw Change')
-    axs[2].plot(numpy.array(x), numpy.array(yaw_change2), label='ATT Yaw Change')
+    axs[2].plot(x, yaw_change1, label='Mag Yaw Change')
+    axs[2].plot(x, yaw_change2, label='ATT Yaw Change')
     axs[2].set_title('Yaw Change (degrees)')
     axs[2].legend(loc='upper left')
 
@@ -517,6 +610,8 @@ class MagFitUI(wx.Dialog):
         self.close_event = close_event
         self.mlog = mlog
         self.timestamp_in_range = timestamp_in_range
+        # messages extracted from the log, kept between fits
+        self.log = MagFitLog(mlog)
 
         # events
         self.timer = wx.Timer(self)
@@ -596,6 +691,7 @@ class MagFitUI(wx.Dialog):
 
         self.StartRow()
         self.AddSpinInteger("Reduce", 1, 20, 1)
+        self.AddSpinFloat("Interval", 0, 10, 0.01, 0)
 
         self.StartRow('Offset Estimation')
         self.AddCheckBox("Offsets", default=True)
@@ -744,4 +840,4 @@ class MagFitUI(wx.Dialog):
     def run(self, cid):
         global margs
         margs = self.values
-        magfit(self.mlog,self.timestamp_in_range)
+        magfit(self.mlog,self.timestamp_in_range,self.log)
@@ -971,7 +971,8 @@ on'''
             print("Need ftp module")
             return
         self.ftp_count = None
-        ftp.cmd_get([self.mission_ftp_name()], callback=self.ftp_callback, callback_progress=self.ftp_callback_progress)
+        ftp.queue_get(self.mission_ftp_name(), callback=self.ftp_callback,
+                      callback_progress=self.ftp_callback_progress, label=self.itemstype())
 
     def ftp_callback_progress(self, fh, total_size):
         '''progress callback from ftp fetch of mission items'''
@@ -48,27 +48,58 @@ class ElevationModel():
         if latitude is None or longitude is None:
             return None
         if self.database in ['SRTM1', 'SRTM3']:
-            TileID = (numpy.floor(latitude), numpy.floor(longitude))
-            if TileID in self.tileDict:
-                alt = self.tileDict[TileID].getAltitudeFromLatLon(latitude, longitude)
-            else:
-                tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                if tile == 0:
-                    if timeout > 0:
-                        t0 = time.time()
-                        while time.time() < t0+timeout and tile == 0:
-                            tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                            if tile == 0:
-                                time.sleep(0.1)
+            tile = self.GetTile((numpy.floor(latitude), numpy.floor(longitude)), timeout=timeout)
+            if tile is None:
+                return None
+            return tile.getAltitudeFromLatLon(latitude, longitude)
+        alt = self.GetElevationArray([latitude], [longitude], timeout=timeout)[0]
+        if numpy.isnan(alt):
+            return None
+        return float(alt)
+
+    def GetTile(self, TileID, timeout=0):
+        '''Returns the SRTM tile for a (lat, lon) tile corner, or None if unavailable'''
+        if TileID in self.tileDict:
+            return self.tileDict[TileID]
+        tile = self.downloader.getTile(TileID[0], TileID[1])
+        if tile == 0 and timeout > 0:
+            t0 = time.time()
+            while time.time() < t0+timeout and tile == 0:
+                tile = self.downloader.getTile(TileID[0], TileID[1])
                 if tile == 0:
-                    return None
-                self.tileDict[TileID] = tile
-                alt = tile.getAltitudeFromLatLon(latitude, longitude)
-        elif self.database == 'geoscience':
-             alt = self.mappy.getAltitudeAtPoint(latitude, longitude)
-        else:
+                    time.sleep(0.1)
+        if tile == 0:
             return None
-        return alt
+        self.tileDict[TileID] = tile
+        return tile
+
+    def GetElevationArray(self, latitudes, longitudes, timeout=0):
+        '''Returns an array of altitudes (m ASL) for arrays of lat/long pairs,
+        with NaN where the altitude is unknown'''
+        lats = numpy.asarray(latitudes, dtype=float)
+        lons = numpy.asarray(longitudes, dtype=float)
+        (lats, lons) = numpy.broadcast_arrays(lats, lons)
+        alts = numpy.full(lats.shape, numpy.nan)
+        valid = numpy.isfinite(lats) & numpy.isfinite(lons)
+        if self.database in ['SRTM1', 'SRTM3']:
+            idx = numpy.flatnonzero(valid)
+            tlat = numpy.floor(lats.flat[idx])
+            tlon = numpy.floor(lons.flat[idx])
+            # look up the points in each tile together
+            (corners, inverse) = numpy.unique(numpy.column_stack((tlat, tlon)), axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            for (i, (lat, lon)) in enumerate(corners):
+                tile = self.GetTile((lat, lon), timeout=timeout)
+                if tile is None:
+                    continue
+                sel = idx[inverse == i]
+                alts.flat[sel] = tile.getAltitudeArray(lats.flat[sel], lons.flat[sel])
+        elif self.database == 'geoscience':
+            for i in numpy.flatnonzero(valid):
+                alt = self.mappy.getAltitudeAtPoint(lats.flat[i], lons.flat[i])
+                if alt is not None:
+                    alts.flat[i] = alt
+        return alts
 
 
 if __name__ == "__main__":
@@ -112,5 +143,16 @@ if __name__ == "__main__":
     t1 = time.time()+.000001
     print("Altitude at (%.6f, %.6f) is %u m. Pulled at %.1f FPS" % (lat, lon, alt, 1/(t1-t0)))
 
-
-
+    # compare single point and batch lookups over a grid around the start point
+    n = 100
+    lats = args.lat + numpy.linspace(-0.01, 0.01, n)
+    lons = args.lon + numpy.linspace(-0.01, 0.01, n)
+    (lats, lons) = numpy.meshgrid(lats, lons)
+    t0 = time.time()
+    for (lat, lon) in zip(lats.flat, lons.flat):
+        EleModel.GetElevation(lat, lon)
+    t1 = time.time()
+    alts = EleModel.GetElevationArray(lats, lons)
+    t2 = time.time()
+    print("%u points: %.3fs single, %.4fs batch. Range %.0f to %.0f m" % (
+        n*n, t1-t0, t2-t1, numpy.nanmin(alts), numpy.nanmax(alts)))
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+'''
+event loop for the MAVProxy main loop
+
+This replaces a select() call over a list that is rebuilt on every
+iteration with a selectors based engine (epoll/kqueue where available)
+and a dispatch table keyed by file descriptor. The table is only rebuilt
+when links, outputs or select_extra entries are added or removed, or when
+a connection changes its file descriptor (for example on a serial port
+reconnect or a tcpin accept). Descriptor changes are polled for at
+check_interval rather than on every iteration
+
+Run this file directly for a benchmark comparing the engine against the
+old select() loop as the number of outputs grows
+
+AP_FLAKE8_CLEAN
+'''
+
+import selectors
+import time
+
+
+class TrackedList(list):
+    '''a list that invalidates an EventLoop when modified'''
+    def __init__(self, loop, *args):
+        list.__init__(self, *args)
+        self._loop = loop
+
+    def _changed(self):
+        self._loop.invalidate()
+
+    def append(self, v):
+        list.append(self, v)
+        self._changed()
+
+    def extend(self, v):
+        list.extend(self, v)
+        self._changed()
+
+    def insert(self, i, v):
+        list.insert(self, i, v)
+        self._changed()
+
+    def pop(self, *args):
+        ret = list.pop(self, *args)
+        self._changed()
+        return ret
+
+    def remove(self, v):
+        list.remove(self, v)
+        self._changed()
+
+    def clear(self):
+        list.clear(self)
+        self._changed()
+
+    def __setitem__(self, k, v):
+        list.__setitem__(self, k, v)
+        self._changed()
+
+    def __delitem__(self, k):
+        list.__delitem__(self, k)
+        self._changed()
+
+    def __iadd__(self, v):
+        list.extend(self, v)
+        self._changed()
+        return self
+
+
+class TrackedDict(dict):
+    '''a dict that invalidates an EventLoop when modified'''
+    def __init__(self, loop, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._loop = loop
+
+    def _changed(self):
+        self._loop.invalidate()
+
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, v)
+        self._changed()
+
+    def __delitem__(self, k):
+        dict.__delitem__(self, k)
+        self._changed()
+
+    def pop(self, *args):
+        ret = dict.pop(self, *args)
+        self._changed()
+        return ret
+
+    def popitem(self):
+        ret = dict.popitem(self)
+        self._changed()
+        return ret
+
+    def clear(self):
+        dict.clear(self)
+        self._changed()
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._changed()
+
+    def setdefault(self, k, default=None):
+        ret = dict.setdefault(self, k, default)
+        self._changed()
+        return ret
+
+
+def conn_key(conn):
+    '''return a tuple identifying the current OS level state of a connection.
+    A change in this tuple means the connection needs re-registering'''
+    return (conn.fd, getattr(conn, 'portdead', False), id(getattr(conn, 'port', None)))
+
+
+class EventLoop(object):
+    '''cached fd dispatch table on top of a selectors selector.
+
+    collect is a function returning a list of (conn, handler) tuples
+    for all connections that should be read. A connection is readable
+    when conn.fd is not None and conn.portdead is not set. handler(conn)
+    is called when the connection is readable.
+
+    extra is a dict of fd -> (fn, args) of additional descriptors
+    registered by modules. fn(args) is called when the fd is readable
+    '''
+    def __init__(self, collect, extra=None, check_interval=0.1):
+        self.collect = collect
+        self.check_interval = check_interval
+        self.last_check = 0
+        self.extra = extra if extra is not None else {}
+        self.selector = selectors.DefaultSelector()
+        self.dirty = True
+        self.sources = []
+        self.bindings = {}
+        self.have_sources = False
+        self.rebuild_count = 0
+
+    def invalidate(self):
+        '''mark the dispatch table as needing a rebuild'''
+        self.dirty = True
+
+    def _check_sources(self):
+        '''see if any connection has changed its fd or dead state'''
+        changed = False
+        for src in self.sources:
+            key = conn_key(src[0])
+            if key != src[2]:
+                src[2] = key
+                changed = True
+        return changed
+
+    def _rebuild(self):
+        '''rebuild the selector registrations from the connection lists'''
+        if self.dirty:
+            self.sources = [[conn, handler, conn_key(conn)] for (conn, handler) in self.collect()]
+            self.dirty = False
+        self.rebuild_count += 1
+        wanted = {}
+        for (conn, handler, key) in self.sources:
+            (fd, portdead, port_id) = key
+            if fd is None or portdead:
+                continue
+            wanted[fd] = (handler, conn, key)
+        self.have_sources = len(wanted) > 0
+        for fd in self.extra:
+            if fd not in wanted:
+                (fn, args) = self.extra[fd]
+                wanted[fd] = (fn, args, None)
+        for fd in list(self.bindings.keys()):
+            if self.bindings[fd] != wanted.get(fd, None):
+                self._unregister(fd)
+        for fd in wanted:
+            if fd in self.bindings:
+                continue
+            try:
+                self.selector.register(fd, selectors.EVENT_READ, wanted[fd])
+            except (OSError, ValueError, KeyError):
+                continue
+            self.bindings[fd] = wanted[fd]
+
+    def _unregister(self, fd):
+        self.bindings.pop(fd, None)
+        try:
+            self.selector.unregister(fd)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def reset(self):
+        '''discard the selector and all registrations'''
+        try:
+            self.selector.close()
+        except Exception:
+            pass
+        self.selector = selectors.DefaultSelector()
+        self.bindings = {}
+        self.dirty = True
+
+    def poll(self, timeout):
+        '''wait for up to timeout seconds for readable descriptors. Returns a
+        list of (fd, fn, arg, is_extra) tuples for the caller to dispatch, or
+        None if there are no link or output descriptors to wait on'''
+        if self.dirty:
+            self._rebuild()
+        else:
+            now = time.monotonic()
+            if now - self.last_check >= self.check_interval:
+                self.last_check = now
+                if self._check_sources():
+                    self._rebuild()
+        if not self.have_sources:
+            return None
+        try:
+            events = self.selector.select(timeout)
+        except (OSError, ValueError):
+            # a descriptor was closed underneath us, start again
+            self.reset()
+            return []
+        ret = []
+        for (key, mask) in events:
+            (fn, arg, conn_state) = key.data
+            ret.append((key.fileobj, fn, arg, conn_state is None))
+        return ret
+
+    def close(self):
+        self.selector.close()
+
+
+if __name__ == '__main__':
+    # benchmark the engine against the old select() loop, with N UDP
+    # outputs, one master and a packet arriving on a random output
+    # each iteration
+    import random
+    import select
+    import socket
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='mp_eventloop benchmark')
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--outputs", default="1,5,10,20,50,100")
+    args = parser.parse_args()
+
+    class FakeConn(object):
+        def __init__(self):
+            self.port = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.port.bind(('127.0.0.1', 0))
+            self.port.setblocking(False)
+            self.addr = self.port.getsockname()
+            self.fd = self.port.fileno()
+            self.portdead = False
+            self.latency = 0.0
+            self.count = 0
+
+        def recv(self):
+            buf = self.port.recv(1024)
+            self.latency += time.perf_counter() - float(buf.decode())
+            self.count += 1
+
+        def close(self):
+            self.port.close()
+
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def legacy_loop(masters, outputs, sysid_outputs, extra, count):
+        '''the select() loop as it was in mavproxy.main_loop'''
+        for i in range(count):
+            target = random.choice(outputs)
+            sender.sendto(str(time.perf_counter()).encode(), target.addr)
+            rin = []
+            for master in masters:
+                if master.fd is not None and not master.portdead:
+                    rin.append(master.fd)
+            for m in outputs:
+                rin.append(m.fd)
+            for sysid in sysid_outputs:
+                rin.append(sysid_outputs[sysid].fd)
+            for fd in extra:
+                rin.append(fd)
+            (rin, win, xin) = select.select(rin, [], [], 0.01)
+            for fd in rin:
+                for master in masters:
+                    if fd == master.fd:
+                        master.recv()
+                        continue
+                for m in outputs:
+                    if fd == m.fd:
+                        m.recv()
+                        continue
+                for sysid in sysid_outputs:
+                    m = sysid_outputs[sysid]
+                    if fd == m.fd:
+                        m.recv()
+                        continue
+
+    def engine_loop(masters, outputs, sysid_outputs, extra, count):
+        '''the same loop driven by EventLoop'''
+        def collect():
+            ret = [(m, FakeConn.recv) for m in masters]
+            ret.extend([(m, FakeConn.recv) for m in outputs])
+            ret.extend([(m, FakeConn.recv) for m in sysid_outputs.values()])
+            return ret
+        loop = EventLoop(collect, extra)
+        for i in range(count):
+            target = random.choice(outputs)
+            sender.sendto(str(time.perf_counter()).encode(), target.addr)
+            for (fd, fn, arg, is_extra) in loop.poll(0.01):
+                fn(arg)
+        loop.close()
+
+    print("%8s %10s %14s %14s" % ("outputs", "engine", "iterations/s", "latency(us)"))
+    for n in [int(x) for x in args.outputs.split(',')]:
+        masters = [FakeConn()]
+        outputs = [FakeConn() for i in range(n)]
+        for (name, fn) in [("select", legacy_loop), ("selectors", engine_loop)]:
+            for c in outputs:
+                c.latency = 0.0
+                c.count = 0
+            t0 = time.perf_counter()
+            fn(masters, outputs, {}, {}, args.iterations)
+            dt = time.perf_counter() - t0
+            latency = sum([c.latency for c in outputs])
+            count = sum([c.count for c in outputs])
+            print("%8u %10s %14.0f %14.1f" % (n, name, args.iterations / dt, 1.0e6 * latency / max(count, 1)))
+        for c in masters + outputs:
+            c.close()
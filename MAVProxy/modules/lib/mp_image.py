@@ -20,6 +20,7 @@ from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_widgets
 from MAVProxy.modules.lib import win_layout
 from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib import frame_ring
 from MAVProxy.modules.lib.mp_menu import *
 
 
@@ -30,7 +31,18 @@ class MPImageData:
             img = np.asarray(img[:,:])
         self.width = img.shape[1]
         self.height = img.shape[0]
-        self.data = img.tostring()
+        self.data = img.tobytes()
+
+class MPImageShared:
+    '''image data in a slot of a shared memory FrameRing'''
+    def __init__(self, ring, slot, seq, shape, timestamp):
+        self.ring_name = ring.name
+        self.slot_size = ring.slot_size
+        self.nslots = ring.nslots
+        self.slot = slot
+        self.seq = seq
+        self.shape = shape
+        self.timestamp = timestamp
 
 class MPImageTitle:
     '''window title to use'''
@@ -220,6 +232,12 @@ class MPImage():
         self.in_queue = multiproc.Queue()
         self.out_queue = multiproc.Queue()
 
+        # frames from set_image() go through shared memory when it is
+        # available, with counters shared with the child
+        self.frame_ring = None
+        self.old_frame_rings = []
+        self.frame_stats = frame_ring.FrameStats() if frame_ring.available() else None
+
         self.default_menu = MPMenuSubMenu('View',
                                           items=[MPMenuItem('Fit Window', 'Fit Window', 'fitWindow'),
                                                  MPMenuItem('Full Zoom',  'Full Zoom', 'fullSize')])
@@ -250,10 +268,37 @@ class MPImage():
             return
         if not hasattr(img, 'shape'):
             img = np.asarray(img[:,:])
+        if self.frame_stats is not None and img.dtype == np.uint8 and img.ndim == 3 and img.shape[2] == 3:
+            self.in_queue.put(self.share_image(img, bgr))
+            return
         if bgr:
             img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         self.in_queue.put(MPImageData(img))
 
+    def share_image(self, img, bgr):
+        '''put an image in the frame ring, returning the message for the child'''
+        now = time.time()
+        if self.frame_ring is None or img.nbytes > self.frame_ring.slot_size:
+            # the child may still be reading the old ring, so it is
+            # kept until the one after is made
+            for ring in self.old_frame_rings:
+                ring.close()
+            if self.frame_ring is not None:
+                self.old_frame_rings = [self.frame_ring]
+            self.frame_ring = frame_ring.FrameRing(img.nbytes)
+        convert = None
+        if bgr:
+            convert = lambda src, dst: cv2.cvtColor(src, cv2.COLOR_BGR2RGB, dst=dst)
+        (slot, seq) = self.frame_ring.write(np.ascontiguousarray(img), convert)
+        self.frame_stats.add_frame()
+        return MPImageShared(self.frame_ring, slot, seq, img.shape, now)
+
+    def get_frame_stats(self):
+        '''frame counters and latency for images from set_image(), or None'''
+        if self.frame_stats is None:
+            return None
+        return self.frame_stats.get()
+
     def set_fps_max(self, fps_max):
         '''set the maximum frame rate'''
         self.in_queue.put(MPImageFPSMax(fps_max))
@@ -358,6 +403,14 @@ class MPImage():
         '''terminate child process'''
         self.child.terminate()
         self.child.join()
+        for ring in self.old_frame_rings + [self.frame_ring]:
+            if ring is not None:
+                ring.close()
+        self.frame_ring = None
+        self.old_frame_rings = []
+        if self.frame_stats is not None:
+            self.frame_stats.close()
+            self.frame_stats = None
 
     def center(self, location):
         self.in_queue.put(MPImageRecenter(location))
@@ -418,6 +471,13 @@ class MPImagePanel(wx.Panel):
         self.seek_percentage = None
         self.seek_frame = None
         self.osd_elements = None
+        # the newest frame not yet shown, from set_image() or the video
+        # thread, with the time it was sent and a count of video frames
+        self.frame_rings = {}
+        self.latest_shared = None
+        self.video_frame = None
+        self.video_seq = 0
+        self.video_seq_shown = 0
         state.brightness = 1.0
 
         # dragpos is the top left position in image coordinates
@@ -586,6 +646,11 @@ class MPImagePanel(wx.Panel):
                 self.handle_osd(obj)
             if isinstance(obj, MPImageData):
                 self.set_image_data(obj.data, obj.width, obj.height)
+            if isinstance(obj, MPImageShared):
+                # only the newest frame is worth showing
+                if self.latest_shared is not None and state.frame_stats is not None:
+                    state.frame_stats.add_dropped()
+                self.latest_shared = obj
             if isinstance(obj, MPImageTitle):
                 state.frame.SetTitle(obj.title)
             if isinstance(obj, MPImageRecenter):
@@ -623,8 +688,49 @@ class MPImagePanel(wx.Panel):
             if isinstance(obj, MPImageEndTracker):
                 self.tracker = None
 
+        sent_time = self.show_latest_frame()
+
         if self.need_redraw:
             self.redraw()
+        if sent_time is not None and state.frame_stats is not None:
+            state.frame_stats.add_displayed(time.time() - sent_time)
+
+    def show_latest_frame(self):
+        '''show the newest shared memory or video frame, returning the
+        time it was sent or None'''
+        state = self.state
+        sent_time = None
+        if self.latest_shared is not None:
+            obj = self.latest_shared
+            self.latest_shared = None
+            ring = self.frame_rings.get(obj.ring_name, None)
+            if ring is None:
+                # the producer has made a new ring, so the old ones are done with
+                for old in self.frame_rings.values():
+                    old.close()
+                self.frame_rings = {}
+                try:
+                    ring = frame_ring.FrameRing(obj.slot_size, obj.nslots, name=obj.ring_name)
+                    self.frame_rings[obj.ring_name] = ring
+                except Exception:
+                    # replaced and removed before we got to it
+                    pass
+            data = ring.read(obj.slot, obj.seq, obj.shape) if ring is not None else None
+            if data is not None:
+                self.set_image_data(data, obj.shape[1], obj.shape[0])
+                sent_time = obj.timestamp
+            elif state.frame_stats is not None:
+                state.frame_stats.add_torn()
+        video_frame = self.video_frame
+        if video_frame is not None:
+            self.video_frame = None
+            (frame, width, height, seq, frame_time) = video_frame
+            if state.frame_stats is not None and seq > self.video_seq_shown + 1:
+                state.frame_stats.add_dropped(seq - self.video_seq_shown - 1)
+            self.video_seq_shown = seq
+            self.set_image_data(frame, width, height)
+            sent_time = frame_time
+        return sent_time
 
     def start_tracker(self, obj):
         '''start a tracker on an object identified by a box'''
@@ -691,6 +797,7 @@ class MPImagePanel(wx.Panel):
             if frame_count % 5 == 0:
                 self.state.out_queue.put(MPImageFrameCounter(frame_count))
 
+            frame_time = time.time()
             frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
             (width, height) = (frame.shape[1], frame.shape[0])
             if self.tracker:
@@ -711,7 +818,12 @@ class MPImagePanel(wx.Panel):
                         self.state.out_queue.put(MPImageTrackPos(int((startX+endX)/2),
                                                                  int((startY+endY)/2),
                                                                 frame.shape))
-            self.set_image_data(frame, width, height)
+            # shown by the redraw timer, so frames the display can't
+            # keep up with are skipped rather than each converted
+            self.video_seq += 1
+            if self.state.frame_stats is not None:
+                self.state.frame_stats.add_frame()
+            self.video_frame = (frame, width, height, self.video_seq, frame_time)
             if self.fps_max is not None:
                 while self.fps_max <= 0:
                     time.sleep(0.1)
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+'''
+link I/O worker processes
+
+A mavworker is a stand in for a mavutil connection where the real
+connection is owned by a child process. The child reads the port and
+parses MAVLink frames as fast as they arrive, so a slow main thread no
+longer causes serial or UDP buffers to overflow. Raw data and the
+validated frames are handed to MAVProxy through a shared memory ring
+buffer, with a pipe used only to wake up the main loop. The frames are
+decoded in the main process so signing and callbacks work as for a
+normal link.
+
+Workers are not available on Windows, where the pipe used to wake the
+main loop can't be waited on with select.
+
+Run this file directly with a tlog to replay it over UDP at 10x real
+time while the main thread stalls, comparing message loss with and
+without a worker
+
+AP_FLAKE8_CLEAN
+'''
+
+import collections
+import os
+import select
+import signal
+import struct
+import time
+
+from pymavlink import mavutil
+from MAVProxy.modules.lib import multiproc
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# each ring record is a length prefix then a record header of raw
+# byte count, frame count and count of bytes dropped by the worker
+record_len = struct.Struct('<I')
+record_header = struct.Struct('<III')
+# a frame table entry is length and kind
+frame_entry = struct.Struct('<HB')
+FRAME_MSG = 0
+FRAME_BAD_DATA = 1
+RING_WRAP = 0xFFFFFFFF
+
+
+def available():
+    '''True if link workers can be used. The main loop waits on the
+    wakeup pipe with select, which on Windows only works with sockets,
+    so there a worker link would never be read'''
+    return shared_memory is not None and os.name != 'nt'
+
+
+class ShmRing(object):
+    '''single producer, single consumer ring buffer of variable length
+    records in shared memory. The head and tail counters each have a
+    single writer so no locking is needed'''
+    counters = struct.Struct('<QQ')
+
+    def __init__(self, size=4*1024*1024, name=None):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size + self.counters.size)
+            self.counters.pack_into(self.shm.buf, 0, 0, 0)
+            self.owner = True
+        else:
+            # the resource tracker is shared with the parent, so
+            # attaching here does not cause an unlink when we exit
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+        self.size = size
+        self.data = self.shm.buf[self.counters.size:self.counters.size+size]
+
+    def _get(self):
+        return self.counters.unpack_from(self.shm.buf, 0)
+
+    def free(self):
+        (head, tail) = self._get()
+        return self.size - (head - tail)
+
+    def used(self):
+        (head, tail) = self._get()
+        return head - tail
+
+    def write(self, parts):
+        '''write a record made of a list of buffers, returning False if
+        there is no room'''
+        total = record_len.size + sum([len(p) for p in parts])
+        (head, tail) = self._get()
+        pos = head % self.size
+        skip = 0
+        if pos + total > self.size:
+            # no room at the end, wrap to the start
+            skip = self.size - pos
+        if total + skip > self.size - (head - tail):
+            return False
+        if skip > 0:
+            if skip >= record_len.size:
+                record_len.pack_into(self.data, pos, RING_WRAP)
+            pos = 0
+        record_len.pack_into(self.data, pos, total)
+        pos += record_len.size
+        for p in parts:
+            n = len(p)
+            self.data[pos:pos+n] = p
+            pos += n
+        struct.pack_into('<Q', self.shm.buf, 0, head + skip + total)
+        return True
+
+    def read(self):
+        '''return a list of all available records, as bytes'''
+        (head, tail) = self._get()
+        ret = []
+        while tail < head:
+            pos = tail % self.size
+            if self.size - pos < record_len.size:
+                tail += self.size - pos
+                continue
+            (n,) = record_len.unpack_from(self.data, pos)
+            if n == RING_WRAP:
+                tail += self.size - pos
+                continue
+            ret.append(bytes(self.data[pos+record_len.size:pos+n]))
+            tail += n
+        struct.pack_into('<Q', self.shm.buf, 8, tail)
+        return ret
+
+    def close(self):
+        self.data.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def make_record(raw, msgs, dropped):
+    '''make the list of buffers for a ring record'''
+    table = []
+    frames = []
+    for m in msgs:
+        if m.get_type() == 'BAD_DATA':
+            reason = getattr(m, 'reason', '')
+            buf = reason.encode('utf-8', 'replace') + b'\0' + bytes(m.data)
+            kind = FRAME_BAD_DATA
+        else:
+            buf = m.get_msgbuf()
+            kind = FRAME_MSG
+        table.append(frame_entry.pack(len(buf), kind))
+        frames.append(buf)
+    return [record_header.pack(len(raw), len(frames), dropped), raw] + table + frames
+
+
+def parse_record(rec):
+    '''parse a ring record into (raw, frames, dropped), where frames is a
+    list of (kind, buffer)'''
+    (raw_len, nframes, dropped) = record_header.unpack_from(rec, 0)
+    ofs = record_header.size
+    raw = rec[ofs:ofs+raw_len]
+    ofs += raw_len
+    lengths = []
+    for i in range(nframes):
+        lengths.append(frame_entry.unpack_from(rec, ofs))
+        ofs += frame_entry.size
+    frames = []
+    for (n, kind) in lengths:
+        frames.append((kind, rec[ofs:ofs+n]))
+        ofs += n
+    return (raw, frames, dropped)
+
+
+def worker_main(device, kwargs, dialect, mavlink20, shm_name, shm_size, notify, cmds, max_pending):
+    '''main function of the worker process'''
+    # don't inherit the MAVProxy signal handlers. We exit when the main
+    # process closes the command pipe
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if mavlink20:
+        os.environ['MAVLINK20'] = '1'
+    mavutil.set_dialect(dialect)
+    ring = ShmRing(size=shm_size, name=shm_name)
+    try:
+        conn = mavutil.mavlink_connection(device, **kwargs)
+    except Exception as ex:
+        print("link worker: failed to open %s: %s" % (device, ex))
+        return
+    pending = collections.deque()
+    pending_bytes = 0
+    dropped = 0
+    while True:
+        # handle writes and calls from the main process
+        try:
+            while cmds.poll():
+                cmd = cmds.recv_bytes()
+                if cmd[:1] == b'w':
+                    conn.write(cmd[1:])
+                elif cmd[:1] == b'c':
+                    import pickle
+                    (name, args) = pickle.loads(cmd[1:])
+                    getattr(conn, name)(*args)
+                elif cmd[:1] == b'q':
+                    conn.close()
+                    ring.close()
+                    return
+        except (EOFError, OSError):
+            # main process has gone away
+            return
+
+        timeout = 0.001 if len(pending) > 0 else 0.1
+        if conn.fd is None:
+            cmds.poll(min(timeout, 0.01))
+        else:
+            try:
+                select.select([conn.fd, cmds.fileno()], [], [], timeout)
+            except (OSError, ValueError):
+                time.sleep(0.1)
+
+        try:
+            s = conn.recv(16*1024)
+        except Exception:
+            time.sleep(0.1)
+            s = b''
+        if len(s) > 0:
+            if conn.first_byte:
+                conn.auto_mavlink_version(s)
+            msgs = conn.mav.parse_buffer(s)
+            if msgs is None:
+                msgs = []
+            rec = make_record(s, msgs, 0)
+            n = sum([len(p) for p in rec])
+            if pending_bytes + n > max_pending:
+                dropped += len(s)
+            else:
+                pending.append(rec)
+                pending_bytes += n
+
+        # pass as much as we can to the main process
+        sent = False
+        while len(pending) > 0:
+            rec = pending[0]
+            if dropped > 0:
+                rec[0] = record_header.pack(len(rec[1]), (len(rec) - 2) // 2, dropped)
+            if not ring.write(rec):
+                break
+            dropped = 0
+            pending.popleft()
+            pending_bytes -= sum([len(p) for p in rec])
+            sent = True
+        if sent:
+            try:
+                # the wakeup pipe is used as a raw byte pipe, which lets
+                # the main process drain it with a single read
+                os.write(notify.fileno(), b'x')
+            except (EOFError, OSError):
+                return
+
+
+class mavworker(mavutil.mavfile):
+    '''a MAVLink connection whose I/O is done in a worker process'''
+    def __init__(self, device, source_system=255, source_component=0, ring_size=4*1024*1024,
+                 max_pending=64*1024*1024, **kwargs):
+        if not available():
+            raise RuntimeError("link workers are not supported on this platform")
+        self.ring = ShmRing(size=ring_size)
+        (self.notify, notify_child) = multiproc.Pipe(duplex=False)
+        (cmds_child, self.cmds) = multiproc.Pipe(duplex=False)
+        kwargs['source_system'] = source_system
+        kwargs['source_component'] = source_component
+        self.child = multiproc.Process(target=worker_main,
+                                       args=(device, kwargs, mavutil.current_dialect,
+                                             'MAVLINK20' in os.environ, self.ring.name, ring_size,
+                                             notify_child, cmds_child, max_pending),
+                                       name='link worker %s' % device)
+        self.child.daemon = True
+        self.child.start()
+        notify_child.close()
+        cmds_child.close()
+        mavutil.mavfile.__init__(self, self.notify.fileno(), device,
+                                 source_system=source_system, source_component=source_component)
+        self.port = None
+        os.set_blocking(self.notify.fileno(), False)
+        # statistics
+        self.worker_bytes = 0
+        self.worker_frames = 0
+        self.worker_dropped = 0
+        self.ring_highwater = 0
+
+    def recv(self, n=None):
+        '''data is read with recv_batches()'''
+        return b''
+
+    def write(self, buf):
+        try:
+            self.cmds.send_bytes(b'w' + bytes(buf))
+        except (EOFError, OSError):
+            self.portdead = True
+
+    def call(self, name, *args):
+        '''call a method on the connection in the worker'''
+        import pickle
+        try:
+            self.cmds.send_bytes(b'c' + pickle.dumps((name, args)))
+        except (EOFError, OSError):
+            self.portdead = True
+
+    def set_rtscts(self, enable):
+        self.call('set_rtscts', enable)
+
+    def set_baudrate(self, baudrate):
+        self.call('set_baudrate', baudrate)
+
+    def recv_batches(self):
+        '''return a list of (raw, frames) from the worker, where frames is
+        a list of (kind, buffer)'''
+        try:
+            if len(os.read(self.notify.fileno(), 65536)) == 0:
+                # worker has exited
+                self.portdead = True
+        except BlockingIOError:
+            pass
+        except (EOFError, OSError):
+            self.portdead = True
+        self.ring_highwater = max(self.ring_highwater, self.ring.used())
+        ret = []
+        for rec in self.ring.read():
+            (raw, frames, dropped) = parse_record(rec)
+            self.worker_bytes += len(raw)
+            self.worker_frames += len(frames)
+            self.worker_dropped += dropped
+            ret.append((raw, frames))
+        return ret
+
+    def decode_frames(self, frames):
+        '''decode frames from the worker into MAVLink messages, calling
+        the message callback as parse_buffer() would'''
+        mav = self.mav
+        ret = []
+        for (kind, buf) in frames:
+            if kind == FRAME_BAD_DATA:
+                (reason, data) = buf.split(b'\0', 1)
+                m = mavutil.mavlink.MAVLink_bad_data(bytearray(data), reason.decode('utf-8', 'replace'))
+                mav.total_receive_errors += 1
+            else:
+                try:
+                    m = mav.decode(bytearray(buf))
+                except mavutil.mavlink.MAVError as ex:
+                    m = mavutil.mavlink.MAVLink_bad_data(bytearray(buf), ex.message)
+                    mav.total_receive_errors += 1
+                else:
+                    mav.total_packets_received += 1
+            if mav.callback is not None:
+                mav.callback(m, *mav.callback_args, **mav.callback_kwargs)
+            ret.append(m)
+        return ret
+
+    def child_fds(self):
+        '''file descriptors to close in forked child processes: the
+        pipes to the worker and the shared memory'''
+        ret = [self.notify.fileno(), self.cmds.fileno()]
+        shm_fd = getattr(self.ring.shm, '_fd', -1)
+        if shm_fd >= 0:
+            ret.append(shm_fd)
+        return ret
+
+    def stats(self):
+        '''return a string describing the worker statistics'''
+        return "worker: %u bytes %u frames %u dropped ring highwater %u/%u" % (
+            self.worker_bytes, self.worker_frames, self.worker_dropped, self.ring_highwater, self.ring.size)
+
+    def close(self):
+        try:
+            self.cmds.send_bytes(b'q')
+        except (EOFError, OSError):
+            pass
+        self.child.join(timeout=2)
+        if self.child.is_alive():
+            self.child.terminate()
+        self.notify.close()
+        self.cmds.close()
+        self.ring.close()
+
+
+def replay_main(filename, port, speedup):
+    '''replay a tlog over UDP at speedup times real time'''
+    mlog = mavutil.mavlink_connection(filename)
+    sock = mavutil.mavudp('127.0.0.1:%u' % port, input=False)
+    first_log = None
+    first_real = time.time()
+    count = 0
+    while True:
+        m = mlog.recv_msg()
+        if m is None:
+            break
+        if m.get_type() == 'BAD_DATA':
+            continue
+        t = m._timestamp
+        if first_log is None:
+            first_log = t
+        delay = first_real + (t - first_log) / speedup - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        sock.write(m.get_msgbuf())
+        count += 1
+    print("replay sent %u messages in %.1fs" % (count, time.time() - first_real))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='link worker stress benchmark')
+    parser.add_argument("log", help="tlog to replay")
+    parser.add_argument("--speedup", type=float, default=10.0)
+    parser.add_argument("--port", type=int, default=14599)
+    parser.add_argument("--stall-ms", type=float, default=200, help="time the main thread stalls for")
+    parser.add_argument("--stall-interval", type=float, default=1.0, help="seconds between stalls")
+    parser.add_argument("--no-worker", action='store_true', help="read the link in the main process")
+    args = parser.parse_args()
+
+    device = 'udpin:127.0.0.1:%u' % args.port
+    if args.no_worker:
+        conn = mavutil.mavlink_connection(device)
+    else:
+        conn = mavworker(device)
+        time.sleep(0.5)
+    sender = multiproc.Process(target=replay_main, args=(args.log, args.port, args.speedup))
+    sender.start()
+
+    count = 0
+    t0 = time.time()
+    last_stall = t0
+    parse_time = 0
+    while sender.is_alive() or time.time() - t0 < 1:
+        rin = select.select([conn.fd], [], [], 0.1)[0]
+        if len(rin) == 0:
+            if not sender.is_alive():
+                break
+            continue
+        p0 = time.time()
+        if args.no_worker:
+            msgs = conn.mav.parse_buffer(conn.recv(16*1024))
+            count += len(msgs) if msgs else 0
+        else:
+            for (raw, frames) in conn.recv_batches():
+                count += len(conn.decode_frames(frames))
+        parse_time += time.time() - p0
+        if time.time() - last_stall >= args.stall_interval:
+            # simulate a module holding up the main loop
+            time.sleep(args.stall_ms * 0.001)
+            last_stall = time.time()
+    sender.join()
+    dt = time.time() - t0
+    print("received %u messages in %.1fs (%.0f msgs/s), main thread parse/decode %.2fs" % (
+        count, dt, count / dt, parse_time))
+    if not args.no_worker:
+        print(conn.stats())
+        conn.close()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+'''
+batched telemetry log writer
+
+Log data is queued as a list of buffers by the main thread without
+copying and written by a background thread in large batches with a
+single writev() call. Optionally the log can be compressed as it is
+written with gzip, zstd or lz4. Compressed logs are a sequence of
+independent frames, so appending to an existing log works.
+
+mavlink_connection() in this module is a drop in replacement for
+mavutil.mavlink_connection() that can open compressed logs. It
+decompresses the whole log to a temporary file first, as the dataflash
+reader maps the log into memory and seeks in it
+
+AP_FLAKE8_CLEAN
+'''
+
+import atexit
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+# timestamp prefix on each message in a .tlog
+tlog_header = struct.Struct('>Q')
+
+# max buffers in one writev() call, IOV_MAX is 1024 on Linux
+max_iov = 1024
+
+
+class GzipCompressor(object):
+    '''streaming gzip compression'''
+    extension = '.gz'
+
+    def __init__(self, level=6):
+        self.level = level
+        self.obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        '''make all data so far decodable'''
+        return self.obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        ret = self.obj.flush(zlib.Z_FINISH)
+        self.obj = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return ret
+
+
+class ZstdCompressor(object):
+    '''streaming zstd compression, needs the zstandard package'''
+    extension = '.zst'
+
+    def __init__(self, level=3):
+        import zstandard
+        self.zstd = zstandard
+        self.obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush(self.zstd.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.obj.flush(self.zstd.COMPRESSOBJ_FLUSH_FINISH)
+
+
+class LZ4Compressor(object):
+    '''streaming lz4 frame compression, needs the lz4 package'''
+    extension = '.lz4'
+
+    def __init__(self, level=0):
+        import lz4.frame
+        self.level = level
+        self.lz4 = lz4.frame
+        self.obj = None
+
+    def compress(self, data):
+        ret = b''
+        if self.obj is None:
+            self.obj = self.lz4.LZ4FrameCompressor(compression_level=self.level)
+            ret = self.obj.begin()
+        return ret + self.obj.compress(data)
+
+    def flush(self):
+        # lz4 frames can't be flushed part way, so end the frame and
+        # start a new one on the next write
+        return self.finish()
+
+    def finish(self):
+        if self.obj is None:
+            return b''
+        ret = self.obj.flush()
+        self.obj = None
+        return ret
+
+
+compressors = {
+    'gzip': GzipCompressor,
+    'zstd': ZstdCompressor,
+    'lz4': LZ4Compressor,
+}
+
+
+def compressor(name):
+    '''return a compressor object given a name, or None for no compression'''
+    if name is None or name in ['', 'none']:
+        return None
+    if name not in compressors:
+        raise ValueError("Unknown log compression %s, must be one of %s" % (name, ','.join(compressors.keys())))
+    return compressors[name]()
+
+
+class LogWriter(object):
+    '''a batched log file writer.
+
+    Data is queued with put() or log_message() and written by a
+    background thread once batch_bytes is pending, or every
+    flush_interval seconds. If flush_now is given and returns True the
+    writer flushes on every wakeup, for the flushlogs setting
+    '''
+    def __init__(self, compression=None, batch_bytes=64*1024, flush_interval=1.0, flush_now=None):
+        self.compressor = compressor(compression)
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.flush_now = flush_now
+        self.cond = threading.Condition()
+        self.pending = []
+        self.pending_bytes = 0
+        self.fd = None
+        self.filename = None
+        self.thread = None
+        self.closing = False
+        self.last_sync = time.time()
+        self.sync_interval = 10.0
+        # statistics
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.write_calls = 0
+
+    def open(self, filename, mode='wb'):
+        '''open the log file and start the writer thread. The compression
+        extension is added to filename. Returns the filename used'''
+        if self.compressor is not None:
+            filename += self.compressor.extension
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        if mode.startswith('a'):
+            flags |= os.O_APPEND
+        else:
+            flags |= os.O_TRUNC
+        self.fd = os.open(filename, flags, 0o644)
+        self.filename = filename
+        self.thread = threading.Thread(target=self.writer_thread, name='log_writer')
+        self.thread.daemon = True
+        self.thread.start()
+        return filename
+
+    def put(self, buf):
+        '''queue a buffer for writing. The buffer must not be modified
+        after it is queued'''
+        n = len(buf)
+        with self.cond:
+            self.pending.append(buf)
+            self.pending_bytes += n
+            if self.pending_bytes >= self.batch_bytes and self.pending_bytes - n < self.batch_bytes:
+                self.cond.notify()
+
+    def log_message(self, usec, msgbuf):
+        '''queue a tlog entry with a timestamp in microseconds'''
+        hdr = tlog_header.pack(usec)
+        n = len(msgbuf) + 8
+        with self.cond:
+            self.pending.append(hdr)
+            self.pending.append(msgbuf)
+            self.pending_bytes += n
+            if self.pending_bytes >= self.batch_bytes and self.pending_bytes - n < self.batch_bytes:
+                self.cond.notify()
+
+    def flush(self):
+        '''ask the writer thread to write out all pending data'''
+        with self.cond:
+            self.cond.notify()
+
+    def close(self):
+        '''write out all pending data and close the file'''
+        if self.thread is None:
+            return
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.thread.join(timeout=10)
+        self.thread = None
+
+    def writer_thread(self):
+        '''log writing thread'''
+        while True:
+            flush_now = self.flush_now is not None and self.flush_now()
+            with self.cond:
+                if not self.closing and self.pending_bytes < self.batch_bytes:
+                    self.cond.wait(0.1 if flush_now else self.flush_interval)
+                chunks = self.pending
+                self.pending = []
+                self.pending_bytes = 0
+                closing = self.closing
+            try:
+                self.write_chunks(chunks, closing, flush_now)
+            except OSError as e:
+                print("ERROR: writing log %s: %s" % (self.filename, e))
+                time.sleep(1)
+            if closing:
+                os.close(self.fd)
+                self.fd = None
+                return
+
+    def write_chunks(self, chunks, closing, flush_now):
+        '''write a list of buffers to the file'''
+        for c in chunks:
+            self.bytes_in += len(c)
+        if self.compressor is not None:
+            out = [self.compressor.compress(b''.join(chunks))] if chunks else []
+            now = time.time()
+            if closing:
+                out.append(self.compressor.finish())
+            elif flush_now or now - self.last_sync >= self.sync_interval:
+                # regularly make the log decodable up to this point
+                # in case we crash
+                out.append(self.compressor.flush())
+                self.last_sync = now
+            chunks = [c for c in out if len(c) > 0]
+        while len(chunks) > 0:
+            batch = chunks[:max_iov]
+            chunks = chunks[max_iov:]
+            self.write_all(batch)
+
+    def write_all(self, batch):
+        '''write a batch of buffers, coping with short writes'''
+        total = sum([len(b) for b in batch])
+        if not hasattr(os, 'writev'):
+            os.write(self.fd, b''.join(batch))
+            done = total
+        else:
+            done = os.writev(self.fd, batch)
+        self.write_calls += 1
+        if done < total:
+            # short write, fall back to writing the remainder in one go
+            rest = memoryview(b''.join(batch))[done:]
+            while len(rest) > 0:
+                n = os.write(self.fd, rest)
+                rest = rest[n:]
+                self.write_calls += 1
+        self.bytes_out += total
+
+    def stats(self):
+        '''return a string describing the writer statistics'''
+        ratio = self.bytes_out / float(self.bytes_in) if self.bytes_in > 0 else 1.0
+        return "%s: %u bytes in %u bytes out (%.2f) %u writes" % (self.filename, self.bytes_in, self.bytes_out,
+                                                                  ratio, self.write_calls)
+
+
+def compression_type(filename):
+    '''return the compression type of a file by looking at its magic
+    number, or None if it is not compressed'''
+    try:
+        with open(filename, 'rb') as f:
+            magic = f.read(4)
+    except OSError:
+        return None
+    if magic[:2] == b'\x1f\x8b':
+        return 'gzip'
+    if magic == b'\x28\xb5\x2f\xfd':
+        return 'zstd'
+    if magic == b'\x04\x22\x4d\x18':
+        return 'lz4'
+    return None
+
+
+def decompressed_stream(filename, ctype):
+    '''open a decompressing stream on a compressed log'''
+    if ctype == 'gzip':
+        import gzip
+        return gzip.open(filename, 'rb')
+    if ctype == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames=True)
+    if ctype == 'lz4':
+        import lz4.frame
+        return lz4.frame.open(filename, 'rb')
+    raise ValueError("Unknown compression %s" % ctype)
+
+
+temp_files = []
+temp_files_pid = os.getpid()
+
+
+def remove_temp_files():
+    if os.getpid() != temp_files_pid:
+        # don't remove our parents files from a forked child
+        return
+    for f in temp_files:
+        try:
+            os.unlink(f)
+        except OSError:
+            pass
+
+
+atexit.register(remove_temp_files)
+
+
+def uncompressed_filename(filename):
+    '''if filename is a compressed log then decompress it to a temporary
+    file and return the temporary file name, otherwise return filename.
+    The temporary file keeps the extension of the uncompressed log so
+    mavutil can tell what type of log it is'''
+    ctype = compression_type(filename)
+    if ctype is None:
+        return filename
+    base = os.path.basename(filename)
+    for c in compressors.values():
+        if base.endswith(c.extension):
+            base = base[:-len(c.extension)]
+    ext = os.path.splitext(base)[1]
+    (fd, tmpname) = tempfile.mkstemp(suffix=ext, prefix='mavlog')
+    temp_files.append(tmpname)
+    with os.fdopen(fd, 'wb') as out:
+        with decompressed_stream(filename, ctype) as f:
+            shutil.copyfileobj(f, out, 1024*1024)
+    return tmpname
+
+
+def mavlink_connection(filename, **kwargs):
+    '''open a log with mavutil.mavlink_connection(), transparently
+    decompressing gzip, zstd and lz4 compressed logs.
+
+    A compressed log is decompressed in full to a temporary file, removed
+    at exit, before it is opened. This needs free space in the temporary
+    directory for the uncompressed log, often 5 to 10 times the
+    compressed size, and delays opening by the time to decompress it,
+    roughly a second per few hundred MB. Streaming isn't possible as
+    DFReader maps dataflash logs into memory, and both log readers seek
+    to rewind'''
+    from pymavlink import mavutil
+    if os.path.isfile(filename):
+        filename = uncompressed_filename(filename)
+    return mavutil.mavlink_connection(filename, **kwargs)
@@ -16,6 +16,8 @@ class MPModule(object):
         self.needs_unloading = False
         self.multi_instance = multi_instance
         self.multi_vehicle = multi_vehicle
+        # set of message types passed to mavlink_packet, None for all
+        self.subscribed_types = None
 
         if description is None:
             self.description = name + " handling"
@@ -60,6 +62,21 @@ class MPModule(object):
         '''Find a public module (most modules are private)'''
         return self.mpstate.module(name)
 
+    def subscribe(self, msg_types):
+        '''only pass messages of the given types to mavlink_packet().
+        Modules that never call this are passed every message'''
+        if self.subscribed_types is None:
+            self.subscribed_types = set()
+        self.subscribed_types.update(msg_types)
+        self.mpstate.module_generation += 1
+
+    def unsubscribe(self, msg_types):
+        '''stop passing messages of the given types to mavlink_packet()'''
+        if self.subscribed_types is None:
+            return
+        self.subscribed_types.difference_update(msg_types)
+        self.mpstate.module_generation += 1
+
     def module_matching(self, name):
         '''Find a list of modules matching a wildcard pattern'''
         import fnmatch
@@ -130,6 +130,33 @@ def gps_offset(lat, lon, east, north):
     distance = sqrt(east**2 + north**2)
     return gps_newpos(lat, lon, bearing, distance)
 
+def gps_newpos_array(lat, lon, bearing, distance):
+    '''gps_newpos() for numpy arrays of positions, bearings and distances,
+    returning arrays of latitude and longitude'''
+    import numpy as np
+    eps = 1.0e-15
+    lat1 = np.clip(np.radians(lat), -pi/2+eps, pi/2-eps)
+    lon1 = np.radians(lon)
+    tc = np.radians(-np.asarray(bearing, dtype=float))
+    d = np.asarray(distance, dtype=float)/radius_of_earth
+
+    lat = np.clip(lat1 + d * np.cos(tc), -pi/2+eps, pi/2-eps)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dphi = np.log(np.tan(lat/2+pi/4)/np.tan(lat1/2+pi/4))
+        q = np.where(np.abs(lat-lat1) < eps, np.cos(lat1), (lat-lat1)/dphi)
+    dlon = -d*np.sin(tc)/q
+    lon = np.fmod(lon1+dlon+pi,2*pi)-pi
+    return (np.degrees(lat), np.degrees(lon))
+
+def gps_offset_array(lat, lon, east, north):
+    '''gps_offset() for numpy arrays of positions and offsets in meters'''
+    import numpy as np
+    east = np.asarray(east, dtype=float)
+    north = np.asarray(north, dtype=float)
+    bearing = np.degrees(np.arctan2(east, north))
+    distance = np.sqrt(east**2 + north**2)
+    return gps_newpos_array(lat, lon, bearing, distance)
+
 
 def mkdir_p(dir):
     '''like mkdir -p'''
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+'''
+filtered, rate limited MAVLink publishing from a background thread
+
+The main thread only decides whether to send a message, which is a
+dict lookup for its type and a rate check, and queues it. A publisher
+thread encodes the queued messages as JSON and publishes them, one per
+message or batched into one payload every batch seconds, or sooner
+when the queue is half full.
+
+The queue is bounded. When it is full the oldest message is dropped,
+so a slow or stalled broker costs the main thread nothing but the
+dropped messages, which are counted along with the queue depth and the
+time messages wait to be published.
+
+AP_FLAKE8_CLEAN
+'''
+
+import collections
+import fnmatch
+import json
+import numbers
+import threading
+import time
+
+
+def convert_to_dict(message):
+    '''converts a mavlink message to a python dict'''
+    if hasattr(message, '_fieldnames'):
+        result = {}
+        for field in message._fieldnames:
+            result[field] = convert_to_dict(getattr(message, field))
+        return result
+    if isinstance(message, numbers.Number):
+        return message
+    return str(message)
+
+
+def parse_patterns(spec):
+    '''split a comma separated list of message type patterns'''
+    return [p.strip().upper() for p in spec.split(',') if p.strip()]
+
+
+class TypeFilter(object):
+    '''include and exclude lists of fnmatch patterns on message types.
+    An empty include list includes everything. Results are cached per
+    type, so checking a message is a dict lookup'''
+    def __init__(self, include='', exclude=''):
+        self.include = parse_patterns(include)
+        self.exclude = parse_patterns(exclude)
+        self.cache = {}
+
+    def match(self, msg_type, patterns):
+        for p in patterns:
+            if fnmatch.fnmatchcase(msg_type, p):
+                return True
+        return False
+
+    def allowed(self, msg_type):
+        ret = self.cache.get(msg_type, None)
+        if ret is None:
+            ret = ((not self.include or self.match(msg_type, self.include)) and
+                   not self.match(msg_type, self.exclude))
+            self.cache[msg_type] = ret
+        return ret
+
+
+class RateLimiter(object):
+    '''per message type rate caps. rates is a spec like
+    "ATTITUDE:5,GPS_RAW_INT:1", and types not listed are capped at
+    default_rate. A rate of 0 is no cap'''
+    def __init__(self, rates='', default_rate=0):
+        self.rates = {}
+        for item in rates.split(','):
+            (msg_type, sep, rate) = item.strip().partition(':')
+            if msg_type and sep:
+                self.rates[msg_type.upper()] = float(rate)
+        self.default_rate = default_rate
+        self.intervals = {}
+        self.next_time = {}
+
+    def interval(self, msg_type):
+        ret = self.intervals.get(msg_type, None)
+        if ret is None:
+            rate = self.rates.get(msg_type, self.default_rate)
+            ret = 1.0 / rate if rate > 0 else 0
+            self.intervals[msg_type] = ret
+        return ret
+
+    def due(self, msg_type, now):
+        '''True if a message of msg_type may be sent now'''
+        interval = self.interval(msg_type)
+        if interval == 0:
+            return True
+        next_time = self.next_time.get(msg_type, None)
+        if next_time is not None and now < next_time:
+            return False
+        # keep to the rate on average when messages don't line up with
+        # it, unless there has been a gap
+        if next_time is None or now - next_time > interval:
+            next_time = now
+        self.next_time[msg_type] = next_time + interval
+        return True
+
+
+class PublisherStats(object):
+    '''counters for the publisher'''
+    def __init__(self):
+        self.received = 0
+        self.filtered = 0
+        self.rate_limited = 0
+        self.queued = 0
+        self.dropped = 0
+        self.published = 0
+        self.payloads = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.latency_sum = 0.0
+        self.max_latency = 0.0
+        self.encode_time = 0.0
+
+    def describe(self, depth):
+        avg = self.latency_sum / self.published if self.published else 0
+        return ("%u received %u filtered %u rate limited, %u queued %u dropped, depth %u max %u, "
+                "%u published in %u payloads %u errors, latency avg %.1fms max %.1fms, encoding %.2fs" % (
+                    self.received, self.filtered, self.rate_limited, self.queued, self.dropped,
+                    depth, self.max_depth, self.published, self.payloads, self.errors,
+                    1000 * avg, 1000 * self.max_latency, self.encode_time))
+
+
+class MAVPublisher(object):
+    '''publishes MAVLink messages to prefix/TYPE topics through client,
+    which needs a publish(topic, payload) method that returns something
+    with an rc attribute (as paho's does) or raises on failure.
+
+    With batch > 0 the messages queued over batch seconds, or until the
+    queue is half full, are published together to prefix/batch as a
+    JSON list of
+    {"topic": TYPE, "time": t, "data": fields}'''
+    def __init__(self, client, prefix='', max_queue=1000, batch=0, type_filter=None, rate_limiter=None):
+        self.client = client
+        self.prefix = prefix
+        self.max_queue = max(1, max_queue)
+        self.batch = batch
+        self.type_filter = type_filter if type_filter is not None else TypeFilter()
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.stats = PublisherStats()
+        self.topics = {}
+        self.last_error = None
+        self.thread = None
+        self.stopping = False
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name='mqtt_publisher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=2.0):
+        '''stop the thread, publishing what is queued first'''
+        if self.thread is None:
+            return
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def depth(self):
+        return len(self.queue)
+
+    def add(self, msg, now=None):
+        '''called from the main thread for each message. Returns True if
+        it was queued'''
+        stats = self.stats
+        stats.received += 1
+        msg_type = msg.get_type()
+        if not self.type_filter.allowed(msg_type):
+            stats.filtered += 1
+            return False
+        if now is None:
+            now = time.time()
+        if not self.rate_limiter.due(msg_type, now):
+            stats.rate_limited += 1
+            return False
+        with self.cond:
+            queue = self.queue
+            if len(queue) >= self.max_queue:
+                queue.popleft()
+                stats.dropped += 1
+            queue.append((msg_type, msg, now))
+            stats.queued += 1
+            if len(queue) > stats.max_depth:
+                stats.max_depth = len(queue)
+            if self.batch <= 0 or len(queue) == 1 or len(queue) >= self.flush_depth():
+                self.cond.notify()
+        return True
+
+    def flush_depth(self):
+        '''queue depth at which a batch is sent without waiting for the
+        end of the batch period, leaving room for messages queued while
+        the batch is published'''
+        return max(1, self.max_queue // 2)
+
+    def topic(self, msg_type):
+        ret = self.topics.get(msg_type, None)
+        if ret is None:
+            ret = '%s/%s' % (self.prefix, msg_type)
+            self.topics[msg_type] = ret
+        return ret
+
+    def take(self):
+        '''wait for messages to publish, returning them'''
+        with self.cond:
+            while not self.queue and not self.stopping:
+                self.cond.wait(1.0)
+            if self.batch > 0 and not self.stopping:
+                # gather a batch from the time its first message was queued
+                deadline = self.queue[0][2] + self.batch
+                while not self.stopping and len(self.queue) < self.flush_depth():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            items = list(self.queue)
+            self.queue.clear()
+        return items
+
+    def publish(self, topic, payload):
+        try:
+            ret = self.client.publish(topic, payload)
+        except Exception as ex:
+            self.stats.errors += 1
+            self.last_error = str(ex)
+            return
+        if getattr(ret, 'rc', 0) != 0:
+            self.stats.errors += 1
+
+    def send(self, items):
+        '''encode and publish a list of queued messages'''
+        if not items:
+            return
+        t0 = time.time()
+        if self.batch > 0:
+            payload = json.dumps([{'topic': msg_type, 'time': t, 'data': convert_to_dict(msg)}
+                                  for (msg_type, msg, t) in items])
+            self.stats.encode_time += time.time() - t0
+            self.publish(self.prefix + '/batch', payload)
+            self.stats.payloads += 1
+        else:
+            for (msg_type, msg, t) in items:
+                t1 = time.time()
+                payload = json.dumps(convert_to_dict(msg))
+                self.stats.encode_time += time.time() - t1
+                self.publish(self.topic(msg_type), payload)
+                self.stats.payloads += 1
+        now = time.time()
+        stats = self.stats
+        for (msg_type, msg, t) in items:
+            latency = now - t
+            stats.latency_sum += latency
+            if latency > stats.max_latency:
+                stats.max_latency = latency
+        stats.published += len(items)
+
+    def run(self):
+        '''publisher thread'''
+        while True:
+            items = self.take()
+            self.send(items)
+            if self.stopping and not self.queue:
+                break
+
+    def describe(self):
+        return self.stats.describe(self.depth())
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from pymavlink.dialects.v20 import ardupilotmega as mavlink
+    parser = ArgumentParser(description='time the main thread cost of publishing, against a client with a slow publish()')
+    parser.add_argument("--count", type=int, default=50000, help="messages to publish")
+    parser.add_argument("--publish-time", type=float, default=0.0001, help="seconds each publish takes")
+    parser.add_argument("--batch", type=float, default=0.1)
+    args = parser.parse_args()
+
+    class SlowClient(object):
+        def __init__(self):
+            self.count = 0
+
+        def publish(self, topic, payload):
+            time.sleep(args.publish_time)
+            self.count += 1
+
+    msgs = [mavlink.MAVLink_attitude_message(0, 0.1, 0.2, 0.3, 0, 0, 0),
+            mavlink.MAVLink_global_position_int_message(0, 1, 2, 3, 4, 5, 6, 7, 8),
+            mavlink.MAVLink_vfr_hud_message(1, 2, 3, 4, 5, 6),
+            mavlink.MAVLink_sys_status_message(0, 0, 0, 0, 12000, -1, 90, 0, 0, 0, 0, 0, 0)]
+
+    client = SlowClient()
+    t0 = time.time()
+    for i in range(args.count):
+        m = msgs[i % len(msgs)]
+        client.publish('/' + m.get_type(), json.dumps(convert_to_dict(m)))
+    dt = time.time() - t0
+    print("synchronous: %.2fs on the main thread, %.1fus per message" % (dt, 1.0e6 * dt / args.count))
+
+    runs = [('queued', 0, ''),
+            ('batched', args.batch, ''),
+            ('batched, capped', args.batch, 'ATTITUDE:10')]
+    for (name, batch, rates) in runs:
+        client = SlowClient()
+        pub = MAVPublisher(client, max_queue=1000, batch=batch, rate_limiter=RateLimiter(rates))
+        pub.start()
+        t0 = time.time()
+        main = 0
+        for i in range(args.count):
+            t1 = time.time()
+            pub.add(msgs[i % len(msgs)], t1)
+            main += time.time() - t1
+            # leave the publisher time to run, as the main loop would
+            if i % 100 == 0:
+                time.sleep(0.001)
+        pub.stop(10)
+        print("%s: %.2fs, %.1fus per message on the main thread, %u publishes" % (
+            name, time.time() - t0, 1.0e6 * main / args.count, client.count))
+        print("  " + pub.describe())
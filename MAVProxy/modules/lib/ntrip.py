@@ -167,10 +167,12 @@ class NtripClient(object):
                     # Request was valid
                     self.send_gga()
             return None
-        # normal data read
-        while True:
+        # normal data read. One recv may bring several packets, which
+        # are returned by the calls that follow
+        data = b''
+        while not self.rtcm3.read(data):
             try:
-                data = self.socket.recv(1)
+                data = self.socket.recv(4096)
             except ssl.SSLWantReadError:
                     return None
             except IOError as e:
@@ -187,9 +189,8 @@ class NtripClient(object):
                 self.socket.close()
                 self.socket = None
                 return None
-            if self.rtcm3.read(data):
-                self.last_id = self.rtcm3.get_packet_ID()
-                return self.rtcm3.get_packet()
+        self.last_id = self.rtcm3.get_packet_ID()
+        return self.rtcm3.get_packet()
 
     def connect(self):
         '''connect to NTRIP server'''
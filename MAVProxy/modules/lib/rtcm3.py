@@ -1,127 +1,277 @@
 #!/usr/bin/env python
-'''Decode RTCM v3 messages'''
+'''
+Decode RTCM v3 messages
+
+RTCM3.frames() takes data as it arrives in whatever size pieces, finds
+each frame's preamble with find(), checks its CRC24 and returns the good
+frames as memoryviews into the data, so frames aren't copied. Only the
+start of a frame left at the end of one piece is kept for the next.
+read() takes data a byte (or more) at a time as before.
+
+gps_rtcm_fragments() splits a frame into the fragments sent in
+GPS_RTCM_DATA messages.
+
+Run this file with --benchmark to time parsing of a recorded RTCM
+stream (or a generated one)
+
+AP_FLAKE8_CLEAN
+'''
+
+import collections
+import struct
 
 RTCMv3_PREAMBLE = 0xD3
 POLYCRC24 = 0x1864CFB
 
-import struct
+# bytes before and after a frame's payload
+HEADER_LEN = 3
+CRC_LEN = 3
+
+# data bytes in a GPS_RTCM_DATA message
+RTCM_DATA_LEN = 180
+
+# fragments a message may be sent in
+MAX_FRAGMENTS = 4
+
+
+def _crc24_table():
+    table = []
+    for i in range(256):
+        crc = i << 16
+        for j in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= POLYCRC24
+        table.append(crc)
+    return tuple(table)
+
+
+CRC24_TABLE = _crc24_table()
+
+# CRC of each pair of bytes, built on first use
+_crc24_table16 = None
+
+
+def _crc24_pair_table():
+    global _crc24_table16
+    if _crc24_table16 is None:
+        t = CRC24_TABLE
+        table = [0] * 65536
+        for w in range(65536):
+            c = t[w >> 8]
+            table[w] = ((c << 8) & 0xFFFFFF) ^ t[(c >> 16) ^ (w & 0xFF)]
+        _crc24_table16 = tuple(table)
+    return _crc24_table16
+
+
+def crc24(data, crc=0):
+    '''the CRC24Q of a bytes-like object, taking it two bytes at a time'''
+    mv = memoryview(data)
+    n = len(mv)
+    t = _crc24_pair_table()
+    for w in struct.unpack_from('>%uH' % (n // 2), mv):
+        crc = ((crc << 16) & 0xFFFFFF) ^ t[(crc >> 8) ^ w]
+    if n & 1:
+        crc = ((crc << 8) & 0xFFFFFF) ^ CRC24_TABLE[(crc >> 16) ^ mv[n - 1]]
+    return crc
+
+
+def frame_ID(frame):
+    '''the message number of a frame, or None if too short'''
+    if frame is None or len(frame) < 8:
+        return None
+    return (frame[3] << 4) | (frame[4] >> 4)
+
+
+_zeros = memoryview(bytes(RTCM_DATA_LEN))
+
+
+def gps_rtcm_fragments(data, seq, pad=None):
+    '''generate (flags, length, data) for the GPS_RTCM_DATA messages
+    carrying an RTCM message with sequence number seq. Full fragments
+    are slices of data. The last fragment is padded in pad, a bytearray
+    of RTCM_DATA_LEN that is overwritten by the next call, so each
+    fragment must be sent before taking the next'''
+    mv = memoryview(data)
+    n = len(mv)
+    if n > RTCM_DATA_LEN * MAX_FRAGMENTS:
+        raise ValueError("RTCM message too large: %u" % n)
+    if pad is None:
+        pad = bytearray(RTCM_DATA_LEN)
+    nfrags = (n + RTCM_DATA_LEN - 1) // RTCM_DATA_LEN
+    flags = (seq & 0x1F) << 3
+    if nfrags > 1:
+        flags |= 1
+    for i in range(nfrags):
+        chunk = mv[i * RTCM_DATA_LEN:(i + 1) * RTCM_DATA_LEN]
+        length = len(chunk)
+        if length < RTCM_DATA_LEN:
+            pad[:length] = chunk
+            pad[length:] = _zeros[length:]
+            chunk = pad
+        yield (flags | (i & 0x3) << 1, length, chunk)
+    if 1 < nfrags < MAX_FRAGMENTS and n % RTCM_DATA_LEN == 0:
+        # an empty fragment marks the end of a message that fills its
+        # last fragment
+        pad[:] = _zeros
+        yield (flags | (nfrags & 0x3) << 1, 0, pad)
+
 
 class RTCM3:
     def __init__(self, debug=False):
-        self.crc_table = None
         self.debug = debug
+        self.frame_count = 0
+        self.crc_errors = 0
+        self.discarded = 0
         self.reset()
 
     def get_packet(self):
-        '''return bytearray of last parsed packet'''
+        '''return memoryview of last parsed packet'''
         return self.parsed_pkt
 
     def get_packet_ID(self):
         '''get get of packet, or None'''
-        if self.parsed_pkt is None or len(self.parsed_pkt) < 8:
-            return None
-        id, = struct.unpack('>H', self.parsed_pkt[3:5])
-        id >>= 4
-        return id
+        return frame_ID(self.parsed_pkt)
 
     def reset(self):
         '''reset state'''
-        self.pkt = bytearray()
-        self.pkt_len = 0
+        self.pending = bytearray()
+        # bytes needed in pending before it is worth parsing again
+        self.need = 0
         self.parsed_pkt = None
+        self.queue = collections.deque()
 
-    def parse(self):
-        '''parse packet'''
-        parity = self.pkt[-3:]
-        crc1 = parity[0] << 16 | parity[1] << 8 | parity[2]
-        crc2 = self.crc24(self.pkt[:-3])
-        if crc1 != crc2:
-            if self.debug:
-                print("crc fail len=%u" % len(self.pkt))
-            # look for preamble
-            idx = self.pkt[1:].find(bytearray([RTCMv3_PREAMBLE]))
-            if idx >= 0:
-                self.pkt = self.pkt[1+idx:]
-                if len(self.pkt) >= 3:
-                    self.pkt_len, = struct.unpack('>H', self.pkt[1:3])
-                    self.pkt_len &= 0x3ff
-                else:
-                    self.pkt_len = 0
-            else:
-                self.reset()
-            return False
-
-        # got a good packet
-        self.parsed_pkt = self.pkt
-        self.pkt = bytearray()
-        self.pkt_len = 0
-        return True
-
-    def read(self, byte):
-        '''read in one byte, return true if a full packet is available'''
-
-        #import random
-        #if random.uniform(0,1000) < 1:
-        #    return False
+    def frames(self, data):
+        '''take in more data, returning a list of the complete frames
+        found as memoryviews. Frames are views into data if it is
+        bytes, so a bytearray passed in must not be changed while its
+        frames are in use'''
+        if self.pending:
+            self.pending.extend(data)
+            if len(self.pending) < self.need:
+                return []
+            data = bytes(self.pending)
+            self.pending = bytearray()
+        mv = memoryview(data)
+        n = len(mv)
+        ret = []
+        pos = 0
+        while pos < n:
+            idx = data.find(RTCMv3_PREAMBLE, pos)
+            if idx < 0:
+                self.discarded += n - pos
+                return ret
+            self.discarded += idx - pos
+            if n - idx < HEADER_LEN:
+                self.pending = bytearray(mv[idx:])
+                self.need = HEADER_LEN
+                return ret
+            length = ((mv[idx + 1] & 0x03) << 8) | mv[idx + 2]
+            if length == 0:
+                self.discarded += 1
+                pos = idx + 1
+                continue
+            end = idx + HEADER_LEN + length + CRC_LEN
+            if end > n:
+                # the rest of the frame is still to come
+                self.pending = bytearray(mv[idx:])
+                self.need = end - idx
+                return ret
+            crc = (mv[end - 3] << 16) | (mv[end - 2] << 8) | mv[end - 1]
+            if crc24(mv[idx:end - CRC_LEN]) != crc:
+                if self.debug:
+                    print("crc fail len=%u" % (end - idx))
+                self.crc_errors += 1
+                self.discarded += 1
+                pos = idx + 1
+                continue
+            ret.append(mv[idx:end])
+            self.frame_count += 1
+            pos = end
+        return ret
 
-        byte = ord(byte)
-        if len(self.pkt) == 0 and byte != RTCMv3_PREAMBLE:
-            # discard
+    def read(self, data):
+        '''read in one byte (or more), return true if a full packet is
+        available. Further packets found are returned by later calls'''
+        pending = self.pending
+        if pending and len(pending) + len(data) < self.need:
+            pending.extend(data)
+        elif len(data) > 0:
+            self.queue.extend(self.frames(data))
+        if not self.queue:
             return False
+        self.parsed_pkt = self.queue.popleft()
+        return True
 
-        self.pkt.append(byte)
-        if self.pkt_len == 0 and len(self.pkt) >= 3:
-            self.pkt_len, = struct.unpack('>H', self.pkt[1:3])
-            self.pkt_len &= 0x3ff
-            if self.pkt_len == 0:
-                self.reset()
-                return False
-
-        if self.pkt_len > 0 and len(self.pkt) >= 3 + self.pkt_len + 3:
-            remainder = self.pkt[6+self.pkt_len:]
-            self.pkt = self.pkt[:6+self.pkt_len]
-            # got header, packet body and parity
-            ret = self.parse()
-            self.pkt.extend(remainder)
-            return ret
-
-        # need more bytes
-        return False
-
-    def crc24(self, bytes):
-        '''calculate 24 bit crc'''
-        if self.crc_table is None:
-            # initialise table
-            self.crc_table = [0] * 256
-            for i in range(256):
-                self.crc_table[i] = i<<16
-                for j in range(8):
-                    self.crc_table[i] <<= 1
-                    if (self.crc_table[i] & 0x1000000):
-                        self.crc_table[i] ^= POLYCRC24
-        crc = 0
-        for b in bytes:
-            crc = ((crc<<8)&0xFFFFFF) ^ self.crc_table[(crc>>16) ^ b]
-        return crc
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
+    import os
+    import random
     import time
     parser = ArgumentParser(description='RTCM3 parser')
 
-    parser.add_argument("filename", type=str, help="input file")
+    parser.add_argument("filename", type=str, nargs='?', default=None, help="input file")
     parser.add_argument("--debug", action='store_true', help="show errors")
     parser.add_argument("--follow", action='store_true', help="continue reading on EOF")
+    parser.add_argument("--benchmark", action='store_true', help="time parsing the file, or a generated stream")
+    parser.add_argument("--size", type=int, default=2000000, help="size of generated stream")
     args = parser.parse_args()
 
-    rtcm3 = RTCM3(args.debug)
-    f = open(args.filename, 'rb')
-    while True:
-        b = f.read(1)
-        if len(b) == 0:
-            if args.follow:
-                time.sleep(0.1)
-                continue
-            break
-        if rtcm3.read(b):
-            print("packet len %u ID %u" % (len(rtcm3.get_packet()), rtcm3.get_packet_ID()))
+    if args.benchmark:
+        if args.filename is not None:
+            stream = open(args.filename, 'rb').read()
+        else:
+            # a mix of station, MSM and ephemeris messages with some
+            # line noise between them
+            rng = random.Random(1)
+            parts = []
+            size = 0
+            while size < args.size:
+                msg_id = rng.choice([1005, 1074, 1077, 1084, 1087, 1094, 1097, 1124, 1127, 1019, 1230])
+                length = 19 if msg_id in [1005, 1230] else rng.randint(60, 700)
+                body = bytearray(struct.pack('>H', msg_id << 4)) + bytearray(os.urandom(length - 2))
+                frame = bytearray([RTCMv3_PREAMBLE, length >> 8, length & 0xFF]) + body
+                frame += struct.pack('>I', crc24(frame))[1:]
+                if rng.random() < 0.01:
+                    parts.append(os.urandom(rng.randint(1, 20)))
+                parts.append(bytes(frame))
+                size += len(frame)
+            stream = b''.join(parts)
+        print("%u bytes" % len(stream))
+
+        rtcm3 = RTCM3()
+        t0 = time.time()
+        count = 0
+        for i in range(len(stream)):
+            if rtcm3.read(stream[i:i + 1]):
+                count += 1
+        dt = time.time() - t0
+        print("read() a byte at a time: %u frames %.2fs %.2f MByte/s" % (count, dt, len(stream) / dt / 1.0e6))
+
+        for chunk in [16, 512, 4096]:
+            rtcm3 = RTCM3()
+            t0 = time.time()
+            count = 0
+            for i in range(0, len(stream), chunk):
+                count += len(rtcm3.frames(stream[i:i + chunk]))
+            dt = time.time() - t0
+            print("frames() in %4u byte pieces: %u frames %.2fs %.2f MByte/s, %u crc errors %u bytes discarded" % (
+                chunk, count, dt, len(stream) / dt / 1.0e6, rtcm3.crc_errors, rtcm3.discarded))
+
+        t0 = time.time()
+        crc24(stream)
+        dt = time.time() - t0
+        print("crc24: %.2f MByte/s" % (len(stream) / dt / 1.0e6))
+    else:
+        rtcm3 = RTCM3(args.debug)
+        f = open(args.filename, 'rb')
+        while True:
+            b = f.read(4096)
+            if len(b) == 0:
+                if args.follow:
+                    time.sleep(0.1)
+                    continue
+                break
+            for frame in rtcm3.frames(b):
+                print("packet len %u ID %u" % (len(frame), frame_ID(frame)))
@@ -19,8 +19,8 @@ import pickle
 import os.path
 import os
 import zipfile
-import array
 import math
+import numpy
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
 
@@ -336,24 +336,76 @@ class SRTMTile:
         only have to look at a single tile.
         """
     def __init__(self, f, lat, lon):
+        self.lat = lat
+        self.lon = lon
+        # the samples are big-endian 16 bit integers, kept decompressed
+        # on disk next to the zip file and memory mapped
+        hgtfile = self.hgtFilename(f)
+        data = None
+        if self.validHgtFile(f, hgtfile):
+            try:
+                data = numpy.memmap(hgtfile, dtype='>i2', mode='r')
+            except Exception:
+                data = None
+        if data is None:
+            data = self.unzip(f, hgtfile)
+        self.size = int(math.sqrt(len(data)))
+        # Currently only SRTM1/3 is supported
+        if self.size not in (1201, 3601) or len(data) != self.size * self.size:
+            raise InvalidTileError(lat, lon)
+        self.data = data
+        # rows are in order of decreasing latitude
+        self.grid = data.reshape((self.size, self.size))
+
+    @staticmethod
+    def hgtFilename(f):
+        """name of the decompressed copy of a zipped tile"""
+        if f.endswith('.zip'):
+            return f[:-4]
+        return f + '.hgt'
+
+    @staticmethod
+    def validHgtFile(f, hgtfile):
+        """see if there is a usable decompressed copy of a zipped tile"""
+        try:
+            st = os.stat(hgtfile)
+            if st.st_size not in (1201*1201*2, 3601*3601*2):
+                return False
+            return st.st_mtime >= os.stat(f).st_mtime
+        except OSError:
+            return False
+
+    def unzip(self, f, hgtfile):
+        """read the samples from a zipped tile, saving a decompressed
+            copy to load next time"""
         try:
             zipf = zipfile.ZipFile(f, 'r')
         except Exception:
-            raise InvalidTileError(lat, lon)
+            raise InvalidTileError(self.lat, self.lon)
         names = zipf.namelist()
         if len(names) != 1:
-            raise InvalidTileError(lat, lon)
+            raise InvalidTileError(self.lat, self.lon)
         data = zipf.read(names[0])
-        self.size = int(math.sqrt(len(data)/2)) # 2 bytes per sample
-        # Currently only SRTM1/3 is supported
-        if self.size not in (1201, 3601):
-            raise InvalidTileError(lat, lon)
-        self.data = array.array('h', data)
-        self.data.byteswap()
-        if len(self.data) != self.size * self.size:
-            raise InvalidTileError(lat, lon)
-        self.lat = lat
-        self.lon = lon
+        zipf.close()
+        if len(data) not in (1201*1201*2, 3601*3601*2):
+            raise InvalidTileError(self.lat, self.lon)
+        tmpname = hgtfile + ".tmp%u" % os.getpid()
+        try:
+            with open(tmpname, 'wb') as output:
+                output.write(data)
+            try:
+                os.unlink(hgtfile)
+            except Exception:
+                pass
+            os.rename(tmpname, hgtfile)
+            return numpy.memmap(hgtfile, dtype='>i2', mode='r')
+        except Exception:
+            # can't cache it, keep the samples in memory
+            try:
+                os.unlink(tmpname)
+            except Exception:
+                pass
+            return numpy.frombuffer(data, dtype='>i2')
 
     @staticmethod
     def _avg(value1, value2, weight):
@@ -395,11 +447,16 @@ class SRTMTile:
         # Same as calcOffset, inlined for performance reasons
         offset = x + self.size * (self.size - y - 1)
         #print(offset)
-        value = self.data[offset]
+        value = int(self.data[offset])
         if value == -32768:
             return -1 # -32768 is a special value for areas with no data
         return value
 
+    def getPixelValues(self, x, y):
+        """Get the values of arrays of pixels, handling voids in the SRTM
+            data."""
+        values = self.grid[self.size - y - 1, x]
+        return numpy.where(values == -32768, -1, values)
 
     def getAltitudeFromLatLon(self, lat, lon):
         """Get the altitude of a lat lon pair, using the four neighbouring
@@ -430,6 +487,30 @@ class SRTMTile:
         #        value00, value10, value1, value01, value11, value2, value))
         return value
 
+    def getAltitudeArray(self, lats, lons):
+        """Get the altitudes of arrays of lat lon pairs within the tile,
+            using the four neighbouring pixels of each for interpolation.
+        """
+        lats = numpy.asarray(lats, dtype=float) - self.lat
+        lons = numpy.asarray(lons, dtype=float) - self.lon
+        outside = (lats < 0.0) | (lats >= 1.0) | (lons < 0.0) | (lons >= 1.0)
+        if outside.any():
+            i = numpy.flatnonzero(outside)[0]
+            raise WrongTileError(self.lat, self.lon, self.lat+lats.flat[i], self.lon+lons.flat[i])
+        x = lons * (self.size - 1)
+        y = lats * (self.size - 1)
+        x_int = x.astype(int)
+        x_frac = x - x_int
+        y_int = y.astype(int)
+        y_frac = y - y_int
+        value00 = self.getPixelValues(x_int, y_int)
+        value10 = self.getPixelValues(x_int+1, y_int)
+        value01 = self.getPixelValues(x_int, y_int+1)
+        value11 = self.getPixelValues(x_int+1, y_int+1)
+        value1 = value10 * x_frac + value00 * (1 - x_frac)
+        value2 = value11 * x_frac + value01 * (1 - x_frac)
+        return value2 * y_frac + value1 * (1 - y_frac)
+
 class SRTMOceanTile(SRTMTile):
     '''a tile for areas of zero altitude'''
     def __init__(self, lat, lon):
@@ -439,6 +520,9 @@ class SRTMOceanTile(SRTMTile):
     def getAltitudeFromLatLon(self, lat, lon):
         return 0
 
+    def getAltitudeArray(self, lats, lons):
+        return numpy.zeros(numpy.shape(lats))
+
 
 class parseHTMLDirectoryListing(HTMLParser):
 
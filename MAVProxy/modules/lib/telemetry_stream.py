@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+'''
+latest MAVLink messages as cached JSON, pushed to subscribers
+
+TelemetryHub is given each message as it arrives and keeps the latest
+of each type. A message's JSON is made at most once per update and
+shared by everything that sends it, so a poll of the whole status only
+serialises the types that changed since the last one.
+
+Subscribers ask for a set of message types (or all of them), each with
+a rate limit. The hub pushes each update to the subscribers that are
+due one into a bounded queue per subscriber holding at most the latest
+message of each type, so a client that falls behind skips the stale
+samples rather than building up a backlog. The queue is drained by the
+thread serving the client, for example as Server-Sent Events with
+sse_events().
+
+Message fields are given as strings, as the REST server always has.
+
+AP_FLAKE8_CLEAN
+'''
+
+import collections
+import json
+import threading
+import time
+
+
+class CachedMessage(object):
+    '''a message with its JSON, made when first needed'''
+    __slots__ = ['msg', 'msg_type', '_fields', '_json', '_event']
+
+    def __init__(self, msg):
+        self.msg = msg
+        self.msg_type = msg.get_type()
+        self._fields = None
+        self._json = None
+        self._event = None
+
+    def fields(self):
+        '''dict of field name to value as a string'''
+        if self._fields is None:
+            msg = self.msg
+            self._fields = dict([(f, "%s" % getattr(msg, f)) for f in msg._fieldnames])
+        return self._fields
+
+    def json(self):
+        if self._json is None:
+            self._json = json.dumps(self.fields())
+        return self._json
+
+    def event(self):
+        '''the message as a Server-Sent Event named after its type'''
+        if self._event is None:
+            self._event = "event: %s\ndata: %s\n\n" % (self.msg_type, self.json())
+        return self._event
+
+
+def parse_rates(spec, default_rate=0):
+    '''parse a subscription like "ATTITUDE:10,GPS_RAW_INT:1,VFR_HUD" into
+    a dict of message type to rate in Hz, where a rate of 0 is every
+    update. Returns None (all types) for an empty spec. Raises ValueError
+    on a bad rate'''
+    if not spec:
+        return None
+    rates = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        (msg_type, sep, rate) = item.partition(':')
+        rate = float(rate) if sep else default_rate
+        if rate < 0:
+            raise ValueError("bad rate %s" % item)
+        rates[msg_type.upper()] = rate
+    return rates
+
+
+class Subscriber(object):
+    '''one client's subscription. rates is a dict of message type to rate
+    in Hz (0 for every update), or None for all types at default_rate'''
+    def __init__(self, rates=None, default_rate=0, max_queue=100):
+        self.rates = rates
+        self.default_rate = default_rate
+        self.max_queue = max(1, max_queue)
+        self.queue = collections.OrderedDict()
+        self.cond = threading.Condition()
+        self.last_sent = {}
+        self.closed = False
+        self.created = time.time()
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def due(self, msg_type, now):
+        '''True if an update of msg_type should be pushed now'''
+        if self.rates is None:
+            rate = self.default_rate
+        else:
+            rate = self.rates.get(msg_type, None)
+            if rate is None:
+                return False
+        if rate <= 0:
+            return True
+        last = self.last_sent.get(msg_type, None)
+        if last is not None and now - last < 1.0 / rate:
+            return False
+        # keep to the rate on average when updates don't line up with it
+        if last is not None and now - last < 2.0 / rate:
+            self.last_sent[msg_type] = last + 1.0 / rate
+        else:
+            self.last_sent[msg_type] = now
+        return True
+
+    def push(self, entry):
+        '''queue a CachedMessage, replacing any not yet sent of its type'''
+        with self.cond:
+            if self.queue.pop(entry.msg_type, None) is not None:
+                self.dropped += 1
+            self.queue[entry.msg_type] = entry
+            while len(self.queue) > self.max_queue:
+                self.queue.popitem(last=False)
+                self.dropped += 1
+            self.queued += 1
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        '''wait for queued messages, returning them oldest first. Returns
+        an empty list on timeout or when closed'''
+        with self.cond:
+            if not self.queue and not self.closed:
+                self.cond.wait(timeout)
+            ret = list(self.queue.values())
+            self.queue.clear()
+        self.sent += len(ret)
+        return ret
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def describe(self):
+        types = "all" if self.rates is None else ",".join(sorted(self.rates.keys()))
+        return "%s: %u sent %u dropped, %.0fs" % (types, self.sent, self.dropped, time.time() - self.created)
+
+
+class TelemetryHub(object):
+    '''the latest message of each type, and the subscribers to them'''
+    def __init__(self, max_subscribers=10):
+        self.latest = {}
+        self.max_subscribers = max_subscribers
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.updates = 0
+        self.pushed = 0
+        self.status_json = None
+        self.status_updates = -1
+
+    def update(self, msg, now=None):
+        '''record a message and push it to the subscribers due an update'''
+        entry = CachedMessage(msg)
+        self.latest[entry.msg_type] = entry
+        self.updates += 1
+        subscribers = self.subscribers
+        if not subscribers:
+            return
+        if now is None:
+            now = time.time()
+        for sub in subscribers:
+            if sub.due(entry.msg_type, now):
+                # made here once rather than by each client's thread
+                entry.event()
+                sub.push(entry)
+                self.pushed += 1
+
+    def get(self, msg_type):
+        '''the latest CachedMessage of a type, or None'''
+        return self.latest.get(msg_type, None)
+
+    def types(self):
+        return list(self.latest.keys())
+
+    def status(self):
+        '''JSON object of all the latest messages. Only types updated
+        since the last call are serialised again'''
+        updates = self.updates
+        if self.status_updates != updates:
+            latest = list(self.latest.values())
+            self.status_json = '{' + ', '.join(['"%s": %s' % (e.msg_type, e.json()) for e in latest]) + '}'
+            self.status_updates = updates
+        return self.status_json
+
+    def subscribe(self, rates=None, default_rate=0, max_queue=100):
+        '''add a Subscriber, or return None if there are too many'''
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            sub = Subscriber(rates, default_rate, max_queue)
+            # replaced rather than changed, so update() can iterate
+            # over it without a lock
+            self.subscribers = self.subscribers + [sub]
+        # start with the latest of each type wanted
+        now = time.time()
+        for entry in list(self.latest.values()):
+            if sub.due(entry.msg_type, now):
+                entry.event()
+                sub.push(entry)
+        return sub
+
+    def unsubscribe(self, sub):
+        sub.close()
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not sub]
+
+    def close(self):
+        '''disconnect all subscribers'''
+        for sub in self.subscribers:
+            self.unsubscribe(sub)
+
+
+def sse_events(hub, sub, keepalive=15.0):
+    '''generate a Server-Sent Events stream for a subscriber until it is
+    closed or the generator is, sending a comment every keepalive seconds
+    when idle so proxies and clients keep the connection open'''
+    try:
+        yield "retry: 1000\n\n"
+        while not sub.closed:
+            entries = sub.get(keepalive)
+            if entries:
+                yield "".join([e.event() for e in entries])
+            elif not sub.closed:
+                yield ": keepalive\n\n"
+    finally:
+        hub.unsubscribe(sub)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from pymavlink.dialects.v20 import ardupilotmega as mavlink
+    parser = ArgumentParser(description='benchmark TelemetryHub against serialising the whole status per poll')
+    parser.add_argument("--types", type=int, default=60, help="number of message types in the status")
+    parser.add_argument("--updates", type=int, default=100000, help="messages to send")
+    parser.add_argument("--polls", type=int, default=10, help="polls per 100 messages")
+    parser.add_argument("--subscribers", type=int, default=5)
+    args = parser.parse_args()
+
+    names = sorted([n for n in dir(mavlink) if n.startswith('MAVLink_') and n.endswith('_message')])
+    msgs = []
+    for n in names:
+        cls = getattr(mavlink, n)
+        try:
+            nargs = len(cls.fieldnames)
+            m = cls(*([0] * nargs))
+        except Exception:
+            continue
+        m._type = m.get_type()
+        msgs.append(m)
+        if len(msgs) >= args.types:
+            break
+
+    def old_status(status):
+        '''the REST server's old per poll serialisation'''
+        data = '{'
+        for key in status:
+            msg = status[key]
+            ret = '"%s": {' % msg._type
+            for fieldname in msg._fieldnames:
+                ret += '"%s" : "%s", ' % (fieldname, getattr(msg, fieldname))
+            data += ret[0:-2] + '},'
+        return json.loads(data[:-1] + '}')
+
+    status = {}
+    t0 = time.time()
+    for i in range(args.updates):
+        m = msgs[i % len(msgs)]
+        status[m._type] = m
+        if i % 100 < args.polls:
+            json.dumps(old_status(status))
+    dt_old = time.time() - t0
+    print("old polling: %.2fs" % dt_old)
+
+    hub = TelemetryHub(max_subscribers=args.subscribers)
+    subs = [hub.subscribe(parse_rates("%s,%s:10" % (msgs[0]._type, msgs[1]._type))) for i in range(args.subscribers)]
+    t0 = time.time()
+    for i in range(args.updates):
+        hub.update(msgs[i % len(msgs)])
+        if i % 100 < args.polls:
+            hub.status()
+        if i % 10 == 0:
+            for s in subs:
+                s.get(0)
+    dt_new = time.time() - t0
+    print("hub polling with %u subscribers: %.2fs (%.1fx)" % (args.subscribers, dt_new, dt_old / dt_new))
+    for s in subs:
+        print("  " + s.describe())
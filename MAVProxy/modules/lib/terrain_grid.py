@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+'''
+answering TERRAIN_REQUEST a whole grid at a time
+
+A TERRAIN_REQUEST asks for some of the 56 blocks of a grid, 8 blocks
+east by 7 north, each of 4x4 heights grid_spacing apart. TerrainGrid
+finds the positions of all 896 heights at once and looks them up with
+one GetElevationArray call. Grids are kept in an LRU cache by their
+(lat, lon, spacing), as a vehicle asks for the same grids again over a
+mission, and blocks without terrain data yet are looked up again later.
+
+The vehicle repeats its request with the blocks it still needs, which
+tells the responder which blocks arrived. Blocks are sent at a rate
+that rises as they are received and is halved when they are lost or
+the radio reports its transmit buffer filling, between min_rate and
+max_rate blocks per second.
+
+Run this file directly to compare building grids with looking up one
+block at a time, and filling a mission's grids at a fixed 5Hz with the
+adaptive rate over a simulated link
+
+AP_FLAKE8_CLEAN
+'''
+
+import collections
+import time
+
+import numpy as np
+
+from MAVProxy.modules.lib import mp_util
+
+# blocks in a grid, GRID_EAST of them east by GRID_NORTH north
+GRID_BLOCKS = 56
+GRID_EAST = 8
+GRID_NORTH = 7
+# heights along each side of a block
+BLOCK_SIZE = 4
+FULL_MASK = (1 << GRID_BLOCKS) - 1
+
+
+def grid_points(lat, lon, spacing):
+    '''the (lats, lons) arrays, of shape (56, 16), of the heights of each
+    block of the grid at lat, lon in degrees, in TERRAIN_DATA order'''
+    bits = np.arange(GRID_BLOCKS)
+    block_spacing = spacing * BLOCK_SIZE
+    (blat, blon) = mp_util.gps_offset_array(lat, lon,
+                                            block_spacing * (bits % GRID_EAST),
+                                            block_spacing * (bits // GRID_EAST))
+    i = np.arange(BLOCK_SIZE * BLOCK_SIZE)
+    return mp_util.gps_offset_array(blat[:, np.newaxis], blon[:, np.newaxis],
+                                    spacing * (i % BLOCK_SIZE),
+                                    spacing * (i // BLOCK_SIZE))
+
+
+class TerrainGrid(object):
+    '''the heights of one grid. lat and lon are in 1e7 degrees, as in
+    TERRAIN_REQUEST'''
+    def __init__(self, lat, lon, spacing):
+        self.key = (lat, lon, spacing)
+        (self.lats, self.lons) = grid_points(lat * 1.0e-7, lon * 1.0e-7, spacing)
+        self.heights = np.zeros((GRID_BLOCKS, BLOCK_SIZE * BLOCK_SIZE), dtype=int)
+        self.valid = np.zeros(GRID_BLOCKS, dtype=bool)
+        self.valid_mask = 0
+        self.last_update = 0
+
+    def complete(self):
+        return self.valid_mask == FULL_MASK
+
+    def update(self, elevation, now=None):
+        '''look up the blocks not yet known. elevation(lats, lons) returns
+        an array of heights with NaN where unknown'''
+        self.last_update = time.time() if now is None else now
+        missing = np.flatnonzero(~self.valid)
+        if len(missing) == 0:
+            return
+        alts = np.asarray(elevation(self.lats[missing], self.lons[missing]), dtype=float)
+        ok = np.all(np.isfinite(alts), axis=1)
+        idx = missing[ok]
+        # truncated, as int() did
+        self.heights[idx] = np.trunc(alts[ok]).astype(int)
+        self.valid[idx] = True
+        for bit in idx.tolist():
+            self.valid_mask |= 1 << bit
+
+    def block(self, bit):
+        '''the 16 heights of a block, for TERRAIN_DATA'''
+        return self.heights[bit].tolist()
+
+
+class GridCache(object):
+    '''LRU cache of TerrainGrid by (lat, lon, spacing)'''
+    def __init__(self, elevation, size=32, retry=1.0):
+        self.elevation = elevation
+        self.size = max(1, size)
+        self.retry = retry
+        self.grids = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, lat, lon, spacing, now=None):
+        '''the grid, built if not cached, and with any missing blocks
+        looked up again if it has been retry seconds since the last try'''
+        if now is None:
+            now = time.time()
+        key = (lat, lon, spacing)
+        grid = self.grids.pop(key, None)
+        if grid is None:
+            self.misses += 1
+            grid = TerrainGrid(lat, lon, spacing)
+            grid.update(self.elevation, now)
+        else:
+            self.hits += 1
+        self.grids[key] = grid
+        while len(self.grids) > self.size:
+            self.grids.popitem(last=False)
+        self.refresh(grid, now)
+        return grid
+
+    def refresh(self, grid, now):
+        '''look up missing blocks again if it is time to'''
+        if not grid.complete() and now - grid.last_update >= self.retry:
+            grid.update(self.elevation, now)
+
+
+class SendRate(object):
+    '''a token bucket of blocks per second, raised by increase for each
+    block received and halved on losses or a filling radio buffer'''
+    def __init__(self, min_rate=2.0, max_rate=50.0, rate=10.0, increase=1.0):
+        self.min_rate = min_rate
+        self.max_rate = max(min_rate, max_rate)
+        self.rate = min(max(rate, self.min_rate), self.max_rate)
+        self.increase = increase
+        self.tokens = 1.0
+        self.last_t = None
+        self.congested = False
+        self.last_cut = 0
+
+    def take(self, now):
+        '''True if a block may be sent now'''
+        if self.last_t is not None:
+            burst = max(1.0, 0.1 * self.rate)
+            self.tokens = min(burst, self.tokens + (now - self.last_t) * self.rate)
+        self.last_t = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def cut(self, now):
+        '''halve the rate, at most once a second'''
+        if now - self.last_cut < 1.0:
+            return
+        self.last_cut = now
+        self.rate = max(self.min_rate, 0.5 * self.rate)
+
+    def received(self, count):
+        if not self.congested:
+            self.rate = min(self.max_rate, self.rate + count * self.increase)
+
+    def lost(self, count, now):
+        if count > 0:
+            self.cut(now)
+
+    def radio_status(self, txbuf, now):
+        '''adjust for a RADIO_STATUS txbuf, the percentage of the radio's
+        transmit buffer free'''
+        self.congested = txbuf < 50
+        if txbuf < 20:
+            self.cut(now)
+
+
+class TerrainResponder(object):
+    '''answers TERRAIN_REQUEST from a GridCache at a SendRate. Blocks
+    not in a repeated request after they were sent were received, and
+    blocks still requested timeout seconds after being sent were lost'''
+    def __init__(self, elevation, cache_size=32, min_rate=2.0, max_rate=50.0, timeout=1.0):
+        self.cache = GridCache(elevation, cache_size)
+        self.rate = SendRate(min_rate, max_rate)
+        self.timeout = timeout
+        self.grid = None
+        self.mask = 0
+        self.sent = {}
+        self.requests = 0
+        self.blocks_sent = 0
+        self.received = 0
+        self.lost = 0
+
+    def request(self, lat, lon, spacing, mask, now=None):
+        '''handle a TERRAIN_REQUEST'''
+        if now is None:
+            now = time.time()
+        self.requests += 1
+        if self.grid is not None and self.grid.key == (lat, lon, spacing):
+            received = 0
+            lost = 0
+            for bit in list(self.sent.keys()):
+                if not mask & (1 << bit):
+                    received += 1
+                    del self.sent[bit]
+                elif now - self.sent[bit] >= self.timeout:
+                    lost += 1
+                    del self.sent[bit]
+            self.received += received
+            self.lost += lost
+            self.rate.received(received)
+            self.rate.lost(lost, now)
+            self.cache.refresh(self.grid, now)
+        else:
+            self.grid = self.cache.get(lat, lon, spacing, now)
+            self.sent = {}
+        self.mask = mask & FULL_MASK
+
+    def pending(self):
+        '''mask of requested blocks not sent'''
+        ret = self.mask
+        for bit in self.sent:
+            ret &= ~(1 << bit)
+        return ret
+
+    def next_blocks(self, now=None):
+        '''the (bit, heights) of the blocks to send now'''
+        if self.grid is None or not self.mask:
+            return []
+        if now is None:
+            now = time.time()
+        pending = self.pending()
+        if pending & ~self.grid.valid_mask:
+            self.cache.refresh(self.grid, now)
+        pending &= self.grid.valid_mask
+        ret = []
+        bit = 0
+        while pending and self.rate.take(now):
+            while not pending & (1 << bit):
+                bit += 1
+            pending &= ~(1 << bit)
+            self.sent[bit] = now
+            ret.append((bit, self.grid.block(bit)))
+        self.blocks_sent += len(ret)
+        return ret
+
+    def missing(self):
+        '''the number of requested blocks with no terrain data'''
+        if self.grid is None:
+            return 0
+        return bin(self.mask & ~self.grid.valid_mask).count('1')
+
+    def describe(self):
+        return ("rate %.1f/s, %u requests %u blocks sent %u received %u lost, %u missing, "
+                "%u grids cached %u hits %u misses" % (
+                    self.rate.rate, self.requests, self.blocks_sent, self.received, self.lost,
+                    self.missing(), len(self.cache.grids), self.cache.hits, self.cache.misses))
+
+
+if __name__ == '__main__':
+    import random
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='compare whole grid terrain responses with one block at a time')
+    parser.add_argument("--lat", type=float, default=-35.363261)
+    parser.add_argument("--lon", type=float, default=149.165230)
+    parser.add_argument("--spacing", type=int, default=100)
+    parser.add_argument("--grids", type=int, default=12, help="grids along the mission")
+    parser.add_argument("--capacity", type=float, default=40, help="link capacity in blocks per second")
+    parser.add_argument("--buffer", type=int, default=8, help="blocks the link can queue")
+    parser.add_argument("--latency", type=float, default=0.1, help="link latency in seconds")
+    parser.add_argument("--srtm", action='store_true', help="use SRTM terrain rather than generated hills")
+    args = parser.parse_args()
+
+    if args.srtm:
+        from MAVProxy.modules.lib import mp_elevation
+        model = mp_elevation.ElevationModel()
+        GetElevation = model.GetElevation
+        GetElevationArray = model.GetElevationArray
+    else:
+        def GetElevationArray(lats, lons):
+            '''rolling hills'''
+            lats = np.asarray(lats)
+            lons = np.asarray(lons)
+            return 600 + 40 * np.sin(lats * 2000.0) * np.cos(lons * 1500.0)
+
+        def GetElevation(lat, lon):
+            return float(GetElevationArray(lat, lon))
+
+    def old_block(lat, lon, spacing, bit):
+        '''the terrain module's old send_terrain_data_bit lookups'''
+        bit_spacing = spacing * 4
+        (lat, lon) = mp_util.gps_offset(lat, lon, east=bit_spacing * (bit % 8), north=bit_spacing * (bit // 8))
+        data = []
+        for i in range(4 * 4):
+            (lat2, lon2) = mp_util.gps_offset(lat, lon, east=spacing * (i % 4), north=spacing * (i // 4))
+            data.append(int(GetElevation(lat2, lon2)))
+        return data
+
+    # a mission's grids, returning to some of them
+    keys = []
+    for i in range(args.grids):
+        (lat, lon) = mp_util.gps_offset(args.lat, args.lon, east=2800 * (i % 4), north=2800 * (i // 4 % 2))
+        keys.append((int(lat * 1.0e7), int(lon * 1.0e7), args.spacing))
+
+    t0 = time.time()
+    old = [[old_block(k[0] * 1.0e-7, k[1] * 1.0e-7, k[2], bit) for bit in range(GRID_BLOCKS)] for k in keys]
+    t_old = time.time() - t0
+    cache = GridCache(GetElevationArray, size=args.grids)
+    t0 = time.time()
+    new = [cache.get(*k) for k in keys]
+    t_new = time.time() - t0
+    t0 = time.time()
+    for k in keys:
+        cache.get(*k)
+    t_hit = time.time() - t0
+    same = all([old[i][bit] == new[i].block(bit) for i in range(len(keys)) for bit in range(GRID_BLOCKS)])
+    print("%u grids: block at a time %.1fms/grid, whole grid %.2fms/grid, cached %.3fms/grid, same heights: %s" % (
+        len(keys), 1000 * t_old / len(keys), 1000 * t_new / len(keys), 1000 * t_hit / len(keys), same))
+
+    class OldResponder(object):
+        '''the old module: one block every 0.2s, starting again on each request'''
+        def __init__(self):
+            self.key = None
+            self.mask = 0
+            self.sent_mask = 0
+            self.last_send = 0
+            self.blocks_sent = 0
+
+        def request(self, lat, lon, spacing, mask, now):
+            self.key = (lat, lon, spacing)
+            self.mask = mask
+            self.sent_mask = 0
+
+        def next_blocks(self, now):
+            if now - self.last_send < 0.2:
+                return []
+            for bit in range(GRID_BLOCKS):
+                if self.mask & (1 << bit) and not self.sent_mask & (1 << bit):
+                    self.sent_mask |= 1 << bit
+                    self.last_send = now
+                    self.blocks_sent += 1
+                    return [(bit, None)]
+            return []
+
+    def simulate(responder, dt=0.01, request_interval=0.5, limit=3600):
+        '''a vehicle asking for each grid in turn over a link of limited
+        capacity, returning the seconds to fill them all'''
+        rng = random.Random(1)
+        now = 0
+        queue = collections.deque()
+        link_free = 0
+        for key in keys:
+            have = 0
+            last_request = -request_interval
+            while have != FULL_MASK:
+                if now > limit:
+                    return None
+                while queue and queue[0][0] <= now:
+                    have |= 1 << queue.popleft()[1]
+                if now - last_request >= request_interval:
+                    last_request = now
+                    responder.request(key[0], key[1], key[2], FULL_MASK & ~have, now)
+                for (bit, data) in responder.next_blocks(now):
+                    # the link queues a few blocks and drops the rest, and
+                    # loses one in a hundred
+                    if len(queue) >= args.buffer or rng.random() < 0.01:
+                        continue
+                    link_free = max(link_free, now) + 1.0 / args.capacity
+                    queue.append((link_free + args.latency, bit))
+                now += dt
+        return now
+
+    t = simulate(OldResponder())
+    print("fixed 5Hz: %.1fs to fill %u grids (%.1fs per grid)" % (t, len(keys), t / len(keys)))
+    responder = TerrainResponder(GetElevationArray, cache_size=args.grids)
+    t = simulate(responder)
+    print("adaptive, %.0f blocks/s link: %.1fs (%.1fs per grid)" % (args.capacity, t, t / len(keys)))
+    print("  " + responder.describe())
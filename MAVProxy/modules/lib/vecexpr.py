@@ -0,0 +1,997 @@
+#!/usr/bin/env python3
+'''
+vectorised evaluation of graph expressions
+
+Graph expressions such as "degrees(ATT.Roll)*2" or
+"MAG.MagX-expected_mag_yaw(GPS,ATT,MAG).x{GPS.Status>=3}" are normally
+evaluated with eval() once per message against a dict holding the
+latest message of each type. This module compiles an expression once
+into Python code over NumPy arrays and evaluates it over the columns in
+a logcolumns.LogColumns in one go.
+
+Each output row is triggered by one message of a type named in the
+expression, exactly as in the per message path, and every message type
+the expression refers to is aligned to the row as the latest message of
+that type before it in the log. Rows where a referenced message has not
+been seen yet are dropped, as are infinite values from division by zero.
+
+compile_expression() returns None for expressions that can't be
+vectorised; evaluation raises Unsupported if an expression turns out to
+need something the columns don't have (for example a text field). In
+both cases the caller should fall back to the per message path.
+
+The mavextra helpers used by the stock graphs are implemented here with
+the same semantics. State for lowpass(), diff() and delta() is kept per
+expression rather than being shared between expressions with the same key.
+
+Run this file directly with a log filename for a benchmark over the
+graph definitions in MAVProxy/tools/graphs
+
+AP_FLAKE8_CLEAN
+'''
+
+import ast
+import re
+
+import numpy as np
+
+# the same patterns grapher uses to find message types in an expression
+re_caps = re.compile(r'[A-Z_][A-Z0-9_]+')
+re_instance = re.compile(r'([A-Z_][A-Z0-9_]+)\[([0-9A-Z_]+)\]')
+
+
+class Unsupported(Exception):
+    '''raised when an expression can't be evaluated over columns'''
+    pass
+
+
+def split_condition(expression):
+    '''split EXPRESSION{CONDITION} into its parts'''
+    if expression.endswith('}'):
+        startidx = expression.rfind('{')
+        if startidx != -1:
+            return (expression[:startidx], expression[startidx+1:-1])
+    return (expression, None)
+
+
+class Vec3(object):
+    '''a vector of arrays, standing in for rotmat.Vector3'''
+    def __init__(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
+
+    def __add__(self, v):
+        return Vec3(self.x + v.x, self.y + v.y, self.z + v.z)
+
+    def __sub__(self, v):
+        return Vec3(self.x - v.x, self.y - v.y, self.z - v.z)
+
+    def __neg__(self):
+        return Vec3(-self.x, -self.y, -self.z)
+
+    def __mul__(self, s):
+        return Vec3(self.x * s, self.y * s, self.z * s)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, s):
+        return Vec3(self.x / s, self.y / s, self.z / s)
+
+    def length(self):
+        return np.sqrt(self.x**2 + self.y**2 + self.z**2)
+
+
+class Mat3(object):
+    '''a matrix of arrays, standing in for rotmat.Matrix3'''
+    def __init__(self, a, b, c):
+        self.a = a
+        self.b = b
+        self.c = c
+
+    @staticmethod
+    def from_euler(roll, pitch, yaw):
+        '''matrix from Euler angles in radians, as Matrix3.from_euler()'''
+        cp = np.cos(pitch)
+        sp = np.sin(pitch)
+        sr = np.sin(roll)
+        cr = np.cos(roll)
+        sy = np.sin(yaw)
+        cy = np.cos(yaw)
+        return Mat3(Vec3(cp * cy, (sr * sp * cy) - (cr * sy), (cr * sp * cy) + (sr * sy)),
+                    Vec3(cp * sy, (sr * sp * sy) + (cr * cy), (cr * sp * sy) - (sr * cy)),
+                    Vec3(-sp, sr * cp, cr * cp))
+
+    def transposed(self):
+        return Mat3(Vec3(self.a.x, self.b.x, self.c.x),
+                    Vec3(self.a.y, self.b.y, self.c.y),
+                    Vec3(self.a.z, self.b.z, self.c.z))
+
+    def __mul__(self, v):
+        return Vec3(self.a.x * v.x + self.a.y * v.y + self.a.z * v.z,
+                    self.b.x * v.x + self.b.y * v.y + self.b.z * v.z,
+                    self.c.x * v.x + self.c.y * v.y + self.c.z * v.z)
+
+
+class MsgVec(object):
+    '''the fields of one message type aligned to the rows of a RowFrame'''
+    def __init__(self, frame, name):
+        self._frame = frame
+        self._name = name
+
+    def has(self, field):
+        return self._frame.has_field(self._name, field)
+
+    def __getattr__(self, field):
+        if field.startswith('__'):
+            raise AttributeError(field)
+        return self._frame.field(self._name, field)
+
+
+class RowFrame(object):
+    '''a set of rows, one per message of the trigger types, with other
+    message types aligned to them.
+
+    sources maps a reference name to (mtype, instance) where instance is
+    None for all messages of the type. The rows are triggered by the
+    names listed in triggers. If msg_types is given then other message
+    types are treated as not being in the log, as they are never read
+    by the per message path'''
+    def __init__(self, columns, sources, triggers, msg_types=None):
+        self.columns = columns
+        self.sources = sources
+        self.msg_types = msg_types
+        self.cols = {}
+        self.index_cache = {}
+        self.field_cache = {}
+        self.triggers = [t for t in triggers if self.source(t) is not None]
+        # rows are in log order when we know it, so messages with the
+        # same timestamp line up as they do when reading the log
+        trigger_cols = [self.source(t) for t in self.triggers]
+        self.use_position = all([c.position is not None for c in trigger_cols])
+        parts_t = [np.zeros(0)]
+        parts_p = [np.zeros(0, dtype=np.int64)]
+        parts_src = [np.zeros(0, dtype=np.int32)]
+        parts_idx = [np.zeros(0, dtype=np.int64)]
+        for k in range(len(trigger_cols)):
+            c = trigger_cols[k]
+            parts_t.append(c.timestamp)
+            if self.use_position:
+                parts_p.append(c.position)
+            parts_src.append(np.full(len(c), k, dtype=np.int32))
+            parts_idx.append(np.arange(len(c), dtype=np.int64))
+        t = np.concatenate(parts_t)
+        if self.use_position:
+            p = np.concatenate(parts_p)
+            order = np.argsort(p, kind='stable')
+            self.position = p[order]
+        else:
+            order = np.argsort(t, kind='stable')
+            self.position = None
+        self.timestamp = t[order]
+        self.src = np.concatenate(parts_src)[order]
+        self.src_idx = np.concatenate(parts_idx)[order]
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def select(self, mask):
+        '''keep only the rows in mask'''
+        self.timestamp = self.timestamp[mask]
+        if self.position is not None:
+            self.position = self.position[mask]
+        self.src = self.src[mask]
+        self.src_idx = self.src_idx[mask]
+        self.index_cache = {}
+        self.field_cache = {}
+
+    def source(self, name):
+        '''return the MessageColumns for a reference name'''
+        if name in self.cols:
+            return self.cols[name]
+        (mtype, instance) = self.sources[name]
+        if self.msg_types is not None and mtype not in self.msg_types:
+            cols = None
+        else:
+            cols = self.columns.get(mtype)
+        if cols is not None and instance is not None:
+            mask = cols.instance_mask(instance)
+            if mask is None:
+                raise Unsupported("%s has no instances" % mtype)
+            if not np.any(mask):
+                cols = None
+            else:
+                from MAVProxy.modules.lib.logcolumns import MessageColumns
+                position = cols.position[mask] if cols.position is not None else None
+                cols = MessageColumns(cols.name, cols.timestamp[mask],
+                                      dict([(k, v[mask]) for (k, v) in cols.columns.items()]),
+                                      cols.instance_field, position)
+        self.cols[name] = cols
+        return cols
+
+    def index(self, name):
+        '''index into a source for each row, -1 where there is no message yet'''
+        if name in self.index_cache:
+            return self.index_cache[name]
+        cols = self.source(name)
+        if cols is None:
+            idx = np.full(len(self), -1, dtype=np.int64)
+        else:
+            if self.position is not None and cols.position is not None:
+                idx = np.searchsorted(cols.position, self.position, side='right') - 1
+            else:
+                idx = np.searchsorted(cols.timestamp, self.timestamp, side='right') - 1
+            if name in self.triggers:
+                k = self.triggers.index(name)
+                own = self.src == k
+                idx[own] = self.src_idx[own]
+        self.index_cache[name] = idx
+        return idx
+
+    def present(self, names):
+        '''mask of rows where all of a set of references have a message'''
+        mask = np.ones(len(self), dtype=bool)
+        for name in names:
+            mask &= self.index(name) >= 0
+        return mask
+
+    def has_field(self, name, field):
+        cols = self.source(name)
+        return cols is not None and field in cols
+
+    def field(self, name, field):
+        '''the value of a field for each row, NaN where there is no message'''
+        key = (name, field)
+        if key in self.field_cache:
+            return self.field_cache[key]
+        cols = self.source(name)
+        idx = self.index(name)
+        if cols is None:
+            ret = np.full(len(self), np.nan)
+        else:
+            if field == '_timestamp':
+                data = cols.timestamp
+            elif field in cols:
+                data = cols.field(field)
+            else:
+                raise Unsupported("%s.%s is not a numeric field" % (cols.name, field))
+            if len(data) == 0:
+                ret = np.full(len(self), np.nan)
+            else:
+                ret = data[np.maximum(idx, 0)].astype(np.float64)
+                ret[idx < 0] = np.nan
+        self.field_cache[key] = ret
+        return ret
+
+
+def _ok(v):
+    return ~np.isnan(v)
+
+
+def lowpass(var, key, factor):
+    '''a simple lowpass filter, skipping NaN rows as mavextra.lowpass skips None'''
+    var = np.asarray(var, dtype=np.float64)
+    ret = np.full(len(var), np.nan)
+    ok = np.flatnonzero(_ok(var))
+    if len(ok) == 0:
+        return ret
+    x = var[ok]
+    try:
+        from scipy.signal import lfilter
+        y = lfilter([1.0 - factor], [1.0, -factor], x, zi=[factor * x[0]])[0]
+    except ImportError:
+        y = np.empty(len(x))
+        state = x[0]
+        for i in range(len(x)):
+            state = factor * state + (1.0 - factor) * x[i]
+            y[i] = state
+    ret[ok] = y
+    return ret
+
+
+def diff(var, key):
+    '''differences between successive values'''
+    var = np.asarray(var, dtype=np.float64)
+    ret = np.full(len(var), np.nan)
+    ok = _ok(var)
+    v = var[ok]
+    if len(v) > 0:
+        ret[ok] = np.diff(v, prepend=v[0])
+    return ret
+
+
+def delta(var, key, tusec=None):
+    '''slope of a value over time'''
+    if tusec is None:
+        # this uses the timestamp of the log object, which is only
+        # meaningful when reading the log one message at a time
+        raise Unsupported("delta without a time")
+    var = np.asarray(var, dtype=np.float64)
+    tnow = np.asarray(tusec, dtype=np.float64) * 1.0e-6
+    ret = np.full(len(var), np.nan)
+    ok = _ok(var)
+    v = var[ok]
+    t = np.broadcast_to(tnow, var.shape)[ok]
+    if len(v) == 0:
+        return ret
+    # a repeated timestamp returns the last slope without updating the
+    # state, so the slope is between the first rows of runs of equal time
+    start = np.ones(len(t), dtype=bool)
+    start[1:] = t[1:] != t[:-1]
+    starts = np.flatnonzero(start)
+    vs = v[starts]
+    ts = t[starts]
+    r = np.zeros(len(starts))
+    r[1:] = (vs[1:] - vs[:-1]) / (ts[1:] - ts[:-1])
+    ret[ok] = r[np.cumsum(start) - 1]
+    return ret
+
+
+def wrap_360(angle):
+    angle = np.where(angle > 360, angle - 360.0, angle)
+    return np.where(angle < 0, angle + 360.0, angle)
+
+
+def wrap_180(angle):
+    angle = np.where(angle > 180, angle - 360.0, angle)
+    return np.where(angle < -180, angle + 360.0, angle)
+
+
+def get_mag_field_ef(lat, lon):
+    '''vectorised mavextra.get_mag_field_ef, returns (declination, inclination, intensity)'''
+    from pymavlink import mavextra
+    res = mavextra.SAMPLING_RES
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    inside = ((lat >= mavextra.SAMPLING_MIN_LAT) & (lat < mavextra.SAMPLING_MAX_LAT) &
+              (lon >= mavextra.SAMPLING_MIN_LON) & (lon < mavextra.SAMPLING_MAX_LON))
+    lat = np.where(inside, lat, 0.0)
+    lon = np.where(inside, lon, 0.0)
+    min_lat = np.trunc(np.floor(lat / res) * res)
+    min_lon = np.trunc(np.floor(lon / res) * res)
+    lat_i = (np.floor(-mavextra.SAMPLING_MIN_LAT + min_lat) / res).astype(int)
+    lon_i = (np.floor(-mavextra.SAMPLING_MIN_LON + min_lon) / res).astype(int)
+    ret = []
+    for table in (mavextra.declination_table, mavextra.inclination_table, mavextra.intensity_table):
+        table = np.asarray(table, dtype=np.float64)
+        sw = table[lat_i, lon_i]
+        se = table[lat_i, lon_i + 1]
+        ne = table[lat_i + 1, lon_i + 1]
+        nw = table[lat_i + 1, lon_i]
+        dmin = ((lon - min_lon) / res) * (se - sw) + sw
+        dmax = ((lon - min_lon) / res) * (ne - nw) + nw
+        v = ((lat - min_lat) / res) * (dmax - dmin) + dmin
+        ret.append(np.where(inside, v, np.nan))
+    return ret
+
+
+def get_lat_lon_status(GPS):
+    if GPS.has('fix_type'):
+        return (GPS.lat*1.0e-7, GPS.lon*1.0e-7, GPS.fix_type)
+    return (GPS.Lat, GPS.Lng, GPS.Status)
+
+
+def expected_earth_field_lat_lon(lat, lon):
+    (dec, inc, intensity) = get_mag_field_ef(lat, lon)
+    R = Mat3.from_euler(0.0, -np.radians(inc), np.radians(dec))
+    return R * Vec3(intensity*1000.0, 0.0, 0.0)
+
+
+def expected_earth_field(GPS):
+    '''return expected magnetic field for a location'''
+    (lat, lon, gps_status) = get_lat_lon_status(GPS)
+    ef = expected_earth_field_lat_lon(lat, lon)
+    nofix = gps_status < 3
+    return Vec3(np.where(nofix, 0.0, ef.x), np.where(nofix, 0.0, ef.y), np.where(nofix, 0.0, ef.z))
+
+
+def expected_mag(GPS, ATT, roll_adjust=0, pitch_adjust=0, yaw_adjust=0):
+    '''return expected magnetic field for a location and attitude'''
+    earth_field = expected_earth_field(GPS)
+    if ATT.has('roll'):
+        roll = np.degrees(ATT.roll)+roll_adjust
+        pitch = np.degrees(ATT.pitch)+pitch_adjust
+        yaw = np.degrees(ATT.yaw)+yaw_adjust
+    else:
+        roll = ATT.Roll+roll_adjust
+        pitch = ATT.Pitch+pitch_adjust
+        yaw = ATT.Yaw+yaw_adjust
+    rot = Mat3.from_euler(np.radians(roll), np.radians(pitch), np.radians(yaw))
+    return rot.transposed() * earth_field
+
+
+def rotation_df(ATT):
+    '''return the current DCM rotation matrix'''
+    return Mat3.from_euler(np.radians(ATT.Roll), np.radians(ATT.Pitch), np.radians(ATT.Yaw))
+
+
+def heading_from_dcm(mag, dcm_matrix, declination):
+    cos_pitch_sq = 1.0-(dcm_matrix.c.x*dcm_matrix.c.x)
+    headY = mag.y * dcm_matrix.c.z - mag.z * dcm_matrix.c.y
+    headX = mag.x * cos_pitch_sq - dcm_matrix.c.x * (mag.y * dcm_matrix.c.y + mag.z * dcm_matrix.c.z)
+    heading = np.degrees(np.arctan2(-headY, headX)) + declination
+    return np.where(heading < 0, heading + 360, heading)
+
+
+def mag_yaw(GPS, ATT, MAG):
+    '''calculate heading from raw magnetometer'''
+    (lat, lon, gps_status) = get_lat_lon_status(GPS)
+    declination = get_mag_field_ef(lat, lon)[0]
+    return heading_from_dcm(Vec3(MAG.MagX, MAG.MagY, MAG.MagZ), rotation_df(ATT), declination)
+
+
+def expected_mag_yaw(GPS, ATT, MAG, roll_adjust=0, pitch_adjust=0, yaw_adjust=0):
+    '''return expected magnetic field for a location and attitude'''
+    earth_field = expected_earth_field(GPS)
+    roll = ATT.Roll+roll_adjust
+    pitch = ATT.Pitch+pitch_adjust
+    yaw = mag_yaw(GPS, ATT, MAG)
+    rot = Mat3.from_euler(np.radians(roll), np.radians(pitch), np.radians(yaw))
+    return rot.transposed() * earth_field
+
+
+def earth_field_error(GPS, NKF2):
+    '''return vector error in earth field estimate'''
+    return Vec3(NKF2.MN, NKF2.ME, NKF2.MD) - expected_earth_field(GPS)
+
+
+def earth_accel_df(IMU, ATT):
+    '''return earth frame acceleration vector from df log'''
+    return rotation_df(ATT) * Vec3(IMU.AccX, IMU.AccY, IMU.AccZ)
+
+
+def gps_velocity_df(GPS):
+    '''return GPS velocity vector'''
+    return Vec3(GPS.Spd * np.cos(np.radians(GPS.GCrs)), GPS.Spd * np.sin(np.radians(GPS.GCrs)), GPS.VZ)
+
+
+def mag_field(RAW_IMU, SENSOR_OFFSETS=None, ofs=None):
+    '''calculate magnetic field strength from raw magnetometer'''
+    if SENSOR_OFFSETS is not None and ofs is not None:
+        raise Unsupported("mag_field offsets")
+    return np.sqrt(RAW_IMU.xmag**2 + RAW_IMU.ymag**2 + RAW_IMU.zmag**2)
+
+
+def corrected_mag_df(MAG, ofs=None, diagonals=None, offdiagonals=None):
+    '''raw dataflash magnetometer vector with replacement offsets'''
+    if diagonals is not None or offdiagonals is not None:
+        raise Unsupported("mag scaling")
+    mag = Vec3(MAG.MagX, MAG.MagY, MAG.MagZ)
+    if ofs is not None:
+        mag = (mag - Vec3(MAG.OfsX, MAG.OfsY, MAG.OfsZ)) + Vec3(ofs[0], ofs[1], ofs[2])
+    return mag
+
+
+def mag_field_df(MAG, ofs=None, diagonals=None, offdiagonals=None):
+    '''calculate magnetic field strength from raw magnetometer (dataflash version)'''
+    return corrected_mag_df(MAG, ofs, diagonals, offdiagonals).length()
+
+
+def param(name, default):
+    '''a parameter from the log being graphed'''
+    from pymavlink import mavutil
+    return mavutil.mavfile_global.param(name, default)
+
+
+def rotation(ATTITUDE):
+    '''return the current DCM rotation matrix'''
+    if ATTITUDE.has('roll'):
+        return Mat3.from_euler(ATTITUDE.roll, ATTITUDE.pitch, ATTITUDE.yaw)
+    return rotation_df(ATTITUDE)
+
+
+def mag_heading(RAW_IMU, ATTITUDE, declination=None, SENSOR_OFFSETS=None, ofs=None):
+    '''calculate heading from raw magnetometer'''
+    if SENSOR_OFFSETS is not None and ofs is not None:
+        raise Unsupported("mag_heading offsets")
+    if declination is None:
+        declination = np.degrees(param('COMPASS_DEC', 0))
+    mag = Vec3(RAW_IMU.xmag, RAW_IMU.ymag, RAW_IMU.zmag)
+    return heading_from_dcm(mag, rotation(ATTITUDE), declination)
+
+
+def mag_heading_df(MAG, ATT, declination=None, ofs=None, diagonals=None, offdiagonals=None):
+    '''calculate heading from raw magnetometer'''
+    if declination is None:
+        declination = np.degrees(param('COMPASS_DEC', 0))
+    return heading_from_dcm(corrected_mag_df(MAG, ofs, diagonals, offdiagonals), rotation_df(ATT), declination)
+
+
+def altitude(SCALED_PRESSURE, ground_pressure=None, ground_temp=None):
+    '''calculate barometric altitude'''
+    if ground_pressure is None:
+        if param('GND_ABS_PRESS', None) is None:
+            return np.zeros(len(SCALED_PRESSURE.press_abs))
+        ground_pressure = param('GND_ABS_PRESS', 1)
+    if ground_temp is None:
+        ground_temp = param('GND_TEMP', 0)
+    scaling = ground_pressure / (SCALED_PRESSURE.press_abs*100.0)
+    temp = ground_temp + 273.15
+    return np.log(scaling) * temp * 29271.267 * 0.001
+
+
+def gravity(RAW_IMU, SENSOR_OFFSETS=None, ofs=None, mul=None, smooth=0.7):
+    '''estimate pitch from accelerometer'''
+    if SENSOR_OFFSETS is not None and ofs is not None:
+        raise Unsupported("gravity offsets")
+    if RAW_IMU.has('xacc'):
+        rx = RAW_IMU.xacc * 9.81 / 1000.0
+        ry = RAW_IMU.yacc * 9.81 / 1000.0
+        rz = RAW_IMU.zacc * 9.81 / 1000.0
+    else:
+        rx = RAW_IMU.AccX
+        ry = RAW_IMU.AccY
+        rz = RAW_IMU.AccZ
+    return np.sqrt(rx**2+ry**2+rz**2)
+
+
+def get_lat_lon_alt(MSG):
+    '''gets lat and lon in radians and alt in meters from a position msg'''
+    if MSG.has('Lat') and MSG.has('Lng'):
+        return (np.radians(MSG.Lat), np.radians(MSG.Lng), MSG.Alt)
+    if MSG.has('Lat') and MSG.has('Lon'):
+        return (np.radians(MSG.Lat), np.radians(MSG.Lon), MSG.Alt)
+    if MSG.has('cog'):
+        return (np.radians(MSG.lat)*1.0e-7, np.radians(MSG.lon)*1.0e-7, MSG.alt*0.001)
+    if MSG.has('lat') and MSG.has('lon'):
+        return (np.radians(MSG.lat), np.radians(MSG.lon), MSG.alt*0.001)
+    if MSG.has('lat') and MSG.has('lng'):
+        return (np.radians(MSG.lat), np.radians(MSG.lng), MSG.alt*0.001)
+    raise Unsupported("no position in message")
+
+
+def distance_lat_lon_alt(pos1, pos2, horizontal=True):
+    (lat1, lon1, alt1) = pos1
+    (lat2, lon2, alt2) = pos2
+    dLat = lat2 - lat1
+    dLon = lon2 - lon1
+    a = np.sin(0.5*dLat)**2 + np.sin(0.5*dLon)**2 * np.cos(lat1) * np.cos(lat2)
+    c = 2.0 * np.arctan2(np.sqrt(a), np.sqrt(1.0-a))
+    ground_dist = 6371 * 1000 * c
+    if horizontal:
+        return ground_dist
+    return np.sqrt(ground_dist**2 + (alt2-alt1)**2)
+
+
+def distance_two(MSG1, MSG2, horizontal=True):
+    '''distance between two points'''
+    return distance_lat_lon_alt(get_lat_lon_alt(MSG1), get_lat_lon_alt(MSG2), horizontal)
+
+
+def distance_home(GPS_RAW):
+    '''distance from first fix point'''
+    if GPS_RAW.has('fix_type'):
+        status = GPS_RAW.fix_type
+    else:
+        status = GPS_RAW.Status
+    (lat, lon, alt) = get_lat_lon_alt(GPS_RAW)
+    fix = np.flatnonzero(status >= 2)
+    ret = np.zeros(len(status))
+    ret[np.isnan(status)] = np.nan
+    if len(fix) == 0:
+        return ret
+    first = fix[0]
+    d = distance_lat_lon_alt((lat, lon, alt), (lat[first], lon[first], alt[first]))
+    return np.where(status >= 2, d, ret)
+
+
+def sim_body_rates(SIM):
+    '''return body frame rates from simulator attitudes'''
+    rollRate = delta(SIM.Roll, 'sbr', SIM.TimeUS)
+    pitchRate = delta(SIM.Pitch, 'sbp', SIM.TimeUS)
+    yawRate = delta(SIM.Yaw, 'sby', SIM.TimeUS)
+    phi = np.radians(SIM.Roll)
+    theta = np.radians(SIM.Pitch)
+    phiDot = np.radians(rollRate)
+    thetaDot = np.radians(pitchRate)
+    psiDot = np.radians(yawRate)
+    p = phiDot - psiDot*np.sin(theta)
+    q = np.cos(phi)*thetaDot + np.sin(phi)*psiDot*np.cos(theta)
+    r = np.cos(phi)*psiDot*np.cos(theta) - np.sin(phi)*thetaDot
+    return Vec3(p, q, r)
+
+
+def _min(*args):
+    if len(args) < 2:
+        raise Unsupported("min of a sequence")
+    ret = args[0]
+    for a in args[1:]:
+        ret = np.minimum(ret, a)
+    return ret
+
+
+def _max(*args):
+    if len(args) < 2:
+        raise Unsupported("max of a sequence")
+    ret = args[0]
+    for a in args[1:]:
+        ret = np.maximum(ret, a)
+    return ret
+
+
+def _and(*args):
+    ret = args[0] != 0
+    for a in args[1:]:
+        ret = np.logical_and(ret, a != 0)
+    return ret
+
+
+def _or(*args):
+    ret = args[0] != 0
+    for a in args[1:]:
+        ret = np.logical_or(ret, a != 0)
+    return ret
+
+
+def _bitop(op, a, b):
+    '''integer operators on float columns'''
+    a = np.asarray(a)
+    b = np.asarray(b)
+    bad = np.isnan(a) | np.isnan(b)
+    ai = np.where(bad, 0, a).astype(np.int64)
+    bi = np.where(bad, 0, b).astype(np.int64)
+    ret = {'&': np.bitwise_and, '|': np.bitwise_or, '^': np.bitwise_xor,
+           '<<': np.left_shift, '>>': np.right_shift}[op](ai, bi).astype(np.float64)
+    return np.where(bad, np.nan, ret)
+
+
+# functions and constants available to vectorised expressions, the
+# names are the same as in math and mavextra
+namespace = {
+    'degrees': np.degrees, 'radians': np.radians,
+    'sqrt': np.sqrt, 'sin': np.sin, 'cos': np.cos, 'tan': np.tan,
+    'asin': np.arcsin, 'acos': np.arccos, 'atan': np.arctan, 'atan2': np.arctan2,
+    'exp': np.exp, 'log': np.log, 'log10': np.log10, 'fabs': np.fabs, 'abs': np.abs,
+    'floor': np.floor, 'ceil': np.ceil, 'pow': np.power, 'hypot': np.hypot,
+    'isnan': np.isnan, 'min': _min, 'max': _max,
+    'pi': np.pi, 'e': np.e,
+    'wrap_360': wrap_360, 'wrap_180': wrap_180,
+    'lowpass': lowpass, 'diff': diff, 'delta': delta,
+    'expected_earth_field': expected_earth_field, 'expected_mag': expected_mag,
+    'mag_yaw': mag_yaw, 'expected_mag_yaw': expected_mag_yaw,
+    'earth_field_error': earth_field_error, 'rotation_df': rotation_df,
+    'earth_accel_df': earth_accel_df, 'gps_velocity_df': gps_velocity_df,
+    'mag_field': mag_field, 'mag_field_df': mag_field_df, 'gravity': gravity,
+    'rotation': rotation, 'mag_heading': mag_heading, 'mag_heading_df': mag_heading_df,
+    'altitude': altitude,
+    'distance_two': distance_two, 'distance_home': distance_home,
+    'sim_body_rates': sim_body_rates,
+    '_and': _and, '_or': _or, '_not': np.logical_not, '_where': np.where, '_bitop': _bitop,
+}
+
+bitops = {ast.BitAnd: '&', ast.BitOr: '|', ast.BitXor: '^', ast.LShift: '<<', ast.RShift: '>>'}
+
+
+class _Rewriter(ast.NodeTransformer):
+    '''rewrite an expression AST into one that works on arrays'''
+    def __init__(self):
+        self.sources = {}
+
+    def _call(self, name, args):
+        return ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args, keywords=[])
+
+    def visit_Name(self, node):
+        if node.id in namespace and not node.id.startswith('_'):
+            return node
+        if re_caps.fullmatch(node.id) is not None:
+            self.sources[node.id] = (node.id, None)
+            return node
+        raise Unsupported("unknown name %s" % node.id)
+
+    def visit_Subscript(self, node):
+        # MSG[instance] becomes a reference to just that instance
+        idx = node.slice
+        if isinstance(idx, ast.Index):
+            idx = idx.value
+        if (isinstance(node.value, ast.Name) and re_caps.fullmatch(node.value.id) is not None and
+                isinstance(idx, ast.Constant) and isinstance(idx.value, int)):
+            name = '_inst_%s_%u' % (node.value.id, idx.value)
+            self.sources[name] = (node.value.id, idx.value)
+            return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+        raise Unsupported("subscript")
+
+    def visit_Attribute(self, node):
+        if isinstance(node.value, ast.Attribute):
+            raise Unsupported("nested attribute")
+        self.generic_visit(node)
+        return node
+
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.func.id not in namespace or node.func.id.startswith('_'):
+            if isinstance(node.func, ast.Attribute) and node.func.attr == 'length':
+                self.generic_visit(node)
+                return node
+            raise Unsupported("unknown function")
+        args = [self.visit(a) for a in node.args]
+        keywords = [ast.keyword(arg=k.arg, value=self.visit(k.value)) for k in node.keywords]
+        return ast.copy_location(ast.Call(func=node.func, args=args, keywords=keywords), node)
+
+    def visit_BoolOp(self, node):
+        values = [self.visit(v) for v in node.values]
+        name = '_and' if isinstance(node.op, ast.And) else '_or'
+        return ast.copy_location(self._call(name, values), node)
+
+    def visit_UnaryOp(self, node):
+        operand = self.visit(node.operand)
+        if isinstance(node.op, ast.Not):
+            return ast.copy_location(self._call('_not', [operand]), node)
+        if isinstance(node.op, ast.Invert):
+            raise Unsupported("invert")
+        node.operand = operand
+        return node
+
+    def visit_BinOp(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if type(node.op) in bitops:
+            return ast.copy_location(self._call('_bitop', [ast.Constant(value=bitops[type(node.op)]), left, right]),
+                                     node)
+        node.left = left
+        node.right = right
+        return node
+
+    def visit_Compare(self, node):
+        left = self.visit(node.left)
+        comparators = [self.visit(c) for c in node.comparators]
+        if len(node.ops) == 1:
+            node.left = left
+            node.comparators = comparators
+            return node
+        parts = []
+        for (op, right) in zip(node.ops, comparators):
+            parts.append(ast.Compare(left=left, ops=[op], comparators=[right]))
+            left = right
+        return ast.copy_location(self._call('_and', parts), node)
+
+    def visit_IfExp(self, node):
+        args = [self.visit(node.test), self.visit(node.body), self.visit(node.orelse)]
+        return ast.copy_location(self._call('_where', args), node)
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, (int, float, str)) and not isinstance(node.value, bool):
+            return node
+        raise Unsupported("constant")
+
+    def generic_visit(self, node):
+        if not isinstance(node, (ast.Expression, ast.Attribute, ast.Load, ast.operator, ast.unaryop,
+                                 ast.cmpop, ast.keyword, ast.Tuple)):
+            raise Unsupported(type(node).__name__)
+        return ast.NodeTransformer.generic_visit(self, node)
+
+
+def compile_part(expression):
+    '''compile one expression to (code, sources)'''
+    tree = ast.parse(expression.strip(), mode='eval')
+    r = _Rewriter()
+    tree = ast.fix_missing_locations(r.visit(tree))
+    return (compile(tree, '<vecexpr>', 'eval'), r.sources)
+
+
+class VecExpression(object):
+    '''a graph expression compiled for evaluation over columns'''
+    def __init__(self, expression):
+        self.expression = expression
+        (expr, cond) = split_condition(expression)
+        (self.code, self.value_sources) = compile_part(expr)
+        self.sources = dict(self.value_sources)
+        self.cond_code = None
+        self.cond_sources = {}
+        if cond is not None:
+            (self.cond_code, self.cond_sources) = compile_part(cond)
+            self.sources.update(self.cond_sources)
+
+    def evaluate(self, frame):
+        '''evaluate over a RowFrame, returning (values, mask) where mask
+        selects the rows that give a value'''
+        env = {}
+        for name in self.sources:
+            env[name] = MsgVec(frame, name)
+        n = len(frame)
+        with np.errstate(all='ignore'):
+            mask = frame.present(self.value_sources)
+            if self.cond_code is not None:
+                c = self._run(self.cond_code, env, n)
+                # NaN is true, as it is in python
+                mask &= frame.present(self.cond_sources) & (c != 0)
+            v = self._run(self.code, env, n)
+            # division by zero gives no value in the per message path
+            mask &= ~np.isinf(v)
+        return (v, mask)
+
+    def _run(self, code, env, n):
+        try:
+            v = eval(code, namespace, env)
+        except Unsupported:
+            raise
+        except (TypeError, AttributeError, ValueError, IndexError) as ex:
+            raise Unsupported(str(ex))
+        if isinstance(v, (Vec3, Mat3, MsgVec)):
+            raise Unsupported("expression is not a number")
+        v = np.asarray(v)
+        if v.dtype.kind not in 'biuf':
+            raise Unsupported("expression is not a number")
+        if v.ndim == 0:
+            v = np.full(n, v, dtype=np.float64)
+        elif v.shape != (n,):
+            raise Unsupported("expression has the wrong shape")
+        return v.astype(np.float64)
+
+
+def compile_expression(expression):
+    '''compile a graph expression, returning None if it can't be vectorised'''
+    try:
+        return VecExpression(expression)
+    except (Unsupported, SyntaxError, ValueError):
+        return None
+
+
+def trigger_sources(field):
+    '''work out the rows a graph field is evaluated on, following
+    grapher's rules: one row per message of each type named in the
+    field, or only the named instances of a type if it is indexed'''
+    instances = {}
+    for (itype, ivalue) in re.findall(re_instance, field):
+        if not ivalue.isdigit():
+            raise Unsupported("non-numeric instance")
+        instances.setdefault(itype, set()).add(int(ivalue))
+    sources = {}
+    triggers = []
+    for mtype in sorted(set(re.findall(re_caps, field))):
+        if mtype in instances:
+            for ins in sorted(instances[mtype]):
+                name = '_inst_%s_%u' % (mtype, ins)
+                sources[name] = (mtype, ins)
+                triggers.append(name)
+        else:
+            sources[mtype] = (mtype, None)
+            triggers.append(mtype)
+    return (sources, triggers)
+
+
+def rate_mask(timestamp, min_dt):
+    '''greedy thinning of a sorted set of timestamps to a minimum spacing'''
+    keep = np.zeros(len(timestamp), dtype=bool)
+    last = None
+    for i in range(len(timestamp)):
+        t = timestamp[i]
+        if last is not None and t - last < min_dt:
+            continue
+        keep[i] = True
+        last = t
+    return keep
+
+
+def evaluate_field(columns, field, condition=None, xaxis=None, row_mask_fn=None, max_rate=0, msg_types=None):
+    '''evaluate one graph field over a LogColumns. Returns (timestamps,
+    xvalues, yvalues) where xvalues is None unless xaxis is given.
+    row_mask_fn(timestamps) can return a mask to restrict rows, for
+    flight mode selection. msg_types is the set of message types read
+    for the whole graph. Raises Unsupported if the field can't be
+    vectorised'''
+    expr = VecExpression(field)
+    cond = VecExpression(condition) if condition else None
+    xexpr = VecExpression(xaxis) if xaxis else None
+    (sources, triggers) = trigger_sources(field)
+    for e in (expr, cond, xexpr):
+        if e is not None:
+            for (k, v) in e.sources.items():
+                sources.setdefault(k, v)
+    frame = RowFrame(columns, sources, triggers, msg_types)
+    if cond is not None:
+        (c, cmask) = cond.evaluate(frame)
+        frame.select(cmask & (c != 0))
+    if row_mask_fn is not None:
+        mask = row_mask_fn(frame.timestamp)
+        if mask is not None:
+            frame.select(mask)
+    if max_rate > 0:
+        mask = np.zeros(len(frame), dtype=bool)
+        for k in range(len(frame.triggers)):
+            rows = np.flatnonzero(frame.src == k)
+            mask[rows[rate_mask(frame.timestamp[rows], 1.0 / max_rate)]] = True
+        frame.select(mask)
+    (v, mask) = expr.evaluate(frame)
+    xv = None
+    if xexpr is not None:
+        (xv, xmask) = xexpr.evaluate(frame)
+        mask &= xmask
+        xv = xv[mask]
+    return (frame.timestamp[mask], xv, v[mask])
+
+
+if __name__ == '__main__':
+    import os
+    import time
+    import xml.etree.ElementTree as ET
+    from argparse import ArgumentParser
+    from pymavlink import mavutil
+    from MAVProxy.modules.lib import logcolumns
+
+    parser = ArgumentParser(description='vectorised graph expression benchmark')
+    parser.add_argument("--graphs", default=None, help="graph XML file, default the stock graphs")
+    parser.add_argument("--no-compare", action='store_true', help="skip the per message path")
+    parser.add_argument("log")
+    args = parser.parse_args()
+
+    if args.graphs is not None:
+        gfiles = [args.graphs]
+    else:
+        gdir = os.path.join(os.path.dirname(__file__), '..', '..', 'tools', 'graphs')
+        gfiles = [os.path.join(gdir, f) for f in sorted(os.listdir(gdir)) if f.endswith('.xml')]
+    expressions = []
+    for f in gfiles:
+        for g in ET.parse(f).getroot().findall('graph'):
+            for e in g.findall('expression'):
+                expressions.append((g.get('name'), e.text.strip()))
+
+    mlog = mavutil.mavlink_connection(args.log)
+    mlog.flightmode_list()
+    cols = logcolumns.LogColumns(args.log, mlog, cache=False)
+    if hasattr(mlog, 'name_to_id'):
+        logtypes = set(mlog.name_to_id.keys())
+    else:
+        logtypes = set(mlog.messages.keys())
+
+    compiled = 0
+    total_fields = 0
+    for (name, expression) in expressions:
+        for f in expression.split():
+            total_fields += 1
+            if compile_expression(f.split(':')[0].split('<')[0]) is not None:
+                compiled += 1
+    print("%u of %u stock graph fields compile" % (compiled, total_fields))
+
+    def per_message(field):
+        from pymavlink.mavextra import reset_state_data
+        reset_state_data()
+        mlog.rewind()
+        types = set(re.findall(re_caps, field))
+        allm = {}
+        out = []
+        while True:
+            m = mlog.recv_match(type=types)
+            if m is None:
+                break
+            mtype = m.get_type()
+            allm[mtype] = m
+            if mtype not in types:
+                continue
+            try:
+                v = mavutil.evaluate_expression(field, allm)
+            except Exception:
+                v = None
+            if v is not None:
+                out.append(v)
+        return out
+
+    print("%-40s %8s %10s %10s %s" % ("field", "rows", "vector(s)", "message(s)", "match"))
+    tv_total = 0
+    tm_total = 0
+    done = set()
+    for (name, expression) in expressions:
+        # only graphs whose messages are all in the log
+        if not set(re.findall(re_caps, expression)).issubset(logtypes):
+            continue
+        for f in expression.split():
+            f = f.split(':')[0].split('<')[0]
+            if f in done:
+                continue
+            done.add(f)
+            t0 = time.time()
+            try:
+                (t, x, y) = evaluate_field(cols, f)
+            except (Unsupported, SyntaxError) as ex:
+                print("%-40s unsupported: %s" % (f[:40], ex))
+                continue
+            t1 = time.time()
+            tv_total += t1 - t0
+            if args.no_compare:
+                print("%-40s %8u %10.3f" % (f[:40], len(y), t1 - t0))
+                continue
+            ref = per_message(f)
+            t2 = time.time()
+            tm_total += t2 - t1
+            ref = np.array(ref, dtype=np.float64)
+            match = len(ref) == len(y) and np.allclose(ref, y, rtol=1.0e-6, atol=1.0e-6, equal_nan=True)
+            print("%-40s %8u %10.3f %10.3f %s" % (f[:40], len(y), t1 - t0, t2 - t1, match))
+    print("total vector %.2fs per message %.2fs" % (tv_total, tm_total))
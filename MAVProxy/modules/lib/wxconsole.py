@@ -2,11 +2,17 @@
 
 """
   MAVProxy message console, implemented in a child process
+
+  Everything sent to the child goes through a sender thread, so a busy
+  GUI or a full pipe never holds up the caller. Status values are
+  recorded per field and only fields whose value changed are sent, in
+  one batch every 1/status_rate seconds
 """
+import collections
 import threading
 import sys, time
 
-from MAVProxy.modules.lib.wxconsole_util import Value, Text
+from MAVProxy.modules.lib.wxconsole_util import Text, Value, ValueBatch
 from MAVProxy.modules.lib import textconsole
 from MAVProxy.modules.lib import win_layout
 from MAVProxy.modules.lib import multiproc
@@ -16,10 +22,29 @@ class MessageConsole(textconsole.SimpleConsole):
     a message console for MAVProxy
     '''
     def __init__(self,
-                 title='MAVProxy: console'):
+                 title='MAVProxy: console',
+                 status_rate=10,
+                 max_queued=1000):
         textconsole.SimpleConsole.__init__(self)
         self.title = title
         self.menu_callback = None
+        self.status_rate = status_rate
+        # latest (text, row, fg, bg) of each status field, and the
+        # fields changed since the last batch, in the order they changed
+        self.status_values = {}
+        self.status_dirty = {}
+        self.status_updates = 0
+        self.status_suppressed = 0
+        self.status_sent = 0
+        self.status_batches = 0
+        # other objects for the child. Once max_queued text objects are
+        # queued the oldest text is dropped. Menus and layouts are never
+        # dropped
+        self.send_queue = collections.deque()
+        self.max_queued = max_queued
+        self.text_queued = 0
+        self.dropped = 0
+        self.alive = True
         self.parent_pipe_recv,self.child_pipe_send = multiproc.Pipe(duplex=False)
         self.child_pipe_recv,self.parent_pipe_send = multiproc.Pipe(duplex=False)
         self.close_event = multiproc.Event()
@@ -28,9 +53,15 @@ class MessageConsole(textconsole.SimpleConsole):
         self.child.start()
         self.child_pipe_send.close()
         self.child_pipe_recv.close()
+        # created after the child starts as locks can't be pickled
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
         t = threading.Thread(target=self.watch_thread)
         t.daemon = True
         t.start()
+        t = threading.Thread(target=self.sender_thread)
+        t.daemon = True
+        t.start()
 
     def child_task(self):
         '''child process - this holds all the GUI elements'''
@@ -60,36 +91,107 @@ class MessageConsole(textconsole.SimpleConsole):
         except EOFError:
             pass
 
+    def sender_thread(self):
+        '''send to the child at the status rate'''
+        while not self.close_event.is_set():
+            if not self.child.is_alive():
+                self.alive = False
+                break
+            self.flush()
+            time.sleep(1.0 / max(self.status_rate, 0.1))
+
+    def flush(self):
+        '''send what is queued and the changed status values'''
+        with self.lock:
+            objs = list(self.send_queue)
+            self.send_queue.clear()
+            self.text_queued = 0
+            values = [(name,) + self.status_values[name] for name in self.status_dirty]
+            self.status_dirty = {}
+        # join up runs of text in the same colours
+        send = []
+        for obj in objs:
+            if (isinstance(obj, Text) and send and isinstance(send[-1], Text) and
+                    send[-1].fg == obj.fg and send[-1].bg == obj.bg):
+                send[-1] = Text(send[-1].text + obj.text, obj.fg, obj.bg)
+            else:
+                send.append(obj)
+        if values:
+            send.append(ValueBatch(values))
+        try:
+            with self.send_lock:
+                for obj in send:
+                    self.parent_pipe_send.send(obj)
+        except Exception:
+            return
+        if values:
+            self.status_sent += len(values)
+            self.status_batches += 1
+
+    def queue_send(self, obj):
+        '''queue an object for the sender thread. Only text is dropped
+        when the queue is full'''
+        with self.lock:
+            queue = self.send_queue
+            if isinstance(obj, (Text, Value)):
+                if self.text_queued >= self.max_queued:
+                    for (i, queued) in enumerate(queue):
+                        if isinstance(queued, (Text, Value)):
+                            del queue[i]
+                            break
+                    self.dropped += 1
+                else:
+                    self.text_queued += 1
+            queue.append(obj)
+
     def set_layout(self, layout):
         '''set window layout'''
-        self.parent_pipe_send.send(layout)
+        self.queue_send(layout)
         
     def write(self, text, fg='black', bg='white'):
         '''write to the console'''
-        try:
-            self.parent_pipe_send.send(Text(text, fg, bg))
-        except Exception:
-            pass
+        self.queue_send(Text(text, fg, bg))
 
     def set_status(self, name, text='', row=0, fg='black', bg='white'):
-        '''set a status value'''
-        if self.is_alive():
-            self.parent_pipe_send.send(Value(name, text, row, fg, bg))
+        '''set a status value. Values the same as the last one set are
+        not sent again'''
+        value = (text, row, fg, bg)
+        with self.lock:
+            if self.status_values.get(name, None) == value:
+                self.status_suppressed += 1
+                return
+            self.status_values[name] = value
+            self.status_dirty[name] = True
+            self.status_updates += 1
+
+    def status_counters(self):
+        '''counters for the status channel'''
+        return {'updates': self.status_updates,
+                'suppressed': self.status_suppressed,
+                'sent': self.status_sent,
+                'batches': self.status_batches,
+                'pending': len(self.status_dirty),
+                'dropped': self.dropped}
 
     def set_menu(self, menu, callback):
         if self.is_alive():
-            self.parent_pipe_send.send(menu)
+            self.queue_send(menu)
             self.menu_callback = callback
 
     def close(self):
         '''close the console'''
+        if self.child.is_alive():
+            # send what is still queued before the sender thread stops
+            self.flush()
         self.close_event.set()
-        if self.is_alive():
+        if self.child.is_alive():
             self.child.join(2)
+        self.alive = self.child.is_alive()
 
     def is_alive(self):
-        '''check if child is still going'''
-        return self.child.is_alive()
+        '''check if child is still going. This is checked by the sender
+        thread, as it is called for every message'''
+        return self.alive
 
 if __name__ == "__main__":
     # test the console
@@ -3,7 +3,7 @@ import time
 import os
 import socket
 from MAVProxy.modules.lib import mp_menu
-from MAVProxy.modules.lib.wxconsole_util import Value, Text
+from MAVProxy.modules.lib.wxconsole_util import Value, Text, ValueBatch
 from MAVProxy.modules.lib.wx_loader import wx
 from MAVProxy.modules.lib import win_layout
 from MAVProxy.modules.lib import icon
@@ -82,6 +82,26 @@ class ConsoleFrame(wx.Frame):
                 # use the system configured default browser
                 webbrowser.open_new_tab(url)
 
+    def set_value(self, name, text, row, fg, bg):
+        '''set a status field, without laying out the panel'''
+        if not name in self.values:
+            # create a new status field
+            value = wx.StaticText(self.panel, -1, text)
+            # possibly add more status rows
+            for i in range(len(self.status), row+1):
+                self.status.append(wx.BoxSizer(wx.HORIZONTAL))
+                self.vbox.Insert(len(self.status)-1, self.status[i], 0, flag=wx.ALIGN_LEFT | wx.TOP)
+                self.vbox.Layout()
+            self.status[row].Add(value, border=5)
+            self.status[row].AddSpacer(20)
+            self.values[name] = value
+        value = self.values[name]
+        value.SetForegroundColour(fg)
+        value.SetBackgroundColour(bg)
+        # workaround wx bug on windows
+        value._foregroundColour = fg
+        value.SetLabel(text)
+
     def on_idle(self, event):
         time.sleep(0.05)
         now = time.time()
@@ -112,25 +132,14 @@ class ConsoleFrame(wx.Frame):
             except EOFError:
                 break
                 
-            if isinstance(obj, Value):
+            if isinstance(obj, ValueBatch):
+                # status fields that changed, laid out once
+                for (name, text, row, fg, bg) in obj.values:
+                    self.set_value(name, text, row, fg, bg)
+                self.panel.Layout()
+            elif isinstance(obj, Value):
                 # request to set a status field
-                if not obj.name in self.values:
-                    # create a new status field
-                    value = wx.StaticText(self.panel, -1, obj.text)
-                    # possibly add more status rows
-                    for i in range(len(self.status), obj.row+1):
-                        self.status.append(wx.BoxSizer(wx.HORIZONTAL))
-                        self.vbox.Insert(len(self.status)-1, self.status[i], 0, flag=wx.ALIGN_LEFT | wx.TOP)
-                        self.vbox.Layout()
-                    self.status[obj.row].Add(value, border=5)
-                    self.status[obj.row].AddSpacer(20)
-                    self.values[obj.name] = value
-                value = self.values[obj.name]
-                value.SetForegroundColour(obj.fg)
-                value.SetBackgroundColour(obj.bg)
-                # workaround wx bug on windows
-                value._foregroundColour = obj.fg
-                value.SetLabel(obj.text)
+                self.set_value(obj.name, obj.text, obj.row, obj.fg, obj.bg)
                 self.panel.Layout()
             elif isinstance(obj, Text):
                 '''request to add text to the console'''
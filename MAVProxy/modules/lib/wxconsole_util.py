@@ -12,4 +12,10 @@ class Value():
         self.text = text
         self.row = row
         self.fg = fg
-        self.bg = bg
\ No newline at end of file
+        self.bg = bg
+
+class ValueBatch():
+    '''status bar values changed since the last batch, as a list of
+    (name, text, row, fg, bg) tuples'''
+    def __init__(self, values):
+        self.values = values
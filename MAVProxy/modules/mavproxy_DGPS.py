@@ -6,6 +6,7 @@ support for a GCS attached DGPS system
 import socket, errno
 from pymavlink import mavutil
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import rtcm3
 
 class DGPSModule(mp_module.MPModule):
     def __init__(self, mpstate):
@@ -17,67 +18,39 @@ class DGPSModule(mp_module.MPModule):
         mavutil.set_close_on_exec(self.port.fileno())
         self.port.setblocking(0)
         self.inject_seq_nr = 0
+        self.rtcm3 = rtcm3.RTCM3()
+        # padding for the last fragment of each message
+        self.rtcm_pad = bytearray(rtcm3.RTCM_DATA_LEN)
         print("DGPS: Listening for RTCM packets on UDP://%s:%s" % ("127.0.0.1", self.portnum))
     
     def send_rtcm_msg(self, data):
-        msglen = 180;
-        
-        if (len(data) > msglen * 4):
+        '''send a message of up to 720 bytes in GPS_RTCM_DATA fragments'''
+        if len(data) > rtcm3.RTCM_DATA_LEN * rtcm3.MAX_FRAGMENTS:
             print("DGPS: Message too large", len(data))
             return
-        
-        # How many messages will we send?
-        msgs = 0
-        if (len(data) % msglen == 0):
-            msgs = len(data) // msglen
-        else:
-            msgs = (len(data) // msglen) + 1
-
-        for a in range(0, msgs):
-            
-            flags = 0
-            
-            # Set the fragment flag if we're sending more than 1 packet.
-            if (msgs) > 1:
-                flags = 1
-            
-            # Set the ID of this fragment
-            flags |= (a & 0x3) << 1
-            
-            # Set an overall sequence number
-            flags |= (self.inject_seq_nr & 0x1f) << 3
-            
-            
-            amount = min(len(data) - a * msglen, msglen)
-            datachunk = data[a*msglen : a*msglen + amount]
-
-            self.master.mav.gps_rtcm_data_send(
-                flags,
-                len(datachunk),
-                bytearray(datachunk.ljust(180, b'\0')))
-        
-        # Send a terminal 0-length message if we sent 2 or 3 exactly-full messages.     
-        if (msgs < 4) and (len(data) % msglen == 0) and (len(data) > msglen):
-            flags = 1 | (msgs & 0x3)  << 1 | (self.inject_seq_nr & 0x1f) << 3
-            self.master.mav.gps_rtcm_data_send(
-                flags,
-                0,
-                bytearray("".ljust(180, '\0')))
-            
+        for (flags, length, chunk) in rtcm3.gps_rtcm_fragments(data, self.inject_seq_nr, self.rtcm_pad):
+            self.master.mav.gps_rtcm_data_send(flags, length, chunk)
         self.inject_seq_nr += 1
 
-
-
     def idle_task(self):
         '''called in idle time'''
         try:
-            data = self.port.recv(1024) # Attempt to read up to 1024 bytes.
+            data = self.port.recv(4096) # Attempt to read up to 4096 bytes.
         except socket.error as e:
             if e.errno in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
                 return
             raise
         try:
-            self.send_rtcm_msg(data)
+            # a datagram of whole RTCM3 frames is sent a frame at a time,
+            # so each goes in its own fragment sequence. Anything else
+            # (SBP, UBX, partial frames) is sent as it came
+            self.rtcm3.reset()
+            frames = self.rtcm3.frames(data)
+            if len(frames) > 0 and sum([len(f) for f in frames]) == len(data):
+                for frame in frames:
+                    self.send_rtcm_msg(frame)
+            else:
+                self.send_rtcm_msg(data)
 
         except Exception as e:
             print("DGPS: GPS Inject Failed:", e)
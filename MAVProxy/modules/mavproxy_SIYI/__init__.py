@@ -21,8 +21,9 @@ from threading import Thread
 import cv2
 import traceback
 import copy
+import numpy as np
 
-import socket, time, os, struct
+import socket, time, os
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import MPMenuCallTextDialog
@@ -34,6 +35,8 @@ if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_image import MPImageOSD_None
 
 from MAVProxy.modules.mavproxy_SIYI.camera_view import CameraView
+from MAVProxy.modules.mavproxy_SIYI import raycast
+from MAVProxy.modules.mavproxy_SIYI import siyi_packet
 
 SIYI_RATE_MAX_DPS = 90.0
 SIYI_HEADER1 = 0x55
@@ -106,23 +109,9 @@ def crc16_from_bytes(bytes, initial=0):
     # Output xor: 0
     # Check string: '123456789'
     # Check value: 0x29B1
-
-    try:
-        if isinstance(bytes, basestring):  # Python 2.7 compatibility
-            bytes = map(ord, bytes)
-    except NameError:
-        if isinstance(bytes, str):  # This branch will be taken on Python 3
-            bytes = map(ord, bytes)
-
-    crc = initial
-    for byte in bytes:
-        crc ^= byte << 8
-        for bit in range(8):
-            if crc & 0x8000:
-                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
-            else:
-                crc = (crc << 1) & 0xFFFF
-    return crc & 0xFFFF
+    if isinstance(bytes, str):
+        bytes = bytes.encode('latin-1')
+    return siyi_packet.crc16(bytes, initial)
 
 class PI_controller:
     '''simple PI controller'''
@@ -333,6 +322,7 @@ class SIYIModule(mp_module.MPModule):
         self.last_zoom = 1.0
         self.rgb_lens = "wide"
         self.bad_crc = 0
+        self.parser = siyi_packet.PacketParser()
         self.control_mode = -1
         self.last_SIEA = time.time()
         self.last_therm_cap = time.time()
@@ -749,12 +739,10 @@ class SIYIModule(mp_module.MPModule):
 
     def send_packet(self, command_id, pkt):
         '''send SIYI packet'''
-        plen = len(pkt) if pkt else 0
-        buf = struct.pack("<BBBHHB", SIYI_HEADER1, SIYI_HEADER2, 1, plen,
-                          self.sequence, command_id)
-        if pkt:
-            buf += pkt
-        buf += struct.pack("<H", crc16_from_bytes(buf))
+        self.send_buf(siyi_packet.encode(self.sequence, command_id, pkt))
+
+    def send_buf(self, buf):
+        '''send an encoded SIYI packet'''
         self.sequence = (self.sequence+1) % 0xffff
         try:
             self.sock.send(buf)
@@ -766,44 +754,31 @@ class SIYIModule(mp_module.MPModule):
         if fmt is None:
             fmt = ""
             args = []
-        self.send_packet(command_id, struct.pack(fmt, *args))
+        self.send_buf(siyi_packet.encode_fmt(self.sequence, command_id, fmt, *args))
         args = list(args)
         args.extend([0]*(8-len(args)))
         self.logf.write('SIOU', 'QBffffffff', 'TimeUS,Cmd,P1,P2,P3,P4,P5,P6,P7,P8', self.micros64(), command_id, *args)
 
     def unpack(self, command_id, fmt, data):
         '''unpack SIYI data and log'''
-        fsize = struct.calcsize(fmt)
-        if fsize != len(data):
-            print("cmd 0x%02x needs %u bytes got %u" % (command_id, fsize, len(data)))
+        st = siyi_packet.get_struct(fmt)
+        if st.size != len(data):
+            print("cmd 0x%02x needs %u bytes got %u" % (command_id, st.size, len(data)))
             return None
-        v = struct.unpack(fmt, data[:fsize])
+        v = st.unpack(data)
         args = list(v)
         args.extend([0]*(12-len(args)))
         self.logf.write('SIIN', 'QBffffffffffff', 'TimeUS,Cmd,P1,P2,P3,P4,P5,P6,P7,P8,P9,P10,P11,P12', self.micros64(), command_id, *args)
         return v
 
     def parse_data(self, pkt):
-        '''parse SIYI packet'''
-        while len(pkt) >= 10:
-            (h1,h2,rack,plen,seq,cmd) = struct.unpack("<BBBHHB", pkt[:8])
-            if plen+10 > len(pkt):
-                #print("SIYI: short packet", plen+10, len(pkt))
-                break
-            self.parse_packet(pkt[:plen+10])
-            pkt = pkt[plen+10:]
+        '''parse SIYI packets'''
+        for (cmd, seq, data) in self.parser.parse_datagram(pkt):
+            self.parse_packet(cmd, data)
+        self.bad_crc = self.parser.bad_crc
 
-    def parse_packet(self, pkt):
+    def parse_packet(self, cmd, data):
         '''parse SIYI packet'''
-        (h1,h2,rack,plen,seq,cmd) = struct.unpack("<BBBHHB", pkt[:8])
-        data = pkt[8:-2]
-        crc, = struct.unpack("<H", pkt[-2:])
-        crc2 = crc16_from_bytes(pkt[:-2])
-        if crc != crc2:
-            self.bad_crc += 1
-            #print("SIYI: BAD CRC", crc, crc2, self.bad_crc)
-            return
-
         if cmd == ACQUIRE_FIRMWARE_VERSION:
             patch,minor,major,gpatch,gminor,gmajor,zpatch,zminor,zmajor,_,_,_ = self.unpack(cmd, "<BBBBBBBBBBBB", data)
             self.have_version = True
@@ -1111,6 +1086,44 @@ class SIYIModule(mp_module.MPModule):
         (r,p,y) = self.get_gimbal_attitude()
         return (r,p-self.siyi_settings.mount_pitch,mp_util.wrap_180(y-self.siyi_settings.mount_yaw))
 
+    def get_camera_pose(self):
+        '''get camera position and earth frame attitude for ray casting, or None'''
+        gpi = self.master.messages.get('GLOBAL_POSITION_INT',None)
+        att = self.master.messages.get('ATTITUDE',None)
+        if gpi is None or att is None or self.attitude is None:
+            return None
+        fov_att = self.get_fov_attitude()
+        return raycast.CameraPose(gpi.lat*1.0e-7, gpi.lon*1.0e-7, gpi.alt*1.0e-3,
+                                  math.radians(fov_att[0]),
+                                  math.radians(fov_att[1]),
+                                  math.radians(fov_att[2])+att.yaw)
+
+    def get_ground_alt(self, lat, lon):
+        '''get terrain height at one point'''
+        return self.module('terrain').ElevationModel.GetElevation(lat, lon)
+
+    def get_ground_alt_array(self, lats, lons):
+        '''get terrain heights for arrays of points, NaN where unknown'''
+        return self.module('terrain').ElevationModel.GetElevationArray(lats, lons)
+
+    def get_ground_points(self, xs, ys, FOV, aspect_ratio, pose=None):
+        '''
+         get arrays of ground lat, lon and alt for arrays of points in the camera view,
+         with NaN for points not on the ground, or None if there is no position or attitude
+         x and y are from -1 to 1, relative to center of camera view
+        '''
+        if pose is None:
+            pose = self.get_camera_pose()
+        if pose is None:
+            return None
+        slant_range = None
+        if self.rf_dist > 0 and self.siyi_settings.use_lidar > 0:
+            # use rangefinder if enabled
+            slant_range = self.rf_dist
+        ground_alt = self.get_ground_alt(pose.lat, pose.lon)
+        return raycast.ground_points(pose, xs, ys, FOV, aspect_ratio,
+                                     ground_alt, self.get_ground_alt_array, slant_range)
+
     def get_slantrange(self,x,y,FOV,aspect_ratio):
         '''
          get range to ground
@@ -1119,59 +1132,27 @@ class SIYIModule(mp_module.MPModule):
         if self.rf_dist > 0 and self.siyi_settings.use_lidar > 0:
             # use rangefinder if enabled
             return self.rf_dist
-        gpi = self.master.messages.get('GLOBAL_POSITION_INT',None)
-        if not gpi:
-            return None
-        (lat,lon,alt) = gpi.lat*1.0e-7,gpi.lon*1.0e-7,gpi.alt*1.0e-3
-        ground_alt = self.module('terrain').ElevationModel.GetElevation(lat, lon)
-        if alt <= ground_alt:
+        pose = self.get_camera_pose()
+        if pose is None:
             return None
-        if self.attitude is None:
-            return None
-        fov_att = self.get_fov_attitude()
-        pitch = fov_att[1]
-        if pitch >= 0:
+        ground_alt = self.get_ground_alt(pose.lat, pose.lon)
+        sr = raycast.slant_ranges(pose, x, y, FOV, aspect_ratio, ground_alt, self.get_ground_alt_array)
+        if math.isnan(sr):
             return None
-        pitch -= y*FOV*0.5/aspect_ratio
-        pitch = min(pitch, -1)
-
-        # start with flat earth
-        sin_pitch = math.sin(abs(math.radians(pitch)))
-        sr = (alt-ground_alt) / sin_pitch
-
-        # iterate to make more accurate
-        for i in range(3):
-            (lat2,lon2,alt2) = self.get_latlonalt(sr,x,y,FOV,aspect_ratio)
-            ground_alt2 = self.module('terrain').ElevationModel.GetElevation(lat2, lon2)
-            if ground_alt2 is None:
-                return None
-            # adjust for height at this point
-            sr += (alt2 - ground_alt2) / sin_pitch
-        return sr
-
-
+        return float(sr)
 
     def get_view_vector(self, x, y, FOV, aspect_ratio):
         '''
-        get ground lat/lon given vehicle orientation, camera orientation and slant range
+        get earth frame view vector for a point in the camera view
         x and y are from -1 to 1, relative to center of camera view
         positive x is to the right
         positive y is down
         '''
-        att = self.master.messages.get('ATTITUDE',None)
-        if att is None:
+        pose = self.get_camera_pose()
+        if pose is None:
             return None
-        v = Vector3(1, 0, 0)
-        m = Matrix3()
-        fov_att = self.get_fov_attitude()
-        (roll,pitch,yaw) = (math.radians(fov_att[0]),math.radians(fov_att[1]),math.radians(fov_att[2]))
-        yaw += att.yaw
-        FOV_half = math.radians(0.5*FOV)
-        yaw += FOV_half*x
-        pitch -= y*FOV_half/aspect_ratio
-        m.from_euler(roll, pitch, yaw)
-        v = m * v
-        return v
+        v = raycast.view_vectors(pose, x, y, FOV, aspect_ratio)
+        return Vector3(v[0], v[1], v[2])
 
     def get_latlonalt(self, slant_range, x, y, FOV, aspect_ratio):
         '''
@@ -1180,16 +1161,11 @@ class SIYIModule(mp_module.MPModule):
         '''
         if slant_range is None:
             return None
-        v = self.get_view_vector(x,y,FOV,aspect_ratio)
-        if v is None:
+        pose = self.get_camera_pose()
+        if pose is None:
             return None
-        gpi = self.master.messages.get('GLOBAL_POSITION_INT',None)
-        if gpi is None:
-            return None
-        v *= slant_range
-        (lat,lon,alt) = (gpi.lat*1.0e-7,gpi.lon*1.0e-7,gpi.alt*1.0e-3)
-        (lat,lon) = mp_util.gps_offset(lat,lon,v.y,v.x)
-        return (lat,lon,alt-v.z)
+        (lat,lon,alt) = raycast.project(pose, slant_range, x, y, FOV, aspect_ratio)
+        return (float(lat),float(lon),float(alt))
 
     def get_target_yaw_pitch(self, lat, lon, alt, mylat, mylon, myalt, vehicle_yaw_rad):
         '''get target yaw/pitch in vehicle frame for a target lat/lon'''
@@ -1286,26 +1262,30 @@ class SIYIModule(mp_module.MPModule):
         self.logf.write('SIPP', "Qfffff", "TimeUS,CPitch,TPitch,Perr,I,FF",
                         self.micros64(), cam_pitch, pitch_deg, err_pitch, self.pitch_controller.I, los_pitch_rate)
 
-    def show_fov1(self, FOV, name, aspect_ratio, color):
+    def show_fov1(self, FOV, name, aspect_ratio, color, pose):
         '''show one FOV polygon'''
-        points = []
-        for (x,y) in [(-1,-1),(1,-1),(1,1),(-1,1),(-1,-1)]:
-            latlonalt = self.get_latlonalt(self.get_slantrange(x,y,FOV,aspect_ratio),x,y,FOV,aspect_ratio)
-            if latlonalt is None:
-                self.mpstate.map.remove_object(name)
-                return
-            (lat,lon) = (latlonalt[0],latlonalt[1])
-            points.append((lat,lon))
+        (xs,ys) = zip(*raycast.FOV_CORNERS)
+        ground = self.get_ground_points(xs, ys, FOV, aspect_ratio, pose)
+        if ground is None or not np.all(np.isfinite(ground[0])):
+            self.mpstate.map.remove_object(name)
+            return
+        points = list(zip(ground[0].tolist(), ground[1].tolist()))
+        points.append(points[0])
         self.mpstate.map.add_object(mp_slipmap.SlipPolygon(name, points, layer='SIYI',
                                                            linewidth=2, colour=color))
 
     def show_fov(self):
         '''show FOV polygons'''
-        self.show_fov1(self.siyi_settings.thermal_fov, 'FOV_thermal', 640.0/512.0, (0,0,128))
+        pose = self.get_camera_pose()
+        if pose is None:
+            self.mpstate.map.remove_object('FOV_thermal')
+            self.mpstate.map.remove_object('FOV_RGB')
+            return
+        self.show_fov1(self.siyi_settings.thermal_fov, 'FOV_thermal', 640.0/512.0, (0,0,128), pose)
         FOV2 = self.siyi_settings.wide_fov
         if self.rgb_lens == "zoom":
             FOV2 = self.siyi_settings.zoom_fov / self.last_zoom
-        self.show_fov1(FOV2, 'FOV_RGB', 1280.0/720.0, (0,128,128))
+        self.show_fov1(FOV2, 'FOV_RGB', 1280.0/720.0, (0,128,128), pose)
 
     def end_tracking(self):
         '''end all tracking'''
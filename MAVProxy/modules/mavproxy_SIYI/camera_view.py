@@ -184,10 +184,10 @@ class CameraView:
             FOV = self.siyi.siyi_settings.zoom_fov / self.siyi.last_zoom
         else:
             FOV = self.siyi.siyi_settings.wide_fov
-        slant_range = self.siyi.get_slantrange(x, y, FOV, aspect_ratio)
-        if slant_range is None:
+        ground = self.siyi.get_ground_points(x, y, FOV, aspect_ratio)
+        if ground is None or not np.isfinite(ground[0]):
             return None
-        return self.siyi.get_latlonalt(slant_range, x, y, FOV, aspect_ratio)
+        return (float(ground[0]), float(ground[1]), float(ground[2]))
 
 
     def check_events(self):
@@ -197,6 +197,7 @@ class CameraView:
         if not self.im.is_alive():
             self.im = None
             return
+        track_pos = None
         for event in self.im.events():
             if isinstance(event, MPMenuItem):
                 if event.returnkey.startswith("COLORMAP_Threshold"):
@@ -222,12 +223,9 @@ class CameraView:
                     self.im.full_size()
                 continue
             if isinstance(event, MPImageTrackPos):
-                if not self.tracking:
-                    continue
-                latlonalt = self.xy_to_latlon(event.x, event.y, event.shape)
-                if latlonalt is None:
-                    return
-                self.siyi.set_target(latlonalt[0], latlonalt[1], latlonalt[2])
+                # only the latest tracker position is projected
+                if self.tracking:
+                    track_pos = event
                 continue
             if isinstance(event, MPImageFrameCounter):
                 self.frame_counter = event.frame
@@ -263,6 +261,11 @@ class CameraView:
                         mp_slipmap.SlipIcon("SIYIClick", latlon, self.siyi.click_icon, layer="SIYI")
                     )
 
+        if track_pos is not None and self.tracking:
+            latlonalt = self.xy_to_latlon(track_pos.x, track_pos.y, track_pos.shape)
+            if latlonalt is not None:
+                self.siyi.set_target(latlonalt[0], latlonalt[1], latlonalt[2])
+
 if __name__ == '__main__':
     from optparse import OptionParser
     parser = OptionParser("camera_view.py [options]")
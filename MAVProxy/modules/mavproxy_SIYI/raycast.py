@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+'''
+batched ray casting from the SIYI camera to the terrain
+
+Points in the camera image are given as arrays of x and y from -1 to 1
+relative to the centre of the view, with positive x to the right and
+positive y down. Their view vectors are found together from stacked
+rotation matrices, and the slant range to the ground is refined with
+one batch elevation lookup per iteration for all the points, rather
+than a Matrix3 and an elevation lookup per point per iteration. This
+makes it cheap enough to project a whole FOV footprint or a tracker box
+every frame.
+
+The camera model is the one the SIYI module has always used: a point's
+offset in the image is added to the gimbal yaw and pitch.
+
+Run this file directly with a tlog or dataflash log (or none, for a
+generated flight over generated hills) to compare it with casting one
+ray at a time
+
+AP_FLAKE8_CLEAN
+'''
+
+import math
+
+import numpy as np
+
+from MAVProxy.modules.lib import mp_util
+
+# slant range refinement steps, as used by the SIYI module
+ITERATIONS = 3
+
+# the image corners, in the order the FOV polygon is drawn
+FOV_CORNERS = [(-1, -1), (1, -1), (1, 1), (-1, 1)]
+
+
+class CameraPose(object):
+    '''the camera position, and its attitude in radians with the yaw
+    relative to north'''
+    def __init__(self, lat, lon, alt, roll, pitch, yaw):
+        self.lat = lat
+        self.lon = lon
+        self.alt = alt
+        self.roll = roll
+        self.pitch = pitch
+        self.yaw = yaw
+
+
+def euler_to_dcm(roll, pitch, yaw):
+    '''rotation matrices for arrays of 321 Euler angles in radians, as
+    Matrix3.from_euler() makes them, with shape (..., 3, 3)'''
+    (roll, pitch, yaw) = np.broadcast_arrays(roll, pitch, yaw)
+    (cp, sp) = (np.cos(pitch), np.sin(pitch))
+    (cr, sr) = (np.cos(roll), np.sin(roll))
+    (cy, sy) = (np.cos(yaw), np.sin(yaw))
+    dcm = np.empty(roll.shape + (3, 3))
+    dcm[..., 0, 0] = cp * cy
+    dcm[..., 0, 1] = sr * sp * cy - cr * sy
+    dcm[..., 0, 2] = cr * sp * cy + sr * sy
+    dcm[..., 1, 0] = cp * sy
+    dcm[..., 1, 1] = sr * sp * sy + cr * cy
+    dcm[..., 1, 2] = cr * sp * sy - sr * cy
+    dcm[..., 2, 0] = -sp
+    dcm[..., 2, 1] = sr * cp
+    dcm[..., 2, 2] = cr * cp
+    return dcm
+
+
+def view_angles(pose, x, y, fov, aspect_ratio):
+    '''the pitch and yaw in radians of the rays through image points'''
+    fov_half = math.radians(0.5 * fov)
+    yaw = pose.yaw + fov_half * np.asarray(x, dtype=float)
+    pitch = pose.pitch - np.asarray(y, dtype=float) * fov_half / aspect_ratio
+    return (pitch, yaw)
+
+
+def view_vectors(pose, x, y, fov, aspect_ratio, body=(1, 0, 0)):
+    '''unit NED vectors along the rays through image points, as an
+    (N, 3) array'''
+    (pitch, yaw) = view_angles(pose, x, y, fov, aspect_ratio)
+    dcm = euler_to_dcm(pose.roll, pitch, yaw)
+    return np.einsum('...ij,j->...i', dcm, np.asarray(body, dtype=float))
+
+
+def project(pose, slant_range, x, y, fov, aspect_ratio):
+    '''the (lat, lon, alt) arrays of the points slant_range along the
+    rays through image points'''
+    v = view_vectors(pose, x, y, fov, aspect_ratio) * np.asarray(slant_range, dtype=float)[..., np.newaxis]
+    (lat, lon) = mp_util.gps_offset_array(pose.lat, pose.lon, v[..., 1], v[..., 0])
+    return (lat, lon, pose.alt - v[..., 2])
+
+
+def slant_ranges(pose, x, y, fov, aspect_ratio, ground_alt, elevation, iterations=ITERATIONS):
+    '''the distances along the rays through image points to the ground,
+    with NaN for rays that don't reach it. ground_alt is the terrain
+    height under the camera and elevation(lats, lons) returns an array
+    of terrain heights, with NaN where unknown'''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    (x, y) = np.broadcast_arrays(x, y)
+    if ground_alt is None or not pose.alt > ground_alt or pose.pitch >= 0:
+        return np.full(x.shape, np.nan)
+    # the pitch used for the flat earth estimate is kept below the horizon
+    pitch = np.minimum(math.degrees(pose.pitch) - y * fov * 0.5 / aspect_ratio, -1)
+    sin_pitch = np.sin(np.abs(np.radians(pitch)))
+    sr = (pose.alt - ground_alt) / sin_pitch
+    for i in range(iterations):
+        (lat2, lon2, alt2) = project(pose, sr, x, y, fov, aspect_ratio)
+        sr = sr + (alt2 - elevation(lat2, lon2)) / sin_pitch
+    return sr
+
+
+def ground_points(pose, x, y, fov, aspect_ratio, ground_alt, elevation, slant_range=None):
+    '''the (lat, lon, alt) arrays where the rays through image points
+    meet the ground, NaN where they don't. A slant_range given (eg from
+    a rangefinder) is used for all points'''
+    x = np.asarray(x, dtype=float)
+    if slant_range is None:
+        sr = slant_ranges(pose, x, y, fov, aspect_ratio, ground_alt, elevation)
+    else:
+        sr = np.full(np.broadcast(x, y).shape, float(slant_range))
+    return project(pose, sr, x, y, fov, aspect_ratio)
+
+
+def box_points(cx, cy, width, height, n=3):
+    '''x and y arrays of an n by n grid of points over a box centred on
+    cx, cy, all in image coordinates'''
+    (gx, gy) = np.meshgrid(np.linspace(-0.5, 0.5, n), np.linspace(-0.5, 0.5, n))
+    return (cx + gx.ravel() * width, cy + gy.ravel() * height)
+
+
+if __name__ == '__main__':
+    import time
+    from argparse import ArgumentParser
+    from pymavlink import mavutil
+    from pymavlink.rotmat import Matrix3, Vector3
+
+    parser = ArgumentParser(description='compare batched SIYI ray casting with one ray at a time')
+    parser.add_argument("log", nargs='?', default=None, help="tlog or dataflash log of a flight")
+    parser.add_argument("--samples", type=int, default=500, help="positions to use from the flight")
+    parser.add_argument("--gimbal-pitch", type=float, default=-45, help="gimbal pitch in degrees")
+    parser.add_argument("--fov", type=float, default=80, help="horizontal FOV in degrees")
+    parser.add_argument("--grid", type=int, default=5, help="side of the grid of points over the tracker box")
+    parser.add_argument("--srtm", action='store_true', help="use SRTM terrain rather than generated hills")
+    args = parser.parse_args()
+
+    if args.srtm:
+        from MAVProxy.modules.lib import mp_elevation
+        model = mp_elevation.ElevationModel()
+        GetElevation = model.GetElevation
+        GetElevationArray = model.GetElevationArray
+    else:
+        def GetElevationArray(lats, lons):
+            '''rolling hills, a few hundred meters across'''
+            lats = np.asarray(lats)
+            lons = np.asarray(lons)
+            return 600 + 40 * np.sin(lats * 2000.0) * np.cos(lons * 1500.0) + 10 * np.sin(lats * 9000.0 + lons * 7000.0)
+
+        def GetElevation(lat, lon):
+            return float(GetElevationArray(lat, lon))
+
+    poses = []
+    if args.log is not None:
+        mlog = mavutil.mavlink_connection(args.log)
+        att = None
+        while True:
+            m = mlog.recv_match(type=['ATTITUDE', 'GLOBAL_POSITION_INT', 'ATT', 'POS'])
+            if m is None:
+                break
+            t = m.get_type()
+            if t == 'ATTITUDE':
+                att = m.yaw
+            elif t == 'ATT':
+                att = math.radians(m.Yaw)
+            elif att is not None and t == 'GLOBAL_POSITION_INT':
+                poses.append((m.lat * 1.0e-7, m.lon * 1.0e-7, m.alt * 1.0e-3, att))
+            elif att is not None and t == 'POS':
+                poses.append((m.Lat, m.Lng, m.Alt, att))
+        step = max(1, len(poses) // args.samples)
+        poses = poses[::step][:args.samples]
+        print("%s: %u positions" % (args.log, len(poses)))
+    else:
+        for i in range(args.samples):
+            a = 2 * math.pi * i / args.samples
+            poses.append((-35.36 + 0.01 * math.sin(a), 149.16 + 0.01 * math.cos(a), 750 + 30 * math.sin(3 * a), a))
+
+    aspect = 1280.0 / 720.0
+    roll = 0
+    pitch = math.radians(args.gimbal_pitch)
+    (bx, by) = box_points(0.2, 0.1, 0.3, 0.3, args.grid)
+    (cx, cy) = zip(*FOV_CORNERS)
+    xs = np.concatenate((np.array(cx, dtype=float), bx))
+    ys = np.concatenate((np.array(cy, dtype=float), by))
+
+    def scalar_point(lat, lon, alt, yaw, x, y):
+        '''the SIYI module's old per point get_slantrange and get_latlonalt'''
+        def latlonalt(sr):
+            m = Matrix3()
+            fov_half = math.radians(0.5 * args.fov)
+            m.from_euler(roll, pitch - y * fov_half / aspect, yaw + fov_half * x)
+            v = m * Vector3(1, 0, 0)
+            v *= sr
+            (lat2, lon2) = mp_util.gps_offset(lat, lon, v.y, v.x)
+            return (lat2, lon2, alt - v.z)
+        ground_alt = GetElevation(lat, lon)
+        p = min(args.gimbal_pitch - y * args.fov * 0.5 / aspect, -1)
+        sin_pitch = math.sin(abs(math.radians(p)))
+        sr = (alt - ground_alt) / sin_pitch
+        for i in range(ITERATIONS):
+            (lat2, lon2, alt2) = latlonalt(sr)
+            sr += (alt2 - GetElevation(lat2, lon2)) / sin_pitch
+        return latlonalt(sr)
+
+    t0 = time.time()
+    old = []
+    for (lat, lon, alt, yaw) in poses:
+        old.append([scalar_point(lat, lon, alt, yaw, x, y) for (x, y) in zip(xs, ys)])
+    t_old = time.time() - t0
+
+    t0 = time.time()
+    new = []
+    for (lat, lon, alt, yaw) in poses:
+        pose = CameraPose(lat, lon, alt, roll, pitch, yaw)
+        ground_alt = float(GetElevationArray(lat, lon))
+        new.append(np.column_stack(ground_points(pose, xs, ys, args.fov, aspect, ground_alt, GetElevationArray)))
+    t_new = time.time() - t0
+
+    old = np.array(old, dtype=float)
+    new = np.array(new)
+    err_m = np.nanmax(np.abs(old[..., :2] - new[..., :2])) * 111319.5
+    print("%u poses x %u points: one ray at a time %.3fs, batched %.3fs (%.1fx), max difference %.6fm" % (
+        len(poses), len(xs), t_old, t_new, t_old / t_new, err_m))
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+'''
+SIYI camera protocol packet framing
+
+A packet is a 0x55 0x66 header, an ack flag, the payload length, a
+sequence number and a command id, then the payload and a CRC16-CCITT
+of everything before it.
+
+The CRC is binascii.crc_hqx, which is the same table driven CRC done
+in C and works on any buffer, so packets are checked in place. The
+parser keeps a bytearray of any partial packet and returns payloads as
+memoryviews of the received data rather than slices, and packets are
+built with pack_into a single buffer using cached Struct objects.
+
+Run this file directly to compare this with the old framing, replaying
+camera traffic through a local UDP socket standing in for the camera
+
+AP_FLAKE8_CLEAN
+'''
+
+import binascii
+import struct
+
+HEADER = b'\x55\x66'
+HEADER_STRUCT = struct.Struct('<BBBHHB')
+CRC_STRUCT = struct.Struct('<H')
+HEADER_LEN = HEADER_STRUCT.size
+# header and CRC
+OVERHEAD = HEADER_LEN + CRC_STRUCT.size
+# well above the longest reply a SIYI camera sends, so a corrupt length
+# can't make the parser wait for data that will never come
+MAX_PAYLOAD = 256
+
+_structs = {}
+
+
+def get_struct(fmt):
+    '''a cached struct.Struct for a format'''
+    ret = _structs.get(fmt, None)
+    if ret is None:
+        ret = struct.Struct(fmt)
+        _structs[fmt] = ret
+    return ret
+
+
+def crc16(data, initial=0):
+    '''CRC-16-CCITT, poly 0x1021, of a bytes-like object'''
+    return binascii.crc_hqx(data, initial)
+
+
+def encode(seq, command_id, payload=None, ack=1):
+    '''build a packet around a bytes-like payload'''
+    plen = len(payload) if payload else 0
+    buf = bytearray(OVERHEAD + plen)
+    HEADER_STRUCT.pack_into(buf, 0, HEADER[0], HEADER[1], ack, plen, seq, command_id)
+    if plen:
+        buf[HEADER_LEN:HEADER_LEN + plen] = payload
+    end = HEADER_LEN + plen
+    CRC_STRUCT.pack_into(buf, end, crc16(memoryview(buf)[:end]))
+    return buf
+
+
+def encode_fmt(seq, command_id, fmt, *args, ack=1):
+    '''build a packet with a payload packed from args with a struct format'''
+    st = get_struct(fmt)
+    buf = bytearray(OVERHEAD + st.size)
+    HEADER_STRUCT.pack_into(buf, 0, HEADER[0], HEADER[1], ack, st.size, seq, command_id)
+    st.pack_into(buf, HEADER_LEN, *args)
+    end = HEADER_LEN + st.size
+    CRC_STRUCT.pack_into(buf, end, crc16(memoryview(buf)[:end]))
+    return buf
+
+
+class PacketParser(object):
+    '''incremental packet parser. Bytes are given as they arrive and
+    may hold several packets, or parts of them. Framing is recovered
+    after bad data by searching for the next header. UDP datagrams
+    should be given to parse_datagram(), as a packet never spans two
+    of them'''
+    def __init__(self, max_payload=MAX_PAYLOAD):
+        self.max_payload = max_payload
+        self.pending = bytearray()
+        self.packets = 0
+        self.bad_crc = 0
+        self.skipped = 0
+
+    def parse(self, data):
+        '''parse received bytes, returning a list of (command_id, seq,
+        payload) for each complete packet with a good CRC. payload is a
+        memoryview, valid until the next call'''
+        if self.pending:
+            # only when a packet was split between calls
+            self.pending += data
+            data = bytes(self.pending)
+            del self.pending[:]
+        elif not isinstance(data, (bytes, bytearray)):
+            data = bytes(data)
+        view = memoryview(data)
+        n = len(data)
+        ofs = 0
+        ret = []
+        while n - ofs >= OVERHEAD:
+            if data[ofs] != HEADER[0] or data[ofs + 1] != HEADER[1]:
+                i = data.find(HEADER, ofs + 1)
+                if i == -1:
+                    # keep a last byte that may start a header
+                    i = n - 1 if data[n - 1] == HEADER[0] else n
+                self.skipped += i - ofs
+                ofs = i
+                continue
+            (h1, h2, ack, plen, seq, command_id) = HEADER_STRUCT.unpack_from(data, ofs)
+            if plen > self.max_payload:
+                self.skipped += 1
+                ofs += 1
+                continue
+            end = ofs + HEADER_LEN + plen
+            if end + CRC_STRUCT.size > n:
+                break
+            (crc,) = CRC_STRUCT.unpack_from(data, end)
+            if crc16(view[ofs:end]) != crc:
+                self.bad_crc += 1
+                ofs += 1
+                continue
+            ret.append((command_id, seq, view[ofs + HEADER_LEN:end]))
+            ofs = end + CRC_STRUCT.size
+        self.packets += len(ret)
+        if ofs < n:
+            self.pending += view[ofs:]
+        return ret
+
+    def parse_datagram(self, data):
+        '''parse one received datagram on its own. A truncated packet at
+        the end is dropped rather than held for the next datagram'''
+        del self.pending[:]
+        ret = self.parse(data)
+        self.skipped += len(self.pending)
+        del self.pending[:]
+        return ret
+
+
+if __name__ == '__main__':
+    import random
+    import socket
+    import threading
+    import time
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='compare SIYI packet framing with the old bitwise CRC and slicing')
+    parser.add_argument("capture", nargs='?', default=None,
+                        help="file of SIYI packets received from a camera, back to back")
+    parser.add_argument("--packets", type=int, default=20000, help="packets to generate with no capture")
+    parser.add_argument("--repeat", type=int, default=1, help="times to send the traffic")
+    args = parser.parse_args()
+
+    def old_crc16(data, initial=0):
+        '''the old bit by bit crc16_from_bytes'''
+        crc = initial
+        for byte in data:
+            crc ^= byte << 8
+            for bit in range(8):
+                if crc & 0x8000:
+                    crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+                else:
+                    crc = (crc << 1) & 0xFFFF
+        return crc & 0xFFFF
+
+    def old_encode(seq, command_id, pkt):
+        '''the old send_packet'''
+        plen = len(pkt) if pkt else 0
+        buf = struct.pack("<BBBHHB", 0x55, 0x66, 1, plen, seq, command_id)
+        if pkt:
+            buf += pkt
+        buf += struct.pack("<H", old_crc16(buf))
+        return buf
+
+    def old_parse(pkt, out):
+        '''the old parse_data and parse_packet framing'''
+        while len(pkt) >= 10:
+            (h1, h2, rack, plen, seq, cmd) = struct.unpack("<BBBHHB", pkt[:8])
+            if plen + 10 > len(pkt):
+                break
+            p = pkt[:plen + 10]
+            data = p[8:-2]
+            crc, = struct.unpack("<H", p[-2:])
+            if crc == old_crc16(p[:-2]):
+                out.append((cmd, seq, data))
+            pkt = pkt[plen + 10:]
+
+    if args.capture is not None:
+        stream = open(args.capture, 'rb').read()
+        datagrams = []
+        p = PacketParser()
+        for (cmd, seq, payload) in p.parse(stream):
+            datagrams.append(bytes(encode(seq, cmd, payload)))
+        print("%s: %u packets, %u bad CRC" % (args.capture, len(datagrams), p.bad_crc))
+    else:
+        # the replies to polled attitude, rangefinder, zoom and temperature
+        rng = random.Random(1)
+        replies = [(0x0D, '<hhhhhh'), (0x15, '<H'), (0x18, '<BB'), (0x14, '<HHHHHHHHHHHH')]
+        datagrams = []
+        for i in range(args.packets):
+            (cmd, fmt) = replies[i % len(replies)]
+            st = struct.Struct(fmt)
+            values = [rng.randint(0, 255) for v in range(len(fmt) - 1)]
+            datagrams.append(bytes(encode(i & 0xFFFF, cmd, st.pack(*values))))
+    datagrams = datagrams * args.repeat
+    nbytes = sum([len(d) for d in datagrams])
+
+    # both framings must decode the same packets
+    check = []
+    for d in datagrams:
+        old_parse(d, check)
+    p = PacketParser()
+    for d in datagrams:
+        for (cmd, seq, payload) in p.parse_datagram(d):
+            if check[0] != (cmd, seq, bytes(payload)):
+                raise RuntimeError("framing mismatch")
+            check.pop(0)
+
+    def replay(parse):
+        '''send the datagrams from a stand-in camera socket and time parsing them'''
+        camera = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        camera.bind(('127.0.0.1', 0))
+        rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        rx.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        rx.bind(('127.0.0.1', 0))
+        rx.settimeout(0.5)
+        camera.connect(rx.getsockname())
+        result = {'packets': 0, 'parse_time': 0.0}
+
+        def receive():
+            while True:
+                try:
+                    pkt = rx.recv(10240)
+                except socket.timeout:
+                    break
+                t0 = time.process_time()
+                result['packets'] += parse(pkt)
+                result['parse_time'] += time.process_time() - t0
+
+        thread = threading.Thread(target=receive)
+        thread.start()
+        for (i, d) in enumerate(datagrams):
+            camera.send(d)
+            if i % 50 == 0:
+                # pace the stand-in camera so the socket buffer doesn't overflow
+                time.sleep(0.0005)
+        thread.join()
+        camera.close()
+        rx.close()
+        return result
+
+    def parse_old(pkt):
+        out = []
+        old_parse(pkt, out)
+        return len(out)
+
+    new_parser = PacketParser()
+
+    def parse_new(pkt):
+        return len(new_parser.parse_datagram(pkt))
+
+    t0 = time.process_time()
+    for (i, d) in enumerate(datagrams):
+        old_encode(i & 0xFFFF, d[7], d[8:-2])
+    t_old_enc = time.process_time() - t0
+    t0 = time.process_time()
+    for (i, d) in enumerate(datagrams):
+        encode(i & 0xFFFF, d[7], memoryview(d)[8:-2])
+    t_new_enc = time.process_time() - t0
+    print("%u packets, %u bytes" % (len(datagrams), nbytes))
+    print("encode: old %.1fus new %.1fus per packet" % (
+        1.0e6 * t_old_enc / len(datagrams), 1.0e6 * t_new_enc / len(datagrams)))
+    for (name, parse) in [('old', parse_old), ('new', parse_new)]:
+        r = replay(parse)
+        print("%s: %u packets received, parsing %.1fus per packet" % (
+            name, r['packets'], 1.0e6 * r['parse_time'] / max(r['packets'], 1)))
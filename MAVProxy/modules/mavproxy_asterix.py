@@ -53,6 +53,7 @@ class AsterixModule(mp_module.MPModule):
 
     def __init__(self, mpstate):
         super(AsterixModule, self).__init__(mpstate, "asterix", "asterix SDPS data support")
+        self.subscribe(['GLOBAL_POSITION_INT'])
         self.threat_vehicles = {}
         self.active_threat_ids = []  # holds all threat ids the vehicle is evading
 
@@ -36,7 +36,7 @@ class ConsoleModule(mp_module.MPModule):
         self.safety_on = False
         self.unload_check_interval = 5 # seconds
         self.last_unload_check_time = time.time()
-        self.add_command('console', self.cmd_console, "console module", ['add','list','remove'])
+        self.add_command('console', self.cmd_console, "console module", ['add','list','remove','stats'])
         mpstate.console = wxconsole.MessageConsole(title='Console')
 
         # setup some default status information
@@ -92,7 +92,7 @@ class ConsoleModule(mp_module.MPModule):
             self.add_menu(self.vehicle_menu)
 
     def cmd_console(self, args):
-        usage = 'usage: console <add|list|remove|menu>'
+        usage = 'usage: console <add|list|remove|menu|stats>'
         if len(args) < 1:
             print(usage)
             return
@@ -120,6 +120,13 @@ class ConsoleModule(mp_module.MPModule):
                 self.user_added.pop(id)
         elif cmd == 'menu':
             self.cmd_menu(args[1:])
+        elif cmd == 'stats':
+            if not isinstance(self.console, wxconsole.MessageConsole):
+                print("console: no GUI console")
+                return
+            c = self.console.status_counters()
+            print("console: %u status updates %u suppressed, %u sent in %u batches, %u pending, %u dropped" % (
+                c['updates'], c['suppressed'], c['sent'], c['batches'], c['pending'], c['dropped']))
         else:
             print(usage)
 
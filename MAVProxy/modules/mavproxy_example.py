@@ -35,6 +35,10 @@ class example(mp_module.MPModule):
         self.packets_mytarget = 0
         self.packets_othertarget = 0
 
+        # only have mavlink_packet called for the message types we use;
+        # remove this to be passed every message
+        self.subscribe(['GLOBAL_POSITION_INT'])
+
         self.example_settings = mp_settings.MPSettings(
             [ ('verbose', bool, False),
           ])
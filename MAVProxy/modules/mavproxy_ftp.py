@@ -16,6 +16,8 @@ except ImportError:
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib import ftp_window
+from MAVProxy.modules.lib import ftp_jobs
 
 # opcodes
 OP_None = 0
@@ -98,7 +100,7 @@ class FTPModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(FTPModule, self).__init__(mpstate, "ftp", public=True)
         self.add_command('ftp', self.cmd_ftp, "file transfer",
-                         ["<list|get|rm|rmdir|rename|mkdir|crc|cancel|status>",
+                         ["<list|get|rm|rmdir|rename|mkdir|crc|cancel|status|jobs>",
                           "set (FTPSETTING)",
                           "put (FILENAME) (FILENAME)"])
         self.ftp_settings = mp_settings.MPSettings(
@@ -106,38 +108,34 @@ class FTPModule(mp_module.MPModule):
              ('pkt_loss_tx', int, 0),
              ('pkt_loss_rx', int, 0),
              ('max_backlog', int, 5),
-             ('burst_read_size', int, 80),
+             ('burst_read_size', int, 0),
              ('write_size', int, 80),
              ('write_qsize', int, 5),
-             ('retry_time', float, 0.5)])
+             ('retry_time', float, 0),
+             ('sessions', int, 1),
+             ('resume', int, 1)])
         self.add_completion_function('(FTPSETTING)',
                                      self.ftp_settings.completion)
         self.seq = 0
         self.session = 0
         self.network = 0
         self.last_op = None
+        self.op_pending = None
+        self.op_pending_time = 0
         self.fh = None
         self.filename = None
-        self.callback = None
-        self.callback_progress = None
         self.put_callback = None
         self.put_callback_progress = None
         self.total_size = 0
-        self.read_gaps = []
-        self.read_gap_times = {}
-        self.last_gap_send = 0
-        self.read_retries = 0
-        self.read_total = 0
-        self.duplicates = 0
-        self.last_read = None
-        self.last_burst_read = None
+        self.jobs = ftp_jobs.FTPJobQueue()
+        self.session_limit = None
+        self.last_burst_rx = 0
         self.op_start = None
         self.dir_offset = 0
         self.last_op_time = time.time()
+        self.last_send_time = time.time()
+        self.rtt_estimator = ftp_window.RTTEstimator()
         self.rtt = 0.5
-        self.reached_eof = False
-        self.backlog = 0
-        self.burst_size = self.ftp_settings.burst_read_size
         self.write_list = None
         self.write_block_size = 0
         self.write_acks = 0
@@ -151,7 +149,7 @@ class FTPModule(mp_module.MPModule):
 
     def cmd_ftp(self, args):
         '''FTP operations'''
-        usage = "Usage: ftp <list|get|put|rm|rmdir|rename|mkdir|crc>"
+        usage = "Usage: ftp <list|get|put|rm|rmdir|rename|mkdir|crc|cancel|status|jobs>"
         if len(args) < 1:
             print(usage)
             return
@@ -176,7 +174,9 @@ class FTPModule(mp_module.MPModule):
         elif args[0] == 'status':
             self.cmd_status()
         elif args[0] == 'cancel':
-            self.cmd_cancel()
+            self.cmd_cancel(args[1:])
+        elif args[0] == 'jobs':
+            self.cmd_jobs()
         else:
             print(usage)
 
@@ -191,20 +191,22 @@ class FTPModule(mp_module.MPModule):
         self.seq = (self.seq + 1) % 256
         self.last_op = op
         now = time.time()
+        if op.session == self.session and op.opcode not in [OP_TerminateSession, OP_ResetSessions]:
+            # a list, crc, remove, rename or mkdir waiting for its reply
+            self.op_pending = op
+            self.op_pending_time = now
         if self.ftp_settings.debug > 1:
             print("> %s dt=%.2f" % (op, now - self.last_op_time))
-        self.last_op_time = time.time()
+        self.last_op_time = now
+        self.last_send_time = now
 
     def terminate_session(self):
         '''terminate current session'''
         self.send(FTP_OP(self.seq, self.session, OP_TerminateSession, 0, 0, 0, 0, None))
         self.fh = None
+        self.op_pending = None
         self.filename = None
         self.write_list = None
-        if self.callback is not None:
-            # tell caller that the transfer failed
-            self.callback(None)
-            self.callback = None
         if self.put_callback is not None:
             # tell caller that the transfer failed
             self.put_callback(None)
@@ -212,15 +214,7 @@ class FTPModule(mp_module.MPModule):
         if self.put_callback_progress is not None:
             self.put_callback_progress(None)
             self.put_callback_progress = None
-        self.read_gaps = []
-        self.read_total = 0
-        self.read_gap_times = {}
-        self.last_read = None
-        self.last_burst_read = None
         self.session = (self.session + 1) % 256
-        self.reached_eof = False
-        self.backlog = 0
-        self.duplicates = 0
         if self.ftp_settings.debug > 0:
             print("Terminated session")
 
@@ -276,83 +270,290 @@ class FTPModule(mp_module.MPModule):
         '''get file'''
         if len(args) == 0:
             print("Usage: get FILENAME <LOCALNAME>")
-            return
-        self.terminate_session()
+            return None
         fname = args[0]
         if len(args) > 1:
-            self.filename = args[1]
+            local = args[1]
         else:
-            self.filename = os.path.basename(fname)
+            local = os.path.basename(fname)
+        return self.queue_get(fname, local, callback=callback, callback_progress=callback_progress)
+
+    def queue_get(self, remote, local=None, callback=None, callback_progress=None, label=None):
+        '''queue a download, returning the FTPJob. With a callback the
+        file is kept in memory and given to the callback, otherwise it
+        is written to local, or printed if local is "-"'''
+        if callback is not None:
+            local = None
+        job = self.jobs.add(remote, local, callback, callback_progress, label)
         if callback is None or self.ftp_settings.debug > 1:
-            print("Getting %s as %s" % (fname, self.filename))
-        self.op_start = time.time()
-        self.callback = callback
-        self.callback_progress = callback_progress
-        self.read_retries = 0
-        self.duplicates = 0
-        self.reached_eof = False
-        self.burst_size = self.ftp_settings.burst_read_size
-        if self.burst_size < 1:
-            self.burst_size = 239
-        elif self.burst_size > 239:
-            self.burst_size = 239
-        enc_fname = bytearray(fname, 'ascii')
-        self.open_retries = 0
-        op = FTP_OP(self.seq, self.session, OP_OpenFileRO, len(enc_fname), 0, 0, 0, enc_fname)
-        self.send(op)
+            print("Getting %s as %s" % (remote, local))
+        if len(self.jobs.active()) > 0 and self.ftp_settings.debug > 0:
+            print("FTP: queued job %u" % job.job_id)
+        self.start_jobs()
+        return job
+
+    def next_session(self):
+        '''a session number not in use'''
+        used = set([j.session for j in self.jobs.active()])
+        used.add(self.session)
+        session = self.session
+        while session in used:
+            session = (session + 1) % 256
+        return session
+
+    def start_jobs(self):
+        '''start queued downloads while there are sessions free'''
+        self.jobs.prune()
+        limit = max(self.ftp_settings.sessions, 1)
+        if self.session_limit is not None:
+            limit = min(limit, self.session_limit)
+        for job in self.jobs.queued():
+            if len(self.jobs.active()) >= limit:
+                break
+            self.open_job(job)
+
+    def op_outstanding(self, now):
+        '''true while a command other than a download has had no reply'''
+        if self.op_pending is None:
+            return False
+        return now - self.op_pending_time < 10 * max(self.rtt, 1.0)
+
+    def open_job(self, job):
+        '''send the open for a job'''
+        if (len(self.jobs.active()) == 0 and self.write_list is None and
+            not self.op_outstanding(time.time())):
+            # the vehicle may still have a file open from a transfer
+            # that was abandoned
+            self.send(FTP_OP(self.seq, self.session, OP_ResetSessions, 0, 0, 0, 0, None))
+        job.session = self.next_session()
+        job.state = ftp_jobs.OPENING
+        if job.start_time is None:
+            job.start_time = time.time()
+        job.last_request = time.time()
+        enc_fname = bytearray(job.remote, 'ascii')
+        self.send(FTP_OP(self.seq, job.session, OP_OpenFileRO, len(enc_fname), 0, 0, 0, enc_fname))
+
+    def job_for_reply(self, op):
+        '''the job a reply is for'''
+        job = self.jobs.by_session(op.session)
+        if job is None and op.req_opcode == OP_OpenFileRO:
+            # some servers pick their own session number for an open
+            opening = [j for j in self.jobs.active() if j.state == ftp_jobs.OPENING]
+            if len(opening) == 1:
+                job = opening[0]
+                job.session = op.session
+        return job
+
+    def end_job(self, job, state, error=None):
+        '''finish a job, closing its session and starting the next'''
+        self.send(FTP_OP(self.seq, job.session, OP_TerminateSession, 0, 0, 0, 0, None))
+        job.state = state
+        job.error = error
+        job.end_time = time.time()
+        if job.read is not None:
+            job.read.stats.end_time = job.end_time
+        if state == ftp_jobs.DONE:
+            job.clear_state()
+        else:
+            job.save_state()
+        if job.fh is not None and not job.in_memory():
+            job.fh.close()
+        if state != ftp_jobs.DONE and job.callback is not None:
+            # tell caller that the transfer failed
+            job.callback(None)
+        job.callback = None
+        if self.ftp_settings.debug > 0:
+            print("FTP: job %s" % job.describe())
+        self.start_jobs()
+
+    def fail_job(self, job, error):
+        if job.callback is None or self.ftp_settings.debug > 0:
+            print("FTP: %s failed: %s" % (job.remote, error))
+        self.end_job(job, ftp_jobs.FAILED, error)
 
     def handle_open_RO_reply(self, op, m):
         '''handle OP_OpenFileRO reply'''
-        if op.opcode == OP_Ack:
-            if self.filename is None:
+        job = self.job_for_reply(op)
+        if job is None or job.state != ftp_jobs.OPENING:
+            return
+        if op.opcode != OP_Ack:
+            others = len(self.jobs.active()) - 1
+            if others > 0 and len(op.payload) > 0 and op.payload[0] in [ERR_Fail, ERR_NoSessionsAvailable]:
+                # the vehicle can't open any more files at once. Wait
+                # for a running job to finish
+                self.session_limit = others
+                job.state = ftp_jobs.QUEUED
+                job.open_retries = 0
+                if self.ftp_settings.debug > 0:
+                    print("FTP: limiting to %u sessions" % others)
                 return
+            if job.callback is None or self.ftp_settings.debug > 0:
+                print("ftp open failed")
+            self.end_job(job, ftp_jobs.FAILED, "open failed")
+            return
+        size = None
+        if op.size == 4:
+            size, = struct.unpack("<I", op.payload)
+        if job.read is not None:
+            # opened again after the vehicle lost the session
+            if size != job.remote_size:
+                self.restart_job(job)
+            job.state = ftp_jobs.READING
+            self.continue_read(job)
+            return
+        job.remote_size = size
+        if job.fh is None:
+            job.resume_state = job.load_state() if self.ftp_settings.resume else None
             try:
-                if self.callback is not None or self.filename == '-':
-                    self.fh = SIO()
+                if job.in_memory():
+                    job.fh = SIO()
+                elif job.local == '-':
+                    job.fh = SIO()
+                elif job.resume_state is not None:
+                    job.fh = open(job.local, 'r+b')
                 else:
-                    self.fh = open(self.filename, 'wb')
+                    job.fh = open(job.local, 'wb')
             except Exception as ex:
-                print("Failed to open %s: %s" % (self.filename, ex))
-                self.terminate_session()
+                print("Failed to open %s: %s" % (job.local, ex))
+                self.end_job(job, ftp_jobs.FAILED, str(ex))
                 return
-            read = FTP_OP(self.seq, self.session, OP_BurstReadFile, self.burst_size, 0, 0, 0, None)
-            self.last_burst_read = time.time()
-            self.send(read)
-        else:
-            if self.callback is None or self.ftp_settings.debug > 0:
-                print("ftp open failed")
-            self.terminate_session()
+        if job.in_memory() or job.local == '-' or job.resume_state is None:
+            self.begin_read(job)
+            return
+        # the remote CRC checks a resumed download is of the same
+        # file. It is only asked for when there is a partial download
+        # to resume, as the vehicle reads the whole file to find it
+        self.request_crc(job)
+
+    def request_crc(self, job):
+        '''ask for the CRC of the file a job is reading'''
+        job.state = ftp_jobs.CHECKING
+        job.crc_retries = 0
+        self.send_crc_request(job)
+
+    def send_crc_request(self, job):
+        job.last_request = time.time()
+        enc_name = bytearray(job.remote, 'ascii')
+        self.send(FTP_OP(self.seq, job.session, OP_CalcFileCRC32, len(enc_name), 0, 0, 0, enc_name))
+
+    def crc_timeout(self):
+        '''seconds to wait for a CRC reply. The vehicle reads the whole
+        file to find it, so this is well over a round trip'''
+        return max(4 * self.rtt_estimator.rto, 2.0)
+
+    def crc_checked(self, job):
+        '''carry on once the CRC has arrived or been given up on'''
+        if job.read is None:
+            self.begin_read(job)
+            return
+        job.state = ftp_jobs.READING
+        self.check_read_finished(job)
+
+    def new_read_window(self):
+        # the round trip time carries over from earlier transfers
+        return ftp_window.ReadWindow(burst_size=max(self.ftp_settings.burst_read_size, 0),
+                                     max_window=self.ftp_settings.max_backlog,
+                                     retry_time=self.ftp_settings.retry_time,
+                                     rtt=self.rtt_estimator)
+
+    def begin_read(self, job):
+        '''start reading a file once it is open and checked'''
+        job.read = self.new_read_window()
+        job.state = ftp_jobs.READING
+        state = job.resume_state
+        job.resume_state = None
+        # the CRC of the whole file is checked once it has been read, so
+        # a download started without one, or resumed when the CRC reply
+        # was lost, is still checked
+        if (state is not None and state['size'] == job.remote_size and
+            (job.remote_crc is None or state['crc'] in [None, job.remote_crc])):
+            job.read.restore(state['head'], state['eof'], state['missing'])
+            job.resumed = True
+            job.resumed_bytes = job.read.received_bytes()
+            print("FTP: resuming %s at %u bytes" % (job.remote, job.resumed_bytes))
+        elif state is not None:
+            print("FTP: %s has changed, downloading it again" % job.remote)
+            job.fh.truncate(0)
+        self.continue_read(job)
 
-    def check_read_finished(self):
+    def restart_job(self, job):
+        '''throw away what has been read and start again'''
+        job.read = self.new_read_window()
+        job.resumed = False
+        job.resumed_bytes = 0
+        job.fh.seek(0)
+        job.fh.truncate(0)
+
+    def continue_read(self, job):
+        '''carry on reading where the job is up to'''
+        if self.check_read_finished(job):
+            return
+        if not job.read.eof:
+            self.send_burst_read(job, job.read.head)
+        self.check_read_send(job)
+
+    def send_burst_read(self, job, offset):
+        '''start a burst read at offset'''
+        job.read.next_burst_size()
+        job.last_burst_read = time.time()
+        self.send(FTP_OP(self.seq, job.session, OP_BurstReadFile, job.read.burst_size, 0, 0, offset, None))
+
+    def check_read_finished(self, job):
         '''check if download has completed'''
-        if self.reached_eof and len(self.read_gaps) == 0:
-            ofs = self.fh.tell()
-            dt = time.time() - self.op_start
-            rate = (ofs / dt) / 1024.0
-            if self.callback is not None:
-                self.fh.seek(0)
-                self.callback(self.fh)
-                self.callback = None
-            elif self.filename == "-":
-                self.fh.seek(0)
-                if sys.version_info.major < 3:
-                    print(self.fh.read())
-                else:
-                    print(self.fh.read().decode('utf-8'))
+        if job.state == ftp_jobs.CHECKING or not job.read.finished():
+            return False
+        ofs = job.read.head
+        if job.resumed and job.remote_crc is None and not job.crc_at_end and not job.in_memory():
+            # the CRC reply was lost when resuming, so ask again to
+            # check what was read before
+            job.crc_at_end = True
+            self.request_crc(job)
+            return False
+        if job.remote_crc is not None and not job.in_memory():
+            job.fh.flush()
+            crc = ftp_jobs.file_crc32(job.fh, ofs)
+            if crc != job.remote_crc:
+                if job.resumed:
+                    # what was read before doesn't match after all
+                    print("FTP: CRC mismatch on resumed %s, downloading it again" % job.remote)
+                    self.restart_job(job)
+                    self.continue_read(job)
+                    return False
+                print("FTP: CRC mismatch on %s, the file may have changed while downloading" % job.remote)
+        dt = time.time() - job.start_time
+        rate = (ofs / dt) / 1024.0
+        if job.callback is not None:
+            job.fh.seek(0)
+            job.callback(job.fh)
+            job.callback = None
+        elif job.local == "-":
+            job.fh.seek(0)
+            if sys.version_info.major < 3:
+                print(job.fh.read())
             else:
-                print("Wrote %u bytes to %s in %.2fs %.1fkByte/s" % (ofs, self.filename, dt, rate))
-            self.terminate_session()
-            return True
-        return False
+                print(job.fh.read().decode('utf-8'))
+        else:
+            print("Wrote %u bytes to %s in %.2fs %.1fkByte/s" % (ofs, job.local, dt, rate))
+        self.end_job(job, ftp_jobs.DONE)
+        if self.ftp_settings.debug > 0:
+            print("FTP: %s" % job.read.describe())
+        return True
 
-    def write_payload(self, op):
+    def write_payload(self, job, op):
         '''write payload from a read op'''
-        self.fh.seek(op.offset)
-        self.fh.write(op.payload)
-        self.read_total += len(op.payload)
-        if self.callback_progress is not None:
-            self.callback_progress(self.fh, self.read_total)
-    
+        job.fh.seek(op.offset)
+        job.fh.write(op.payload)
+        if job.callback_progress is not None:
+            job.callback_progress(job.fh, job.received_bytes())
+
+    def reopen_job(self, job):
+        '''open a file again after the vehicle has lost the session,
+        such as after a reboot'''
+        if self.ftp_settings.debug > 0:
+            print("FTP: reopening %s" % job.remote)
+        job.open_retries = 0
+        self.open_job(job)
+
     def handle_burst_read(self, op, m):
         '''handle OP_BurstReadFile reply'''
         if self.ftp_settings.pkt_loss_tx > 0:
@@ -360,87 +561,62 @@ class FTPModule(mp_module.MPModule):
                 if self.ftp_settings.debug > 0:
                     print("FTP: dropping TX")
                 return
-        if self.fh is None or self.filename is None:
-            if op.session != self.session:
-                # old session
-                return
-            print("FTP Unexpected burst read reply")
-            print(op)
+        job = self.job_for_reply(op)
+        if job is None or job.state != ftp_jobs.READING:
+            # old session
             return
-        self.last_burst_read = time.time()
+        read = job.read
+        now = time.time()
+        job.last_burst_read = now
+        self.last_burst_rx = now
         size = len(op.payload)
-        if size > self.burst_size:
+        if size > read.burst_size:
             # this server doesn't handle the burst size argument
-            self.burst_size = MAX_Payload
+            read.fixed_burst_size = MAX_Payload
+            read.burst_size = MAX_Payload
             if self.ftp_settings.debug > 0:
-                print("Setting burst size to %u" % self.burst_size)
-        if op.opcode == OP_Ack and self.fh is not None:
-            ofs = self.fh.tell()
-            if op.offset < ofs:
-                # writing an earlier portion, possibly remove a gap
-                gap = (op.offset, len(op.payload))
-                if gap in self.read_gaps:
-                    self.read_gaps.remove(gap)
-                    self.read_gap_times.pop(gap)
-                    if self.ftp_settings.debug > 0:
-                        print("FTP: removed gap", gap, self.reached_eof, len(self.read_gaps))
-                else:
-                    if self.ftp_settings.debug > 0:
-                        print("FTP: dup read reply at %u of len %u ofs=%u" % (op.offset, op.size, self.fh.tell()))
-                    self.duplicates += 1
-                    return
-                self.write_payload(op)
-                self.fh.seek(ofs)
-                if self.check_read_finished():
-                    return
-            elif op.offset > ofs:
-                # we have a gap
-                gap = (ofs, op.offset-ofs)
-                max_read = self.burst_size
-                while True:
-                    if gap[1] <= max_read:
-                        self.read_gaps.append(gap)
-                        self.read_gap_times[gap] = 0
-                        break
-                    g = (gap[0], max_read)
-                    self.read_gaps.append(g)
-                    self.read_gap_times[g] = 0
-                    gap = (gap[0] + max_read, gap[1] - max_read)
-                self.write_payload(op)
-            else:
-                self.write_payload(op)
-            if op.burst_complete:
-                if op.size > 0 and op.size < self.burst_size:
+                print("Setting burst size to %u" % read.burst_size)
+        if op.opcode == OP_Ack:
+            leading = op.offset + size >= read.head
+            if read.burst_data(op.offset, size, now) > 0:
+                self.write_payload(job, op)
+            elif self.ftp_settings.debug > 0:
+                print("FTP: dup read reply at %u of len %u head=%u" % (op.offset, op.size, read.head))
+            if op.burst_complete and leading:
+                if op.size > 0 and op.size < read.burst_size:
                     # a burst complete with non-zero size and less than burst packet size
                     # means EOF
-                    if not self.reached_eof and self.ftp_settings.debug > 0:
-                        print("EOF at %u with %u gaps t=%.2f" % (self.fh.tell(), len(self.read_gaps), time.time() - self.op_start))
-                    self.reached_eof = True
-                    if self.check_read_finished():
+                    if not read.eof and self.ftp_settings.debug > 0:
+                        print("EOF at %u with %u gaps t=%.2f" % (read.head, len(read.missing), now - job.start_time))
+                    read.eof = True
+                    if self.check_read_finished(job):
                         return
-                    self.check_read_send()
+                    self.check_read_send(job)
                     return
-                more = self.last_op
-                more.offset = op.offset + op.size
                 if self.ftp_settings.debug > 0:
-                    print("FTP: burst continue at %u %u" % (more.offset, self.fh.tell()))
-                self.send(more)
+                    print("FTP: burst continue at %u" % (op.offset + op.size))
+                self.send_burst_read(job, op.offset + op.size)
+            if self.check_read_finished(job):
+                return
+            self.check_read_send(job)
         elif op.opcode == OP_Nack:
             ecode = op.payload[0]
             if self.ftp_settings.debug > 0:
                 print("FTP: burst nack: ", op)
             if ecode == ERR_EndOfFile or ecode == 0:
-                if not self.reached_eof and op.offset > self.fh.tell():
+                if not read.eof and op.offset > read.head:
                     # we lost the last part of the burst
                     if self.ftp_settings.debug > 0:
-                        print("burst lost EOF %u %u" % (self.fh.tell(), op.offset))
+                        print("burst lost EOF %u %u" % (read.head, op.offset))
                     return
-                if not self.reached_eof and self.ftp_settings.debug > 0:
-                    print("EOF at %u with %u gaps t=%.2f" % (self.fh.tell(), len(self.read_gaps), time.time() - self.op_start))
-                self.reached_eof = True
-                if self.check_read_finished():
+                if not read.eof and self.ftp_settings.debug > 0:
+                    print("EOF at %u with %u gaps t=%.2f" % (read.head, len(read.missing), now - job.start_time))
+                read.eof = True
+                if self.check_read_finished(job):
                     return
-                self.check_read_send()
+                self.check_read_send(job)
+            elif ecode == ERR_InvalidSession:
+                self.reopen_job(job)
             elif self.ftp_settings.debug > 0:
                 print("FTP: burst Nack (ecode:%u): %s" % (ecode, op))
         else:
@@ -448,37 +624,34 @@ class FTPModule(mp_module.MPModule):
 
     def handle_reply_read(self, op, m):
         '''handle OP_ReadFile reply'''
-        if self.fh is None or self.filename is None:
+        job = self.job_for_reply(op)
+        if job is None or job.state != ftp_jobs.READING:
             if self.ftp_settings.debug > 0:
                 print("FTP Unexpected read reply")
                 print(op)
             return
-        if self.backlog > 0:
-            self.backlog -= 1
-        if op.opcode == OP_Ack and self.fh is not None:
-            gap = (op.offset, op.size)
-            if gap in self.read_gaps:
-                self.read_gaps.remove(gap)
-                self.read_gap_times.pop(gap)
-                ofs = self.fh.tell()
-                self.write_payload(op)
-                self.fh.seek(ofs)
+        if op.opcode == OP_Ack:
+            new = job.read.read_reply(op.offset, len(op.payload), time.time())
+            if new is None:
+                self.fail_job(job, "file size changed to %u" % (op.offset+op.size))
+                return
+            if new > 0:
+                self.write_payload(job, op)
                 if self.ftp_settings.debug > 0:
-                    print("FTP: removed gap", gap, self.reached_eof, len(self.read_gaps))
-                if self.check_read_finished():
+                    print("FTP: filled gap", (op.offset, op.size), job.read.eof, len(job.read.missing))
+                if self.check_read_finished(job):
                     return
-            elif op.size < self.burst_size:
-                print("FTP: file size changed to %u" % op.offset+op.size)
-                self.terminate_session()
-            else:
-                self.duplicates += 1
-                if self.ftp_settings.debug > 0:
-                    print("FTP: no gap read", gap, len(self.read_gaps))
+            elif self.ftp_settings.debug > 0:
+                print("FTP: no gap read", (op.offset, op.size), len(job.read.missing))
         elif op.opcode == OP_Nack:
-            print("Read failed with %u gaps" % len(self.read_gaps), str(op))
-            self.terminate_session()
-        self.check_read_send()
-            
+            if len(op.payload) > 0 and op.payload[0] == ERR_InvalidSession:
+                self.reopen_job(job)
+                return
+            print("Read failed with %u gaps" % len(job.read.missing), str(op))
+            self.fail_job(job, "read failed")
+            return
+        self.check_read_send(job)
+
     def cmd_put(self, args, fh=None, callback=None, progress_callback=None):
         '''put file'''
         if len(args) == 0:
@@ -525,7 +698,6 @@ class FTPModule(mp_module.MPModule):
 
         self.put_callback = callback
         self.put_callback_progress = progress_callback
-        self.read_retries = 0
         self.op_start = time.time()
         enc_fname = bytearray(self.filename, 'ascii')
         op = FTP_OP(self.seq, self.session, OP_CreateFile, len(enc_fname), 0, 0, 0, enc_fname)
@@ -683,6 +855,15 @@ class FTPModule(mp_module.MPModule):
 
     def handle_crc_reply(self, op, m):
         '''handle crc reply'''
+        job = self.job_for_reply(op)
+        if job is not None:
+            if job.state == ftp_jobs.CHECKING:
+                if op.opcode == OP_Ack and op.size == 4:
+                    job.remote_crc, = struct.unpack("<I", op.payload)
+                elif self.ftp_settings.debug > 0:
+                    print("FTP: no CRC for %s, it can't be checked" % job.remote)
+                self.crc_checked(job)
+            return
         if op.opcode == OP_Ack and op.size == 4:
             crc, = struct.unpack("<I", op.payload)
             now = time.time()
@@ -690,19 +871,51 @@ class FTPModule(mp_module.MPModule):
         else:
             print("crc failed %s" % op)
 
-    def cmd_cancel(self):
-        '''cancel any pending op'''
+    def cmd_cancel(self, args=[]):
+        '''cancel any pending op, or one download'''
+        if len(args) > 0:
+            job = self.jobs.get(int(args[0]))
+            if job is None or job.finished():
+                print("No job %s" % args[0])
+                return
+            self.cancel_job(job)
+            return
+        for job in self.jobs.jobs:
+            if not job.finished():
+                self.cancel_job(job)
         self.terminate_session()
 
+    def cancel_job(self, job):
+        if job.state == ftp_jobs.QUEUED:
+            job.state = ftp_jobs.CANCELLED
+            if job.callback is not None:
+                job.callback(None)
+                job.callback = None
+            return
+        self.end_job(job, ftp_jobs.CANCELLED)
+
+    def cmd_jobs(self):
+        '''show downloads'''
+        if len(self.jobs.jobs) == 0:
+            print("No downloads")
+        for job in self.jobs.jobs:
+            print(job.describe())
+
     def cmd_status(self):
         '''show status'''
-        if self.fh is None:
+        active = self.jobs.active()
+        for job in active:
+            print(job.describe())
+            print("  %s" % job.read.describe() if job.read is not None else "  waiting for vehicle")
+        if len(self.jobs.queued()) > 0:
+            print("%u downloads queued" % len(self.jobs.queued()))
+        if self.fh is not None:
+            print("Upload in progress")
+        elif len(active) == 0:
             print("No transfer in progress")
-        else:
-            ofs = self.fh.tell()
-            dt = time.time() - self.op_start
-            rate = (ofs / dt) / 1024.0
-            print("Transfer at offset %u with %u gaps %u retries %.1f kByte/sec" % (ofs, len(self.read_gaps), self.read_retries, rate))
+            finished = [j for j in self.jobs.jobs if j.finished() and j.read is not None]
+            if len(finished) > 0:
+                print("Last download: %s" % finished[-1].read.describe())
 
     def op_parse(self, m):
         '''parse a FILE_TRANSFER_PROTOCOL msg'''
@@ -734,15 +947,24 @@ class FTPModule(mp_module.MPModule):
                         print("FTP: dropping packet RX")
                     return
 
-            if op.req_opcode == self.last_op.opcode and op.seq == (self.last_op.seq + 1) % 256:
-                self.rtt = max(min(self.rtt, dt), 0.01)
+            if (op.req_opcode == self.last_op.opcode and op.seq == (self.last_op.seq + 1) % 256 and
+                op.req_opcode not in [OP_ReadFile, OP_CalcFileCRC32]):
+                # a reply to the request just sent. Gap reads are timed
+                # by the read window, as several are outstanding at once,
+                # and the vehicle takes a while to calculate a CRC
+                self.rtt_estimator.sample(max(now - self.last_send_time, 0.01))
+            if self.rtt_estimator.srtt is not None:
+                self.rtt = self.rtt_estimator.srtt
+            if (self.op_pending is not None and op.session == self.op_pending.session and
+                op.req_opcode == self.op_pending.opcode):
+                self.op_pending = None
             if op.req_opcode == OP_ListDirectory:
                 self.handle_list_reply(op, m)
             elif op.req_opcode == OP_OpenFileRO:
                 self.handle_open_RO_reply(op, m)
             elif op.req_opcode == OP_BurstReadFile:
                 self.handle_burst_read(op, m)
-            elif op.req_opcode == OP_TerminateSession:
+            elif op.req_opcode in [OP_TerminateSession, OP_ResetSessions]:
                 pass
             elif op.req_opcode == OP_CreateFile:
                 self.handle_create_file_reply(op, m)
@@ -761,88 +983,77 @@ class FTPModule(mp_module.MPModule):
             else:
                 print('FTP Unknown %s' % str(op))
 
-    def send_gap_read(self, g):
+    def send_gap_read(self, job, offset, length):
         '''send a read for a gap'''
-        (offset, length) = g
         if self.ftp_settings.debug > 0:
-            print("Gap read of %u at %u rem=%u blog=%u" % (length, offset, len(self.read_gaps), self.backlog))
-        read = FTP_OP(self.seq, self.session, OP_ReadFile, length, 0, 0, offset, None)
+            print("Gap read of %u at %u rem=%u outstanding=%u" % (length, offset, len(job.read.missing),
+                                                                 len(job.read.outstanding)))
+        read = FTP_OP(self.seq, job.session, OP_ReadFile, length, 0, 0, offset, None)
         self.send(read)
-        self.read_gaps.remove(g)
-        self.read_gaps.append(g)
-        self.last_gap_send = time.time()
-        self.read_gap_times[g] = self.last_gap_send
-        self.backlog += 1
-
-    def check_read_send(self):
-        '''see if we should send another gap read'''
-        if len(self.read_gaps) == 0:
-            return
-        g = self.read_gaps[0]
-        now = time.time()
-        dt = now - self.read_gap_times[g]
-        if not self.reached_eof:
-            # send gap reads once
-            for g in self.read_gap_times.keys():
-                if self.read_gap_times[g] == 0:
-                    self.send_gap_read(g)
-            return
-        if self.read_gap_times[g] > 0 and dt > self.ftp_settings.retry_time:
-            if self.backlog > 0:
-                self.backlog -= 1
-            self.read_gap_times[g] = 0
 
-        if self.read_gap_times[g] != 0:
-            # still pending
-            return
-        if not self.reached_eof and self.backlog >= self.ftp_settings.max_backlog:
-            # don't fill queue too far until we have got past the burst
-            return
-        if now - self.last_gap_send < 0.05:
-            # don't send too fast
-            return
-        self.send_gap_read(g)
-
-    def idle_task(self):
-        '''check for file gaps and lost requests'''
-        now = time.time()
+    def check_read_send(self, job):
+        '''send gap reads while there is room in the window'''
+        # the vehicle's request queue is shared by all the sessions
+        job.read.max_window = max(1, self.ftp_settings.max_backlog // max(len(self.jobs.active()), 1))
+        for (offset, length) in job.read.next_reads(time.time()):
+            self.send_gap_read(job, offset, length)
 
-        # see if we lost an open reply
-        if self.op_start is not None and now - self.op_start > 1.0 and self.last_op.opcode == OP_OpenFileRO:
-            self.op_start = now
-            self.open_retries += 1
-            if self.open_retries > 2:
+    def job_idle(self, job, now):
+        '''check a running download for lost requests'''
+        if job.state == ftp_jobs.OPENING and now - job.last_request > 1.0:
+            # see if we lost an open reply
+            job.open_retries += 1
+            if job.open_retries > 2:
                 # fail the get
-                self.op_start = None
-                self.terminate_session()
+                self.fail_job(job, "no reply to open")
                 return
             if self.ftp_settings.debug > 0:
                 print("FTP: retry open")
-            send_op = self.last_op
-            self.send(FTP_OP(self.seq, self.session, OP_TerminateSession, 0, 0, 0, 0, None))
-            self.session = (self.session + 1) % 256
-            send_op.session = self.session
-            self.send(send_op)
+            self.send(FTP_OP(self.seq, job.session, OP_TerminateSession, 0, 0, 0, 0, None))
+            self.open_job(job)
+            return
 
-        if len(self.read_gaps) == 0 and self.last_burst_read is None and self.write_list is None:
+        if job.state == ftp_jobs.CHECKING and now - job.last_request > self.crc_timeout():
+            # see if we lost a CRC request or reply
+            job.crc_retries += 1
+            if job.crc_retries > 2:
+                if self.ftp_settings.debug > 0:
+                    print("FTP: no CRC reply for %s" % job.remote)
+                self.crc_checked(job)
+                return
+            if self.ftp_settings.debug > 0:
+                print("FTP: retry CRC")
+            self.send_crc_request(job)
             return
 
-        if self.fh is None:
+        if job.state != ftp_jobs.READING:
             return
 
-        # see if burst read has stalled
-        if not self.reached_eof and self.last_burst_read is not None and now - self.last_burst_read > self.ftp_settings.retry_time:
-            dt = now - self.last_burst_read
-            self.last_burst_read = now
+        # see if burst read has stalled. The vehicle streams one burst
+        # at a time, so a burst may be waiting for another session's
+        read = job.read
+        last_burst = max(job.last_burst_read or 0, self.last_burst_rx)
+        if not read.eof and job.last_burst_read is not None and now - last_burst > read.timeout():
+            dt = now - job.last_burst_read
             if self.ftp_settings.debug > 0:
-                print("Retry read at %u rtt=%.2f dt=%.2f" % (self.fh.tell(), self.rtt, dt))
-            self.send(FTP_OP(self.seq, self.session, OP_BurstReadFile, self.burst_size, 0, 0, self.fh.tell(), None))
-            self.read_retries += 1
+                print("Retry read at %u rtt=%.2f dt=%.2f" % (read.head, self.rtt, dt))
+            self.send_burst_read(job, read.head)
+            read.stats.burst_retries += 1
+            self.rtt_estimator.backoff()
 
         # see if we can fill gaps
-        self.check_read_send()
+        self.check_read_send(job)
 
-        if self.write_list is not None:
+        if now - job.last_save > 2.0:
+            job.save_state()
+
+    def idle_task(self):
+        '''check for file gaps and lost requests'''
+        now = time.time()
+        for job in self.jobs.active():
+            self.job_idle(job, now)
+
+        if self.write_list is not None and self.fh is not None:
             self.send_more_writes()
 
 def init(mpstate):
@@ -7,7 +7,7 @@
 '''
 
 from pymavlink import mavutil
-import time, struct, math, sys, fnmatch, traceback, json, os
+import time, math, sys, fnmatch, traceback, json, os
 
 if sys.version_info[0] >= 3:
     import io as StringIO
@@ -16,6 +16,7 @@ else:
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_linkworker
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
@@ -59,6 +60,9 @@ class LinkModule(mp_module.MPModule):
         self.add_command('vehicle', self.cmd_vehicle, "vehicle control")
         self.add_command('alllinks', self.cmd_alllinks, "send command on all links", ["(COMMAND)"])
         self.no_fwd_types = set()
+        # message type -> list of modules to pass it to, see module_dispatch()
+        self.dispatch_table = {}
+        self.dispatch_key = None
         self.no_fwd_types.add("BAD_DATA")
         self.add_completion_function('(SERIALPORT)', self.complete_serial_ports)
         self.add_completion_function('(LINKS)', self.complete_links)
@@ -297,6 +301,8 @@ class LinkModule(mp_module.MPModule):
                 print("%u (%s): %s" % (i, conn.label, conn.address))
             else:
                 print("%u: %s" % (i, conn.address))
+            if isinstance(conn, mp_linkworker.mavworker):
+                print("   %s" % conn.stats())
 
     def parse_link_attributes(self, some_json):
         '''return a dict based on some_json (empty if json invalid)'''
@@ -338,11 +344,20 @@ class LinkModule(mp_module.MPModule):
                         device = device.split(':')[0]
                         break
             print("Connect %s source_system=%d" % (device, self.settings.source_system))
+            if self.settings.linkworker and not mp_linkworker.available():
+                print("Link workers are not supported on this platform, reading %s in this process" % device)
             try:
-                conn = mavutil.mavlink_connection(device, autoreconnect=True,
-                                                  source_system=self.settings.source_system,
-                                                  baud=self.settings.baudrate,
-                                                  force_connected=force_connected)
+                if self.settings.linkworker and mp_linkworker.available():
+                    # read and parse the link in a separate process
+                    conn = mp_linkworker.mavworker(device, autoreconnect=True,
+                                                   source_system=self.settings.source_system,
+                                                   baud=self.settings.baudrate,
+                                                   force_connected=force_connected)
+                else:
+                    conn = mavutil.mavlink_connection(device, autoreconnect=True,
+                                                      source_system=self.settings.source_system,
+                                                      baud=self.settings.baudrate,
+                                                      force_connected=force_connected)
             except Exception as e:
                 # try the same thing but without force-connected for
                 # backwards-compatability
@@ -370,11 +385,18 @@ class LinkModule(mp_module.MPModule):
         self.status.counters['MasterIn'].append(0)
         self.status.bytecounters['MasterIn'].append(self.status.ByteCounter())
         self.mpstate.vehicle_link_map[conn.linknum] = set(())
+        for fd in self.link_child_fds(conn):
+            mp_util.child_fd_list_add(fd)
+        return True
+
+    def link_child_fds(self, conn):
+        '''file descriptors of a link to close in child processes'''
+        if isinstance(conn, mp_linkworker.mavworker):
+            return conn.child_fds()
         try:
-            mp_util.child_fd_list_add(conn.port.fileno())
+            return [conn.port.fileno()]
         except Exception:
-            pass
-        return True
+            return []
 
     def cmd_link_add(self, args):
         '''add new link'''
@@ -426,10 +448,8 @@ class LinkModule(mp_module.MPModule):
         conn = self.mpstate.mav_master[i]
         print("Removing link %s" % conn.address)
         try:
-            try:
-                mp_util.child_fd_list_remove(conn.port.fileno())
-            except Exception:
-                pass
+            for fd in self.link_child_fds(conn):
+                mp_util.child_fd_list_remove(fd)
             self.mpstate.mav_master[i].close()
         except Exception as msg:
             print(msg)
@@ -481,7 +501,7 @@ class LinkModule(mp_module.MPModule):
         if mtype != 'BAD_DATA' and self.mpstate.logqueue:
             usec = self.get_usec()
             usec = (usec & ~3) | 3 # linknum 3
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.log_message(usec, m.get_msgbuf())
 
     def handle_msec_timestamp(self, m, master):
         '''special handling for MAVLink packets with a time_boot_ms field'''
@@ -910,7 +930,7 @@ class LinkModule(mp_module.MPModule):
             # delay in saved logs
             usec = self.get_usec()
             usec = (usec & ~3) | master.linknum
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.log_message(usec, m.get_msgbuf())
 
         # keep the last message of each type around
         self.status.msgs[mtype] = m
@@ -960,12 +980,14 @@ class LinkModule(mp_module.MPModule):
             target_sysid = self.target_system
 
             # pass to modules
-            for (mod,pm) in self.mpstate.modules:
-                if not hasattr(mod, 'mavlink_packet'):
-                    continue
+            from_primary = None
+            for mod in self.module_dispatch(mtype):
                 # Do not send other-system-or-component heartbeat packets to non-multi-vehicle modules
-                if not self.message_is_from_primary_vehicle(m) and not mod.multi_vehicle and mtype == 'HEARTBEAT':
-                    continue
+                if mtype == 'HEARTBEAT' and not mod.multi_vehicle:
+                    if from_primary is None:
+                        from_primary = self.message_is_from_primary_vehicle(m)
+                    if not from_primary:
+                        continue
                 # sysid 51/'3' is used by SiK radio for the injected RADIO/RADIO_STATUS mavlink frames.
                 # In order to be able to pass these to e.g. the graph module, which is not multi-vehicle,
                 # special handling is needed, so that the module gets both RADIO_STATUS and (single) target 
@@ -992,6 +1014,29 @@ class LinkModule(mp_module.MPModule):
                     elif self.mpstate.settings.moddebug == 1:
                         print(msg)
 
+    def module_dispatch(self, mtype):
+        '''return the list of modules which want messages of type mtype.
+        The table is filled in lazily and discarded whenever modules are
+        loaded or unloaded or change their subscriptions'''
+        key = (self.mpstate.module_generation, len(self.mpstate.modules))
+        if key != self.dispatch_key:
+            self.dispatch_table = {}
+            self.dispatch_key = key
+        mods = self.dispatch_table.get(mtype, None)
+        if mods is not None:
+            return mods
+        mods = []
+        for (mod,pm) in self.mpstate.modules:
+            if getattr(type(mod), 'mavlink_packet', None) in (None, mp_module.MPModule.mavlink_packet):
+                # module does not handle packets at all
+                continue
+            subscribed = getattr(mod, 'subscribed_types', None)
+            if subscribed is not None and mtype not in subscribed:
+                continue
+            mods.append(mod)
+        self.dispatch_table[mtype] = mods
+        return mods
+
     def cmd_vehicle(self, args):
         '''handle vehicle commands'''
         if len(args) < 1:
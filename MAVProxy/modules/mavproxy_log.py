@@ -4,21 +4,32 @@
 import time, os
 
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib import log_download
+from MAVProxy.modules.lib.ftp_window import RTTEstimator
 
 class LogModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(LogModule, self).__init__(mpstate, "log", "log transfer")
-        self.add_command('log', self.cmd_log, "log file handling", ['<download|status|erase|resume|cancel|list>'])
+        self.subscribe(['LOG_ENTRY', 'LOG_DATA'])
+        self.add_command('log', self.cmd_log, "log file handling", ['<download|status|erase|resume|cancel|list>',
+                                                                     'set (LOGSETTING)'])
+        self.log_settings = mp_settings.MPSettings(
+            [('window', int, 1048576),
+             ('chunk_size', int, 65536),
+             ('debug', int, 0)])
+        self.add_completion_function('(LOGSETTING)',
+                                     self.log_settings.completion)
+        # the round trip time carries over from one download to the next
+        self.rtt_estimator = RTTEstimator()
         self.reset()
 
     def reset(self):
-        self.download_set = set()
+        self.download = None
         self.download_file = None
         self.download_lognum = None
         self.download_filename = None
         self.download_start = None
-        self.download_last_timestamp = None
-        self.download_ofs = 0
         self.retries = 0
         self.entries = {}
         self.download_queue = []
@@ -46,70 +57,50 @@ class LogModule(mp_module.MPModule):
 
     def handle_log_data(self, m):
         '''handling incoming log data'''
-        if self.download_file is None:
+        if self.download is None or m.id != self.download_lognum:
             return
         # lose some data
         # import random
         # if random.uniform(0,1) < 0.05:
         #    print('dropping ', str(m))
         #    return
-        if m.ofs != self.download_ofs:
-            self.download_file.seek(m.ofs)
-            self.download_ofs = m.ofs
-        if m.count != 0:
-            s = bytearray(m.data[:m.count])
-            self.download_file.write(s)
-            self.download_set.add(m.ofs // 90)
-            self.download_ofs += m.count
-        self.download_last_timestamp = time.time()
-        if m.count == 0 or (m.count < 90 and len(self.download_set) == 1 + (m.ofs // 90)):
-            dt = time.time() - self.download_start
+        self.download.data(m.ofs, m.count, bytearray(m.data), time.time())
+        if self.download.finished():
+            self.download.close()
             self.download_file.close()
-            size = os.path.getsize(self.download_filename)
+            dt = time.time() - self.download_start
+            size = self.download.size
             speed = size / (1000.0 * dt)
             status = "Finished downloading %s (%u bytes %u seconds, %.1f kbyte/sec %u retries)" % (self.download_filename,
                                                                                                    size,
                                                                                                    dt, speed,
-                                                                                                   self.retries)
+                                                                                                   self.download.retries)
             self.console.set_status('LogDownload',status, row=4)
             print(status)
+            if self.log_settings.debug > 0:
+                print(self.download.describe())
+            self.retries = self.download.retries
+            self.download = None
             self.download_file = None
             self.download_filename = None
-            self.download_set = set()
             self.master.mav.log_request_end_send(self.target_system,
                                                  self.target_component)
             if len(self.download_queue):
                 self.log_download_next()
+            return
+        self.send_log_request()
         self.update_status()
 
-    def handle_log_data_missing(self):
-        '''handling missing incoming log data'''
-        if len(self.download_set) == 0:
+    def send_log_request(self):
+        '''ask for the next range of the log if it is time to'''
+        req = self.download.next_request(time.time())
+        if req is None:
             return
-        highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
-        if len(diff) == 0:
-            self.master.mav.log_request_data_send(self.target_system,
-                                                       self.target_component,
-                                                       self.download_lognum, (1 + highest) * 90, 0xffffffff)
-            self.retries += 1
-        else:
-            num_requests = 0
-            while num_requests < 20:
-                start = min(diff)
-                diff.remove(start)
-                end = start
-                while end + 1 in diff:
-                    end += 1
-                    diff.remove(end)
-                self.master.mav.log_request_data_send(self.target_system,
-                                                           self.target_component,
-                                                           self.download_lognum, start * 90, (end + 1 - start) * 90)
-                num_requests += 1
-                self.retries += 1
-                if len(diff) == 0:
-                    break
-
+        if self.log_settings.debug > 0:
+            print("LOG: request %u bytes at %u%s" % (req.count, req.ofs, " (retry)" if req.retry else ""))
+        self.master.mav.log_request_data_send(self.target_system,
+                                              self.target_component,
+                                              self.download_lognum, req.ofs, req.count)
 
     def log_status(self, console=False):
         '''show download status'''
@@ -117,33 +108,28 @@ class LogModule(mp_module.MPModule):
             print("No download")
             return
         dt = time.time() - self.download_start
-        speed = os.path.getsize(self.download_filename) / (1000.0 * dt)
-        m = self.entries.get(self.download_lognum, None)
-        file_size = os.path.getsize(self.download_filename)
-        if m is None:
+        received = self.download.received_bytes()
+        speed = received / (1000.0 * dt)
+        size = self.download.size
+        if size is None:
             size = 0
             pct = 0
-        elif m.size == 0:
-            size = 0
+        elif size == 0:
             pct = 100
         else:
-            size = m.size
-            pct = (100.0*file_size)/size
-        highest = 0
-        if len(self.download_set):
-            highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
+            pct = (100.0*received)/size
         status = "Downloading %s - %u/%u bytes %.1f%% %.1f kbyte/s (%u retries %u missing)" % (self.download_filename,
-                                                                                            os.path.getsize(self.download_filename),
-                                                                                        size,
-                                                                                        pct,
-                                                                                        speed,
-                                                                                        self.retries,
-                                                                                            len(diff))
+                                                                                            received,
+                                                                                            size,
+                                                                                            pct,
+                                                                                            speed,
+                                                                                            self.download.retries,
+                                                                                            self.download.missing.size)
         if console:
             self.console.set_status('LogDownload', status, row=4)
         else:
             print(status)
+            print(self.download.describe())
 
     def log_download_next(self):
         if len(self.download_queue) == 0:
@@ -179,33 +165,39 @@ class LogModule(mp_module.MPModule):
     def log_download(self, log_num, filename):
         '''download a log file'''
         print("Downloading log %u as %s" % (log_num, filename))
+        if self.download is not None:
+            self.download.close()
+        if self.download_file is not None:
+            self.download_file.close()
         self.download_lognum = log_num
         self.download_file = open(filename, "wb")
-        self.master.mav.log_request_data_send(self.target_system,
-                                                   self.target_component,
-                                                   log_num, 0, 0xFFFFFFFF)
+        entry = self.entries.get(log_num, None)
+        self.download = log_download.LogDownload(log_num, self.download_file,
+                                                 size=entry.size if entry is not None else None,
+                                                 window=self.log_settings.window,
+                                                 chunk_size=self.log_settings.chunk_size,
+                                                 rtt=self.rtt_estimator)
         self.download_filename = filename
-        self.download_set = set()
         self.download_start = time.time()
-        self.download_last_timestamp = time.time()
-        self.download_ofs = 0
         self.retries = 0
+        self.send_log_request()
 
     def default_log_filename(self, log_num):
         return "log%u.bin" % log_num
 
     def cmd_log(self, args):
         '''log commands'''
-        usage = "usage: log <list|download|erase|resume|status|cancel>"
+        usage = "usage: log <list|download|erase|resume|status|cancel|set>"
         if len(args) < 1:
             print(usage)
             return
 
         if args[0] == "status":
             self.log_status()
+        elif args[0] == "set":
+            self.log_settings.command(args[1:])
         elif args[0] == "list":
             print("Requesting log list")
-            self.download_set = set()
             self.master.mav.log_request_list_send(self.target_system,
                                                        self.target_component,
                                                        0, 0xffff)
@@ -219,6 +211,8 @@ class LogModule(mp_module.MPModule):
                                                       self.target_component)
 
         elif args[0] == "cancel":
+            if self.download is not None:
+                self.download.close()
             if self.download_file is not None:
                 self.download_file.close()
             self.reset()
@@ -266,9 +260,8 @@ class LogModule(mp_module.MPModule):
             
     def idle_task(self):
         '''handle missing log data'''
-        if self.download_last_timestamp is not None and time.time() - self.download_last_timestamp > 0.7:
-            self.download_last_timestamp = time.time()
-            self.handle_log_data_missing()
+        if self.download is not None:
+            self.send_log_request()
         self.update_status()
 
 def init(mpstate):
@@ -61,7 +61,8 @@ class MapModule(mp_module.MPModule):
               ('showwpnum',bool, True),
               ('showdirection', bool, False),
               ('setpos_accuracy', float, 50),
-              ('font_size', float, 0.5) ])
+              ('font_size', float, 0.5),
+              ('download_workers', int, 4) ])
         
         service='MicrosoftHyb'
         if 'MAP_SERVICE' in os.environ:
@@ -75,7 +76,8 @@ class MapModule(mp_module.MPModule):
         terrain_module = self.module('terrain')
         if terrain_module is not None:
             elevation = terrain_module.ElevationModel.database
-        self.map = mp_slipmap.MPSlipMap(service=service, elevation=elevation, title=title)
+        self.map = mp_slipmap.MPSlipMap(service=service, elevation=elevation, title=title,
+                                        download_workers=self.map_settings.download_workers)
         if self.instance == 1:
             self.mpstate.map = self.map
             mpstate.map_functions = { 'draw_lines' : self.draw_lines }
@@ -87,7 +89,8 @@ class MapModule(mp_module.MPModule):
                                                                 'zoom',
                                                                 'center',
                                                                 'follow',
-                                                                'clear'])
+                                                                'clear',
+                                                                'stats'])
         self.add_completion_function('(MAPSETTING)', self.map_settings.completion)
 
         self.default_popup = MPMenuSubMenu('Popup', items=[])
@@ -231,6 +234,7 @@ class MapModule(mp_module.MPModule):
         elif args[0] == "set":
             self.map_settings.command(args[1:])
             self.map.add_object(mp_slipmap.SlipBrightness(self.map_settings.brightness))
+            self.map.add_object(mp_slipmap.SlipDownloadWorkers(self.map_settings.download_workers))
         elif args[0] == "sethome":
             self.cmd_set_home(args)
         elif args[0] == "sethomepos":
@@ -251,9 +255,19 @@ class MapModule(mp_module.MPModule):
             self.cmd_set_roi(args)
         elif args[0] == "setposition":
             self.cmd_set_position(args)
+        elif args[0] == "stats":
+            self.cmd_stats(args)
         else:
             print("usage: map <icon|set>")
 
+    def cmd_stats(self, args):
+        '''show map update statistics'''
+        stats = self.map.update_stats()
+        if stats is None:
+            print("Map updates are not batched")
+            return
+        print("Map updates: %s" % stats)
+
     def colour_for_wp(self, wp_num):
         '''return a tuple describing the colour a waypoint should appear on the map'''
         wp = self.module('wp').wploader.wp(wp_num)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+'''
+level of detail for long paths on the map
+
+A path of many points is kept as numpy arrays and simplified for the
+scale it is drawn at, so drawing a multi-hour flight costs about the
+same as drawing the pixels it covers:
+
+ - positions are converted once to mercator coordinates in radians, in
+   which the map scale is the same in both directions
+ - lines are simplified with Douglas-Peucker to half a pixel, running
+   the recursion on every open segment at once with numpy
+ - point markers are thinned to about one per two pixels. Where points
+   were dropped the markers are filled in, as the many markers they
+   replace would have been
+ - colour changes and the ends of the shown time range are kept
+ - results are cached per power of two scale and time range
+
+Run this file directly to benchmark drawing a long path with
+mavflightview.create_imagefile
+
+AP_FLAKE8_CLEAN
+'''
+
+import math
+import collections
+
+import numpy as np
+
+from MAVProxy.modules.mavproxy_map.mp_tile import mercator_y
+
+# simplified lines are within this many pixels of the full path
+LINE_TOLERANCE = 0.5
+
+# markers are at least this many pixels apart
+MARKER_SPACING = 2.0
+
+
+def douglas_peucker(x, y, tolerance, segments):
+    '''simplify polylines with the Douglas-Peucker algorithm.
+    segments is an Nx2 array of (start, end) point indices, each of
+    which is simplified separately. Returns a boolean array marking
+    the points kept, which include the ends of every segment'''
+    keep = np.zeros(len(x), dtype=bool)
+    if len(segments) == 0:
+        return keep
+    (s, e) = (segments[:, 0], segments[:, 1])
+    keep[s] = True
+    keep[e] = True
+    while len(s) > 0:
+        # only segments with points between the ends need looking at
+        n = e - s - 1
+        open_seg = n > 0
+        (s, e, n) = (s[open_seg], e[open_seg], n[open_seg])
+        if len(s) == 0:
+            break
+        # the indices of all the interior points, segment by segment
+        first = np.cumsum(n) - n
+        seg = np.repeat(np.arange(len(s)), n)
+        idx = np.arange(n.sum()) - first[seg] + s[seg] + 1
+
+        # distance of each interior point from its segment's chord
+        (ax, ay) = (x[s][seg], y[s][seg])
+        (dx, dy) = (x[e][seg] - ax, y[e][seg] - ay)
+        (px, py) = (x[idx] - ax, y[idx] - ay)
+        length = np.hypot(dx, dy)
+        dist = np.where(length > 0, np.abs(dx * py - dy * px) / np.where(length > 0, length, 1), np.hypot(px, py))
+
+        # the furthest point of each segment
+        dmax = np.maximum.reduceat(dist, first)
+        at_max = np.flatnonzero(dist == dmax[seg])
+        (segs, pos) = np.unique(seg[at_max], return_index=True)
+        split = dmax > tolerance
+        m = np.zeros(len(s), dtype=np.int64)
+        m[segs] = idx[at_max[pos]]
+
+        # split the segments that are too far from their chord
+        (s, e, m) = (s[split], e[split], m[split])
+        keep[m] = True
+        (s, e) = (np.concatenate((s, m)), np.concatenate((m, e)))
+    return keep
+
+
+def thin_points(x, y, spacing, segments):
+    '''thin points so that consecutive points are in different cells
+    of a grid of size spacing. The ends of each segment are kept'''
+    keep = np.zeros(len(x), dtype=bool)
+    if len(segments) == 0:
+        return keep
+    cx = np.floor(x / spacing)
+    cy = np.floor(y / spacing)
+    keep[1:] = (cx[1:] != cx[:-1]) | (cy[1:] != cy[:-1])
+    keep[segments[:, 0]] = True
+    keep[segments[:, 1]] = True
+    return keep
+
+
+class PathLOD(object):
+    '''a path with simplified versions for each map scale.
+
+    The path is drawn as lines from each point to the next, coloured
+    by the first point of each. With a time range, only lines that start
+    in the range are drawn.
+    '''
+    def __init__(self, lat, lon, colours=None, timestamps=None, cache_size=16):
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.x = np.radians(self.lon)
+        self.y = -mercator_y(self.lat)
+        self.colours = colours
+        self.timestamps = timestamps
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.lat)
+
+    def pieces(self, time_range):
+        '''return an Nx2 array of (first, last) point indices of the
+        runs of points to draw, split where the colour changes'''
+        n = len(self.lat)
+        if n < 2:
+            return np.zeros((0, 2), dtype=np.int64)
+        drawn = np.ones(n - 1, dtype=bool)
+        if time_range is not None and self.timestamps is not None:
+            t = self.timestamps[:-1]
+            drawn = (t >= time_range[0]) & (t <= time_range[1])
+        # runs of lines to draw
+        edges = np.diff(np.concatenate(([0], drawn.astype(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        marks = [starts, ends]
+        if self.colours is not None:
+            # colours change at these points, which end one line and start the next
+            change = np.flatnonzero((self.colours[1:] != self.colours[:-1]).any(axis=1)) + 1
+            change = change[drawn[change - 1] & drawn[np.minimum(change, n - 2)] & (change < n - 1)]
+            marks.append(change)
+        marks = np.unique(np.concatenate(marks))
+        if len(marks) < 2:
+            return np.zeros((0, 2), dtype=np.int64)
+        # pair up consecutive marks that are in the same run
+        run = np.searchsorted(starts, marks, side='right') - 1
+        first = marks[:-1]
+        last = marks[1:]
+        same = (run[:-1] == run[1:]) & (last <= ends[run[:-1]])
+        return np.column_stack((first[same], last[same]))
+
+    def simplify(self, scale, time_range=None):
+        '''return (points, links, markers, dense) for a map scale in
+        pixels per radian. points are the indices of the line vertices,
+        links[i] is true when a line joins points[i] to points[i+1],
+        markers are indices of points to mark and dense[i] is true when
+        points after markers[i] were dropped'''
+        level = int(math.floor(math.log2(max(scale, 1.0e-9))))
+        key = (level, time_range)
+        ret = self.cache.get(key, None)
+        if ret is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return ret
+        self.misses += 1
+        # the tolerance is for the largest scale of this level
+        scale = 2.0 ** (level + 1)
+        segments = self.pieces(time_range)
+        keep = douglas_peucker(self.x, self.y, LINE_TOLERANCE / scale, segments)
+        points = np.flatnonzero(keep)
+        # a line joins two points if they are in the same piece
+        in_line = np.zeros(len(self.lat) + 1, dtype=np.int64)
+        if len(segments):
+            np.add.at(in_line, segments[:, 0], 1)
+            np.add.at(in_line, segments[:, 1], -1)
+        in_line = np.cumsum(in_line)[:-1] > 0
+        links = in_line[points[:-1]] if len(points) else np.zeros(0, dtype=bool)
+        markers = np.flatnonzero(thin_points(self.x, self.y, MARKER_SPACING / scale, segments) &
+                                 (in_line | np.roll(in_line, 1)))
+        dense = np.diff(np.append(markers, len(self.lat))) > 1
+        ret = (points, links, markers, dense)
+        self.cache[key] = ret
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return ret
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import tempfile
+    import time
+    from argparse import ArgumentParser
+
+    import cv2
+
+    from MAVProxy.modules.mavproxy_map import mp_slipmap_util
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tools'))
+    import mavflightview
+
+    parser = ArgumentParser(description='benchmark drawing a long path with and without level of detail')
+    parser.add_argument("--points", type=int, default=1000000, help="number of path points")
+    parser.add_argument("--size", type=int, default=1000, help="image size")
+    parser.add_argument("--output", default=tempfile.gettempdir(), help="directory for the images")
+    parser.add_argument("--no-lines", action='store_true', help="only draw the points")
+    parser.add_argument("--time-range", type=float, nargs=2, default=None,
+                        help="only draw this range of the flight, in hours from the start")
+    args = parser.parse_args()
+
+    # a wandering flight at 10Hz with a mode change every 10 minutes
+    rng = np.random.default_rng(1)
+    n = args.points
+    heading = np.cumsum(rng.normal(0, 0.05, n))
+    speed = 20 + 5 * np.sin(np.arange(n) / 3000.0)
+    north = np.cumsum(speed * 0.1 * np.cos(heading))
+    east = np.cumsum(speed * 0.1 * np.sin(heading))
+    # fold the flight into a 20km square
+    north = np.abs(north % 40000 - 20000)
+    east = np.abs(east % 40000 - 20000)
+    lat = -35.36 + north / 111319.5
+    lon = 149.16 + east / (111319.5 * math.cos(math.radians(35.36)))
+    modes = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0)]
+    mode = (np.arange(n) // 6000) % len(modes)
+    colours = np.array(modes, dtype=np.uint8)[mode]
+    tdays = 19000 + np.arange(n) * 0.1 / 86400
+
+    class Options(object):
+        service = 'MicrosoftSat'
+        colour_source = 'type'
+
+    mt = mavflightview.mp_tile.MPTile(download=False)
+    (top, left) = (lat.max() + 0.001, lon.min() - 0.001)
+    ground_width = 23000
+
+    def render(name, path_objs):
+        filename = os.path.join(args.output, 'path_%s.png' % name)
+        t0 = time.time()
+        mavflightview.create_imagefile(Options(), filename, (top, left), ground_width, path_objs, None, None, None,
+                                       width=args.size, height=args.size, mt=mt)
+        return (time.time() - t0, cv2.imread(filename), filename)
+
+    t0 = time.time()
+    points = [(lat[i], lon[i], tuple(colours[i].tolist()), tdays[i]) for i in range(n)]
+    t_list = time.time() - t0
+    t0 = time.time()
+    path = mp_slipmap_util.SlipPath('path', lat, lon, layer='FlightPath', linewidth=2, colours=colours,
+                                    timestamps=tdays, showlines=not args.no_lines, colour=(255, 0, 180))
+    t_array = time.time() - t0
+
+    polygon = mp_slipmap_util.SlipPolygon('path', points, layer='FlightPath', linewidth=2, colour=(255, 0, 180),
+                                          showlines=not args.no_lines)
+    if args.time_range is not None:
+        trange = (tdays[0] + args.time_range[0] / 24, tdays[0] + args.time_range[1] / 24)
+        polygon.set_time_range(trange)
+        path.set_time_range(trange)
+    (t_full, img_full, f_full) = render('full', [polygon])
+    (t_lod, img_lod, f_lod) = render('lod', [path])
+    (t_again, img_again, f_again) = render('lod', [path])
+
+    differ = (img_full != img_lod).any(axis=2)
+    print("%u points: building tuples %.2fs, arrays %.3fs" % (n, t_list, t_array))
+    print("SlipPolygon: %.2fs -> %s" % (t_full, f_full))
+    print("SlipPath:    %.2fs first, %.3fs cached -> %s" % (t_lod, t_again, f_lod))
+    print("%u of %u pixels differ" % (differ.sum(), differ.size))
+    (points, links, markers, dense) = path.lod.simplify(path.last_scale, path._timestamp_range)
+    print("%u line points, %u markers drawn, cache hits=%u misses=%u" % (
+        len(points), len(markers), path.lod.hits, path.lod.misses))
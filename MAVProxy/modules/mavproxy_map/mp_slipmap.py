@@ -6,9 +6,11 @@ Andrew Tridgell
 June 2012
 '''
 
+import collections
 import functools
 import math
 import os, sys
+import threading
 import time
 import cv2
 import numpy as np
@@ -21,6 +23,109 @@ from MAVProxy.modules.lib import multiproc
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import *
 
 
+class SlipUpdateStats:
+    '''counts of updates sent to the map'''
+    def __init__(self):
+        self.queued = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.batches = 0
+
+    def __str__(self):
+        return "queued=%u delivered=%u dropped=%u batches=%u" % (
+            self.queued, self.delivered, self.dropped, self.batches)
+
+class SlipUpdateChannel:
+    '''send updates to the map process, keeping only the newest
+    update for each object and sending them as one batch per frame'''
+    def __init__(self, queue, rate=10):
+        self.queue = queue
+        self.period = 1.0 / rate
+        self.stats = SlipUpdateStats()
+        self._pending = collections.OrderedDict()
+        self._seq = 0
+        self._last_flush = 0
+        self._closed = False
+        self._lock = threading.Condition()
+        self._thread = threading.Thread(target=self._flush_thread)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @staticmethod
+    def coalesce_key(obj):
+        '''return the key under which a newer update replaces an older
+        one, or None if every update of this type must be delivered'''
+        if isinstance(obj, SlipPosition):
+            key = ('position', obj.key, obj.layer)
+        elif isinstance(obj, SlipObject):
+            key = ('object', obj.layer, obj.key)
+        elif isinstance(obj, SlipFollowObject):
+            key = ('follow', obj.key)
+        elif isinstance(obj, SlipHideObject):
+            key = ('hide', obj.key)
+        elif isinstance(obj, (SlipCenter, SlipZoom, SlipFollow, SlipBrightness,
+                              SlipDownloadWorkers, SlipDefaultPopup, win_layout.WinLayout)):
+            key = (obj.__class__.__name__,)
+        else:
+            return None
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def put(self, obj):
+        '''queue an update for the next batch'''
+        with self._lock:
+            self.stats.queued += 1
+            key = self.coalesce_key(obj)
+            if key is None:
+                self._seq += 1
+                key = ('seq', self._seq)
+            elif key in self._pending:
+                # the newer update goes after anything queued since the old one
+                self._pending.pop(key)
+                self.stats.dropped += 1
+            self._pending[key] = obj
+            self._lock.notify()
+
+    def pending(self):
+        '''number of updates waiting to be sent'''
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        '''send all waiting updates now'''
+        with self._lock:
+            self._last_flush = time.time()
+            if not self._pending:
+                return
+            objects = list(self._pending.values())
+            self._pending.clear()
+            self.stats.delivered += len(objects)
+            self.stats.batches += 1
+            self.queue.put(SlipBatch(objects))
+
+    def close(self):
+        '''send waiting updates and stop the flush thread'''
+        self.flush()
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+
+    def _flush_thread(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._lock.wait()
+                if self._closed:
+                    return
+                wait = self._last_flush + self.period - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.flush()
+
+
 class MPSlipMap():
     '''
     a generic map viewer widget for use in mavproxy
@@ -40,7 +145,9 @@ class MPSlipMap():
                  elevation=None,
                  download=True,
                  show_flightmode_legend=True,
-                 timelim_pipe=None):
+                 timelim_pipe=None,
+                 update_rate=10,
+                 download_workers=4):
 
         self.lat = lat
         self.lon = lon
@@ -50,6 +157,7 @@ class MPSlipMap():
         self.download = download
         self.service = service
         self.tile_delay = tile_delay
+        self.download_workers = download_workers
         self.debug = debug
         self.max_zoom = max_zoom
         self.elevation = elevation
@@ -66,10 +174,16 @@ class MPSlipMap():
         self.object_queue = multiproc.Queue()
         self.close_window = multiproc.Semaphore()
         self.close_window.acquire()
+        self._channel = None
         self.child = multiproc.Process(target=self.child_task)
         self.child.start()
         self._callbacks = set()
 
+        # updates are batched at the frame rate, update_rate=0 sends
+        # each one immediately. This is only used in the parent process
+        if update_rate > 0:
+            self._channel = SlipUpdateChannel(self.object_queue, update_rate)
+
         # ensure the map application is ready before returning
         if not self._wait_ready(timeout=5.0):
             raise Exception("map not ready")
@@ -88,10 +202,13 @@ class MPSlipMap():
                                  service=self.service,
                                  tile_delay=self.tile_delay,
                                  debug=self.debug,
-                                 max_zoom=self.max_zoom)
+                                 max_zoom=self.max_zoom,
+                                 download_workers=self.download_workers)
         state.layers = {}
+        state.layer_index = {}
         state.info = {}
         state.need_redraw = True
+        state.dirty_layers = set()
 
         self.app = wx.App(False)
         self.app.SetExitOnFrameDelete(True)
@@ -102,6 +219,8 @@ class MPSlipMap():
 
     def close(self):
         '''close the window'''
+        if self._channel is not None:
+            self._channel.close()
         self.close_window.release()
         count=0
         while self.child.is_alive() and count < 30: # 3 seconds to die...
@@ -117,37 +236,55 @@ class MPSlipMap():
         '''check if graph is still going'''
         return self.child.is_alive()
 
+    def send(self, obj):
+        '''send an update to the map'''
+        if self._channel is not None:
+            self._channel.put(obj)
+        else:
+            self.object_queue.put(obj)
+
+    def flush(self):
+        '''send any batched updates now'''
+        if self._channel is not None:
+            self._channel.flush()
+
+    def update_stats(self):
+        '''return a SlipUpdateStats, or None if updates are not batched'''
+        if self._channel is None:
+            return None
+        return self._channel.stats
+
     def add_object(self, obj):
         '''add or update an object on the map'''
-        self.object_queue.put(obj)
+        self.send(obj)
 
     def remove_object(self, key):
         '''remove an object on the map by key'''
-        self.object_queue.put(SlipRemoveObject(key))
+        self.send(SlipRemoveObject(key))
 
     def set_zoom(self, ground_width):
         '''set ground width of view'''
-        self.object_queue.put(SlipZoom(ground_width))
+        self.send(SlipZoom(ground_width))
 
     def set_center(self, lat, lon):
         '''set center of view'''
-        self.object_queue.put(SlipCenter((lat,lon)))
+        self.send(SlipCenter((lat,lon)))
 
     def set_follow(self, enable):
         '''set follow on/off'''
-        self.object_queue.put(SlipFollow(enable))
+        self.send(SlipFollow(enable))
 
     def set_follow_object(self, key, enable):
         '''set follow on/off on an object'''
-        self.object_queue.put(SlipFollowObject(key, enable))
+        self.send(SlipFollowObject(key, enable))
         
     def hide_object(self, key, hide=True):
         '''hide an object on the map by key'''
-        self.object_queue.put(SlipHideObject(key, hide))
+        self.send(SlipHideObject(key, hide))
 
     def set_position(self, key, latlon, layer='', rotation=0, label=None, colour=None):
         '''move an object on the map'''
-        self.object_queue.put(SlipPosition(key, latlon, layer, rotation, label, colour))
+        self.send(SlipPosition(key, latlon, layer, rotation, label, colour))
 
     def event_queue_empty(self):
         '''return True if there are no events waiting to be processed'''
@@ -155,7 +292,7 @@ class MPSlipMap():
 
     def set_layout(self, layout):
         '''set window layout'''
-        self.object_queue.put(layout)
+        self.send(layout)
     
     def get_event(self):
         '''return next event or None'''
@@ -203,7 +340,6 @@ class MPSlipMap():
 
 if __name__ == "__main__":
     multiproc.freeze_support()
-    import time
 
     from argparse import ArgumentParser
     parser = ArgumentParser("mp_slipmap.py [options]")
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+'''
+spatial index for slipmap objects
+
+A uniform lat/lon grid of object keys, kept up to date as objects are
+added, moved and removed. Drawing uses it to find the objects that may
+be in view, and mouse clicks use it to find the objects near the click,
+instead of looking at every object in every layer.
+
+Queries return candidate keys. Callers still do their exact test
+(bounds_overlap for drawing, clicked() for clicks), so the index only
+has to never miss an object:
+
+ - objects with no bounds are returned by every query
+ - objects covering more than max_cells cells are kept in a list that
+   is checked against each query
+ - circles are indexed with their radius so they can be clicked on
+   anywhere on the circumference
+
+Run this file directly for a benchmark
+
+AP_FLAKE8_CLEAN
+'''
+
+import math
+
+from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipCircle
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipThumbnail
+
+# metres per degree of latitude
+LATITUDE_METRES = 111319.5
+
+# the furthest in pixels any object accepts a click from its outline
+CLICK_MARGIN = 10
+
+
+def index_bounds(obj):
+    '''the bounds an object is indexed under, which cover its bounds()
+    and anywhere it can be clicked on other than its pixel size'''
+    bounds = obj.bounds()
+    if bounds is None or not isinstance(obj, SlipCircle):
+        return bounds
+    (lat, lon, dlat, dlon) = bounds
+    rlat = obj.radius / LATITUDE_METRES
+    rlon = rlat / max(math.cos(math.radians(lat)), 0.01)
+    return (lat - rlat, lon - rlon, dlat + 2 * rlat, dlon + 2 * rlon)
+
+
+def pixel_radius(obj):
+    '''how far from its position in pixels an object may be clicked on'''
+    if isinstance(obj, SlipThumbnail):
+        # the click area is moved by up to half its size when the image
+        # is clipped at the edge of the map
+        return max(obj.width, obj.height) + 1
+    return 0
+
+
+class SlipSpatialIndex(object):
+    '''a grid index of the objects in a layer'''
+    def __init__(self, cell_size=0.01, max_cells=64):
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self.columns = int(math.ceil(360.0 / cell_size))
+        self.cells = {}
+        self.entries = {}
+        self.large = {}
+        self.unbounded = set()
+        self.max_pixel_radius = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def cell_range(self, bounds):
+        '''return the rows and columns covered by bounds, or None if
+        there are too many'''
+        (lat, lon, dlat, dlon) = bounds
+        y1 = int(math.floor(lat / self.cell_size))
+        y2 = int(math.floor((lat + dlat) / self.cell_size))
+        x1 = int(math.floor((lon + 180.0) / self.cell_size))
+        x2 = int(math.floor((lon + 180.0 + dlon) / self.cell_size))
+        return (y1, y2, x1, x2)
+
+    def insert(self, key, obj):
+        '''add an object, or update it after it has moved or changed'''
+        self.remove(key)
+        bounds = index_bounds(obj)
+        self.max_pixel_radius = max(self.max_pixel_radius, pixel_radius(obj))
+        if bounds is None:
+            self.unbounded.add(key)
+            self.entries[key] = None
+            return
+        (y1, y2, x1, x2) = self.cell_range(bounds)
+        if (y2 - y1 + 1) * (x2 - x1 + 1) > self.max_cells:
+            self.large[key] = bounds
+            self.entries[key] = bounds
+            return
+        cells = []
+        for y in range(y1, y2 + 1):
+            for x in range(x1, x2 + 1):
+                cell = (y, x % self.columns)
+                self.cells.setdefault(cell, set()).add(key)
+                cells.append(cell)
+        self.entries[key] = cells
+
+    def remove(self, key):
+        '''remove an object if it is in the index'''
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.unbounded.discard(key)
+        elif isinstance(entry, tuple):
+            self.large.pop(key, None)
+        else:
+            for cell in entry:
+                keys = self.cells[cell]
+                keys.discard(key)
+                if not keys:
+                    self.cells.pop(cell)
+
+    def rebuild(self, objects):
+        '''index a dictionary of objects from scratch'''
+        self.cells = {}
+        self.entries = {}
+        self.large = {}
+        self.unbounded = set()
+        self.max_pixel_radius = 0
+        for (key, obj) in objects.items():
+            self.insert(key, obj)
+
+    def query(self, bounds):
+        '''return a set of keys of objects that may overlap bounds'''
+        ret = set(self.unbounded)
+        for (key, b) in self.large.items():
+            if mp_util.bounds_overlap(bounds, b):
+                ret.add(key)
+        (y1, y2, x1, x2) = self.cell_range(bounds)
+        ncells = (y2 - y1 + 1) * min(x2 - x1 + 1, self.columns)
+        if ncells > len(self.cells):
+            # zoomed out, it is quicker to look at the cells in use
+            columns = set([x % self.columns for x in range(x1, x2 + 1)]) if x2 - x1 < self.columns else None
+            for ((y, x), keys) in self.cells.items():
+                if y1 <= y <= y2 and (columns is None or x in columns):
+                    ret.update(keys)
+            return ret
+        for y in range(y1, y2 + 1):
+            for x in range(x1, x2 + 1):
+                keys = self.cells.get((y, x % self.columns), None)
+                if keys is not None:
+                    ret.update(keys)
+        return ret
+
+    def query_click(self, px, py, coordinates):
+        '''return a set of keys of objects that may accept a click at
+        pixel px,py. coordinates(x,y) gives the lat/lon of a pixel'''
+        m = max(self.max_pixel_radius, CLICK_MARGIN)
+        (lat1, lon1) = coordinates(px - m, py - m)
+        (lat2, lon2) = coordinates(px + m, py + m)
+        return self.query((lat2, lon1, lat1 - lat2, mp_util.wrap_180(lon2 - lon1)))
+
+
+if __name__ == "__main__":
+    import random
+    import time
+    from argparse import ArgumentParser
+
+    import numpy as np
+
+    from MAVProxy.modules.mavproxy_map import mp_tile
+    from MAVProxy.modules.mavproxy_map.mp_slipmap_render import SlipMapRenderer
+    from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipIcon, SlipPolygon
+
+    parser = ArgumentParser(description='benchmark the slipmap spatial index')
+    parser.add_argument("--objects", type=int, default=20000, help="number of objects")
+    parser.add_argument("--spread", type=float, default=2.0, help="size of the area holding the objects in degrees")
+    parser.add_argument("--repeat", type=int, default=20, help="number of queries")
+    args = parser.parse_args()
+
+    random.seed(1)
+    (lat, lon) = (-35.36, 149.16)
+    icon = mp_tile.mp_icon('redplane.png')
+    objects = {}
+    for i in range(args.objects):
+        p = (lat - random.uniform(0, args.spread), lon + random.uniform(0, args.spread))
+        key = 'obj%u' % i
+        if i % 3 == 0:
+            objects[key] = SlipIcon(key, p, icon, layer=1)
+        elif i % 3 == 1:
+            objects[key] = SlipCircle(key, 1, p, random.uniform(10, 300), (255, 0, 0), 1)
+        else:
+            q = [mp_util.gps_newpos(p[0], p[1], random.uniform(0, 360), random.uniform(50, 500)) for j in range(4)]
+            objects[key] = SlipPolygon(key, [p] + q, layer=1, colour=(0, 255, 0), linewidth=1)
+
+    t0 = time.time()
+    index = SlipSpatialIndex()
+    index.rebuild(objects)
+    print("%u objects indexed in %.1f ms, %u cells" % (len(index), 1000 * (time.time() - t0), len(index.cells)))
+
+    t0 = time.time()
+    for key in list(objects.keys())[:1000]:
+        index.insert(key, objects[key])
+    print("update: %.1f us per object" % (1000 * (time.time() - t0)))
+
+    # a view of the middle of the area, 1000x800 pixels wide
+    mt = mp_tile.MPTile(download=False)
+    renderer = SlipMapRenderer(mt)
+    (width, height) = (1000, 800)
+    for ground_width in [2000, 20000, 200000]:
+        (vlat, vlon) = (lat - args.spread / 2, lon + args.spread / 2)
+
+        def pixmapper(latlon):
+            return mt.coord_to_pixel(vlat, vlon, width, ground_width, latlon[0], latlon[1])
+
+        (lat2, lon2) = mt.coord_from_area(width - 1, height - 1, vlat, vlon, width, ground_width)
+        bounds = (lat2, vlon, vlat - lat2, mp_util.wrap_180(lon2 - vlon))
+
+        def cull_linear():
+            return [k for k in sorted(objects.keys())
+                    if objects[k].bounds() is None or mp_util.bounds_overlap(bounds, objects[k].bounds())]
+
+        def cull_index():
+            return [k for k in sorted(index.query(bounds))
+                    if objects[k].bounds() is None or mp_util.bounds_overlap(bounds, objects[k].bounds())]
+
+        results = []
+        for fn in [cull_linear, cull_index]:
+            t0 = time.time()
+            for i in range(args.repeat):
+                visible = fn()
+            results.append((1000 * (time.time() - t0) / args.repeat, visible))
+        assert results[0][1] == results[1][1]
+        print("view %6.0fm: %5u visible, cull linear %6.2f ms, index %6.2f ms" % (
+            ground_width, len(visible), results[0][0], results[1][0]))
+
+        # draw once so objects know where they are on screen, then click around
+        visible = set(visible)
+        img = np.zeros((height, width, 3), np.uint8)
+        renderer.draw_objects(objects, bounds, img, pixmapper, index=index)
+        clicks = [(random.randint(0, width - 1), random.randint(0, height - 1)) for i in range(args.repeat)]
+
+        def hit_linear(px, py):
+            hits = [(objects[k].clicked(px, py), k) for k in objects.keys()]
+            # objects drawn in earlier views remember where they were
+            return sorted([h for h in hits if h[0] is not None and h[1] in visible])
+
+        def coordinates(x, y):
+            return mt.coord_from_area(x, y, vlat, vlon, width, ground_width)
+
+        def hit_index(px, py):
+            hits = [(objects[k].clicked(px, py), k) for k in index.query_click(px, py, coordinates)]
+            return sorted([h for h in hits if h[0] is not None and h[1] in visible])
+
+        results = []
+        for fn in [hit_linear, hit_index]:
+            t0 = time.time()
+            hits = [fn(px, py) for (px, py) in clicks]
+            results.append((1000 * (time.time() - t0) / len(clicks), hits))
+        assert results[0][1] == results[1][1]
+        print("               %5u hits,    click linear %6.2f ms, index %6.2f ms" % (
+            sum([len(h) for h in hits]), results[0][0], results[1][0]))
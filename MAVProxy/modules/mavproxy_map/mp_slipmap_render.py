@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+'''
+layered slipmap renderer
+
+Draws the map image for the slipmap from the tile mosaic and the
+object layers, caching what hasn't changed between redraws:
+
+ - the base image (tiles, brightness and grid) is kept until the view
+   moves or new tiles arrive
+ - each layer that is unchanged while the view is still is rendered
+   once into an overlay and pasted on later frames. Layers that change
+   every frame, such as moving vehicles, are drawn directly
+
+Layers are composited in the same order as they were drawn before, so
+the result is the same image as drawing every object each frame.
+
+Run this file directly for a headless benchmark
+
+AP_FLAKE8_CLEAN
+'''
+
+import numpy as np
+
+from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipFlightModeLegend
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipGrid
+
+
+class LayerOverlay(object):
+    '''a layer rendered on its own. Only the drawn pixels are kept, as
+    indices into the image and their colours'''
+    def __init__(self, img0, img1):
+        # drawing the layer on black and on white finds the drawn pixels,
+        # including any drawn in black or white
+        mask = (img0 != 0).any(axis=2) | (img1 != 255).any(axis=2)
+        self.shape = img0.shape
+        self.index = np.flatnonzero(mask)
+        self.pixels = img0.reshape(-1, img0.shape[2])[self.index]
+
+    def paste(self, img):
+        '''draw the layer onto an image of the same size'''
+        if len(self.index) == 0:
+            return
+        # a reshape of a contiguous image is a view, so this writes to img
+        assert img.shape == self.shape and img.flags.c_contiguous
+        img.reshape(-1, img.shape[2])[self.index] = self.pixels
+
+
+class RenderStats(object):
+    '''counters for the renderer'''
+    def __init__(self):
+        self.frames = 0
+        self.base_renders = 0
+        self.layers_cached = 0
+        self.layers_drawn = 0
+        self.layers_pasted = 0
+
+    def __str__(self):
+        return "frames=%u base=%u cached=%u drawn=%u pasted=%u" % (
+            self.frames, self.base_renders, self.layers_cached, self.layers_drawn, self.layers_pasted)
+
+
+class SlipMapRenderer(object):
+    '''render the slipmap image from an MPTile and the object layers'''
+    def __init__(self, mt):
+        self.mt = mt
+        self.base = None
+        self.base_key = None
+        self.overlays = {}
+        self.last_view = None
+        self.stats = RenderStats()
+
+    def invalidate(self, layer=None):
+        '''forget the cached overlay for one layer, or all of them'''
+        if layer is None:
+            self.overlays = {}
+        else:
+            self.overlays.pop(layer, None)
+
+    def draw_objects(self, objects, bounds, img, pixmapper, legend=True, index=None):
+        '''draw objects on the image. With a spatial index only the
+        objects it finds in the view are looked at'''
+        if index is None:
+            keys = sorted(objects.keys())
+        else:
+            if len(index) != len(objects):
+                # objects were added or removed without updating the index
+                index.rebuild(objects)
+            keys = sorted(index.query(bounds))
+        for k in keys:
+            obj = objects[k]
+            if not legend and isinstance(obj, SlipFlightModeLegend):
+                continue
+            bounds2 = obj.bounds()
+            if bounds2 is None or mp_util.bounds_overlap(bounds, bounds2):
+                obj.draw(img, pixmapper, bounds)
+
+    def render_base(self, view, pixmapper, bounds, brightness, grid):
+        '''the tile mosaic with brightness and grid applied'''
+        (lat, lon, width, height, ground_width) = view
+        img = self.mt.area_to_image(lat, lon, width, height, ground_width)
+        if brightness != 0:  # valid brightness range is [-255, 255]
+            b = np.uint8(np.abs(brightness))
+            if brightness > 0:
+                img = np.where((255 - img) < b, 255, img + b)
+            else:
+                img = np.where((255 + img) < b, 0, img - b)
+        if grid:
+            SlipGrid('grid', layer=3, linewidth=1, colour=(255, 255, 0)).draw(img, pixmapper, bounds)
+        self.stats.base_renders += 1
+        return img
+
+    def base_image(self, view, pixmapper, bounds, brightness, grid):
+        '''return the base image, rendering it if the view has changed or
+        new tiles have arrived'''
+        key = (view, self.mt.get_service(), brightness, grid, self.tiles_key())
+        if self.base is None or key != self.base_key:
+            self.base = self.render_base(view, pixmapper, bounds, brightness, grid)
+            self.base_key = key
+        return self.base
+
+    def tiles_key(self):
+        '''changes when tiles are downloaded or fail'''
+        stats = self.mt.download_stats()
+        return (self.mt.tiles_pending(), stats.downloaded, stats.failed)
+
+    @staticmethod
+    def cacheable(objects):
+        '''see if a layer can be drawn separately and pasted'''
+        for obj in objects.values():
+            if not getattr(obj, 'cacheable', True):
+                return False
+        return True
+
+    def render(self, layers, view, pixmapper, bounds, dirty=None, brightness=0, grid=False, legend=True,
+               indexes={}):
+        '''render the map image. layers is a dict of dicts of objects,
+        view is (lat, lon, width, height, ground_width) and dirty is
+        the set of layers changed since the last render, or None if
+        everything may have changed. indexes holds an optional
+        SlipSpatialIndex for each layer'''
+        self.stats.frames += 1
+        img = self.base_image(view, pixmapper, bounds, brightness, grid).copy()
+
+        # cached layers are only valid for the view they were drawn in
+        still = (view, legend) == self.last_view and dirty is not None
+        if not still:
+            self.invalidate()
+        else:
+            for layer in dirty:
+                self.invalidate(layer)
+        self.last_view = (view, legend)
+
+        for k in sorted(layers.keys()):
+            overlay = self.overlays.get(k, None)
+            if overlay is not None:
+                overlay.paste(img)
+                self.stats.layers_pasted += 1
+            elif still and k not in dirty and self.cacheable(layers[k]):
+                # the layer didn't change since the last frame, keep it
+                img0 = np.zeros_like(img)
+                img1 = np.full_like(img, 255)
+                index = indexes.get(k, None)
+                self.draw_objects(layers[k], bounds, img0, pixmapper, legend, index)
+                self.draw_objects(layers[k], bounds, img1, pixmapper, legend, index)
+                overlay = LayerOverlay(img0, img1)
+                self.overlays[k] = overlay
+                overlay.paste(img)
+                self.stats.layers_cached += 1
+            else:
+                self.draw_objects(layers[k], bounds, img, pixmapper, legend, indexes.get(k, None))
+                self.stats.layers_drawn += 1
+        return img
+
+
+if __name__ == "__main__":
+    import math
+    import random
+    import shutil
+    import tempfile
+    import time
+    from argparse import ArgumentParser
+
+    from MAVProxy.modules.mavproxy_map import mp_tile
+    from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipCircle, SlipIcon, SlipPolygon, SlipPosition
+
+    parser = ArgumentParser(description='benchmark the slipmap renderer')
+    parser.add_argument("--waypoints", type=int, default=2000, help="mission size")
+    parser.add_argument("--vehicles", type=int, default=50, help="moving icons")
+    parser.add_argument("--frames", type=int, default=100, help="frames to render")
+    args = parser.parse_args()
+
+    (lat, lon, width, height, ground_width) = (-35.36, 149.16, 1000, 800, 3000.0)
+    view = (lat, lon, width, height, ground_width)
+    cache = tempfile.mkdtemp()
+    mt = mp_tile.MPTile(cache_path=cache, download=False)
+
+    def pixmapper(latlon):
+        return mt.coord_to_pixel(lat, lon, width, ground_width, latlon[0], latlon[1])
+
+    (lat2, lon2) = mt.coord_from_area(width-1, height-1, lat, lon, width, ground_width)
+    bounds = (lat2, lon, lat-lat2, mp_util.wrap_180(lon2-lon))
+
+    random.seed(1)
+    (clat, clon) = mt.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
+    layers = {'Mission': {}, 'Fence': {}, '3': {}}
+    points = [mp_util.gps_newpos(clat, clon, random.uniform(0, 360), random.uniform(0, 1400))
+              for i in range(args.waypoints)]
+    layers['Mission']['mission'] = SlipPolygon('mission', points, layer='Mission', linewidth=2, colour=(255, 255, 255))
+    for (i, p) in enumerate(points[:200]):
+        layers['Mission']['wp%u' % i] = SlipCircle('wp%u' % i, 'Mission', p, 10, (0, 255, 255), 1)
+    fence = [mp_util.gps_newpos(clat, clon, a, 1300) for a in range(0, 361, 5)]
+    layers['Fence']['fence'] = SlipPolygon('fence', fence, layer='Fence', linewidth=2, colour=(0, 255, 0))
+    icon = mp_tile.mp_icon('redplane.png')
+    for i in range(args.vehicles):
+        layers['3']['v%u' % i] = SlipIcon('v%u' % i, (clat, clon), icon, layer=3)
+
+    def move(frame):
+        for i in range(args.vehicles):
+            a = math.radians(frame * 3 + i * 360.0 / args.vehicles)
+            p = mp_util.gps_newpos(clat, clon, math.degrees(a), 500 + 5 * i)
+            layers['3']['v%u' % i].update_position(SlipPosition('v%u' % i, p, layer=3, rotation=frame))
+
+    def full_redraw(frame):
+        '''the old renderer: draw everything on a copy of the tiles'''
+        img = mt.area_to_image(lat, lon, width, height, ground_width).copy()
+        for k in sorted(layers.keys()):
+            renderer.draw_objects(layers[k], bounds, img, pixmapper)
+        return img
+
+    renderer = SlipMapRenderer(mt)
+    for (name, fn) in [('full', full_redraw),
+                       ('layered', lambda f: renderer.render(layers, view, pixmapper, bounds, dirty=set(['3'])))]:
+        move(0)
+        t0 = time.time()
+        for frame in range(args.frames):
+            move(frame)
+            img = fn(frame)
+        dt = time.time() - t0
+        print("%-8s %.1f ms/frame, %.0f fps" % (name, 1000 * dt / args.frames, args.frames / dt))
+
+    # check both produce the same image
+    move(args.frames)
+    same = np.array_equal(full_redraw(0), renderer.render(layers, view, pixmapper, bounds, dirty=set(['3'])))
+    print("images match: %s" % same)
+    print(renderer.stats)
+    shutil.rmtree(cache)
@@ -8,12 +8,13 @@ import copy
 
 from ..lib.wx_loader import wx
 
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipBatch
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipBrightness
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipCenter
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipClearLayer
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipDefaultPopup
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipDownloadWorkers
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipFlightModeLegend
-from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipGrid
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipHideObject
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipIcon
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipInformation
@@ -28,6 +29,9 @@ from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipThumbnail
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipZoom
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipFollow
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipFollowObject
+from MAVProxy.modules.mavproxy_map.mp_slipmap_render import SlipMapRenderer
+from MAVProxy.modules.mavproxy_map.mp_slipmap_index import SlipSpatialIndex
+from MAVProxy.modules.mavproxy_map.mp_tile import PixelMapper
 
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import win_layout
@@ -207,8 +211,10 @@ class MPSlipMapFrame(wx.Frame):
         if not obj.layer in state.layers:
             # its a new layer
             state.layers[obj.layer] = {}
+            state.layer_index[obj.layer] = SlipSpatialIndex()
         state.layers[obj.layer][obj.key] = obj
-        state.need_redraw = True
+        state.layer_index[obj.layer].insert(obj.key, obj)
+        state.dirty_layers.add(obj.layer)
         if (not self.legend_checkbox_menuitem_added and
             isinstance(obj, SlipFlightModeLegend)):
             self.add_legend_checkbox_menuitem()
@@ -219,9 +225,103 @@ class MPSlipMapFrame(wx.Frame):
         '''remove an object by key from all layers'''
         state = self.state
         for layer in state.layers:
-            state.layers[layer].pop(key, None)
+            if state.layers[layer].pop(key, None) is not None:
+                state.layer_index[layer].remove(key)
+                state.dirty_layers.add(layer)
         state.need_redraw = True
 
+    def handle_object(self, obj):
+        '''handle a display object from the parent'''
+        state = self.state
+
+        if isinstance(obj, win_layout.WinLayout):
+            win_layout.set_wx_window_layout(self, obj)
+
+        if isinstance(obj, SlipObject):
+            self.add_object(obj)
+
+        if isinstance(obj, SlipPosition):
+            # move an object
+            object = self.find_object(obj.key, obj.layer)
+            if object is not None:
+                object.update_position(obj)
+                if getattr(object, 'follow', False):
+                    self.follow(object)
+                if obj.label is not None:
+                    object.label = obj.label
+                if obj.colour is not None:
+                    object.colour = obj.colour
+                if object.layer in state.layer_index:
+                    state.layer_index[object.layer].insert(object.key, object)
+                state.dirty_layers.add(object.layer)
+
+        if isinstance(obj, SlipDefaultPopup):
+            state.default_popup = obj
+
+        if isinstance(obj, SlipInformation):
+            # see if its a existing one or a new one
+            if obj.key in state.info:
+#                print('update %s' % str(obj.key))
+                state.info[obj.key].update(obj)
+            else:
+#                print('add %s' % str(obj.key))
+                state.info[obj.key] = obj
+            state.need_redraw = True
+
+        if isinstance(obj, SlipCenter):
+            # move center
+            (lat,lon) = obj.latlon
+            state.panel.re_center(state.width/2, state.height/2, lat, lon)
+            state.need_redraw = True
+
+        if isinstance(obj, SlipZoom):
+            # change zoom
+            state.panel.set_ground_width(obj.ground_width)
+            state.need_redraw = True
+            
+        if isinstance(obj, SlipFollow):
+            # enable/disable follow
+            state.follow = obj.enable
+
+        if isinstance(obj, SlipFollowObject):
+            # enable/disable follow on an object
+            for layer in state.layers:
+                if obj.key in state.layers[layer]:
+                    if hasattr(state.layers[layer][obj.key], 'follow'):
+                        state.layers[layer][obj.key].follow = obj.enable
+            
+        if isinstance(obj, SlipBrightness):
+            # set map brightness
+            state.brightness = obj.brightness
+            state.need_redraw = True
+
+        if isinstance(obj, SlipDownloadWorkers):
+            # set the number of tile download threads
+            state.mt.set_download_workers(obj.workers)
+
+        if isinstance(obj, SlipClearLayer):
+            # remove all objects from a layer
+            if obj.layer in state.layers:
+                state.layers.pop(obj.layer)
+                state.layer_index.pop(obj.layer)
+            state.dirty_layers.add(obj.layer)
+
+        if isinstance(obj, SlipRemoveObject):
+            # remove an object by key
+            for layer in state.layers:
+                if obj.key in state.layers[layer]:
+                    state.layers[layer].pop(obj.key)
+                    state.layer_index[layer].remove(obj.key)
+                    state.dirty_layers.add(layer)
+
+        if isinstance(obj, SlipHideObject):
+            # hide an object by key
+            for layer in state.layers:
+                if obj.key in state.layers[layer]:
+                    state.layers[layer][obj.key].set_hidden(obj.hide)
+                    state.layer_index[layer].insert(obj.key, state.layers[layer][obj.key])
+                    state.dirty_layers.add(layer)
+
     def on_idle(self, event):
         '''prevent the main loop spinning too fast'''
         state = self.state
@@ -239,85 +339,11 @@ class MPSlipMapFrame(wx.Frame):
 
         while not state.object_queue.empty():
             obj = state.object_queue.get()
-
-            if isinstance(obj, win_layout.WinLayout):
-                win_layout.set_wx_window_layout(self, obj)
-                
-            if isinstance(obj, SlipObject):
-                self.add_object(obj)
-
-            if isinstance(obj, SlipPosition):
-                # move an object
-                object = self.find_object(obj.key, obj.layer)
-                if object is not None:
-                    object.update_position(obj)
-                    if getattr(object, 'follow', False):
-                        self.follow(object)
-                    if obj.label is not None:
-                        object.label = obj.label
-                    if obj.colour is not None:
-                        object.colour = obj.colour
-                    state.need_redraw = True
-
-            if isinstance(obj, SlipDefaultPopup):
-                state.default_popup = obj
-
-            if isinstance(obj, SlipInformation):
-                # see if its a existing one or a new one
-                if obj.key in state.info:
-#                    print('update %s' % str(obj.key))
-                    state.info[obj.key].update(obj)
-                else:
-#                    print('add %s' % str(obj.key))
-                    state.info[obj.key] = obj
-                state.need_redraw = True
-
-            if isinstance(obj, SlipCenter):
-                # move center
-                (lat,lon) = obj.latlon
-                state.panel.re_center(state.width/2, state.height/2, lat, lon)
-                state.need_redraw = True
-
-            if isinstance(obj, SlipZoom):
-                # change zoom
-                state.panel.set_ground_width(obj.ground_width)
-                state.need_redraw = True
-                
-            if isinstance(obj, SlipFollow):
-                # enable/disable follow
-                state.follow = obj.enable
-
-            if isinstance(obj, SlipFollowObject):
-                # enable/disable follow on an object
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        if hasattr(state.layers[layer][obj.key], 'follow'):
-                            state.layers[layer][obj.key].follow = obj.enable
-                
-            if isinstance(obj, SlipBrightness):
-                # set map brightness
-                state.brightness = obj.brightness
-                state.need_redraw = True
-
-            if isinstance(obj, SlipClearLayer):
-                # remove all objects from a layer
-                if obj.layer in state.layers:
-                    state.layers.pop(obj.layer)
-                state.need_redraw = True
-
-            if isinstance(obj, SlipRemoveObject):
-                # remove an object by key
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        state.layers[layer].pop(obj.key)
-                state.need_redraw = True
-
-            if isinstance(obj, SlipHideObject):
-                # hide an object by key
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        state.layers[layer][obj.key].set_hidden(obj.hide)
-                state.need_redraw = True
+            if isinstance(obj, SlipBatch):
+                for o in obj.objects:
+                    self.handle_object(o)
+            else:
+                self.handle_object(obj)
 
         if state.timelim_pipe is not None:
             while state.timelim_pipe[1].poll():
@@ -329,6 +355,7 @@ class MPSlipMapFrame(wx.Frame):
                 for layer in state.layers:
                     for key in state.layers[layer].keys():
                         state.layers[layer][key].set_time_range(obj)
+                state.dirty_layers.update(state.layers.keys())
                 state.need_redraw = True
 
         if obj is None:
@@ -344,7 +371,7 @@ class MPSlipMapPanel(wx.Panel):
         wx.Panel.__init__(self, parent)
         self.state = state
         self.img = None
-        self.map_img = None
+        self.renderer = SlipMapRenderer(state.mt)
         self.redraw_timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.on_redraw_timer, self.redraw_timer)
         self.Bind(wx.EVT_SET_FOCUS, self.on_focus)
@@ -555,52 +582,28 @@ class MPSlipMapPanel(wx.Panel):
         (lat,lon) = (latlon[0], latlon[1])
         return state.mt.coord_to_pixel(state.lat, state.lon, state.width, state.ground_width, lat, lon)
 
-    def draw_objects(self, objects, bounds, img):
-        '''draw objects on the image'''
-        keys = sorted(objects.keys())
-        for k in keys:
-            obj = objects[k]
-            if not self.state.legend and isinstance(obj, SlipFlightModeLegend):
-                continue
-            bounds2 = obj.bounds()
-            if bounds2 is None or mp_util.bounds_overlap(bounds, bounds2):
-                obj.draw(img, self.pixmapper, bounds)
-
     def redraw_map(self):
         '''redraw the map with current settings'''
         state = self.state
 
-        view_same = (self.last_view is not None and self.map_img is not None and self.last_view == self.current_view())
+        view_same = (self.last_view is not None and self.last_view == self.current_view())
 
-        if view_same and not state.need_redraw:
+        if view_same and not state.need_redraw and not state.dirty_layers:
             return
 
-        # get the new map
-        self.map_img = state.mt.area_to_image(state.lat, state.lon,
-                                              state.width, state.height, state.ground_width)
-        if state.brightness != 0: # valid state.brightness range is [-255, 255]
-            brightness = np.uint8(np.abs(state.brightness))
-            if state.brightness > 0:
-                self.map_img = np.where((255 - self.map_img) < brightness, 255, self.map_img + brightness)
-            else:
-                self.map_img = np.where((255 + self.map_img) < brightness, 0, self.map_img - brightness)
-            
         # find display bounding box
         (lat2,lon2) = self.coordinates(state.width-1, state.height-1)
         bounds = (lat2, state.lon, state.lat-lat2, mp_util.wrap_180(lon2-state.lon))
 
-        # get the image
-        img = self.map_img.copy()
-
-        # possibly draw a grid
-        if state.grid:
-            SlipGrid('grid', layer=3, linewidth=1, colour=(255,255,0)).draw(img, self.pixmapper, bounds)
-
-        # draw layer objects
-        keys = state.layers.keys()
-        keys = sorted(list(keys))
-        for k in keys:
-            self.draw_objects(state.layers[k], bounds, img)
+        # draw the map and layer objects, reusing the tiles and any
+        # layers that haven't changed since the last redraw
+        view = (state.lat, state.lon, state.width, state.height, state.ground_width)
+        # this can also convert arrays of positions, for objects such as SlipPath
+        pixmapper = PixelMapper(state.mt, state.lat, state.lon, state.width, state.ground_width)
+        img = self.renderer.render(state.layers, view, pixmapper, bounds, dirty=state.dirty_layers,
+                                   brightness=state.brightness, grid=state.grid, legend=state.legend,
+                                   indexes=state.layer_index)
+        state.dirty_layers = set()
 
         # draw information objects
         for key in state.info:
@@ -650,7 +653,11 @@ class MPSlipMapPanel(wx.Panel):
         selected = []
         (px, py) = pos
         for layer in state.layers:
-            for key in state.layers[layer]:
+            # only look at objects near the click
+            keys = sorted(state.layer_index[layer].query_click(px, py, self.coordinates))
+            for key in keys:
+                if not key in state.layers[layer]:
+                    continue
                 obj = state.layers[layer][key]
                 distance = obj.clicked(px, py)
                 if distance is not None:
@@ -753,6 +760,8 @@ class MPSlipMapPanel(wx.Panel):
                 if (isinstance(state.layers[l][key], SlipThumbnail)
                     and not isinstance(state.layers[l][key], SlipIcon)):
                     state.layers[l].pop(key)
+                    state.layer_index[l].remove(key)
+                    state.dirty_layers.add(l)
 
     def on_key_down(self, event):
         '''handle keyboard input'''
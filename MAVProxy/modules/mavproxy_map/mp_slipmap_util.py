@@ -26,6 +26,10 @@ def image_shape(img):
 
 class SlipObject:
     '''an object to display on the map'''
+    # objects whose drawing only depends on the object and the view can
+    # be rendered once into a layer overlay, see mp_slipmap_render
+    cacheable = True
+
     def __init__(self, key, layer, popup_menu=None):
         self.key = key
         self.layer = str(layer)
@@ -328,6 +332,138 @@ class UnclosedSlipPolygon(SlipPolygon):
                 colour,
                 self.linewidth)
 
+class SlipPath(SlipObject):
+    '''a long path such as a flight log track, held as arrays and drawn
+    simplified for the map scale. Drawn like a SlipPolygon with points
+    (lat, lon, colour, timestamp)'''
+    def __init__(self, key, lat, lon, layer, colour, linewidth, colours=None, timestamps=None,
+                 showlines=True, popup_menu=None):
+        SlipObject.__init__(self, key, layer, popup_menu=popup_menu)
+        from MAVProxy.modules.mavproxy_map.mp_path_lod import PathLOD
+        lat = np.clip(np.asarray(lat, dtype=float), -90+1.0e-3, 90-1.0e-3)
+        lon = (np.asarray(lon, dtype=float) + 180.0) % 360.0 - 180.0
+        if colours is not None:
+            colours = np.asarray(colours, dtype=np.uint8)
+        if timestamps is not None:
+            timestamps = np.asarray(timestamps, dtype=float)
+        self.lod = PathLOD(lat, lon, colours, timestamps)
+        self.colour = colour
+        self.linewidth = linewidth
+        self._showlines = showlines
+        self._bounds = None
+        if len(lat) > 0:
+            self._bounds = (lat.min(), lon.min(), lat.max()-lat.min(), lon.max()-lon.min())
+        self._marker_pix = None
+        self._selected_vertex = None
+        self.last_scale = None
+
+    @staticmethod
+    def from_points(key, points, layer, colour, linewidth, showlines=True, popup_menu=None):
+        '''make a SlipPath from a list of SlipPolygon style points'''
+        lat = [p[0] for p in points]
+        lon = [p[1] for p in points]
+        colours = None
+        timestamps = None
+        if len(points) > 0 and len(points[0]) > 2:
+            colours = [p[2] for p in points]
+        if len(points) > 0 and len(points[0]) > 3:
+            timestamps = [p[3] for p in points]
+        return SlipPath(key, lat, lon, layer, colour, linewidth, colours=colours, timestamps=timestamps,
+                        showlines=showlines, popup_menu=popup_menu)
+
+    def bounds(self):
+        '''return bounding box'''
+        if self.hidden:
+            return None
+        return self._bounds
+
+    def marker_radius(self):
+        return self.linewidth*2
+
+    def projection(self, pixmapper):
+        '''return (scale, project) where scale is in pixels per radian
+        and project(lat, lon) converts arrays to pixel arrays'''
+        if hasattr(pixmapper, 'array'):
+            return (pixmapper.scale, pixmapper.array)
+        def project(lat, lon):
+            pix = np.array([pixmapper((lat[i], lon[i])) for i in range(len(lat))], dtype=np.int64).reshape(-1, 2)
+            return (pix[:,0], pix[:,1])
+        (lat, lon) = (self.lod.lat[0], self.lod.lon[0])
+        (x1, y1) = pixmapper((lat, lon))
+        (x2, y2) = pixmapper((lat, lon+1.0))
+        return (max(abs(x2 - x1), 1) / math.radians(1.0), project)
+
+    def colour_of(self, idx):
+        '''colour of the line starting at a point'''
+        if self.lod.colours is None:
+            return self.colour
+        return tuple(self.lod.colours[idx].tolist())
+
+    def draw(self, img, pixmapper, bounds):
+        '''draw the path on the image'''
+        self._marker_pix = None
+        if self.hidden or len(self.lod) < 2:
+            return
+        (width, height) = image_shape(img)
+        (scale, project) = self.projection(pixmapper)
+        self.last_scale = scale
+        trange = self._timestamp_range
+        if trange is not None:
+            trange = tuple(trange)
+        (points, links, markers, dense) = self.lod.simplify(scale, trange)
+        margin = self.marker_radius() + self.linewidth
+        limit = 1 << 30
+
+        if self._showlines and len(points) > 1:
+            (px, py) = project(self.lod.lat[points], self.lod.lon[points])
+            px = np.clip(px, -limit, limit)
+            py = np.clip(py, -limit, limit)
+            # lines with a bounding box that overlaps the image
+            (x1, x2) = (np.minimum(px[:-1], px[1:]), np.maximum(px[:-1], px[1:]))
+            (y1, y2) = (np.minimum(py[:-1], py[1:]), np.maximum(py[:-1], py[1:]))
+            visible = links & (x2 >= -margin) & (x1 < width+margin) & (y2 >= -margin) & (y1 < height+margin)
+            # draw runs of visible lines of one colour as polylines
+            start = visible.copy()
+            start[1:] &= ~visible[:-1]
+            if self.lod.colours is not None:
+                colours = self.lod.colours[points[:-1]]
+                start[1:] |= visible[1:] & (colours[1:] != colours[:-1]).any(axis=1)
+            end = visible.copy()
+            end[:-1] &= ~visible[1:] | start[1:]
+            pix = np.column_stack((px, py)).astype(np.int32)
+            for (j0, j1) in zip(np.flatnonzero(start), np.flatnonzero(end)):
+                cv2.polylines(img, [pix[j0:j1+2]], False, self.colour_of(points[j0]), self.linewidth)
+
+        # mark the points, coloured by the line they end. Where points
+        # were dropped their overlapping circles would fill in
+        (mx, my) = project(self.lod.lat[markers], self.lod.lon[markers])
+        inside = (mx >= 0) & (mx < width) & (my >= 0) & (my < height)
+        (mx, my, markers, dense) = (mx[inside], my[inside], markers[inside], dense[inside])
+        radius = self.marker_radius()
+        for i in range(len(markers)):
+            thickness = -1 if dense[i] else 1
+            cv2.circle(img, (int(mx[i]), int(my[i])), radius, self.colour_of(max(markers[i]-1, 0)), thickness)
+        self._marker_pix = (mx, my, markers)
+
+    def clicked(self, px, py):
+        '''see if the path has been clicked on.
+        Consider it clicked if the pixel is within 6 of a marked point
+        '''
+        if self.hidden or self._marker_pix is None:
+            return None
+        (mx, my, markers) = self._marker_pix
+        near = np.flatnonzero((np.abs(mx - px) < 6) & (np.abs(my - py) < 6))
+        if len(near) == 0:
+            return None
+        dist = np.hypot(mx[near] - px, my[near] - py)
+        i = near[np.argmin(dist)]
+        self._selected_vertex = int(markers[i])
+        return float(dist.min())
+
+    def selection_info(self):
+        '''extra selection information sent when object is selected'''
+        return self._selected_vertex
+
 class SlipGrid(SlipObject):
     '''a map grid'''
     def __init__(self, key, layer, colour, linewidth):
@@ -538,6 +674,9 @@ class SlipTrail:
 
 class SlipIcon(SlipThumbnail):
     '''a icon to display on the map'''
+    # icons are added to the pixels under them
+    cacheable = False
+
     def __init__(self, key, latlon, img, layer=1, rotation=0,
                  follow=False, trail=None, popup_menu=None, label=None, colour=(255,255,255)):
         SlipThumbnail.__init__(self, key, latlon, layer, img, popup_menu=popup_menu)
@@ -599,6 +738,9 @@ class SlipPosition:
 
 class SlipClickLocation(SlipObject):
     '''current click location tuple'''
+    # disappears after the timeout
+    cacheable = False
+
     def __init__(self, location, layer='', timeout=-1):
         self.location = location
         self.linewidth = 2
@@ -652,6 +794,11 @@ class SlipBrightness:
     def __init__(self, brightness):
         self.brightness = brightness
 
+class SlipDownloadWorkers:
+    '''an object to change the number of tile download threads'''
+    def __init__(self, workers):
+        self.workers = workers
+
 class SlipClearLayer:
     '''remove all objects in a layer'''
     def __init__(self, layer):
@@ -668,6 +815,11 @@ class SlipHideObject:
         self.key = key
         self.hide = hide
 
+class SlipBatch:
+    '''a list of updates sent to the map together'''
+    def __init__(self, objects):
+        self.objects = objects
+
 
 class SlipInformation:
     '''an object to display in the information box'''
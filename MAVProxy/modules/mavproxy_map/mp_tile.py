@@ -20,29 +20,24 @@ see also:
 import collections
 import errno
 import hashlib
-import sys
 import math
-import threading
 import os
 import string
 import time
+import urllib.request
 import cv2
 import numpy as np
 
 from math import log, tan, radians, degrees, sin, cos, exp, pi, asin, atan
 
-if sys.version_info.major < 3:
-    from urllib2 import Request as url_request
-    from urllib2 import urlopen as url_open
-    from urllib2 import URLError as url_error
-else:
-    from urllib.request import Request as url_request
-    from urllib.request import urlopen as url_open
-    from urllib.error import URLError as actual_url_error
-    from http.client import RemoteDisconnected
-    url_error = (RemoteDisconnected, actual_url_error)
-
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.mavproxy_map.mp_tile_download import TileDownloader
+
+def mercator_y(lat):
+    '''mercator y coordinate in radians for a latitude or array of
+    latitudes in degrees'''
+    latr = np.radians(lat)
+    return np.log(np.abs(1.0/np.cos(latr) + np.tan(latr)))
 
 class TileException(Exception):
     '''tile error class'''
@@ -179,7 +174,7 @@ class MPTile:
     '''map tile object'''
     def __init__(self, cache_path=None, download=True, cache_size=500,
              service="MicrosoftSat", tile_delay=0.3, debug=False,
-             max_zoom=19, refresh_age=30*24*60*60):
+             max_zoom=19, refresh_age=30*24*60*60, download_workers=4):
 
         if cache_path is None:
             try:
@@ -203,13 +198,16 @@ class MPTile:
         self.service = service
         self.debug = debug
         self.refresh_age = refresh_age
+        # identify as urllib did when tiles were fetched with urlopen
+        self.user_agent = 'Python-urllib/%s' % urllib.request.__version__
 
         if service not in TILE_SERVICES:
             raise TileException('unknown tile service %s' % service)
 
-        # _download_pending is a dictionary of TileInfo objects
-        self._download_pending = {}
-        self._download_thread = None
+        # tile_delay is the minimum time between requests to each server
+        self._downloader = TileDownloader(self._tile_downloaded, self._tile_failed,
+                                          workers=download_workers, host_delay=tile_delay,
+                                          headers=self._request_headers, debug=debug)
         self._loading = mp_icon('loading.jpg')
         self._unavailable = mp_icon('unavailable.jpg')
         try:
@@ -261,83 +259,70 @@ class MPTile:
         tile = self.coord_to_tile(lat, lon, zoom)
         return self.tile_to_path(tile)
 
+    def set_download_workers(self, workers):
+        '''set the number of tile download threads'''
+        self._downloader.set_workers(workers)
+
     def tiles_pending(self):
         '''return number of tiles pending download'''
-        return len(self._download_pending)
-
-    def downloader(self):
-        '''the download thread'''
-        while self.tiles_pending() > 0:
-            time.sleep(self.tile_delay)
-
-            keys = sorted(self._download_pending.keys())
+        return self._downloader.pending()
+
+    def download_stats(self):
+        '''return tile download statistics'''
+        return self._downloader.stats
+
+    def stop_download(self):
+        '''stop the download threads'''
+        self._downloader.stop()
+
+    def _request_headers(self, url):
+        '''extra HTTP headers for a tile request'''
+        headers = {'User-Agent': self.user_agent}
+        if url.find('google') != -1:
+            headers['Referer'] = 'https://maps.google.com/'
+        return headers
+
+    def _tile_failed(self, request, error):
+        '''called from a download thread when a tile can't be fetched'''
+        key = request.key
+        if not key in self._tile_cache:
+            self._tile_cache[key] = self._unavailable
+
+    def _tile_downloaded(self, request, content_type, img):
+        '''called from a download thread with the response for a tile'''
+        key = request.key
+        tile_info = request.tile
+        url = request.url
+        if content_type.find('image') == -1:
+            if not key in self._tile_cache:
+                self._tile_cache[key] = self._unavailable
+            if self.debug:
+                print("non-image response %s" % url)
+            return
 
-            # work out which one to download next, choosing by request_time
-            tile_info = self._download_pending[keys[0]]
-            for key in keys:
-                if self._download_pending[key].request_time > tile_info.request_time:
-                    tile_info = self._download_pending[key]
+        # see if its a blank/unavailable tile
+        md5 = hashlib.md5(img).hexdigest()
+        if md5 in BLANK_TILES:
+            if self.debug:
+                print("blank tile %s" % url)
+            if not key in self._tile_cache:
+                self._tile_cache[key] = self._unavailable
+            return
 
-            url = tile_info.url(self.service)
-            path = self.tile_to_path(tile_info)
-            key = tile_info.key()
+        path = os.path.join(self.cache_path, tile_info.service, tile_info.path())
+        mp_util.mkdir_p(os.path.dirname(path))
+        h = open(path+'.tmp','wb')
+        h.write(img)
+        h.close()
+        try:
+            os.unlink(path)
+        except Exception:
+            pass
+        os.rename(path+'.tmp', path)
 
-            try:
-                if self.debug:
-                    print("Downloading %s [%u left]" % (url, len(keys)))
-                req = url_request(url)
-                if url.find('google') != -1:
-                    req.add_header('Referer', 'https://maps.google.com/')
-                resp = url_open(req)
-                headers = resp.info()
-            except url_error as e:
-                #print('Error loading %s' % url)
-                if not key in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                if self.debug:
-                    print("Failed %s: %s" % (url, str(e)))
-                continue
-            if 'content-type' not in headers or headers['content-type'].find('image') == -1:
-                if not key in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                if self.debug:
-                    print("non-image response %s" % url)
-                continue
-            else:
-                img = resp.read()
-
-            # see if its a blank/unavailable tile
-            md5 = hashlib.md5(img).hexdigest()
-            if md5 in BLANK_TILES:
-                if self.debug:
-                    print("blank tile %s" % url)
-                    if not key in self._tile_cache:
-                        self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                continue
-
-            mp_util.mkdir_p(os.path.dirname(path))
-            h = open(path+'.tmp','wb')
-            h.write(img)
-            h.close()
-            try:
-                os.unlink(path)
-            except Exception:
-                pass
-            os.rename(path+'.tmp', path)
-            self._download_pending.pop(key)
-        self._download_thread = None
-
-    def start_download_thread(self):
-        '''start the downloader'''
-        if self._download_thread:
-            return
-        t = threading.Thread(target=self.downloader)
-        t.daemon = True
-        self._download_thread = t
-        t.start()
+    def request_download(self, tile):
+        '''queue a tile for download'''
+        self._downloader.request(tile.key(), tile.url(tile.service), tile)
 
     def load_tile_lowres(self, tile):
         '''load a lower resolution tile from cache to fill in a
@@ -418,12 +403,8 @@ class MPTile:
             #cv2.rectangle(ret, (0,0), (TILES_WIDTH-1,TILES_WIDTH-1), (255,0,0), 1)
             # if it is an old tile, then try to refresh
             if os.path.getmtime(path) + self.refresh_age < time.time():
-                try:
-                        self._download_pending[key].refresh_time()
-                except Exception:
-                        self._download_pending[key] = tile
-                self.start_download_thread()
-                    
+                self.request_download(tile)
+
             # add it to the tile cache
             self._tile_cache[key] = ret
             while len(self._tile_cache) > self.cache_size:
@@ -436,11 +417,7 @@ class MPTile:
                 img = self._unavailable
             return img
 
-        try:
-            self._download_pending[key].refresh_time()
-        except Exception:
-            self._download_pending[key] = tile
-        self.start_download_thread()
+        self.request_download(tile)
 
         img = self.load_tile_lowres(tile)
         if img is None:
@@ -502,6 +479,16 @@ class MPTile:
         x = int(0.5 + dx / (pixel_width_equator * cos(radians(lat2))))
         return (x,y)
 
+    def coord_to_pixel_array(self, lat, lon, width, ground_width, lat2, lon2):
+        '''coord_to_pixel for arrays of positions, returning integer
+        arrays (px,py)'''
+        pixel_width_equator = (ground_width / float(width)) / cos(radians(lat))
+        C = mp_util.radius_of_earth / pixel_width_equator
+        y = C * (mercator_y(lat) - mercator_y(np.asarray(lat2)))
+        x = C * np.radians(np.asarray(lon2) - lon)
+        # int() rounds towards zero
+        return (np.trunc(x + 0.5).astype(np.int64), np.trunc(y + 0.5).astype(np.int64))
+
     def area_to_tile_list(self, lat, lon, width, height, ground_width, zoom=None):
         '''return a list of TileInfoScaled objects needed for
         an area of land, with ground_width in meters, and
@@ -574,11 +561,14 @@ class MPTile:
 
         tlist = self.area_to_tile_list(lat, lon, width, height, ground_width, zoom)
 
-        # order the display by distance from the middle, so the download happens
-        # close to the middle of the image first
+        # downloads for this view go ahead of earlier views, closest to
+        # the middle of the image first
+        mid = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
+        self._downloader.set_view(mid, lambda t, mid: t.distance(mid[0], mid[1]))
+
+        # order the display by distance from the middle
         if ordered:
-            (midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
-            tlist.sort(key=lambda d: d.distance(midlat, midlon), reverse=True)
+            tlist.sort(key=lambda d: d.distance(mid[0], mid[1]), reverse=True)
 
         for t in tlist:
             scaled_tile = self.scaled_tile(t)
@@ -591,6 +581,9 @@ class MPTile:
                 w = scaled_tile_roi.shape[1]
                 img[t.dsty:t.dsty+h, t.dstx:t.dstx+w] = scaled_tile_roi.copy()
 
+        # tiles that have gone out of view are no longer needed
+        self._downloader.retain(set([t.key() for t in tlist]))
+
         # return as an RGB image
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         return img
@@ -605,19 +598,39 @@ def mp_icon(filename):
         if name == "__main__":
             name = "MAVProxy.modules.mavproxy_map.mp_tile"
         stream = pkg_resources.resource_stream(name, "data/%s" % filename).read()
-        raw = np.fromstring(stream, dtype=np.uint8)
+        raw = np.frombuffer(stream, dtype=np.uint8)
     except Exception:
         try:
             stream = open(os.path.join(__file__, 'data', filename)).read()
-            raw = np.fromstring(stream, dtype=np.uint8)
+            raw = np.frombuffer(stream, dtype=np.uint8)
         except Exception:
             #we're in a Windows exe, where pkg_resources doesn't work
             import pkgutil
-            raw = pkgutil.get_data( 'MAVProxy', 'modules//mavproxy_map//data//' + filename)
+            raw = np.frombuffer(pkgutil.get_data( 'MAVProxy', 'modules//mavproxy_map//data//' + filename), dtype=np.uint8)
     img = cv2.imdecode(raw, cv2.IMREAD_COLOR)
     return img
 
 
+class PixelMapper:
+    '''convert (lat,lon) to pixel coordinates in an area image with
+    top left lat,lon. Call it with one position, or use array() for
+    arrays of positions'''
+    def __init__(self, mt, lat, lon, width, ground_width):
+        self.mt = mt
+        self.lat = lat
+        self.lon = lon
+        self.width = width
+        self.ground_width = ground_width
+        # pixels per radian of longitude, and of mercator y
+        self.scale = mp_util.radius_of_earth * width * cos(radians(lat)) / float(ground_width)
+
+    def __call__(self, latlon):
+        return self.mt.coord_to_pixel(self.lat, self.lon, self.width, self.ground_width, latlon[0], latlon[1])
+
+    def array(self, lat2, lon2):
+        return self.mt.coord_to_pixel_array(self.lat, self.lon, self.width, self.ground_width, lat2, lon2)
+
+
 if __name__ == "__main__":
 
     from optparse import OptionParser
@@ -629,6 +642,7 @@ if __name__ == "__main__":
     parser.add_option("--zoom", default=None, type='int', help="zoom level")
     parser.add_option("--max-zoom", type='int', default=19, help="maximum tile zoom")
     parser.add_option("--delay", type='float', default=1.0, help="tile download delay")
+    parser.add_option("--workers", type='int', default=4, help="tile download threads")
     parser.add_option("--boundary", default=None, help="region boundary")
     parser.add_option("--debug", action='store_true', default=False, help="show debug info")
     (opts, args) = parser.parse_args()
@@ -647,7 +661,7 @@ if __name__ == "__main__":
         print(lat, lon, ground_width)
 
     mt = MPTile(debug=opts.debug, service=opts.service,
-            tile_delay=opts.delay, max_zoom=opts.max_zoom)
+            tile_delay=opts.delay, max_zoom=opts.max_zoom, download_workers=opts.workers)
     if opts.zoom is None:
         zooms = range(mt.min_zoom, mt.max_zoom+1)
     else:
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+'''
+concurrent map tile downloader
+
+Tiles are queued in a heap ordered by the view they were requested for
+(newest first) and then by distance from the centre of that view, so
+the middle of what is on screen now fills in first. A pool of worker
+threads fetches them over persistent HTTP connections, with a minimum
+interval between requests to any one host. Tiles that are no longer in
+view can be cancelled before they are fetched.
+
+Run this file directly to benchmark the downloader against a local
+stand-in tile server
+
+AP_FLAKE8_CLEAN
+'''
+
+import heapq
+import http.client
+import itertools
+import threading
+import time
+import urllib.parse
+
+
+class TileRequest(object):
+    '''a queued tile download'''
+    def __init__(self, key, url, tile, generation, distance):
+        self.key = key
+        self.url = url
+        self.tile = tile
+        self.generation = generation
+        self.distance = distance
+        self.request_time = time.time()
+        self.cancelled = False
+
+    def priority(self):
+        '''heap ordering, newest view first then closest to the view centre'''
+        return (-self.generation, self.distance, -self.request_time)
+
+
+class DownloadStats(object):
+    '''counters for the downloader'''
+    def __init__(self):
+        self.requested = 0
+        self.downloaded = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.bytes = 0
+        self.connections = 0
+        self.reused = 0
+
+    def __str__(self):
+        return ("requested=%u downloaded=%u failed=%u cancelled=%u bytes=%u connections=%u reused=%u" %
+                (self.requested, self.downloaded, self.failed, self.cancelled,
+                 self.bytes, self.connections, self.reused))
+
+
+class TileDownloader(object):
+    '''fetch tiles with a pool of worker threads.
+
+    handler(request, content_type, data) is called from a worker thread
+    with each response body, and failed(request, error) for errors.
+    Requests to one host start at least host_delay seconds apart.
+    '''
+    def __init__(self, handler, failed, workers=4, host_delay=0.3, headers=None,
+                 timeout=20, debug=False):
+        self.handler = handler
+        self.failed = failed
+        self.workers = max(1, workers)
+        self.host_delay = host_delay
+        self.headers = headers
+        self.timeout = timeout
+        self.debug = debug
+        self.stats = DownloadStats()
+        self._lock = threading.Condition()
+        self._heap = []
+        self._pending = {}
+        self._active = {}
+        self._counter = itertools.count()
+        self._host_next = {}
+        self._threads = []
+        self._generation = 0
+        self._centre = None
+        self._stop = False
+
+    def set_view(self, centre, distance_fn):
+        '''start a new view. Tiles requested after this come ahead of
+        those for earlier views, ordered by distance_fn(tile, centre)'''
+        with self._lock:
+            self._generation += 1
+            self._centre = (centre, distance_fn)
+
+    def set_workers(self, workers):
+        '''change the number of worker threads. Spare workers exit once
+        their current tile is fetched'''
+        with self._lock:
+            self.workers = max(1, workers)
+            self._lock.notify_all()
+
+    def pending(self):
+        '''number of tiles queued or being fetched'''
+        with self._lock:
+            return len(self._pending) + len(self._active)
+
+    def is_pending(self, key):
+        with self._lock:
+            return key in self._pending or key in self._active
+
+    def request(self, key, url, tile=None):
+        '''queue a tile, or move it up the queue if already queued'''
+        distance = 0
+        if self._centre is not None and tile is not None:
+            (centre, distance_fn) = self._centre
+            distance = distance_fn(tile, centre)
+        with self._lock:
+            if key in self._active:
+                return
+            old = self._pending.get(key, None)
+            if old is not None:
+                if old.generation == self._generation and old.distance <= distance:
+                    return
+                # the heap entry for the old request is skipped when popped
+                old.cancelled = True
+            else:
+                self.stats.requested += 1
+            req = TileRequest(key, url, tile, self._generation, distance)
+            self._pending[key] = req
+            heapq.heappush(self._heap, (req.priority(), next(self._counter), req))
+            self._start_workers()
+            self._lock.notify()
+
+    def cancel(self, key):
+        '''cancel a queued tile. Tiles already being fetched complete'''
+        with self._lock:
+            req = self._pending.pop(key, None)
+            if req is not None:
+                req.cancelled = True
+                self.stats.cancelled += 1
+
+    def retain(self, keys):
+        '''cancel all queued tiles not in keys'''
+        with self._lock:
+            for key in list(self._pending.keys()):
+                if key not in keys:
+                    self._pending.pop(key).cancelled = True
+                    self.stats.cancelled += 1
+            if len(self._heap) > 4 * len(self._pending) + 64:
+                # drop cancelled entries so the heap doesn't grow with panning
+                self._heap = [e for e in self._heap if not e[2].cancelled]
+                heapq.heapify(self._heap)
+
+    def stop(self):
+        '''stop the workers'''
+        with self._lock:
+            self._stop = True
+            self._lock.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def _start_workers(self):
+        self._stop = False
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._worker, name='TileDownload')
+            t.daemon = True
+            self._threads.append(t)
+            t.start()
+
+    def _next_request(self):
+        '''pop the best request whose host may be contacted now. Returns
+        (request, wait) where wait is how long to sleep if none is ready'''
+        now = time.time()
+        deferred = []
+        ret = None
+        wait = None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            req = entry[2]
+            if req.cancelled:
+                continue
+            host = urllib.parse.urlsplit(req.url).netloc
+            ready = self._host_next.get(host, 0)
+            if ready <= now:
+                self._host_next[host] = now + self.host_delay
+                ret = req
+                break
+            deferred.append(entry)
+            if wait is None or ready - now < wait:
+                wait = ready - now
+        for entry in deferred:
+            heapq.heappush(self._heap, entry)
+        return (ret, wait)
+
+    def _worker(self):
+        connections = {}
+        while True:
+            with self._lock:
+                while True:
+                    me = threading.current_thread()
+                    if self._stop or (len(self._threads) > self.workers and me in self._threads):
+                        if not self._stop:
+                            self._threads.remove(me)
+                        for c in connections.values():
+                            c.close()
+                        return
+                    (req, wait) = self._next_request()
+                    if req is not None:
+                        break
+                    self._lock.wait(wait)
+                self._pending.pop(req.key, None)
+                self._active[req.key] = req
+            try:
+                (content_type, data) = self._fetch(connections, req.url)
+            except Exception as ex:
+                with self._lock:
+                    self.stats.failed += 1
+                if self.debug:
+                    print("Failed %s: %s" % (req.url, str(ex)))
+                self.failed(req, ex)
+            else:
+                with self._lock:
+                    self.stats.downloaded += 1
+                    self.stats.bytes += len(data)
+                self.handler(req, content_type, data)
+            finally:
+                with self._lock:
+                    self._active.pop(req.key, None)
+
+    def _connection(self, connections, scheme, host, fresh=False):
+        '''get a kept-alive connection to a host'''
+        key = (scheme, host)
+        conn = connections.get(key, None)
+        if conn is not None and not fresh:
+            with self._lock:
+                self.stats.reused += 1
+            return conn
+        if conn is not None:
+            conn.close()
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(host, timeout=self.timeout)
+        connections[key] = conn
+        with self._lock:
+            self.stats.connections += 1
+        return conn
+
+    def _fetch(self, connections, url):
+        '''fetch a URL, following redirects. Returns (content_type, data)'''
+        headers = {}
+        if self.headers is not None:
+            headers = self.headers(url)
+        for redirect in range(5):
+            u = urllib.parse.urlsplit(url)
+            path = u.path or '/'
+            if u.query:
+                path += '?' + u.query
+            conn = self._connection(connections, u.scheme, u.netloc)
+            try:
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                # the server may have closed a kept-alive connection, retry once
+                conn = self._connection(connections, u.scheme, u.netloc, fresh=True)
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+            data = resp.read()
+            if resp.will_close:
+                conn.close()
+                connections.pop((u.scheme, u.netloc), None)
+            if resp.status in [301, 302, 303, 307, 308]:
+                url = urllib.parse.urljoin(url, resp.getheader('Location'))
+                continue
+            if resp.status != 200:
+                raise http.client.HTTPException("HTTP %u" % resp.status)
+            return (resp.getheader('Content-Type', ''), data)
+        raise http.client.HTTPException("too many redirects")
+
+
+if __name__ == "__main__":
+    import http.server
+    import os
+    import shutil
+    import socket
+    import socketserver
+    import tempfile
+    from argparse import ArgumentParser
+
+    import cv2
+    import numpy as np
+
+    from MAVProxy.modules.mavproxy_map import mp_tile
+
+    parser = ArgumentParser(description='benchmark the tile downloader against a local tile server')
+    parser.add_argument("--latency", type=float, default=0.05, help="server response time")
+    parser.add_argument("--workers", type=str, default="1,4,8", help="comma separated worker counts")
+    parser.add_argument("--delay", type=float, default=0, help="per host request interval")
+    args = parser.parse_args()
+
+    tile_png = cv2.imencode('.png', np.full((256, 256, 3), 128, np.uint8))[1].tobytes()
+    server_stats = {'requests': 0, 'connections': 0}
+
+    class TileHandler(http.server.BaseHTTPRequestHandler):
+        '''serves a grey tile for any path after a delay, keeping connections open'''
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            server_stats['connections'] += 1
+            http.server.BaseHTTPRequestHandler.setup(self)
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def do_GET(self):
+            server_stats['requests'] += 1
+            time.sleep(args.latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(tile_png)))
+            self.end_headers()
+            self.wfile.write(tile_png)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), TileHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    mp_tile.TILE_SERVICES['Local'] = "http://127.0.0.1:%u/${ZOOM}/${X}/${Y}.png" % server.server_address[1]
+
+    def run(workers, pan):
+        cache = tempfile.mkdtemp()
+        mt = mp_tile.MPTile(cache_path=cache, service='Local', tile_delay=args.delay, download_workers=workers)
+        server_stats['requests'] = 0
+        server_stats['connections'] = 0
+        lat = -35.362938
+        lon = 149.165085
+        t0 = time.time()
+        mt.area_to_image(lat, lon, 1024, 1024, 2000)
+        if pan:
+            # move the view before the first one has loaded
+            time.sleep(0.2)
+            mt.area_to_image(lat - 0.05, lon + 0.05, 1024, 1024, 2000)
+        while mt.tiles_pending() > 0:
+            time.sleep(0.01)
+        t = time.time() - t0
+        print("workers=%u pan=%s: %.2fs, %u server requests on %u connections" % (
+            workers, pan, t, server_stats['requests'], server_stats['connections']))
+        print("  %s" % mt.download_stats())
+        mt.stop_download()
+        shutil.rmtree(cache)
+
+    for w in [int(w) for w in args.workers.split(',')]:
+        run(w, False)
+        run(w, True)
+    server.shutdown()
+    os._exit(0)
@@ -1,9 +1,8 @@
 from paho.mqtt import MQTTException
 from MAVProxy.modules.lib import mp_settings
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mqtt_publisher
 import paho.mqtt.client as mqtt
-import json
-import numbers
 
 
 class MqttModule(mp_module.MPModule):
@@ -16,21 +15,52 @@ class MqttModule(mp_module.MPModule):
             [('ip', str, '127.0.0.1'),
              ('port', int, '1883'),
              ('name', str, 'mavproxy'),
-             ('prefix', str, '')
+             ('prefix', str, ''),
+             ('include', str, ''),
+             ('exclude', str, ''),
+             ('rate', float, 0),
+             ('rates', str, ''),
+             ('batch', float, 0),
+             ('queue', int, 1000)
              ])
-        self.add_command('mqtt', self.mqtt_command, "mqtt module", ['connect', 'set (MQTTSETTING)'])
+        self.mqtt_settings.set_callback(self.settings_changed)
+        self.add_command('mqtt', self.mqtt_command, "mqtt module", ['connect', 'status', 'set (MQTTSETTING)'])
         self.add_completion_function('(MQTTSETTING)', self.mqtt_settings.completion)
+        # messages are encoded and published by a thread, so the main
+        # loop only filters and queues them
+        self.publisher = mqtt_publisher.MAVPublisher(self.client)
+        self.configure_publisher()
+
+    def configure_publisher(self):
+        """apply the filter, rate and batch settings"""
+        s = self.mqtt_settings
+        try:
+            rate_limiter = mqtt_publisher.RateLimiter(s.rates, s.rate)
+        except ValueError:
+            print(f'mqtt: bad rates "{s.rates}", expected eg ATTITUDE:5,GPS_RAW_INT:1')
+            return
+        self.publisher.rate_limiter = rate_limiter
+        self.publisher.type_filter = mqtt_publisher.TypeFilter(s.include, s.exclude)
+        self.publisher.prefix = s.prefix
+        self.publisher.topics = {}
+        self.publisher.batch = s.batch
+        self.publisher.max_queue = max(1, s.queue)
+
+    def settings_changed(self, setting):
+        """handle changes in settings"""
+        if setting.name in ['prefix', 'include', 'exclude', 'rate', 'rates', 'batch', 'queue']:
+            self.configure_publisher()
 
     def mavlink_packet(self, m):
         """handle an incoming mavlink packet"""
-        try:
-            data = self.convert_to_dict(m)
-            self.client.publish(f'{self.mqtt_settings.prefix}/{m.get_type()}', json.dumps(data))
-        except MQTTException as e:
-            print(f'mqtt: Exception occurred: {e}')
+        if self.publisher.thread is None:
+            # not connected
+            return
+        self.publisher.add(m)
 
     def connect(self):
         """connect to mqtt broker"""
+        self.disconnect()
         try:
             self.client.reinitialise(client_id=self.mqtt_settings.name)
             print(f'connecting to {self.mqtt_settings.ip}:{self.mqtt_settings.port}')
@@ -38,8 +68,27 @@ class MqttModule(mp_module.MPModule):
         except MQTTException as e:
             print(f'mqtt: could not establish connection: {e}')
             return
+        # paho's network thread keeps the connection alive and writes
+        # what the publisher thread publishes
+        self.client.loop_start()
+        self.publisher.start()
         print('connected...')
 
+    def disconnect(self):
+        """stop publishing and close the connection"""
+        if self.publisher.thread is None:
+            return
+        self.publisher.stop()
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def status(self):
+        """show the publisher counters"""
+        state = 'publishing' if self.publisher.thread is not None else 'not connected'
+        print(f'mqtt: {state}: {self.publisher.describe()}')
+        if self.publisher.last_error is not None:
+            print(f'mqtt: last error: {self.publisher.last_error}')
+
     def mqtt_command(self, args):
         """control behaviour of the module"""
         if len(args) == 0:
@@ -48,21 +97,20 @@ class MqttModule(mp_module.MPModule):
             self.mqtt_settings.command(args[1:])
         elif args[0] == 'connect':
             self.connect()
+        elif args[0] == 'status':
+            self.status()
 
     def usage(self):
         """show help on command line options"""
-        return "Usage: mqtt <set|connect>"
+        return "Usage: mqtt <set|connect|status>"
 
     def convert_to_dict(self, message):
         """converts mavlink message to python dict"""
-        if hasattr(message, '_fieldnames'):
-            result = {}
-            for field in message._fieldnames:
-                result[field] = self.convert_to_dict(getattr(message, field))
-            return result
-        if isinstance(message, numbers.Number):
-            return message
-        return str(message)
+        return mqtt_publisher.convert_to_dict(message)
+
+    def unload(self):
+        """unload module"""
+        self.disconnect()
 
 
 def init(mpstate):
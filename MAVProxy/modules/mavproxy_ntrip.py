@@ -7,6 +7,7 @@ import time
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import ntrip
+from MAVProxy.modules.lib import rtcm3
 from MAVProxy.modules.lib import mp_settings
 
 
@@ -14,6 +15,7 @@ class NtripModule(mp_module.MPModule):
 
     def __init__(self, mpstate):
         super(NtripModule, self).__init__(mpstate, "ntrip", "ntrip", public=False)
+        self.subscribe(['GPS_RAW_INT', 'GPS2_RAW'])
         self.ntrip_settings = mp_settings.MPSettings(
             [('caster', str, None),
              ('port', int, 2101),
@@ -43,6 +45,8 @@ class NtripModule(mp_module.MPModule):
         self.logfile = None
         self.id_counts = {}
         self.last_by_id = {}
+        # padding for the last fragment of each message
+        self.rtcm_pad = bytearray(rtcm3.RTCM_DATA_LEN)
 
     def mavlink_packet(self, msg):
         '''handle an incoming mavlink packet'''
@@ -84,41 +88,25 @@ class NtripModule(mp_module.MPModule):
         rtcm_id = self.ntrip.get_ID()
         if not rtcm_id in self.id_counts:
             self.id_counts[rtcm_id] = 0
-            self.last_by_id[rtcm_id] = data[:]
+            self.last_by_id[rtcm_id] = bytes(data)
         self.id_counts[rtcm_id] += 1
 
         blen = len(data)
-        if blen > 4*180:
+        if blen > rtcm3.RTCM_DATA_LEN * rtcm3.MAX_FRAGMENTS:
             # can't send this with GPS_RTCM_DATA
             return
-        total_len = blen
         self.rate_total += blen * self.ntrip_settings.sendmul
 
-        if blen > 180:
-            flags = 1 # fragmented
+        if self.ntrip_settings.sendalllinks:
+            links = self.mpstate.mav_master
         else:
-            flags = 0
-        # add in the sequence number
-        flags |= (self.pkt_count & 0x1F) << 3
-
-        fragment = 0
-        while blen > 0:
-            send_data = bytearray(data[:180])
-            frag_len = len(send_data)
-            data = data[frag_len:]
-            if frag_len < 180:
-                send_data.extend(bytearray([0]*(180-frag_len)))
-            if self.ntrip_settings.sendalllinks:
-                links = self.mpstate.mav_master
-            else:
-                links = [self.master]
+            links = [self.master]
+        for (flags, frag_len, send_data) in rtcm3.gps_rtcm_fragments(data, self.pkt_count, self.rtcm_pad):
             for link in links:
                 for d in range(self.ntrip_settings.sendmul):
                     if random.random() * 100 < self.ntrip_settings.frag_drop_pct:
                         continue
-                    link.mav.gps_rtcm_data_send(flags | (fragment<<1), frag_len, send_data)
-            fragment += 1
-            blen -= frag_len
+                    link.mav.gps_rtcm_data_send(flags, frag_len, send_data)
         self.pkt_count += 1
 
         now = time.time()
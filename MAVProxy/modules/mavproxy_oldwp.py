@@ -911,7 +911,8 @@ class WPModule(mp_module.MPModule):
             return
         print("Fetching mission with ftp")
         self.ftp_count = None
-        ftp.cmd_get([self.mission_ftp_name], callback=self.ftp_callback, callback_progress=self.ftp_callback_progress)
+        ftp.queue_get(self.mission_ftp_name, callback=self.ftp_callback,
+                      callback_progress=self.ftp_callback_progress, label="mission")
 
     def ftp_callback_progress(self, fh, total_size):
         '''progress callback from ftp fetch of mission'''
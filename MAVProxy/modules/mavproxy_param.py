@@ -165,7 +165,8 @@ class ParamState:
             return
         self.ftp_started = True
         self.ftp_count = None
-        ftp.cmd_get(["@PARAM/param.pck?withdefaults=1"], callback=self.ftp_callback, callback_progress=self.ftp_callback_progress)
+        ftp.queue_get("@PARAM/param.pck?withdefaults=1", callback=self.ftp_callback,
+                      callback_progress=self.ftp_callback_progress, label="parameters")
 
     def log_params(self, params):
         '''log PARAM_VALUE messages so that we can extract parameters from a tlog when using ftp download'''
@@ -189,7 +190,7 @@ class ParamState:
             mav.srcComponent = mavutil.mavlink.MAV_COMP_ID_MISSIONPLANNER
             try:
                 buf = p.pack(mav)
-                self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + buf))
+                self.mpstate.logqueue.log_message(usec, buf)
                 # also give to param editor so it can update for changes
                 if editor:
                     editor.mavlink_packet(p)
@@ -17,6 +17,7 @@ class park(mp_module.MPModule):
     def __init__(self, mpstate):
         """Initialise module"""
         super(park, self).__init__(mpstate, "park", "")
+        self.subscribe(['GLOBAL_POSITION_INT'])
         # latest coordinates
         self.lat = 0
         self.lon = 0
@@ -11,9 +11,12 @@ import json
 import socket
 from threading import Thread
 
-from flask import Flask
+from flask import Flask, Response
+from flask import request as flask_request
 from werkzeug.serving import make_server
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib import telemetry_stream
 
 def mavlink_to_json(msg):
     '''Translate mavlink python messages in json string'''
@@ -36,7 +39,7 @@ def mpstatus_to_json(status):
 
 class RestServer():
     '''Rest Server'''
-    def __init__(self):
+    def __init__(self, settings=None):
         # Set log level and remove flask output
         import logging
         self.log = logging.getLogger('werkzeug')
@@ -48,13 +51,14 @@ class RestServer():
         self.address = 'localhost'
         self.port = 5000
 
-        # Save status
-        self.status = None
+        # latest messages as cached JSON, and the stream subscribers
+        self.settings = settings
+        self.hub = telemetry_stream.TelemetryHub()
         self.server = None
 
-    def update_dict(self, mpstate):
-        '''We don't have time to waste'''
-        self.status = mpstate.status
+    def update(self, msg):
+        '''record a message, pushing it to stream subscribers'''
+        self.hub.update(msg)
 
     def set_ip_port(self, ip, port):
         '''set ip and port'''
@@ -79,6 +83,8 @@ class RestServer():
     def stop(self):
         '''Stop server'''
         self.app = None
+        # end the event streams so their threads finish
+        self.hub.close()
         if self.run_thread:
             self.run_thread = None
         if self.server:
@@ -92,23 +98,22 @@ class RestServer():
 
     def request(self, arg=None):
         '''Deal with requests'''
-        if not self.status:
+        if not self.hub.latest:
             return '{"result": "No message"}'
 
-        try:
-            status_dict = json.loads(mpstatus_to_json(self.status))
-        except Exception as e:
-            print(e)
-            return
-
         # If no key, send the entire json
         if not arg:
-            return json.dumps(status_dict)
+            return self.hub.status()
 
         # Get item from path
-        new_dict = status_dict
         args = arg.split('/')
-        for key in args:
+        entry = self.hub.get(args[0])
+        if entry is None:
+            return '{"key": "%s", "last_dict": %s}' % (args[0], self.hub.status())
+        if len(args) == 1:
+            return entry.json()
+        new_dict = entry.fields()
+        for key in args[1:]:
             if key in new_dict:
                 new_dict = new_dict[key]
             else:
@@ -116,24 +121,61 @@ class RestServer():
 
         return json.dumps(new_dict)
 
+    def stream(self):
+        '''stream messages as Server-Sent Events. The types argument
+        picks the messages and their rates, eg
+        /rest/stream?types=ATTITUDE:10,GPS_RAW_INT:2,HEARTBEAT
+        Types without a rate are sent at the rate argument, or on every
+        update if it is 0. With no types all messages are sent'''
+        try:
+            default_rate = float(flask_request.args.get('rate', 0))
+            rates = telemetry_stream.parse_rates(flask_request.args.get('types', ''), default_rate)
+        except ValueError as e:
+            return Response(json.dumps({"error": str(e)}), status=400, mimetype='application/json')
+        self.hub.max_subscribers = self.settings.stream_clients
+        sub = self.hub.subscribe(rates, default_rate, self.settings.stream_queue)
+        if sub is None:
+            return Response('{"error": "too many stream clients"}', status=503, mimetype='application/json')
+        events = telemetry_stream.sse_events(self.hub, sub, self.settings.stream_keepalive)
+        return Response(events, mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
     def add_endpoint(self):
         '''Set endpoits'''
         self.app.add_url_rule('/rest/mavlink/<path:arg>', 'rest', self.request)
         self.app.add_url_rule('/rest/mavlink/', 'rest', self.request)
+        self.app.add_url_rule('/rest/stream', 'stream', self.stream)
 
 class ServerModule(mp_module.MPModule):
     ''' Server Module '''
     def __init__(self, mpstate):
-        super(ServerModule, self).__init__(mpstate, "restserver", "restserver module")
+        # the REST status has always held messages from every vehicle
+        super(ServerModule, self).__init__(mpstate, "restserver", "restserver module", multi_vehicle=True)
+        self.restserver_settings = mp_settings.MPSettings(
+            [('stream_clients', int, 10),
+             ('stream_queue', int, 100),
+             ('stream_keepalive', float, 15.0)])
         # Configure server
-        self.rest_server = RestServer()
+        self.rest_server = RestServer(self.restserver_settings)
 
         self.add_command('restserver', self.cmds, \
-            "restserver module", ['start', 'stop', 'address 127.0.0.1:4777'])
+            "restserver module", ['start', 'stop', 'status', 'address 127.0.0.1:4777',
+                                  'set (RESTSERVERSETTING)'])
+        self.add_completion_function('(RESTSERVERSETTING)',
+                                     self.restserver_settings.completion)
 
     def usage(self):
         '''show help on command line options'''
-        return "Usage: restserver <address|freq|stop|start>"
+        return "Usage: restserver <address|stop|start|status|set>"
+
+    def cmd_status(self):
+        '''show the cache and stream clients'''
+        hub = self.rest_server.hub
+        print("Rest server %s: %u message types, %u updates, %u pushed to %u stream clients" % (
+            "running" if self.rest_server.running() else "stopped",
+            len(hub.types()), hub.updates, hub.pushed, len(hub.subscribers)))
+        for sub in hub.subscribers:
+            print("  " + sub.describe())
 
     def cmds(self, args):
         '''control behaviour of the module'''
@@ -145,6 +187,7 @@ class ServerModule(mp_module.MPModule):
             if self.rest_server.running():
                 print("Rest server already running.")
                 return
+            self.seed()
             self.rest_server.start()
             print("Rest server running: %s:%s" % \
                 (self.rest_server.address, self.rest_server.port))
@@ -155,6 +198,12 @@ class ServerModule(mp_module.MPModule):
                 return
             self.rest_server.stop()
 
+        elif args[0] == "status":
+            self.cmd_status()
+
+        elif args[0] == "set":
+            self.restserver_settings.command(args[1:])
+
         elif args[0] == "address":
             # Check if have necessary amount of arguments
             if len(args) != 2:
@@ -170,10 +219,18 @@ class ServerModule(mp_module.MPModule):
         else:
             print(self.usage())
 
-    def idle_task(self):
-        '''called rapidly by mavproxy'''
-        # Update server with last mpstate
-        self.rest_server.update_dict(self.mpstate)
+    def seed(self):
+        '''fill the server's cache with the messages already received.
+        Later entries replace earlier ones of the same type, as they did
+        when the status was converted to JSON on each request'''
+        for msg in list(self.mpstate.status.msgs.values()):
+            if msg.get_type() != 'BAD_DATA':
+                self.rest_server.update(msg)
+
+    def mavlink_packet(self, msg):
+        '''handle an incoming mavlink packet'''
+        if self.rest_server.running() and msg.get_type() != 'BAD_DATA':
+            self.rest_server.update(msg)
 
     def unload(self):
         '''Stop and kill everything before finishing'''
@@ -24,6 +24,9 @@ from MAVProxy.modules.lib import rline
 from MAVProxy.modules.lib import wxconsole
 from MAVProxy.modules.lib import param_help
 from MAVProxy.modules.lib import param_ftp
+from MAVProxy.modules.lib import mp_logwriter
+from MAVProxy.modules.lib import logcolumns
+from MAVProxy.modules.lib import graph_batch
 from MAVProxy.modules.lib.graph_ui import Graph_UI
 from pymavlink.mavextra import *
 from MAVProxy.modules.lib.mp_menu import *
@@ -115,10 +118,14 @@ class MEState(object):
               MPSetting('debug', int, 0, 'debug level'),
               MPSetting('paramdocs', bool, True, 'show param docs'),
               MPSetting('max_rate', float, 0, 'maximum display rate of graphs in Hz'),
+              MPSetting('colcache', bool, True, 'cache log columns next to the log for fast graphs'),
+              MPSetting('batch_jobs', int, 0, 'processes for batch graphs, 0 for one per CPU'),
+              MPSetting('batch_format', str, 'png', 'image format for batch graphs'),
               ]
             )
 
         self.mlog = None
+        self.columns = None
         self.mav_param = None
         self.filename = None
         self.command_map = command_map
@@ -126,6 +133,7 @@ class MEState(object):
             "set"       : ["(SETTING)"],
             "condition" : ["(VARIABLE)"],
             "graph"     : ['(VARIABLE) (VARIABLE) (VARIABLE) (VARIABLE) (VARIABLE) (VARIABLE) (VARIABLE) (VARIABLE) (VARIABLE) (VARIABLE) (VARIABLE) (VARIABLE)'],
+            "batch"     : ['(FILENAME)'],
             "dump"      : ['(MESSAGETYPE)', '--verbose (MESSAGETYPE)'],
             "map"       : ['(VARIABLE) (VARIABLE) (VARIABLE) (VARIABLE) (VARIABLE)'],
             "param"     : ['download', 'check', 'help (PARAMETER)'],
@@ -237,7 +245,7 @@ def setup_file_menu():
                                             handler=MPMenuCallFileDialog(
                                                                         flags=('open',),
                                                                         title='Logfile Load',
-                                                                        wildcard='*.tlog;*.log;*.BIN;*.bin')),
+                                                                        wildcard='*.tlog;*.log;*.BIN;*.bin;*.gz;*.zst;*.lz4')),
                                   MPMenuItem('&Quit\tCtrl+Q', 'Quit', 'quit')]))
     mestate.console.set_menu(TopMenu, menu_callback)
 
@@ -413,6 +421,52 @@ def cmd_graph(args):
         #print("initial: ", xlimits.last_xlim)
         grui[-1].set_xlim(xlimits.last_xlim)
 
+def batch_graphs(directory, patterns=None):
+    '''render graphs to image files in a directory'''
+    graphs = graph_batch.select_graphs(mestate.graphs, patterns)
+    if len(graphs) == 0:
+        print("No matching graphs")
+        return
+    options = {
+        'condition' : mestate.settings.condition,
+        'xaxis' : mestate.settings.xaxis,
+        'marker' : mestate.settings.marker,
+        'linestyle' : mestate.settings.linestyle,
+        'show_flightmode' : mestate.settings.show_flightmode,
+        'legend' : mestate.settings.legend,
+        'legend2' : mestate.settings.legend2,
+        'max_rate' : mestate.settings.max_rate,
+        'title' : mestate.settings.title,
+        'colcache' : mestate.settings.colcache,
+        'flightmode_selections' : mestate.flightmode_selections,
+        'flightmodes' : mestate.mlog._flightmodes,
+        'colourmap' : flightmode_colours(),
+        }
+    mestate.console.write("Rendering %u graphs to %s\n" % (len(graphs), directory))
+
+    def progress(r):
+        if r.error is not None:
+            mestate.console.write("%s: %s\n" % (r.job.name, r.error), fg='red')
+        else:
+            mestate.console.write("%s\n" % os.path.basename(r.job.filename))
+
+    (results, report) = graph_batch.render_graphs(mestate.mlog, mestate.filename, graphs, directory, options,
+                                                  processes=mestate.settings.batch_jobs,
+                                                  fmt=mestate.settings.batch_format,
+                                                  progress=progress)
+    print(report)
+
+def cmd_batch(args):
+    '''batch graph command'''
+    usage = "usage: batch <DIRECTORY> [GRAPHNAME...]"
+    if len(args) < 1:
+        print(usage)
+        return
+    if mestate.mlog is None:
+        print("No log loaded")
+        return
+    batch_graphs(args[0], args[1:])
+
 map_timelim_pipes = []
 
 def cmd_map(args):
@@ -1319,11 +1373,19 @@ def loadfile(args):
     '''load a log file (path given by arg)'''
     mestate.console.write("Loading %s...\n" % args)
     t0 = time.time()
-    mlog = mavutil.mavlink_connection(args, notimestamps=False,
-                                      zero_time_base=False,
-                                      progress_callback=progress_bar)
+    mlog = mp_logwriter.mavlink_connection(args, notimestamps=False,
+                                           zero_time_base=False,
+                                           progress_callback=progress_bar)
     mestate.filename = args
     mestate.mlog = mlog
+    if mestate.columns is not None:
+        mestate.columns.close()
+    mestate.columns = None
+    if mestate.settings.colcache:
+        try:
+            mestate.columns = logcolumns.LogColumns(args, mlog)
+        except Exception as ex:
+            print("Column cache unavailable: %s" % ex)
     # note that this is a shallow copy of the messages.
     # Instance-number-containing messages in mestate.status.msgs may
     # reference messages in their parent DFReader object which no
@@ -1493,6 +1555,7 @@ def main_loop():
 
 command_map = {
     'graph'      : (cmd_graph,     'display a graph'),
+    'batch'      : (cmd_batch,     'save graphs to a directory of images'),
     'set'        : (cmd_set,       'control settings'),
     'reload'     : (cmd_reload,    'reload graphs'),
     'save'       : (cmd_save,      'save a graph'),
@@ -1521,6 +1584,9 @@ if __name__ == "__main__":
     from argparse import ArgumentParser
     parser = ArgumentParser(description=__doc__)
     parser.add_argument("--version", action='store_true', help="show version")
+    parser.add_argument("--batch", default=None, metavar="DIRECTORY", help="save graphs to a directory of images and exit")
+    parser.add_argument("--batch-graphs", default=None, help="comma separated graph name patterns for --batch")
+    parser.add_argument("--jobs", type=int, default=0, help="number of processes for --batch, 0 for one per CPU")
     parser.add_argument("files", metavar="<FILE>", nargs="?")
     args = parser.parse_args()
 
@@ -1544,6 +1610,16 @@ if __name__ == "__main__":
     if args.files is not None and len(args.files) != 0:
         loadfile(args.files)
 
+    if args.batch is not None:
+        if mestate.mlog is None:
+            print("--batch needs a log file")
+            sys.exit(1)
+        mestate.settings.batch_jobs = args.jobs
+        patterns = args.batch_graphs.split(',') if args.batch_graphs else None
+        batch_graphs(args.batch, patterns)
+        mestate.console.close()
+        sys.exit(0)
+
     # run main loop as a thread
     mestate.thread = threading.Thread(target=main_loop, name='main_loop')
     mestate.thread.daemon = True
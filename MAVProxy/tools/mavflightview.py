@@ -12,10 +12,10 @@ from math import *
 from pymavlink import mavutil, mavwp, mavextra
 from MAVProxy.modules.mavproxy_map import mp_slipmap, mp_tile
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_logwriter
 from MAVProxy.modules.lib import multiproc
 from MAVProxy.modules.lib import grapher
 from MAVProxy.modules.lib import kmlread
-import functools
 import random
 import cv2
 
@@ -27,9 +27,10 @@ def pixel_coords(latlon, ground_width=0, mt=None, topleft=None, width=None):
     (lat,lon) = (latlon[0], latlon[1])
     return mt.coord_to_pixel(topleft[0], topleft[1], width, ground_width, lat, lon)
 
-def create_imagefile(options, filename, latlon, ground_width, path_objs, mission_obj, fence_obj, kml_objects, width=600, height=600, used_flightmodes=[], mav_type=None):
+def create_imagefile(options, filename, latlon, ground_width, path_objs, mission_obj, fence_obj, kml_objects, width=600, height=600, used_flightmodes=[], mav_type=None, mt=None):
     '''create path and mission as an image file'''
-    mt = mp_tile.MPTile(service=options.service)
+    if mt is None:
+        mt = mp_tile.MPTile(service=options.service)
 
     map_img = mt.area_to_image(latlon[0], latlon[1],
                                width, height, ground_width)
@@ -39,7 +40,7 @@ def create_imagefile(options, filename, latlon, ground_width, path_objs, mission
     map_img = mt.area_to_image(latlon[0], latlon[1],
                                width, height, ground_width)
     # a function to convert from (lat,lon) to (px,py) on the map
-    pixmapper = functools.partial(pixel_coords, ground_width=ground_width, mt=mt, topleft=latlon, width=width)
+    pixmapper = mp_tile.PixelMapper(mt, latlon[0], latlon[1], width, ground_width)
     for path_obj in path_objs:
         path_obj.draw(map_img, pixmapper, None)
     if mission_obj is not None:
@@ -525,7 +526,12 @@ def mavflightview_show(path, wp, fen, used_flightmodes, mav_type, options, insta
     path_objs = []
     for i in range(len(path)):
         if len(path[i]) != 0:
-            path_objs.append(mp_slipmap.SlipPolygon(
+            if getattr(options, "lod", True):
+                # simplified to suit the zoom level
+                path_class = mp_slipmap.SlipPath.from_points
+            else:
+                path_class = mp_slipmap.SlipPolygon
+            path_objs.append(path_class(
                 'FlightPath[%u]-%s' % (i,title),
                 path[i],
                 layer='FlightPath',
@@ -635,7 +641,7 @@ def load_kml(kml):
 
 def mavflightview(filename, options):
     print("Loading %s ..." % filename)
-    mlog = mavutil.mavlink_connection(filename)
+    mlog = mp_logwriter.mavlink_connection(filename)
     stuff = mavflightview_mav(mlog, options)
     if stuff is None:
         return
@@ -666,6 +672,7 @@ class mavflightview_options(object):
         self._flightmodes = []
         self.colour_source = 'flightmode'
         self.show_waypoints = True
+        self.lod = True
 
 if __name__ == "__main__":
     multiproc.freeze_support()
@@ -697,6 +704,7 @@ if __name__ == "__main__":
     parser.add_option("--kml", default=None, help="add kml overlay")
     parser.add_option("--hide-waypoints", dest='show_waypoints', action='store_false', help="do not show waypoints", default=True)
     parser.add_option("--no-show-lines", action="store_true", default=False)
+    parser.add_option("--no-lod", dest='lod', action="store_false", default=True, help="draw every point of the flight path")
 
     (opts, args) = parser.parse_args()
 
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+'''
+tests for FTP downloads to a file being resumed, run against the
+stand-in FTP server
+'''
+
+import os
+import time
+
+from MAVProxy.modules import mavproxy_ftp as ftp
+from MAVProxy.modules.lib import ftp_jobs
+from MAVProxy.modules.lib.ftp_standin import FTPServerStandin, StandinLink, new_module, step
+
+FILE_SIZE = 64 * 1024
+
+
+class CRCLossServer(FTPServerStandin):
+    '''a server that loses the first drop_crc CRC requests'''
+    def __init__(self, files, drop_crc):
+        FTPServerStandin.__init__(self, files, StandinLink(latency=0.002), StandinLink(latency=0.002, bandwidth=200000))
+        self.drop_crc = drop_crc
+
+    def handle_request(self, payload, now):
+        if payload[3] == ftp.OP_CalcFileCRC32 and self.drop_crc > 0:
+            self.drop_crc -= 1
+            return
+        FTPServerStandin.handle_request(self, payload, now)
+
+
+def new_server(files, drop_crc=0):
+    return CRCLossServer(files, drop_crc)
+
+
+def run_until(server, module, done, timeout=20):
+    t0 = time.time()
+    while not done() and time.time() - t0 < timeout:
+        step(server, module)
+    assert done()
+
+
+def interrupted_download(files, local):
+    '''start a download to local and stop it part way'''
+    server = new_server(files)
+    module = new_module(server)
+    job = module.queue_get('log.bin', local)
+    run_until(server, module, lambda: job.received_bytes() >= FILE_SIZE // 2)
+    job.save_state()
+    return job
+
+
+def test_get_without_resume_skips_crc(tmp_path):
+    files = {'log.bin': os.urandom(FILE_SIZE)}
+    server = new_server(files)
+    module = new_module(server)
+    local = str(tmp_path / 'log.bin')
+    job = module.queue_get('log.bin', local)
+    run_until(server, module, job.finished)
+    assert job.state == ftp_jobs.DONE
+    assert ftp.OP_CalcFileCRC32 not in module.master.mav.opcodes
+    with open(local, 'rb') as f:
+        assert f.read() == files['log.bin']
+    assert not os.path.exists(local + ftp_jobs.RESUME_SUFFIX)
+
+
+def test_resume(tmp_path):
+    files = {'log.bin': os.urandom(FILE_SIZE)}
+    local = str(tmp_path / 'log.bin')
+    first = interrupted_download(files, local)
+    assert os.path.exists(local + ftp_jobs.RESUME_SUFFIX)
+
+    server = new_server(files)
+    module = new_module(server)
+    job = module.queue_get('log.bin', local)
+    run_until(server, module, job.finished)
+    assert job.state == ftp_jobs.DONE
+    assert ftp.OP_CalcFileCRC32 in module.master.mav.opcodes
+    assert job.resumed
+    assert job.resumed_bytes > 0
+    assert job.resumed_bytes <= first.received_bytes()
+    with open(local, 'rb') as f:
+        assert f.read() == files['log.bin']
+    assert not os.path.exists(local + ftp_jobs.RESUME_SUFFIX)
+
+
+def test_resume_with_lost_crc(tmp_path):
+    files = {'log.bin': os.urandom(FILE_SIZE)}
+    local = str(tmp_path / 'log.bin')
+    first = interrupted_download(files, local)
+
+    # the first CRC request is lost and sent again
+    server = new_server(files, drop_crc=1)
+    module = new_module(server)
+    job = module.queue_get('log.bin', local)
+    run_until(server, module, job.finished)
+    assert job.state == ftp_jobs.DONE
+    assert module.master.mav.opcodes.count(ftp.OP_CalcFileCRC32) == 2
+    assert job.resumed
+    assert 0 < job.resumed_bytes <= first.received_bytes()
+    with open(local, 'rb') as f:
+        assert f.read() == files['log.bin']
+
+
+def test_resume_without_crc(tmp_path):
+    files = {'log.bin': os.urandom(FILE_SIZE)}
+    local = str(tmp_path / 'log.bin')
+    first = interrupted_download(files, local)
+
+    # no CRC reply at the start, so it is asked for again at the end
+    server = new_server(files, drop_crc=3)
+    module = new_module(server)
+    module.crc_timeout = lambda: 0.2
+    job = module.queue_get('log.bin', local)
+    run_until(server, module, job.finished)
+    assert job.state == ftp_jobs.DONE
+    assert job.resumed
+    assert 0 < job.resumed_bytes <= first.received_bytes()
+    assert job.remote_crc == ftp_jobs.crc32(files['log.bin'])
+    with open(local, 'rb') as f:
+        assert f.read() == files['log.bin']
+
+
+def test_resume_of_changed_file(tmp_path):
+    files = {'log.bin': os.urandom(FILE_SIZE)}
+    local = str(tmp_path / 'log.bin')
+    interrupted_download(files, local)
+
+    # the same size, so only the CRC shows it has changed
+    files['log.bin'] = os.urandom(FILE_SIZE)
+    server = new_server(files)
+    module = new_module(server)
+    job = module.queue_get('log.bin', local)
+    run_until(server, module, job.finished)
+    assert job.state == ftp_jobs.DONE
+    with open(local, 'rb') as f:
+        assert f.read() == files['log.bin']
+
+
+def test_no_reset_while_op_pending(tmp_path):
+    files = {'log.bin': os.urandom(1000)}
+    server = new_server(files)
+    module = new_module(server)
+    module.cmd_crc(['log.bin'])
+    job = module.queue_get('log.bin', str(tmp_path / 'log.bin'))
+    assert ftp.OP_ResetSessions not in module.master.mav.opcodes
+    run_until(server, module, job.finished)
+    assert job.state == ftp_jobs.DONE
+
+    # with nothing outstanding an abandoned session is reset first
+    module.master.mav.opcodes = []
+    job = module.queue_get('log.bin', str(tmp_path / 'log2.bin'))
+    assert module.master.mav.opcodes[0] == ftp.OP_ResetSessions
+    run_until(server, module, job.finished)
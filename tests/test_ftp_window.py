@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+'''
+tests for the FTP download read window
+'''
+
+from MAVProxy.modules.lib import ftp_window
+from MAVProxy.modules.lib.ftp_window import GapSet, ReadWindow
+
+
+def ranges(gaps):
+    return list(gaps)
+
+
+def test_gapset_add_merges():
+    g = GapSet()
+    g.add(10, 20)
+    g.add(30, 40)
+    assert ranges(g) == [(10, 20), (30, 40)]
+    assert g.size == 20
+    # touching ranges merge
+    g.add(20, 30)
+    assert ranges(g) == [(10, 40)]
+    assert g.size == 30
+    # an empty range is ignored
+    g.add(50, 50)
+    assert ranges(g) == [(10, 40)]
+
+
+def test_gapset_remove_splits():
+    g = GapSet()
+    g.add(0, 100)
+    assert g.remove(40, 60) == 20
+    assert ranges(g) == [(0, 40), (60, 100)]
+    assert g.size == 80
+    # removing bytes that aren't there
+    assert g.remove(40, 60) == 0
+    # removing across both ranges
+    assert g.remove(30, 70) == 20
+    assert ranges(g) == [(0, 30), (70, 100)]
+    assert g.first() == (0, 30)
+    assert g.intersection(20, 80) == [(20, 30), (70, 80)]
+
+
+def test_window_lost_burst_packets():
+    w = ReadWindow(burst_size=100, max_window=5)
+    now = 1000.0
+    assert w.burst_data(0, 100, now) == 100
+    # the packet at 100 is lost
+    assert w.burst_data(200, 100, now + 0.01) == 100
+    assert w.head == 300
+    assert ranges(w.missing) == [(100, 200)]
+    assert w.received_bytes() == 200
+    w.eof = True
+    assert not w.finished()
+
+    reads = w.next_reads(now + 0.02)
+    assert reads == [(100, 100)]
+    # the gap is outstanding, so it isn't asked for again
+    assert w.next_reads(now + 0.03) == []
+    assert w.read_reply(100, 100, now + 0.1) == 100
+    assert w.finished()
+    assert w.received_bytes() == 300
+
+
+def test_window_long_gap_is_split():
+    w = ReadWindow(burst_size=ftp_window.MAX_PAYLOAD, max_window=2)
+    w.burst_data(0, 10, 1000.0)
+    w.burst_data(1000, 10, 1000.01)
+    reads = w.next_reads(1000.02)
+    # no more than the window at once, each at most MAX_PAYLOAD
+    assert reads == [(10, ftp_window.MAX_PAYLOAD), (10 + ftp_window.MAX_PAYLOAD, ftp_window.MAX_PAYLOAD)]
+
+
+def test_window_read_timeout_retries():
+    w = ReadWindow(burst_size=100, max_window=5, retry_time=0.5)
+    w.burst_data(0, 100, 1000.0)
+    w.burst_data(200, 100, 1000.0)
+    assert w.next_reads(1000.1) == [(100, 100)]
+    assert w.next_reads(1000.3) == []
+    # the read is given up on and sent again
+    assert w.next_reads(1000.7) == [(100, 100)]
+    assert w.stats.timeouts == 1
+    assert w.outstanding[100].retry
+    # a late reply to the first read still fills the gap
+    w.read_reply(100, 100, 1000.8)
+    assert w.missing.size == 0
+
+
+def test_window_restore():
+    w = ReadWindow()
+    w.restore(500, False, [(100, 200), (300, 350)])
+    assert w.head == 500
+    assert w.received_bytes() == 350
+    assert [r[0] for r in w.next_reads(1000.0)] == [100, 300]
+
+
+def test_burst_size_shrinks_with_loss():
+    w = ReadWindow(burst_size=0)
+    assert w.next_burst_size() == ftp_window.MAX_PAYLOAD
+    # lose one packet in two
+    now = 1000.0
+    for i in range(20):
+        w.burst_data(i * 2 * w.burst_size, w.burst_size, now)
+        now += 0.01
+    assert w.next_burst_size() < ftp_window.MAX_PAYLOAD
+    # a fixed size is kept whatever the loss
+    w = ReadWindow(burst_size=80)
+    w.burst_lost = 10
+    w.burst_packets = 10
+    assert w.next_burst_size() == 80
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+'''
+tests for the dataflash log download window, against a simulated
+vehicle running in simulated time
+'''
+
+import io
+import os
+
+from MAVProxy.modules.lib.log_download import ChunkWriter, LogDownload, LOG_DATA_LEN
+
+
+def run_download(log, dl, lose=None, latency=0.01, max_steps=200000):
+    '''serve dl from the bytes of log the way a vehicle does, one
+    LOG_DATA packet per millisecond. lose(n) says if the nth packet is
+    lost'''
+    now = 1000.0
+    # requests on their way to the vehicle, as (arrival, ofs, count)
+    uplink = []
+    # packets on their way back, as (arrival, ofs, data)
+    downlink = []
+    serving = None
+    sent = 0
+    for i in range(max_steps):
+        if dl.finished():
+            break
+        now += 0.001
+        req = dl.next_request(now)
+        if req is not None:
+            uplink.append((now + latency, req.ofs, req.count))
+        while uplink and uplink[0][0] <= now:
+            (t, ofs, count) = uplink.pop(0)
+            # a new request replaces the one being served
+            serving = [ofs, min(ofs + count, len(log))]
+        if serving is not None and serving[0] < serving[1]:
+            ofs = serving[0]
+            data = log[ofs:ofs + min(LOG_DATA_LEN, serving[1] - ofs)]
+            serving[0] += len(data)
+            if lose is None or not lose(sent):
+                downlink.append((now + latency, ofs, data))
+            sent += 1
+        while downlink and downlink[0][0] <= now:
+            (t, ofs, data) = downlink.pop(0)
+            dl.data(ofs, len(data), data.ljust(LOG_DATA_LEN, b'\0'), now)
+    dl.close()
+
+
+def test_chunk_writer_gathers_writes():
+    fh = io.BytesIO()
+    w = ChunkWriter(fh, chunk_size=100, max_chunks=2)
+    data = os.urandom(350)
+    # out of order, with overlaps
+    for ofs in [200, 0, 50, 100, 150, 250, 300]:
+        w.write(ofs, data[ofs:ofs + 60])
+    w.flush()
+    assert fh.getvalue()[:350] == data
+    # chunks are written whole once filled
+    assert w.writes < 7
+
+
+def test_next_range_merges_small_holes():
+    dl = LogDownload(1, io.BytesIO(), size=10000)
+    dl.data(0, LOG_DATA_LEN, bytes(LOG_DATA_LEN), 1000.0)
+    dl.data(2 * LOG_DATA_LEN, LOG_DATA_LEN, bytes(LOG_DATA_LEN), 1000.0)
+    assert list(dl.missing) == [(LOG_DATA_LEN, 2 * LOG_DATA_LEN)]
+    # the hole and the rest of the log in one request
+    assert dl.next_range() == (LOG_DATA_LEN, 10000 - LOG_DATA_LEN)
+    # less what has been asked for already
+    assert dl.next_range([(LOG_DATA_LEN, 3 * LOG_DATA_LEN)]) == (3 * LOG_DATA_LEN, 10000 - 3 * LOG_DATA_LEN)
+
+
+def test_download():
+    log = os.urandom(200000)
+    fh = io.BytesIO()
+    dl = LogDownload(1, fh, size=len(log), window=20000)
+    run_download(log, dl)
+    assert dl.finished()
+    assert fh.getvalue() == log
+    assert dl.retries == 0
+
+
+def test_download_with_loss():
+    log = os.urandom(100000)
+    fh = io.BytesIO()
+    dl = LogDownload(1, fh, size=len(log), window=20000)
+    run_download(log, dl, lose=lambda n: n % 7 == 3)
+    assert dl.finished()
+    assert fh.getvalue() == log
+    assert dl.stats.lost_bytes > 0
+
+
+def test_download_unknown_size():
+    # not a whole number of packets, so the log ends with a short one
+    log = os.urandom(50 * LOG_DATA_LEN + 17)
+    fh = io.BytesIO()
+    dl = LogDownload(1, fh, size=None, window=20000)
+    run_download(log, dl)
+    assert dl.size == len(log)
+    assert fh.getvalue() == log
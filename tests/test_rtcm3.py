@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+'''
+tests for RTCM3 framing and GPS_RTCM_DATA fragmentation
+'''
+
+import random
+
+import pytest
+
+from MAVProxy.modules.lib import rtcm3
+
+
+def make_frame(msg_id, length, rng):
+    '''an RTCM3 frame for message msg_id with a payload of random bytes'''
+    payload = bytearray(rng.getrandbits(8) for i in range(length))
+    payload[0] = msg_id >> 4
+    payload[1] = ((msg_id & 0xF) << 4) | (payload[1] & 0xF)
+    frame = bytearray([rtcm3.RTCMv3_PREAMBLE, length >> 8, length & 0xFF]) + payload
+    crc = rtcm3.crc24(frame)
+    frame += bytearray([crc >> 16, (crc >> 8) & 0xFF, crc & 0xFF])
+    return bytes(frame)
+
+
+def test_crc24_check_value():
+    # the CRC-24/LTE-A check value
+    assert rtcm3.crc24(b'123456789') == 0xCDE703
+    # odd and even lengths agree with the byte at a time table
+    for n in range(8):
+        data = bytes(range(n))
+        crc = 0
+        for b in data:
+            crc = ((crc << 8) & 0xFFFFFF) ^ rtcm3.CRC24_TABLE[(crc >> 16) ^ b]
+        assert rtcm3.crc24(data) == crc
+
+
+def test_frames_whole_buffer():
+    rng = random.Random(1)
+    frames = [make_frame(1005, 19, rng), make_frame(1077, 300, rng), make_frame(1230, 8, rng)]
+    # noise before and between frames
+    stream = b'\x01\x02' + frames[0] + b'\xd3\x00' + frames[1] + frames[2]
+    r = rtcm3.RTCM3()
+    got = r.frames(stream)
+    assert [bytes(f) for f in got] == frames
+    assert [rtcm3.frame_ID(f) for f in got] == [1005, 1077, 1230]
+    assert r.frame_count == 3
+    assert r.discarded > 0
+
+
+def test_frames_split_pieces():
+    rng = random.Random(2)
+    frames = [make_frame(1074 + i, rng.randint(10, 600), rng) for i in range(20)]
+    stream = b''.join(frames)
+    for size in [1, 2, 7, 180, 1000]:
+        r = rtcm3.RTCM3()
+        got = []
+        for i in range(0, len(stream), size):
+            got.extend([bytes(f) for f in r.frames(stream[i:i + size])])
+        assert got == frames
+
+
+def test_frames_bad_crc_resyncs():
+    rng = random.Random(3)
+    good = make_frame(1005, 19, rng)
+    bad = bytearray(make_frame(1006, 21, rng))
+    bad[10] ^= 0xFF
+    r = rtcm3.RTCM3()
+    got = r.frames(bytes(bad) + good)
+    assert [bytes(f) for f in got] == [good]
+    assert r.crc_errors == 1
+
+
+def test_read_a_byte_at_a_time():
+    rng = random.Random(4)
+    frames = [make_frame(1005, 19, rng), make_frame(1087, 200, rng)]
+    r = rtcm3.RTCM3()
+    got = []
+    for b in b''.join(frames):
+        if r.read(bytes([b])):
+            got.append(bytes(r.get_packet()))
+    assert got == frames
+    assert r.get_packet_ID() == 1087
+
+
+def reassemble(fragments):
+    data = b''
+    for (flags, length, chunk) in fragments:
+        data += bytes(chunk[:length])
+    return data
+
+
+def test_fragments():
+    rng = random.Random(5)
+    for length in [10, rtcm3.RTCM_DATA_LEN, rtcm3.RTCM_DATA_LEN + 1, 2 * rtcm3.RTCM_DATA_LEN, 700]:
+        data = bytes(rng.getrandbits(8) for i in range(length))
+        frags = []
+        for (flags, n, chunk) in rtcm3.gps_rtcm_fragments(data, 9):
+            # each fragment is used before taking the next
+            frags.append((flags, n, bytes(chunk)))
+        assert all([len(f[2]) == rtcm3.RTCM_DATA_LEN for f in frags])
+        assert reassemble(frags) == data
+        assert all([(f[0] >> 3) == 9 for f in frags])
+        assert [(f[0] >> 1) & 3 for f in frags] == list(range(len(frags)))
+        if length <= rtcm3.RTCM_DATA_LEN:
+            assert len(frags) == 1 and frags[0][0] & 1 == 0
+        else:
+            assert all([f[0] & 1 for f in frags])
+        if length == 2 * rtcm3.RTCM_DATA_LEN:
+            # ended by an empty fragment
+            assert frags[-1][1] == 0
+            assert len(frags) == 3
+
+
+def test_fragments_too_large():
+    with pytest.raises(ValueError):
+        list(rtcm3.gps_rtcm_fragments(bytes(rtcm3.RTCM_DATA_LEN * rtcm3.MAX_FRAGMENTS + 1), 0))
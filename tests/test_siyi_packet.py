@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+'''
+tests for SIYI camera packet framing
+'''
+
+import importlib.util
+import os
+import struct
+
+# loaded from its file, as importing the SIYI module package needs wx
+_path = os.path.join(os.path.dirname(__file__), '..', 'MAVProxy', 'modules', 'mavproxy_SIYI', 'siyi_packet.py')
+_spec = importlib.util.spec_from_file_location('siyi_packet', _path)
+siyi_packet = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(siyi_packet)
+
+
+def parse_all(parser, pieces, datagrams=True):
+    ret = []
+    for p in pieces:
+        if datagrams:
+            got = parser.parse_datagram(p)
+        else:
+            got = parser.parse(p)
+        ret.extend([(cmd, seq, bytes(payload)) for (cmd, seq, payload) in got])
+    return ret
+
+
+def test_crc16_check_value():
+    # the CRC-16/XMODEM check value
+    assert siyi_packet.crc16(b'123456789') == 0x31C3
+
+
+def test_encode():
+    pkt = siyi_packet.encode(7, 0x0D, b'\x01\x02')
+    assert bytes(pkt[:2]) == siyi_packet.HEADER
+    assert len(pkt) == siyi_packet.OVERHEAD + 2
+    (crc,) = struct.unpack('<H', pkt[-2:])
+    assert crc == siyi_packet.crc16(bytes(pkt[:-2]))
+    assert siyi_packet.encode_fmt(7, 0x0D, '<BB', 1, 2) == pkt
+
+
+def test_several_packets_in_a_datagram():
+    pkts = [siyi_packet.encode(i, 0x0D + i, bytes([i] * i)) for i in range(4)]
+    p = siyi_packet.PacketParser()
+    got = parse_all(p, [b''.join(pkts)])
+    assert got == [(0x0D + i, i, bytes([i] * i)) for i in range(4)]
+    assert p.packets == 4
+
+
+def test_resync_after_noise_and_bad_crc():
+    good = siyi_packet.encode(1, 0x15, b'\x10\x00')
+    bad = bytearray(siyi_packet.encode(2, 0x15, b'\x20\x00'))
+    bad[-1] ^= 0xFF
+    p = siyi_packet.PacketParser()
+    got = parse_all(p, [b'\x00\x55\x12' + bytes(bad) + bytes(good)])
+    assert got == [(0x15, 1, b'\x10\x00')]
+    assert p.bad_crc == 1
+    assert p.skipped > 0
+
+
+def test_packet_split_across_stream_reads():
+    pkts = [siyi_packet.encode(i, 0x0D, bytes(12)) for i in range(10)]
+    stream = b''.join(pkts)
+    for size in [1, 3, 11, 25]:
+        p = siyi_packet.PacketParser()
+        pieces = [stream[i:i + size] for i in range(0, len(stream), size)]
+        got = parse_all(p, pieces, datagrams=False)
+        assert [g[1] for g in got] == list(range(10))
+
+
+def test_truncated_datagram_does_not_stall():
+    # a truncated packet claiming a 2000 byte payload
+    bad = siyi_packet.HEADER + struct.pack('<BHHB', 1, 2000, 0, 0x0D) + bytes(10)
+    good = [siyi_packet.encode(i, 0x0D, bytes(12)) for i in range(90)]
+    p = siyi_packet.PacketParser()
+    got = parse_all(p, [bad] + good)
+    assert len(got) == 90
+    assert len(p.pending) == 0
+
+    # a truncated packet of a plausible length is dropped too
+    short = bytes(siyi_packet.encode(0, 0x0D, bytes(12)))[:-3]
+    p = siyi_packet.PacketParser()
+    got = parse_all(p, [short] + good[:5])
+    assert [g[1] for g in got] == list(range(5))
+
+
+def test_payload_length_cap():
+    pkt = siyi_packet.encode(1, 0x0D, bytes(siyi_packet.MAX_PAYLOAD + 1))
+    p = siyi_packet.PacketParser()
+    assert parse_all(p, [pkt]) == []
+    p = siyi_packet.PacketParser(max_payload=siyi_packet.MAX_PAYLOAD + 1)
+    assert len(parse_all(p, [pkt])) == 1
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+'''
+tests for answering TERRAIN_REQUEST from whole grids
+'''
+
+import numpy as np
+
+from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib.terrain_grid import FULL_MASK, GRID_BLOCKS, GridCache, SendRate, TerrainGrid, TerrainResponder
+
+LAT = -353632610
+LON = 1491652300
+SPACING = 100
+
+
+def hills(lats, lons):
+    lats = np.asarray(lats)
+    lons = np.asarray(lons)
+    return 600 + 40 * np.sin(lats * 2000.0) * np.cos(lons * 1500.0)
+
+
+def east_unknown(lats, lons):
+    '''no terrain data east of the grid's middle'''
+    alts = hills(lats, lons)
+    return np.where(np.asarray(lons) > LON * 1.0e-7 + 0.008, np.nan, alts)
+
+
+def old_block(lat, lon, spacing, bit):
+    '''heights of a block looked up one at a time, as the terrain module used to'''
+    (lat, lon) = mp_util.gps_offset(lat, lon, east=spacing * 4 * (bit % 8), north=spacing * 4 * (bit // 8))
+    data = []
+    for i in range(16):
+        (lat2, lon2) = mp_util.gps_offset(lat, lon, east=spacing * (i % 4), north=spacing * (i // 4))
+        data.append(int(hills(lat2, lon2)))
+    return data
+
+
+def test_grid_matches_block_at_a_time():
+    grid = TerrainGrid(LAT, LON, SPACING)
+    grid.update(hills, 0)
+    assert grid.complete()
+    for bit in [0, 7, 8, 30, GRID_BLOCKS - 1]:
+        assert grid.block(bit) == old_block(LAT * 1.0e-7, LON * 1.0e-7, SPACING, bit)
+
+
+def test_grid_without_terrain_data():
+    grid = TerrainGrid(LAT, LON, SPACING)
+    grid.update(east_unknown, 0)
+    assert not grid.complete()
+    # the west edge of the grid is known
+    assert grid.valid_mask & 1
+    # the data turns up later
+    grid.update(hills, 1)
+    assert grid.complete()
+
+
+def test_cache():
+    calls = []
+
+    def elevation(lats, lons):
+        calls.append(len(lats))
+        return east_unknown(lats, lons)
+
+    cache = GridCache(elevation, size=2, retry=1.0)
+    grid = cache.get(LAT, LON, SPACING, now=0)
+    assert cache.get(LAT, LON, SPACING, now=0.5) is grid
+    assert (cache.hits, cache.misses) == (1, 1)
+    # missing blocks are only looked up again after retry seconds
+    assert len(calls) == 1
+    cache.get(LAT, LON, SPACING, now=1.5)
+    assert len(calls) == 2
+    assert calls[1] < GRID_BLOCKS
+    # least recently used grids are dropped
+    cache.get(LAT + 1000, LON, SPACING, now=2)
+    cache.get(LAT + 2000, LON, SPACING, now=2)
+    assert (LAT, LON, SPACING) not in cache.grids
+
+
+def test_send_rate():
+    r = SendRate(min_rate=2, max_rate=20, rate=10, increase=1)
+    assert r.take(0)
+    assert not r.take(0)
+    sent = sum([r.take(0.01 * i) for i in range(1, 101)])
+    assert 9 <= sent <= 11
+    r.received(5)
+    assert r.rate == 15
+    r.received(100)
+    assert r.rate == 20
+    r.lost(1, 10)
+    assert r.rate == 10
+    # at most one cut a second
+    r.lost(1, 10.5)
+    assert r.rate == 10
+    r.radio_status(10, 12)
+    assert r.rate == 5
+    # no increase while the radio buffer is filling
+    r.received(5)
+    assert r.rate == 5
+    for i in range(10):
+        r.cut(20 + 2 * i)
+    assert r.rate == 2
+
+
+def test_responder():
+    resp = TerrainResponder(hills, min_rate=2, max_rate=50, timeout=1.0)
+    now = 100.0
+    resp.request(LAT, LON, SPACING, FULL_MASK, now)
+    got = {}
+    while len(got) < GRID_BLOCKS and now < 200:
+        now += 0.01
+        for (bit, heights) in resp.next_blocks(now):
+            got[bit] = heights
+        if int(now * 100) % 50 == 0:
+            # the vehicle repeats its request with the blocks it still needs
+            mask = FULL_MASK
+            for bit in got:
+                mask &= ~(1 << bit)
+            resp.request(LAT, LON, SPACING, mask, now)
+    assert len(got) == GRID_BLOCKS
+    assert got[5] == old_block(LAT * 1.0e-7, LON * 1.0e-7, SPACING, 5)
+    assert resp.received > 0
+    assert resp.lost == 0
+    # the rate went up as blocks were received
+    assert resp.rate.rate > 10
+
+
+def test_responder_lost_blocks_are_sent_again():
+    resp = TerrainResponder(hills, timeout=1.0)
+    resp.request(LAT, LON, SPACING, 0b111, 0)
+    sent = [b for (b, h) in resp.next_blocks(0)]
+    assert sent == [0]
+    assert resp.pending() == 0b110
+    # still asked for after the timeout, so it was lost
+    rate = resp.rate.rate
+    resp.request(LAT, LON, SPACING, 0b111, 1.5)
+    assert resp.lost == 1
+    assert resp.rate.rate < rate
+    assert resp.pending() == 0b111
+
+
+def test_responder_missing_blocks():
+    resp = TerrainResponder(east_unknown)
+    resp.request(LAT, LON, SPACING, FULL_MASK, 0)
+    assert resp.missing() > 0
+    sent = set()
+    for i in range(1000):
+        sent.update([b for (b, h) in resp.next_blocks(i * 0.1)])
+    # only blocks with terrain data are sent
+    assert sent == set([b for b in range(GRID_BLOCKS) if resp.grid.valid_mask & (1 << b)])
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+'''
+tests that graph expressions evaluated over log columns by vecexpr give
+the same results as evaluating them one message at a time with the
+mavextra functions
+'''
+
+import math
+import re
+import struct
+
+import numpy as np
+import pytest
+from pymavlink import mavutil
+from pymavlink.mavextra import reset_state_data
+
+from MAVProxy.modules.lib import logcolumns
+from MAVProxy.modules.lib import vecexpr
+
+# message name, format and columns of each message type in the log
+FORMATS = [
+    ('GPS', 'QBLLffff', 'TimeUS,Status,Lat,Lng,Alt,Spd,GCrs,VZ'),
+    ('ATT', 'Qffffff', 'TimeUS,DesRoll,Roll,DesPitch,Pitch,DesYaw,Yaw'),
+    ('MAG', 'Qhhhhhh', 'TimeUS,MagX,MagY,MagZ,OfsX,OfsY,OfsZ'),
+    ('IMU', 'Qffffff', 'TimeUS,GyrX,GyrY,GyrZ,AccX,AccY,AccZ'),
+]
+
+EXPRESSIONS = [
+    "degrees(radians(ATT.Roll))*2",
+    "wrap_180(ATT.Yaw+90)",
+    "lowpass(IMU.AccX,'ax',0.9)",
+    "diff(ATT.Yaw,'dyaw')",
+    "delta(ATT.Yaw,'dyaw',ATT.TimeUS)",
+    "mag_field_df(MAG)",
+    "mag_field_df(MAG,ofs=(10,-20,30))",
+    "mag_yaw(GPS,ATT,MAG)",
+    "expected_mag(GPS,ATT).x",
+    "expected_mag(GPS,ATT,yaw_adjust=10).z",
+    "expected_mag_yaw(GPS,ATT,MAG).y",
+    "MAG.MagX-expected_mag_yaw(GPS,ATT,MAG).x{GPS.Status>=3}",
+    "earth_accel_df(IMU,ATT).z",
+    "gps_velocity_df(GPS).x",
+    "sqrt(IMU.AccX**2+IMU.AccY**2)/ATT.Roll",
+]
+
+
+def df_record(type_id, fmt, *values):
+    return struct.pack('<BBB', 0xA3, 0x95, type_id) + struct.pack('<' + fmt, *values)
+
+
+def write_log(filename, n=300):
+    '''write a dataflash log of a vehicle turning while it gets a GPS fix'''
+    struct_fmt = {'Q': 'Q', 'B': 'B', 'L': 'i', 'f': 'f', 'h': 'h'}
+    data = df_record(128, 'BB4s16s64s', 128, 89, b'FMT', b'BBnNZ', b'Type,Length,Name,Format,Columns')
+    fmts = {}
+    for (i, (name, fmt, columns)) in enumerate(FORMATS):
+        sfmt = ''.join([struct_fmt[c] for c in fmt])
+        fmts[name] = (129 + i, sfmt)
+        data += df_record(128, 'BB4s16s64s', 129 + i, 3 + struct.calcsize('<' + sfmt),
+                          name.encode(), fmt.encode(), columns.encode())
+    for i in range(n):
+        tus = 1000000 + i * 20000
+        yaw = (i * 3.7) % 360
+        roll = 20 * math.sin(i * 0.05)
+        pitch = 10 * math.cos(i * 0.07)
+        data += df_record(fmts['IMU'][0], fmts['IMU'][1], tus, 0.1, -0.2, 0.3 + 0.01 * i,
+                          math.sin(i * 0.1), math.cos(i * 0.1), -9.8 + 0.1 * math.sin(i))
+        data += df_record(fmts['ATT'][0], fmts['ATT'][1], tus, roll, roll, pitch, pitch, yaw, yaw)
+        if i % 2 == 0:
+            data += df_record(fmts['MAG'][0], fmts['MAG'][1], tus + 5000,
+                              int(200 * math.cos(i * 0.06)), int(-150 * math.sin(i * 0.06)), -400 + i,
+                              10, -20, 30)
+        if i % 5 == 0:
+            status = 1 if i < 50 else 3
+            data += df_record(fmts['GPS'][0], fmts['GPS'][1], tus + 7000, status,
+                              -353632610 + 100 * i, 1491652300 - 50 * i, 584.0, 12.0, yaw, -0.5)
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+
+def per_message(mlog, field, condition=None):
+    '''evaluate a field one message at a time, as grapher does'''
+    reset_state_data()
+    mlog.rewind()
+    types = set(re.findall(vecexpr.re_caps, field))
+    read_types = types.union(set(re.findall(vecexpr.re_caps, condition or '')))
+    allm = {}
+    out = []
+    while True:
+        m = mlog.recv_match(type=read_types)
+        if m is None:
+            break
+        mtype = m.get_type()
+        allm[mtype] = m
+        if mtype not in types:
+            continue
+        if condition is not None and not mavutil.evaluate_condition(condition, allm):
+            continue
+        v = mavutil.evaluate_expression(field, allm)
+        if v is not None and not math.isinf(v):
+            out.append(v)
+    return np.array(out, dtype=np.float64)
+
+
+@pytest.fixture(scope='module')
+def log(tmp_path_factory):
+    filename = str(tmp_path_factory.mktemp('vecexpr') / 'flight.bin')
+    write_log(filename)
+    mlog = mavutil.mavlink_connection(filename)
+    return (mlog, logcolumns.LogColumns(filename, mlog, cache=False))
+
+
+@pytest.mark.parametrize('expression', EXPRESSIONS)
+def test_matches_per_message(log, expression):
+    (mlog, columns) = log
+    (field, condition) = vecexpr.split_condition(expression)
+    (t, x, y) = vecexpr.evaluate_field(columns, field, condition=condition)
+    ref = per_message(mlog, field, condition)
+    assert len(y) > 0
+    assert len(y) == len(ref)
+    assert np.allclose(y, ref, rtol=1.0e-6, atol=1.0e-6, equal_nan=True)